@@ -1,36 +1,115 @@
-from .utils.plot_utils import *
-from .utils.dataset import *
-from .utils.constants import *
-from .utils.prompt_utils import *
-from .utils.model_utils import *
-
-from .templates.html_templates import *
-from .templates.prompt_templates import *
-
-from .evaluators.aucroc import *
-from .evaluators.ppl import *
-from .evaluators.lm_judge import *
-from .evaluators.hard_negative import *
-from .evaluators.winrate import *
-from .evaluators.latent_stats import *
-
-from .models.sft import *
-from .models.lora import *
-from .models.reft import *
-from .models.lsreft import *
-from .models.steering_vector import *
-from .models.sae import *
-from .models.probe import *
-from .models.ig import *
-from .models.random import *
-from .models.mean import *
-from .models.prompt import *
-from .models.bow import *
-from .models.language_models import *
-
-from .scripts.args.eval_args import *
-from .scripts.args.training_args import *
-from .scripts.args.dataset_args import *
-
-from .scripts.evaluate import *
-from .scripts.inference import *
+# The package namespace re-exports the public names of the submodules below.
+# They are imported on first access (PEP 562), so `import axbench` is cheap and
+# `getattr(axbench, model_name)` only imports the module of that method.
+import importlib
+
+# submodules whose names are re-exported, in the order they used to be star
+# imported: a name defined by several of them resolves to the last one.
+_SUBMODULES = (
+    ".utils.plot_utils",
+    ".utils.dataset",
+    ".utils.constants",
+    ".utils.prompt_utils",
+    ".utils.model_utils",
+
+    ".templates.html_templates",
+    ".templates.prompt_templates",
+
+    ".evaluators.aucroc",
+    ".evaluators.ppl",
+    ".evaluators.lm_judge",
+    ".evaluators.hard_negative",
+    ".evaluators.winrate",
+    ".evaluators.latent_stats",
+
+    ".models.sft",
+    ".models.lora",
+    ".models.reft",
+    ".models.lsreft",
+    ".models.steering_vector",
+    ".models.sae",
+    ".models.probe",
+    ".models.ig",
+    ".models.random",
+    ".models.mean",
+    ".models.prompt",
+    ".models.bow",
+    ".models.language_models",
+
+    ".scripts.args.eval_args",
+    ".scripts.args.training_args",
+    ".scripts.args.dataset_args",
+
+    ".scripts.evaluate",
+    ".scripts.inference",
+)
+
+_SUBPACKAGES = {"utils", "templates", "evaluators", "models", "scripts", "benchmarks", "tests"}
+
+# the module of every method, evaluator and argument class, so that looking
+# one up imports just that module.
+_ATTRIBUTE_MODULES = {
+    "Prompt": ".utils.dataset",
+    "DatasetFactory": ".utils.dataset",
+    "SteeringDatasetFactory": ".utils.dataset",
+    "SeedContentSampler": ".utils.prompt_utils",
+    "ChatTemplateFormatter": ".utils.model_utils",
+
+    "AUCROCEvaluator": ".evaluators.aucroc",
+    "PerplexityEvaluator": ".evaluators.ppl",
+    "LMJudgeEvaluator": ".evaluators.lm_judge",
+    "HardNegativeEvaluator": ".evaluators.hard_negative",
+    "WinRateEvaluator": ".evaluators.winrate",
+    "LatentStatsEvaluator": ".evaluators.latent_stats",
+
+    "SFT": ".models.sft",
+    "LoRA": ".models.lora",
+    "LoReFT": ".models.reft",
+    "LsReFT": ".models.lsreft",
+    "SteeringVector": ".models.steering_vector",
+    "GemmaScopeSAE": ".models.sae",
+    "GemmaScopeSAEMaxDiff": ".models.sae",
+    "GemmaScopeSAEMaxAUC": ".models.sae",
+    "GemmaScopeSAEBinaryMask": ".models.sae",
+    "LinearProbe": ".models.probe",
+    "IntegratedGradients": ".models.ig",
+    "InputXGradients": ".models.ig",
+    "Random": ".models.random",
+    "MeanEmbedding": ".models.mean",
+    "MeanActivation": ".models.mean",
+    "DiffMean": ".models.mean",
+    "PCA": ".models.mean",
+    "LAT": ".models.mean",
+    "GemmaScopeSAEDiffMean": ".models.mean",
+    "PromptSteering": ".models.prompt",
+    "PromptDetection": ".models.prompt",
+    "BoW": ".models.bow",
+    "LanguageModel": ".models.language_models",
+
+    "EvalArgs": ".scripts.args.eval_args",
+    "ModelParams": ".scripts.args.training_args",
+    "TrainingArgs": ".scripts.args.training_args",
+    "DatasetArgs": ".scripts.args.dataset_args",
+}
+
+
+def _public_names(module):
+    return getattr(module, "__all__", None) or [name for name in vars(module) if not name.startswith("_")]
+
+
+def __getattr__(name):
+    if name in _SUBPACKAGES:
+        return importlib.import_module(f".{name}", __name__)
+    if not name.startswith("__"):
+        module_names = [_ATTRIBUTE_MODULES[name]] if name in _ATTRIBUTE_MODULES else reversed(_SUBMODULES)
+        for module_name in module_names:
+            module = importlib.import_module(module_name, __name__)
+            if name in _public_names(module):
+                value = getattr(module, name)
+                globals()[name] = value
+                return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_ATTRIBUTE_MODULES) | _SUBPACKAGES)
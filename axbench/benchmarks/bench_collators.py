@@ -0,0 +1,236 @@
+# microbenchmark of the intervention collators: collate time per batch of the
+# per-instance padding loops they used to run ("before") and of the current
+# pre-allocated batch padding ("after"). Results are printed as JSON.
+#
+# example launch command:
+#     python axbench/benchmarks/bench_collators.py --batch_size 32 --max_length 256
+
+import argparse, json, time
+from dataclasses import dataclass
+from typing import Dict, Sequence
+import numpy as np
+import torch, transformers
+
+from axbench.utils.data_utils import InterventionDataCollator
+from axbench.models.probe import DataCollator as ProbeDataCollator
+from axbench.models.sft import DataCollator as SFTDataCollator
+from axbench.models.reft import InterventionEvalDataCollator
+
+
+#################################
+#
+# Collators before vectorization.
+#
+#################################
+@dataclass
+class LegacyInterventionDataCollator(object):
+    """Collate examples for Intervention."""
+    
+    tokenizer: transformers.AutoTokenizer
+    data_collator: transformers.DataCollator
+
+    def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
+        max_intervention_len = max([len(inst["intervention_locations"][0]) for inst in instances])
+        max_seq_len = max([len(inst["input_ids"]) for inst in instances])
+        
+        for inst in instances:
+            non_pad_len = len(inst["input_ids"])
+
+            _intervention_mask = torch.ones_like(inst["intervention_locations"][0])
+            _intervention_location_paddings = torch.tensor(
+                [[len(inst["input_ids"]) for _ in range(max_intervention_len - len(inst["intervention_locations"][0]))]])
+            _intervention_mask_paddings = torch.tensor(
+                [0 for _ in range(max_intervention_len - len(inst["intervention_locations"][0]))])
+            inst["intervention_locations"] = torch.cat([inst["intervention_locations"], _intervention_location_paddings], dim=-1).int()
+            inst["intervention_masks"] = torch.cat([_intervention_mask, _intervention_mask_paddings], dim=-1).int()
+            inst["prompt_intervention_masks"] = inst["intervention_masks"].clone()
+            inst["prompt_intervention_masks"][inst["prompt_lengths"]:] = 0 # mask out the intervention locations after prompt length
+
+            _input_id_paddings = torch.tensor(
+                [self.tokenizer.pad_token_id for _ in range(max_seq_len - non_pad_len)])
+            inst["input_ids"] = torch.cat((inst["input_ids"], torch.tensor([self.tokenizer.pad_token_id]), _input_id_paddings)).int()
+
+            _label_paddings = torch.tensor([-100 for _ in range(max_seq_len - non_pad_len+1)])
+            inst["labels"] = torch.cat((inst["labels"], _label_paddings))
+            
+            inst["attention_mask"] = (inst["input_ids"] != self.tokenizer.pad_token_id).int()
+
+        batch_inputs = self.data_collator(instances)
+        return batch_inputs
+
+
+@dataclass
+class LegacyProbeDataCollator(object):
+    """Collate examples for ReFT."""
+    
+    tokenizer: transformers.AutoTokenizer
+    data_collator: transformers.DataCollator
+
+    def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
+        max_intervention_len = max([len(inst["intervention_locations"][0]) for inst in instances])
+        max_seq_len = max([len(inst["input_ids"]) for inst in instances])
+        
+        for inst in instances:
+            non_pad_len = len(inst["input_ids"])
+
+            _intervention_mask = torch.ones_like(inst["intervention_locations"][0])
+            _intervention_location_paddings = torch.tensor(
+                [[len(inst["input_ids"]) for _ in range(max_intervention_len - len(inst["intervention_locations"][0]))]])
+            _intervention_mask_paddings = torch.tensor(
+                [0 for _ in range(max_intervention_len - len(inst["intervention_locations"][0]))])
+            inst["intervention_locations"] = torch.cat([inst["intervention_locations"], _intervention_location_paddings], dim=-1).int()
+            inst["intervention_masks"] = torch.cat([_intervention_mask, _intervention_mask_paddings], dim=-1).int()
+
+            _input_id_paddings = torch.tensor(
+                [self.tokenizer.pad_token_id for _ in range(max_seq_len - non_pad_len)])
+            inst["input_ids"] = torch.cat((inst["input_ids"], torch.tensor([self.tokenizer.pad_token_id]), _input_id_paddings)).int()
+            inst["attention_mask"] = (inst["input_ids"] != self.tokenizer.pad_token_id).int()
+            inst["labels"] = inst["labels"].int()
+        batch_inputs = self.data_collator(instances)
+        return batch_inputs
+
+
+@dataclass
+class LegacySFTDataCollator(object):
+    
+    tokenizer: transformers.AutoTokenizer
+    data_collator: transformers.DataCollator
+
+    def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
+        max_seq_len = max([len(inst["input_ids"]) for inst in instances])
+        
+        for inst in instances:
+            non_pad_len = len(inst["input_ids"])
+
+            _input_id_paddings = torch.tensor(
+                [self.tokenizer.pad_token_id for _ in range(max_seq_len - non_pad_len)])
+            inst["input_ids"] = torch.cat((inst["input_ids"], torch.tensor([self.tokenizer.pad_token_id]), _input_id_paddings)).int()
+
+            _label_paddings = torch.tensor([-100 for _ in range(max_seq_len - non_pad_len+1)])
+            inst["labels"] = torch.cat((inst["labels"], _label_paddings))
+            
+            inst["attention_mask"] = (inst["input_ids"] != self.tokenizer.pad_token_id).int()
+
+        batch_inputs = self.data_collator(instances)
+        return batch_inputs
+
+
+@dataclass
+class LegacyInterventionEvalDataCollator(object):
+    """Collate examples for Intervention."""
+    
+    tokenizer: transformers.AutoTokenizer
+    data_collator: transformers.DataCollator
+
+    def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
+        """
+        intervention_locations will be something like [1,10,0,0,0] where all 0s are padding intervention locations.
+        """
+        max_intervention_len = max([len(inst["intervention_locations"][0]) for inst in instances])
+        max_seq_len = max([len(inst["input_ids"]) for inst in instances])
+        
+        for inst in instances:
+            non_pad_len = len(inst["input_ids"])
+            _intervention_location_paddings = torch.tensor(
+                [[-1 for _ in range(max_intervention_len - len(inst["intervention_locations"][0]))] for _ in range(inst["intervention_locations"].shape[0])]) # pointing to the first padding token
+            inst["intervention_locations"] = torch.cat([inst["intervention_locations"], _intervention_location_paddings], dim=-1).int()
+            inst["intervention_locations"] = inst["intervention_locations"] + 1 # shift by 1 to point to the first non-padding token, and all paddings will be 0.
+
+            _input_id_paddings = torch.tensor(
+                [self.tokenizer.pad_token_id for _ in range(max_seq_len - non_pad_len)])
+            offset = max_seq_len - non_pad_len
+            inst["intervention_locations"] = inst["intervention_locations"] + offset
+            inst["input_ids"] = torch.cat((_input_id_paddings, torch.tensor([self.tokenizer.pad_token_id]), inst["input_ids"])).int()
+            
+            inst["attention_mask"] = (inst["input_ids"] != self.tokenizer.pad_token_id).int()
+
+        batch_inputs = self.data_collator(instances)
+        return batch_inputs
+
+
+#################################
+#
+# Benchmark.
+#
+#################################
+class PadTokenizer(object):
+    pad_token_id = 0
+
+
+def make_instances(n, max_length, seed=0):
+    """Instances shaped like the rows of the make_*_data_module datasets."""
+    rng = np.random.default_rng(seed)
+    instances = []
+    for _ in range(n):
+        length = int(rng.integers(max_length // 4, max_length))
+        prompt_length = int(rng.integers(2, length))
+        input_ids = torch.from_numpy(rng.integers(1, 32000, length))
+        labels = input_ids.clone()
+        labels[:prompt_length] = -100
+        instances.append({
+            "input_ids": input_ids,
+            "labels": labels,
+            "intervention_locations": torch.arange(1, length)[None, :],
+            "prompt_lengths": torch.tensor(prompt_length - 1),
+            "eval_intervention_locations": torch.arange(prompt_length)[None, :],
+            "label": torch.tensor(int(rng.integers(0, 2))),
+        })
+    return instances
+
+
+def select(instances, fields):
+    """Fresh dicts with the dataset columns of a collator (the old collators modify their input)."""
+    return [{name: inst[field] for name, field in fields.items()} for inst in instances]
+
+
+COLLATORS = {
+    "intervention": (
+        LegacyInterventionDataCollator, InterventionDataCollator,
+        {"input_ids": "input_ids", "intervention_locations": "intervention_locations",
+         "labels": "labels", "prompt_lengths": "prompt_lengths"}),
+    "probe": (
+        LegacyProbeDataCollator, ProbeDataCollator,
+        {"input_ids": "input_ids", "labels": "label", "intervention_locations": "intervention_locations"}),
+    "sft": (LegacySFTDataCollator, SFTDataCollator, {"input_ids": "input_ids", "labels": "labels"}),
+    "intervention_eval": (
+        LegacyInterventionEvalDataCollator, InterventionEvalDataCollator,
+        {"input_ids": "input_ids", "intervention_locations": "eval_intervention_locations"}),
+}
+
+
+def time_collator(collator, batches, fields):
+    inputs = [select(batch, fields) for batch in batches]
+    start = time.perf_counter()
+    for batch in inputs:
+        collator(batch)
+    return (time.perf_counter() - start) / len(batches) * 1000
+
+
+def run(batch_size=32, max_length=256, n_batches=50):
+    instances = make_instances(batch_size * n_batches, max_length)
+    batches = [instances[i:i + batch_size] for i in range(0, len(instances), batch_size)]
+    tokenizer = PadTokenizer()
+    results = []
+    for name, (legacy_cls, collator_cls, fields) in COLLATORS.items():
+        before = time_collator(
+            legacy_cls(tokenizer=tokenizer, data_collator=transformers.DefaultDataCollator(return_tensors="pt")),
+            batches, fields)
+        after = time_collator(collator_cls(tokenizer=tokenizer), batches, fields)
+        results.append({
+            "benchmark": f"collate_{name}", "batch_size": batch_size, "max_length": max_length,
+            "before_ms_per_batch": round(before, 3), "after_ms_per_batch": round(after, 3),
+            "speedup": round(before / after, 2)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collate time per batch before and after vectorization.")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--max_length", type=int, default=256)
+    parser.add_argument("--n_batches", type=int, default=50)
+    args = parser.parse_args()
+    print(json.dumps(run(args.batch_size, args.max_length, args.n_batches), indent=2))
+
+
+if __name__ == "__main__":
+    main()
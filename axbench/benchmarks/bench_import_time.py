@@ -0,0 +1,97 @@
+# import-time regression benchmark: every statement runs in a fresh interpreter
+# under `python -X importtime`, timing `import axbench` (and attribute lookups
+# on it) with the lazy package namespace ("after") against importing every
+# re-exported submodule, which is what `import axbench` used to do ("before").
+# Results are printed as JSON; with --max_seconds, the run fails when a cold
+# `import axbench` gets slower than that.
+#
+# example launch command:
+#     python axbench/benchmarks/bench_import_time.py --repeat 3 --max_seconds 0.5
+
+import argparse, json, os, subprocess, sys
+from pathlib import Path
+import numpy as np
+
+# third-party packages that a plain `import axbench` should not load.
+HEAVY_MODULES = (
+    "torch", "transformers", "datasets", "pyvene", "pyreft", "peft",
+    "sklearn", "plotnine", "openai", "httpx", "jinja2")
+
+STATEMENTS = {
+    "import axbench": "import axbench",
+    "import axbench.evaluators": "import axbench.evaluators",
+    "axbench.WinRateEvaluator": "import axbench; axbench.WinRateEvaluator",
+    "axbench.LoRA": "import axbench; axbench.LoRA",
+}
+EAGER_STATEMENT = "import importlib, axbench\nfor module_name in axbench._SUBMODULES: importlib.import_module(module_name, 'axbench')"
+
+PROBE = """
+import sys, time, json
+modules = set(sys.modules)
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "modules": sorted(set(sys.modules) - modules)}}))
+"""
+
+
+def slowest_import(importtime_log, modules):
+    """The top-level import of `modules` with the largest cumulative time in a `-X importtime` log."""
+    slowest = (0, None)
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # nested imports are indented; interpreter startup imports are not in `modules`.
+        if not name[1:].startswith(" ") and name.strip() in modules:
+            slowest = max(slowest, (int(cumulative), name.strip()))
+    return {"module": slowest[1], "cumulative_s": round(slowest[0] / 1e6, 3)}
+
+
+def time_statement(statement):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [str(Path(__file__).resolve().parents[2])] + os.environ.get("PYTHONPATH", "").split(os.pathsep)))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE.format(statement=statement)],
+        capture_output=True, text=True, check=True, env=env)
+    # the last line of stdout: packages may print on import.
+    probe = json.loads(result.stdout.strip().splitlines()[-1])
+    return {
+        "seconds": probe["seconds"], "n_modules": len(probe["modules"]),
+        "heavy_modules": [name for name in HEAVY_MODULES if name in probe["modules"]],
+        "slowest_import": slowest_import(result.stderr, set(probe["modules"]))}
+
+
+def run(repeat=3):
+    def median_time(statement):
+        timings = [time_statement(statement) for _ in range(repeat)]
+        return {**timings[0], "seconds": float(np.median([timing["seconds"] for timing in timings]))}
+
+    before = median_time(EAGER_STATEMENT)
+    results = []
+    for name, statement in STATEMENTS.items():
+        after = median_time(statement)
+        results.append({
+            "benchmark": "import_time", "statement": name, "repeat": repeat,
+            "before_s": round(before["seconds"], 3), "after_s": round(after["seconds"], 3),
+            "speedup": round(before["seconds"] / after["seconds"], 2),
+            "n_modules": after["n_modules"], "heavy_modules": after["heavy_modules"],
+            "slowest_import": after["slowest_import"],
+        })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold import time of axbench, lazy and eager.")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max_seconds", type=float, default=None,
+                        help="Fail if a cold `import axbench` takes longer than this.")
+    args = parser.parse_args()
+    results = run(args.repeat)
+    print(json.dumps(results, indent=2))
+    if args.max_seconds is not None and results[0]["after_s"] > args.max_seconds:
+        sys.exit(f"`import axbench` took {results[0]['after_s']}s, over the {args.max_seconds}s budget.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# benchmark of LoRA steering generation on a tiny model: one generate call
+# per concept with that concept's peft adapter ("before") and generate calls
+# over rows of many concepts with all adapters stacked ("after"). Results
+# are printed as JSON.
+#
+# example launch command:
+#     python axbench/benchmarks/bench_multi_adapter.py --n_concepts 32 --rows_per_concept 4
+
+import argparse, json, time, tempfile
+from pathlib import Path
+import torch
+from peft import LoraConfig, PeftModel, get_peft_model
+from transformers import Gemma2Config, Gemma2ForCausalLM
+
+from axbench.models.stacked_lora import StackedLoRAModel
+
+
+def make_tiny_model(seed=0, hidden_size=32, num_hidden_layers=2, vocab_size=64):
+    torch.manual_seed(seed)
+    return Gemma2ForCausalLM(Gemma2Config(
+        vocab_size=vocab_size, hidden_size=hidden_size, intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_hidden_layers, num_attention_heads=2, num_key_value_heads=1,
+        head_dim=hidden_size // 2, pad_token_id=0)).eval()
+
+
+def save_random_adapter(adapter_dir, seed, r, target_modules, layers=(1,), **model_kwargs):
+    """A LoRA adapter, configured like the LoRA method, with random (non-zero) A and B matrices."""
+    torch.manual_seed(seed)
+    peft_model = get_peft_model(make_tiny_model(**model_kwargs), LoraConfig(
+        r=r, lora_alpha=4, target_modules=target_modules, layers_to_transform=list(layers),
+        use_rslora=True, lora_dropout=0.05, bias="none", task_type="CAUSAL_LM"))
+    with torch.no_grad():
+        for name, param in peft_model.named_parameters():
+            if "lora_" in name:
+                param.normal_(std=0.2)
+    peft_model.save_pretrained(adapter_dir)
+
+
+def generate(model, input_ids, max_new_tokens):
+    with torch.no_grad():
+        return model.generate(
+            input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, do_sample=False)
+
+
+def run(n_concepts=32, rows_per_concept=4, batch_size=32, prompt_length=16, max_new_tokens=16, hidden_size=64):
+    model_kwargs = {"hidden_size": hidden_size, "num_hidden_layers": 4, "vocab_size": 256}
+    model = make_tiny_model(**model_kwargs)
+    input_ids = torch.randint(
+        1, 256, (n_concepts * rows_per_concept, prompt_length), generator=torch.Generator().manual_seed(0))
+    concept_ids = torch.arange(n_concepts).repeat_interleave(rows_per_concept)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        adapter_dirs = [Path(tmp_dir) / str(concept_id) for concept_id in range(n_concepts)]
+        for concept_id, adapter_dir in enumerate(adapter_dirs):
+            save_random_adapter(
+                adapter_dir, concept_id, 4, ["q_proj", "v_proj", "o_proj"], layers=range(4), **model_kwargs)
+
+        # before: every concept loads its adapter and generates for its rows.
+        start = time.perf_counter()
+        before_generations = []
+        for concept_id, adapter_dir in enumerate(adapter_dirs):
+            peft_model = PeftModel.from_pretrained(model, adapter_dir).eval()
+            before_generations.append(generate(peft_model, input_ids[concept_ids == concept_id], max_new_tokens))
+            model = peft_model.unload()
+        before = time.perf_counter() - start
+
+        # after: all adapters stacked, every batch serves rows of many concepts.
+        start = time.perf_counter()
+        stacked = StackedLoRAModel(model, adapter_dirs)
+        after_generations = []
+        for i in range(0, len(input_ids), batch_size):
+            stacked.set_adapter_ids(concept_ids[i:i + batch_size])
+            after_generations.append(generate(model, input_ids[i:i + batch_size], max_new_tokens))
+        stacked.unload()
+        after = time.perf_counter() - start
+
+    return [{
+        "benchmark": "lora_steering_generation", "n_concepts": n_concepts, "rows_per_concept": rows_per_concept,
+        "batch_size": batch_size, "max_new_tokens": max_new_tokens,
+        "before_s": round(before, 3), "after_s": round(after, 3), "speedup": round(before / after, 2),
+        "same_generations": bool(torch.equal(torch.cat(before_generations), torch.cat(after_generations))),
+    }]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LoRA steering generation per concept and with stacked adapters.")
+    parser.add_argument("--n_concepts", type=int, default=32)
+    parser.add_argument("--rows_per_concept", type=int, default=4)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--max_new_tokens", type=int, default=16)
+    args = parser.parse_args()
+    print(json.dumps(run(
+        args.n_concepts, args.rows_per_concept, args.batch_size, max_new_tokens=args.max_new_tokens), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+# benchmark suite of the hot paths of a run, on tiny randomly initialised
+# Gemma2 and Llama models and synthetic concept data, so it runs on a CPU with
+# no downloads: activation gathering, latent and steering inference, the
+# collators, data modules, DiffMean/LsReFT training, the latent evaluators,
+# the parquet save and merge paths and LM calls against a local mock server.
+# Every benchmark reports the median seconds over --repeat runs. Results are
+# printed as JSON (and written to --output); with --compare, every result is
+# matched with the one of an earlier run to spot regressions between commits.
+#
+# example launch command:
+#     python axbench/benchmarks/bench_suite.py --output bench.json --compare bench_main.json
+
+import argparse, asyncio, json, tempfile, time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import torch
+import httpx
+from openai import AsyncOpenAI
+
+from axbench.benchmarks import bench_collators
+from axbench.benchmarks.synthetic import (
+    ARCHITECTURES, make_tokenizer, make_model, make_latent_df, make_training_df, make_steering_df,
+    add_latent_results, MockChatServer)
+from axbench.evaluators.aucroc import AUCROCEvaluator
+from axbench.evaluators.hard_negative import HardNegativeEvaluator
+from axbench.evaluators.latent_stats import LatentStatsEvaluator
+from axbench.evaluators.latent_metrics import compute_latent_metrics
+from axbench.models.language_models import LanguageModel
+from axbench.models.lsreft import LsReFT
+from axbench.models.mean import DiffMean
+from axbench.scripts.args.training_args import ModelParams
+from axbench.scripts.inference import save, merge_rank_files, PARTITION_SORT_BY
+from axbench.utils import data_utils, model_utils
+from axbench.utils.data_utils import make_data_module
+from axbench.utils.model_utils import gather_residual_activations
+
+LAYER = 1
+PREFIX_LENGTH = 1
+
+
+def median_seconds(function, repeat, setup=None):
+    """Median wall time of `function()` over `repeat` runs, after a warm-up run; `setup()` runs before each."""
+    timings = []
+    for i in range(repeat + 1):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        if i > 0:
+            timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def clear_caches():
+    # the tokenization and activation caches would turn repeated runs into cache hits.
+    data_utils._tokenized_cache.clear()
+    model_utils._activation_cache.clear()
+
+
+class Setup(object):
+    """The tiny model, tokenizer and synthetic data of one architecture."""
+    def __init__(self, arch, args):
+        self.arch = arch
+        self.args = args
+        self.tokenizer = make_tokenizer(arch)
+        self.model = make_model(
+            self.tokenizer, arch, hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers)
+        self.latent_df = make_latent_df(args.n_concepts, args.n_examples)
+        self.training_df = make_training_df(args.n_examples)
+        self.steering_df = make_steering_df(args.n_concepts)
+        self.training_args = ModelParams(
+            batch_size=args.batch_size, n_epochs=1, topk=2, lr=0.01, weight_decay=0.0,
+            coeff_latent_l1_loss=0.005, gradient_accumulation_steps=1)
+
+    def method(self, method_class, **kwargs):
+        method = method_class(
+            self.model, self.tokenizer, layer=LAYER, training_args=self.training_args, device="cpu")
+        method.make_model(low_rank_dimension=self.args.n_concepts, **kwargs)
+        return method
+
+
+#################################
+#
+# Model benchmarks (per architecture).
+#
+#################################
+def bench_gather_residual_activations(setup):
+    inputs = setup.tokenizer(
+        setup.latent_df["input"].tolist()[:setup.args.batch_size], return_tensors="pt", padding=True)
+    return {"batch_size": setup.args.batch_size, "seconds": median_seconds(
+        lambda: gather_residual_activations(setup.model, LAYER, inputs), setup.args.repeat)}
+
+
+def bench_predict_latent(setup):
+    results = []
+    for method_class, kwargs in [(DiffMean, {"mode": "train"}), (LsReFT, {"mode": "latent"})]:
+        method = setup.method(method_class, **kwargs)
+        seconds = median_seconds(lambda: method.predict_latent(
+            setup.latent_df, batch_size=setup.args.batch_size, prefix_length=PREFIX_LENGTH), setup.args.repeat)
+        results.append({"method": str(method), "n_rows": len(setup.latent_df), "seconds": seconds})
+    return results
+
+
+def bench_predict_steer(setup):
+    method = setup.method(DiffMean, mode="steering")
+    seconds = median_seconds(lambda: method.predict_steer(
+        setup.steering_df, batch_size=setup.args.batch_size, prefix_length=PREFIX_LENGTH,
+        eval_output_length=setup.args.max_new_tokens), setup.args.repeat)
+    return {"method": "DiffMean", "n_rows": len(setup.steering_df),
+            "max_new_tokens": setup.args.max_new_tokens, "seconds": seconds}
+
+
+def bench_make_data_module(setup):
+    seconds = median_seconds(
+        lambda: make_data_module(setup.tokenizer, setup.training_df, positions="all", prefix_length=PREFIX_LENGTH),
+        setup.args.repeat, setup=clear_caches)
+    return {"n_rows": len(setup.training_df), "seconds": seconds}
+
+
+def bench_train(setup):
+    results = []
+    for method_class in [DiffMean, LsReFT]:
+        method = setup.method(method_class, mode="train")
+        seconds = median_seconds(lambda: method.train(
+            setup.training_df, prefix_length=PREFIX_LENGTH, positions="all", exclude_bos=True),
+            setup.args.repeat, setup=clear_caches)
+        results.append({
+            "method": str(method), "n_rows": len(setup.training_df), "n_epochs": 1, "seconds": seconds})
+    return results
+
+
+MODEL_BENCHMARKS = {
+    "gather_residual_activations": bench_gather_residual_activations,
+    "predict_latent": bench_predict_latent,
+    "predict_steer": bench_predict_steer,
+    "make_data_module": bench_make_data_module,
+    "train": bench_train,
+}
+
+
+#################################
+#
+# Model-free benchmarks.
+#
+#################################
+def bench_collate(args):
+    instances = bench_collators.make_instances(args.batch_size * 20, 128)
+    batches = [instances[i:i + args.batch_size] for i in range(0, len(instances), args.batch_size)]
+    results = []
+    for name, (_, collator_cls, fields) in bench_collators.COLLATORS.items():
+        collator = collator_cls(tokenizer=bench_collators.PadTokenizer())
+        seconds = median_seconds(
+            lambda: bench_collators.time_collator(collator, batches, fields), args.repeat) / len(batches)
+        results.append({"collator": name, "batch_size": args.batch_size, "seconds": seconds})
+    return results
+
+
+def bench_latent_evaluators(args):
+    df = add_latent_results(make_latent_df(args.n_concepts, args.n_examples), "DiffMean")
+    results = []
+    for evaluator_class in [AUCROCEvaluator, HardNegativeEvaluator, LatentStatsEvaluator]:
+        evaluator = evaluator_class("DiffMean")
+        seconds = median_seconds(lambda: [
+            evaluator.compute_metrics(concept_df) for _, concept_df in df.groupby("concept_id")], args.repeat)
+        results.append({"evaluator": str(evaluator), "n_rows": len(df), "seconds": seconds})
+    seconds = median_seconds(lambda: compute_latent_metrics(df, "DiffMean"), args.repeat)
+    results.append({"evaluator": "compute_latent_metrics", "n_rows": len(df), "seconds": seconds})
+    return results
+
+
+def bench_parquet_save(args):
+    df = add_latent_results(make_latent_df(args.n_concepts, args.n_examples), "DiffMean")
+    saved_ranks = {concept_id: concept_id % 2 for concept_id in range(args.n_concepts)}
+    def save_and_merge():
+        with tempfile.TemporaryDirectory() as dump_dir:
+            for concept_id, concept_df in df.groupby("concept_id"):
+                save(dump_dir, "latent", concept_df, saved_ranks[concept_id])
+            merge_rank_files(dump_dir, "latent", saved_ranks, PARTITION_SORT_BY["latent"])
+    return {"n_rows": len(df), "n_ranks": 2, "seconds": median_seconds(save_and_merge, args.repeat)}
+
+
+def bench_chat_completions(args):
+    prompts = [f"Write about concept {i}." for i in range(args.n_prompts)]
+    async def chat_completions(base_url):
+        client = AsyncOpenAI(api_key="mock", base_url=base_url, http_client=httpx.AsyncClient())
+        lm_model = LanguageModel("gpt-4o-mini", client, use_cache=False)
+        await lm_model.chat_completions("benchmark", prompts)
+        await lm_model.close()
+    with MockChatServer() as server:
+        seconds = median_seconds(lambda: asyncio.run(chat_completions(server.base_url)), args.repeat)
+    return {"n_prompts": len(prompts), "seconds": seconds}
+
+
+BENCHMARKS = {
+    "collate": bench_collate,
+    "latent_evaluators": bench_latent_evaluators,
+    "parquet_save": bench_parquet_save,
+    "chat_completions": bench_chat_completions,
+}
+
+
+def result_key(result):
+    """Identifies a result across runs: every field but the timings."""
+    return json.dumps({k: v for k, v in result.items() if k not in {"seconds", "baseline_s", "ratio"}}, sort_keys=True)
+
+
+def compare(results, baseline):
+    baseline = {result_key(result): result["seconds"] for result in baseline}
+    for result in results:
+        if result_key(result) in baseline:
+            result["baseline_s"] = baseline[result_key(result)]
+            result["ratio"] = round(result["seconds"] / baseline[result_key(result)], 3)
+    return results
+
+
+def run(args):
+    torch.set_num_threads(args.num_threads)
+    names = args.only or list(MODEL_BENCHMARKS) + list(BENCHMARKS)
+    results = []
+    def add(name, benchmark_results, **tags):
+        for result in benchmark_results if isinstance(benchmark_results, list) else [benchmark_results]:
+            results.append({"benchmark": name, **tags, **result, "seconds": round(result["seconds"], 6)})
+
+    model_names = [name for name in names if name in MODEL_BENCHMARKS]
+    for arch in args.archs if model_names else []:
+        setup = Setup(arch, args)
+        for name in model_names:
+            add(name, MODEL_BENCHMARKS[name](setup), arch=arch)
+    for name in names:
+        if name in BENCHMARKS:
+            add(name, BENCHMARKS[name](args))
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Hot-path benchmarks on tiny synthetic models.")
+    parser.add_argument("--only", nargs="+", choices=list(MODEL_BENCHMARKS) + list(BENCHMARKS), default=None)
+    parser.add_argument("--archs", nargs="+", choices=ARCHITECTURES, default=list(ARCHITECTURES))
+    parser.add_argument("--hidden_size", type=int, default=64)
+    parser.add_argument("--num_hidden_layers", type=int, default=4)
+    parser.add_argument("--n_concepts", type=int, default=8)
+    parser.add_argument("--n_examples", type=int, default=24, help="examples per concept")
+    parser.add_argument("--n_prompts", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--max_new_tokens", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--num_threads", type=int, default=1, help="torch threads, fixed for comparable timings")
+    parser.add_argument("--output", type=str, default=None, help="write the results to this JSON file")
+    parser.add_argument("--compare", type=str, default=None, help="JSON results of an earlier run")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    results = run(args)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            results = compare(results, json.load(f))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
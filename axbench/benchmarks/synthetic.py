@@ -0,0 +1,130 @@
+# tiny randomly initialised models, tokenizers and synthetic concept data for
+# the benchmarks: everything is built locally, so they run on a CPU with no
+# downloads. A mock OpenAI-compatible server stands in for the LM API.
+
+import json, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+import torch
+from tokenizers import processors
+from transformers import Gemma2Config, Gemma2ForCausalLM, LlamaConfig, LlamaForCausalLM
+
+from axbench.tests.unit_tests.test_chat_template import (
+    create_tokenizer, GEMMA_CHAT_TEMPLATE, LLAMA_CHAT_TEMPLATE, TEXTS)
+
+ARCHITECTURES = ("gemma2", "llama")
+LATENT_CATEGORIES = ["positive", "negative", "hard negative seen", "hard negative unseen"]
+WORDS = " ".join(TEXTS).split()
+
+
+def make_tokenizer(arch="gemma2"):
+    """A small BPE tokenizer with the chat template of `arch` that prepends BOS, like the real ones."""
+    tokenizer = create_tokenizer(GEMMA_CHAT_TEMPLATE if arch == "gemma2" else LLAMA_CHAT_TEMPLATE)
+    tokenizer._tokenizer.post_processor = processors.TemplateProcessing(
+        single="<bos> $A", special_tokens=[("<bos>", tokenizer.bos_token_id)])
+    return tokenizer
+
+
+def make_model(tokenizer, arch="gemma2", hidden_size=64, num_hidden_layers=4, seed=0):
+    """A randomly initialised `arch` causal LM over the vocabulary of `tokenizer`."""
+    torch.manual_seed(seed)
+    kwargs = dict(
+        vocab_size=len(tokenizer), hidden_size=hidden_size, intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_hidden_layers, num_attention_heads=2, num_key_value_heads=1,
+        head_dim=hidden_size // 2, pad_token_id=tokenizer.pad_token_id,
+        bos_token_id=tokenizer.bos_token_id, eos_token_id=tokenizer.eos_token_id)
+    if arch == "gemma2":
+        return Gemma2ForCausalLM(Gemma2Config(**kwargs)).eval()
+    return LlamaForCausalLM(LlamaConfig(**kwargs)).eval()
+
+
+def random_texts(rng, n, n_words):
+    return [" ".join(rng.choice(WORDS, n_words)) for _ in range(n)]
+
+
+def make_latent_df(n_concepts=8, n_examples=24, n_words=24, seed=0):
+    """Concept rows shaped like `latent_eval_data.parquet`, `n_examples` per concept."""
+    rng = np.random.default_rng(seed)
+    n = n_concepts * n_examples
+    concept_ids = np.repeat(np.arange(n_concepts), n_examples)
+    return pd.DataFrame({
+        "input": random_texts(rng, n, n_words),
+        "output": random_texts(rng, n, n_words // 2),
+        "output_concept": [f"concept {concept_id}" for concept_id in concept_ids],
+        "concept_genre": rng.choice(["text", "code", "math"], n),
+        "category": np.tile(np.resize(LATENT_CATEGORIES, n_examples), n_concepts),
+        "dataset_category": "continuation",
+        "concept_id": concept_ids,
+        "sae_link": [f"https://www.neuronpedia.org/gemma-2-2b/20-gemmascope-res-16k/{i}" for i in concept_ids],
+        "sae_id": concept_ids,
+    })
+
+
+def make_training_df(n_examples=32, n_words=24, seed=0):
+    """Training rows of one concept: half positive, half negative."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "input": random_texts(rng, n_examples, n_words),
+        "output": random_texts(rng, n_examples, n_words // 2),
+        "labels": np.arange(n_examples) % 2,
+    })
+
+
+def make_steering_df(n_concepts=4, n_inputs=4, factors=(0.5, 1.0), n_words=12, seed=0):
+    """Steering rows: every input of every concept at every factor."""
+    rng = np.random.default_rng(seed)
+    inputs = random_texts(rng, n_inputs, n_words)
+    rows = [
+        {"concept_id": concept_id, "sae_id": concept_id, "input_id": input_id,
+         "factor": factor, "input": inputs[input_id]}
+        for concept_id in range(n_concepts) for input_id in range(n_inputs) for factor in factors]
+    return pd.DataFrame(rows)
+
+
+def add_latent_results(df, model_name, seed=0):
+    """The columns `predict_latent` of `model_name` adds, with random activations."""
+    rng = np.random.default_rng(seed)
+    acts = [np.round(rng.random(len(text.split())), 3).tolist() for text in df["input"]]
+    df[f"{model_name}_acts"] = acts
+    df[f"{model_name}_max_act"] = [max(act) for act in acts]
+    df[f"{model_name}_max_act_idx"] = [int(np.argmax(act)) for act in acts]
+    df[f"{model_name}_max_token"] = [text.split()[int(np.argmax(act))] for text, act in zip(df["input"], acts)]
+    return df
+
+
+class MockChatHandler(BaseHTTPRequestHandler):
+    """Answers OpenAI chat completion requests with a fixed-length echo of the prompt."""
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = request["messages"][-1]["content"]
+        body = json.dumps({
+            "id": "chatcmpl-mock", "object": "chat.completion", "created": 0, "model": request["model"],
+            "choices": [{
+                "index": 0, "finish_reason": "stop",
+                "message": {"role": "assistant", "content": f" {prompt[:64]} "}}],
+            "usage": {"prompt_tokens": len(prompt.split()), "completion_tokens": 8,
+                      "total_tokens": len(prompt.split()) + 8},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockChatServer(object):
+    """A local OpenAI-compatible chat server, served from a thread while in a `with` block."""
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), MockChatHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,316 @@
+import numpy as np
+import pandas as pd
+
+
+# evaluators whose metrics are derived from the same sorted activations.
+FUSED_LATENT_EVALUATORS = ("AUCROCEvaluator", "HardNegativeEvaluator", "LatentStatsEvaluator")
+
+AUCROC_CLASS_LABELS = {"positive": 1, "negative": 0, "hard negative seen": 0, "hard negative unseen": 0}
+DETECTION_CLASS_LABELS = {"positive": 1, "negative": 0, "hard negative": 0}
+
+# ROC curves are stored interpolated on a fixed FPR grid as fixed-size binary records,
+# optionally pointing at the raw (fpr, tpr) curve in a flat float64 sidecar.
+ROC_GRID = np.linspace(0, 1, 100)
+ROC_RECORD_DTYPE = np.dtype([
+    ("concept_id", np.int64),
+    ("method", "S64"),
+    ("roc_auc", np.float64),
+    ("raw_offset", np.int64),
+    ("raw_length", np.int64),
+    ("tpr", np.float64, (len(ROC_GRID),)),
+])
+
+
+def grouped_clf_counts(groups, labels, scores, n_groups):
+    """
+    Sort all rows once by (group, -score) and return the cumulative false / true
+    positive counts at every distinct score of every group, i.e. the per-group
+    equivalent of sklearn's confusion matrix at thresholds.
+
+    Returns (bounds, fps, tps, thresholds) where the counts of group g live in
+    the flat arrays at [bounds[g], bounds[g + 1]).
+    """
+    order = np.lexsort((-scores, groups))
+    groups, labels, scores = groups[order], labels[order], scores[order]
+    group_starts = np.searchsorted(groups, np.arange(n_groups))
+
+    # the last row of every run of tied scores is a threshold position.
+    is_last = np.ones(len(groups), dtype=bool)
+    is_last[:-1] = (scores[1:] != scores[:-1]) | (groups[1:] != groups[:-1])
+    threshold_idxs = np.flatnonzero(is_last)
+    threshold_groups = groups[threshold_idxs]
+
+    cum_labels = np.cumsum(labels)
+    label_offsets = np.r_[0.0, cum_labels][group_starts]
+    tps = cum_labels[threshold_idxs] - label_offsets[threshold_groups]
+    fps = 1 + (threshold_idxs - group_starts[threshold_groups]) - tps
+    bounds = np.searchsorted(threshold_groups, np.arange(n_groups + 1))
+    return bounds, fps, tps, scores[threshold_idxs]
+
+
+def roc_from_counts(fps, tps, thresholds):
+    """Same as sklearn's `roc_curve` (with `drop_intermediate=True`) given the counts."""
+    if fps.shape[0] > 2:
+        optimal_idxs = np.r_[True, np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), True]
+        fps, tps, thresholds = fps[optimal_idxs], tps[optimal_idxs], thresholds[optimal_idxs]
+    fps = np.r_[0.0, fps]
+    tps = np.r_[0.0, tps]
+    thresholds = np.r_[np.inf, thresholds.astype(np.float64)]
+    fpr = fps / fps[-1] if fps[-1] > 0 else np.full(fps.shape, np.nan)
+    tpr = tps / tps[-1] if tps[-1] > 0 else np.full(tps.shape, np.nan)
+    return fpr, tpr, thresholds
+
+
+def pr_from_counts(fps, tps, thresholds):
+    """Same as sklearn's `precision_recall_curve` given the counts."""
+    ps = tps + fps
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(ps != 0, np.divide(tps, ps), 0.0)
+    recall = np.ones_like(tps) if tps[-1] == 0 else tps / tps[-1]
+    return np.r_[precision[::-1], 1.0], np.r_[recall[::-1], 0.0], thresholds[::-1]
+
+
+def curve_auc(x, y):
+    """Same as sklearn's `auc` for the monotonic curves produced above."""
+    dx = np.diff(x)
+    direction = -1 if np.any(dx < 0) and np.all(dx <= 0) else 1
+    return float(direction * np.trapezoid(y, x))
+
+
+def interpolate_roc(fpr, tpr, grid=ROC_GRID):
+    """Interpolate a ROC curve onto the common FPR grid, starting at TPR = 0."""
+    interp_tpr = np.interp(grid, fpr, tpr)
+    interp_tpr[0] = 0.0  # Ensure TPR starts at 0
+    return interp_tpr
+
+
+def _grouped_category_hits(groups, n_groups, categories, scores, group_thresholds, category, label):
+    """Per-group number of rows of `category` and how many of them are classified as `label`."""
+    mask = categories == category
+    groups = groups[mask]
+    predictions = (scores[mask] >= group_thresholds[groups]).astype(int)
+    hits = np.bincount(groups, weights=(predictions == label), minlength=n_groups)
+    counts = np.bincount(groups, minlength=n_groups)
+    return counts, hits
+
+
+class _LatentCurves:
+    """
+    Lazily computed curves for one method over all groups. Curves are keyed by the
+    label assignment of the rows they include, so evaluators that score the same
+    rows with the same labels share a single sort.
+    """
+    def __init__(self, groups, n_groups, categories, scores):
+        self.groups = groups
+        self.n_groups = n_groups
+        self.categories = categories
+        self.scores = scores
+        self._counts = {}
+
+    def counts(self, included_labels):
+        key = tuple(sorted(included_labels.items()))
+        if key not in self._counts:
+            labels = pd.Series(self.categories).map(included_labels).to_numpy(dtype=np.float64)
+            mask = ~np.isnan(labels)
+            self._counts[key] = grouped_clf_counts(
+                self.groups[mask], labels[mask], self.scores[mask], self.n_groups)
+        return self._counts[key]
+
+    def group_counts(self, included_labels, g):
+        bounds, fps, tps, thresholds = self.counts(included_labels)
+        start, end = bounds[g], bounds[g + 1]
+        return fps[start:end], tps[start:end], thresholds[start:end]
+
+
+def _present_labels(class_labels, categories, present_categories):
+    return {
+        c: class_labels[c] for c in categories
+        if c in class_labels and c in present_categories and not pd.isna(class_labels[c])
+    }
+
+
+def _aucroc_metrics(curves, max_acts, class_labels, present_categories):
+    included = _present_labels(class_labels, class_labels.keys(), present_categories)
+    results = []
+    for g in range(curves.n_groups):
+        fps, tps, thresholds = curves.group_counts(included, g)
+        if len(fps) == 0:
+            results.append({})
+            continue
+        fpr, tpr, thresholds = roc_from_counts(fps, tps, thresholds)
+        optimal_idx = np.argmax(tpr - fpr)
+        results.append({
+            "max_act": float(max_acts[g]),
+            "roc_auc": curve_auc(fpr, tpr),
+            "optimal_threshold": float(thresholds[optimal_idx]),
+            "roc_curve": {
+                "fpr": fpr.tolist(),
+                "tpr": tpr.tolist(),
+            }
+        })
+    return results
+
+
+def _hard_negative_metrics(curves, class_labels, present_categories):
+    included = _present_labels(class_labels, ["positive", "negative"], present_categories)
+    optimal_thresholds = np.full(curves.n_groups, np.inf)
+    for g in range(curves.n_groups):
+        fps, tps, thresholds = curves.group_counts(included, g)
+        if len(fps) == 0:
+            continue
+        fpr, tpr, thresholds = roc_from_counts(fps, tps, thresholds)
+        optimal_thresholds[g] = thresholds[np.argmax(tpr - fpr)]
+
+    accuracies = {}
+    for category in ["positive", "hard negative"]:
+        accuracies[category] = _grouped_category_hits(
+            curves.groups, curves.n_groups, curves.categories, curves.scores, optimal_thresholds,
+            category, class_labels.get(category, np.nan))
+
+    results = []
+    for g in range(curves.n_groups):
+        # If threshold is positive or negative infinity, return 0 for all metrics
+        if np.isinf(optimal_thresholds[g]):
+            results.append({})
+            continue
+        valid_accuracies = []
+        for category, (counts, hits) in accuracies.items():
+            if counts[g] == 0:
+                break
+            valid_accuracies.append(float(hits[g] / counts[g]))
+        if len(valid_accuracies) < len(accuracies):
+            results.append({})
+            continue
+        results.append({"macro_avg_accuracy": float(np.mean(valid_accuracies))})
+    return results
+
+
+def _latent_stats_metrics(curves, max_acts, min_acts, class_labels, present_categories):
+    included = _present_labels(class_labels, ["positive", "negative"], present_categories)
+    optimal_roc_thresholds = np.full(curves.n_groups, np.nan)
+    optimal_pr_thresholds = np.full(curves.n_groups, np.nan)
+    pr_aucs = np.full(curves.n_groups, np.nan)
+    for g in range(curves.n_groups):
+        fps, tps, thresholds = curves.group_counts(included, g)
+        if len(fps) == 0:
+            continue
+        fpr, tpr, roc_thresholds = roc_from_counts(fps, tps, thresholds)
+        optimal_roc_thresholds[g] = roc_thresholds[np.argmax(tpr - fpr)]
+
+        precision, recall, pr_thresholds = pr_from_counts(fps, tps, thresholds)
+        pr_aucs[g] = curve_auc(recall, precision)
+        # Compute F1 scores avoiding division by zero warnings
+        f1_scores = np.zeros_like(precision)
+        mask = (precision + recall) > 0
+        f1_scores[mask] = 2 * (precision[mask] * recall[mask]) / (precision[mask] + recall[mask])
+        optimal_pr_thresholds[g] = pr_thresholds[np.argmax(f1_scores)]
+
+    accuracies = {}
+    for category in ["positive", "negative", "hard negative"]:
+        accuracies[category] = _grouped_category_hits(
+            curves.groups, curves.n_groups, curves.categories, curves.scores, optimal_pr_thresholds,
+            category, class_labels.get(category, np.nan))
+
+    # precision, recall and f1 at the optimal threshold over all labelled rows.
+    labels = pd.Series(curves.categories).map(class_labels).to_numpy(dtype=np.float64)
+    labelled = ~np.isnan(labels)
+    groups = curves.groups[labelled]
+    predictions = curves.scores[labelled] >= optimal_pr_thresholds[groups]
+    positives = labels[labelled] == 1
+    n_rows = np.bincount(groups, minlength=curves.n_groups)
+    tp_sum = np.bincount(groups, weights=predictions & positives, minlength=curves.n_groups)
+    pred_sum = np.bincount(groups, weights=predictions, minlength=curves.n_groups)
+    true_sum = np.bincount(groups, weights=positives, minlength=curves.n_groups)
+    correct = np.bincount(groups, weights=predictions == positives, minlength=curves.n_groups)
+
+    results = []
+    for g in range(curves.n_groups):
+        if np.isnan(optimal_pr_thresholds[g]):
+            results.append({})
+            continue
+        category_accuracies = {
+            category: float(hits[g] / counts[g]) if counts[g] > 0 else np.nan
+            for category, (counts, hits) in accuracies.items()
+        }
+        precision = tp_sum[g] / pred_sum[g] if pred_sum[g] > 0 else 0.0
+        recall = tp_sum[g] / true_sum[g] if true_sum[g] > 0 else 0.0
+        f1_denom = true_sum[g] + pred_sum[g]
+        f1 = 2.0 * tp_sum[g] / f1_denom if f1_denom > 0 else 0.0
+        results.append({
+            "positive_accuracy": category_accuracies["positive"],
+            "negative_accuracy": category_accuracies["negative"],
+            "hard_negative_accuracy": category_accuracies["hard negative"],
+            "precision": float(precision),
+            "recall": float(recall),
+            "f1": float(f1),
+            "macro_avg_accuracy_fixed": float(np.mean(list(category_accuracies.values()))),
+            "overall_accuracy": float(correct[g] / n_rows[g]),
+            "max_act_val": float(max_acts[g]),
+            "min_act_val": float(min_acts[g]),
+            "optimal_roc_threshold": float(optimal_roc_thresholds[g]),
+            "optimal_pr_threshold": float(optimal_pr_thresholds[g]),
+            "pr_auc": float(pr_aucs[g]),
+        })
+    return results
+
+
+def compute_latent_metrics(
+    data, model_name, evaluator_names=FUSED_LATENT_EVALUATORS, group_column="concept_id",
+    class_labels=None):
+    """
+    Compute the AUCROC, HardNegative and LatentStats metrics of `model_name` for every
+    group (concept) of `data` at once. The `*_max_act` column is min-max normalised per
+    group and every score is sorted exactly once per (group, method); all metrics are
+    then derived from the shared cumulative counts.
+
+    Args:
+        data (pd.DataFrame): latent inference results with `category` and `{model_name}_max_act`.
+        model_name (str): the method to evaluate.
+        evaluator_names (list): subset of `FUSED_LATENT_EVALUATORS` to compute.
+        group_column (str): column to group by, or None to treat `data` as a single group.
+        class_labels (dict): optional per-evaluator class label overrides.
+
+    Returns:
+        dict: {group_value: {evaluator_name: metrics}}, matching `compute_metrics` of each evaluator.
+    """
+    class_labels = class_labels or {}
+    if group_column is None:
+        keys, groups = np.array([None]), np.zeros(len(data), dtype=np.int64)
+    else:
+        keys, groups = np.unique(data[group_column].to_numpy(), return_inverse=True)
+    n_groups = len(keys)
+
+    # Normalize the activation columns per group
+    max_acts = data[f"{model_name}_max_act"].reset_index(drop=True)
+    grouped_acts = max_acts.groupby(groups)
+    group_max = grouped_acts.max().reindex(range(n_groups)).to_numpy()
+    group_min = grouped_acts.min().reindex(range(n_groups)).to_numpy()
+    max_acts = max_acts.to_numpy()
+    scores = (max_acts - group_min[groups]) / (group_max[groups] - group_min[groups])
+    scores[np.isnan(scores)] = 0
+
+    categories = data["category"].to_numpy()
+    present_categories = set(pd.unique(categories))
+    curves = _LatentCurves(groups, n_groups, categories, scores)
+
+    per_evaluator = {}
+    for evaluator_name in evaluator_names:
+        if evaluator_name == "AUCROCEvaluator":
+            per_evaluator[evaluator_name] = _aucroc_metrics(
+                curves, group_max, class_labels.get(evaluator_name, AUCROC_CLASS_LABELS),
+                present_categories)
+        elif evaluator_name == "HardNegativeEvaluator":
+            per_evaluator[evaluator_name] = _hard_negative_metrics(
+                curves, class_labels.get(evaluator_name, DETECTION_CLASS_LABELS), present_categories)
+        elif evaluator_name == "LatentStatsEvaluator":
+            per_evaluator[evaluator_name] = _latent_stats_metrics(
+                curves, group_max, group_min, class_labels.get(evaluator_name, DETECTION_CLASS_LABELS),
+                present_categories)
+        else:
+            raise ValueError(f"{evaluator_name} is not a fused latent evaluator.")
+
+    results = {}
+    for g, key in enumerate(keys):
+        results[key] = {
+            evaluator_name: metrics[g] for evaluator_name, metrics in per_evaluator.items()}
+    return results
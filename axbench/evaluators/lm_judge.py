@@ -1,6 +1,7 @@
 import pandas as pd
 import numpy as np
 from .evaluator import Evaluator
+from ..utils.profiler import profiled
 from .prompt_templates import *
 import asyncio
 
@@ -17,6 +18,9 @@ class LMJudgeEvaluator(Evaluator):
         self.model_name = model_name
         self.lm_model = kwargs.get("lm_model", None)
         self.concept_id = kwargs.get("concept_id", None)
+        # judge concept relevance first and only request the remaining axes when
+        # the aggregated rating can still be above zero.
+        self.lazy_cascade = kwargs.get("lm_judge_cascade", False) or False
 
     def __str__(self):
         return 'LMJudgeEvaluator'
@@ -33,6 +37,7 @@ class LMJudgeEvaluator(Evaluator):
             rating = self.DEFAULT_RATING
         return rating
 
+    @profiled("judge_parse")
     def _get_ratings_from_completions(self, completions, min_rating=0.0, max_rating=2.0):
         ratings = []
         for completion in completions:
@@ -49,16 +54,39 @@ class LMJudgeEvaluator(Evaluator):
                 ratings.append(self.DEFAULT_RATING)
         return ratings
     
-    def _get_ratings_from_prompts(self, prompts, api_name, min_rating=0.0, max_rating=2.0):
+    def _get_ratings_from_prompts(self, prompts, api_names, min_rating=0.0, max_rating=2.0):
+        if not isinstance(api_names, list):
+            api_names = [api_names] * len(prompts)
+        api_names = [f"{api_name}_{self.model_name}_LMJudgeEvaluator" for api_name in api_names]
+
         async def process_batch():
-            return await self.lm_model.chat_completions(
-                f"{api_name}_{self.model_name}_LMJudgeEvaluator", prompts, batch_size=32
-            )
+            return await self.lm_model.chat_completions(api_names, prompts, batch_size=32)
 
         # If we're already in an event loop, use that
         completions = asyncio.run(process_batch())
         return self._get_ratings_from_completions(completions, min_rating, max_rating), completions
 
+    def _get_ratings_from_axes(self, axes, indices):
+        """
+        Rate rows `indices` of every `(prompts, api_name)` axis in one call, so batch
+        mode requests all of them in the same round. Returns `(ratings, completions)`
+        per axis; skipped rows get a NaN rating and a None completion.
+        """
+        ratings, completions = [], []
+        if len(indices) > 0:
+            ratings, completions = self._get_ratings_from_prompts(
+                [prompts[i] for prompts, _ in axes for i in indices],
+                [api_name for _, api_name in axes for _ in indices])
+        axis_results = []
+        for axis, (prompts, _) in enumerate(axes):
+            axis_ratings = [np.nan] * len(prompts)
+            axis_completions = [None] * len(prompts)
+            for j, i in enumerate(indices):
+                axis_ratings[i] = ratings[axis * len(indices) + j]
+                axis_completions[i] = completions[axis * len(indices) + j]
+            axis_results.append((axis_ratings, axis_completions))
+        return axis_results
+
     def _get_all_ratings_from_data(self, data, column_name):
         model_relevance_concept_prompts = []
         model_relevance_instruction_prompts = []
@@ -79,12 +107,27 @@ class LMJudgeEvaluator(Evaluator):
             model_fluency_prompts += [UNIDIRECTIONAL_PAIRWISE_EVALUATION_FLUENCY_TEMPLATE.format(
                 sentence=generation
             )]
-        model_relevance_concept_ratings, model_relevance_concept_completions = \
-            self._get_ratings_from_prompts(model_relevance_concept_prompts, f"{column_name}_concept")
-        model_relevance_instruction_ratings, model_relevance_instruction_completions = \
-            self._get_ratings_from_prompts(model_relevance_instruction_prompts, f"{column_name}_instruction")
-        model_fluency_ratings, model_fluency_completions = \
-            self._get_ratings_from_prompts(model_fluency_prompts, f"{column_name}_fluency")
+        concept_axis = (model_relevance_concept_prompts, f"{column_name}_concept")
+        other_axes = [
+            (model_relevance_instruction_prompts, f"{column_name}_instruction"),
+            (model_fluency_prompts, f"{column_name}_fluency")]
+        all_indices = list(range(len(model_relevance_concept_prompts)))
+        if self.lazy_cascade:
+            (model_relevance_concept_ratings, model_relevance_concept_completions), = \
+                self._get_ratings_from_axes([concept_axis], all_indices)
+            # The harmonic mean is 0 whenever the concept rating is 0, so the other axes
+            # cannot change the aggregated rating of those rows.
+            judged_indices = [i for i, rating in enumerate(model_relevance_concept_ratings) if rating > 0]
+            logger.warning(
+                f"Skipping {2 * (len(model_relevance_concept_ratings) - len(judged_indices))} judge calls "
+                f"for concept_id: {self.concept_id}, model: {self.model_name}")
+            axis_results = self._get_ratings_from_axes(other_axes, judged_indices)
+        else:
+            # all three axes are requested in a single event loop.
+            (model_relevance_concept_ratings, model_relevance_concept_completions), *axis_results = \
+                self._get_ratings_from_axes([concept_axis] + other_axes, all_indices)
+        (model_relevance_instruction_ratings, model_relevance_instruction_completions), \
+            (model_fluency_ratings, model_fluency_completions) = axis_results
         return list(zip(model_relevance_concept_prompts, model_relevance_concept_ratings)), \
                list(zip(model_relevance_instruction_prompts, model_relevance_instruction_ratings)), \
                list(zip(model_fluency_prompts, model_fluency_ratings)), \
@@ -100,6 +143,11 @@ class LMJudgeEvaluator(Evaluator):
         We then aggregate these scores with these rules:
         - If the answer gets at least 1 for the first two checks, we sum three scores.
         - If the answer does not get 1 for the first two checks, the score is 0.
+
+        With `lm_judge_cascade`, checks 2 and 3 are skipped for answers with a concept
+        relevance of 0. Their aggregated score is still 0, but their skipped ratings are
+        recorded as NaN (and their completions as None), so the per-factor means of checks
+        2 and 3 only cover the answers that were judged on them.
         """
         logger.warning(
             f"Starting task for concept_id: {self.concept_id}, "
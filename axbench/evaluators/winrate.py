@@ -1,8 +1,11 @@
 from .evaluator import Evaluator
+from ..utils.profiler import profiled
 from .prompt_templates import *
 import asyncio, random, re
 from collections import Counter
 import pickle, os
+import numpy as np
+import pandas as pd
 
 import logging
 logging.basicConfig(format='%(asctime)s,%(msecs)03d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
@@ -10,6 +13,103 @@ logging.basicConfig(format='%(asctime)s,%(msecs)03d %(levelname)-8s [%(filename)
     level=logging.WARN)
 logger = logging.getLogger(__name__)
 
+RATING_AXES = ("concept", "instruction", "fluency")
+RATING_KEY_COLUMNS = ["concept_id", "input_id", "method", "axis", "generation_hash"]
+
+
+def empty_ratings_table():
+    """An empty ratings table; one row per (concept_id, input_id, method, axis, generation)."""
+    return pd.DataFrame({
+        "concept_id": pd.Series(dtype="int64"),
+        "input_id": pd.Series(dtype="int64"),
+        "method": pd.Series(dtype="object"),
+        "axis": pd.Series(dtype="object"),
+        "generation_hash": pd.Series(dtype="uint64"),
+        "rating": pd.Series(dtype="float64"),
+    })
+
+
+def hash_generations(generations):
+    """Stable 64-bit content hashes, so ratings of regenerated outputs are never reused."""
+    return pd.util.hash_pandas_object(
+        pd.Series(generations, dtype=object).astype(str), index=False).to_numpy()
+
+
+def lookup_ratings(data, ratings, method):
+    """
+    Join the rows of `data` against the ratings table.
+
+    Returns an array of shape (len(data), len(RATING_AXES)) holding the ratings
+    of `method`'s generations, with NaN for unrated axes.
+    """
+    keys = pd.DataFrame({
+        "concept_id": data["concept_id"].to_numpy(dtype=np.int64),
+        "input_id": data["input_id"].to_numpy(dtype=np.int64),
+        "generation_hash": hash_generations(data[f"{method}_steered_generation"]),
+    })
+    method_ratings = ratings[ratings["method"] == method].drop_duplicates(
+        subset=RATING_KEY_COLUMNS, keep="last")
+    wide = method_ratings.pivot(
+        index=["concept_id", "input_id", "generation_hash"], columns="axis", values="rating")
+    wide = wide.reindex(columns=list(RATING_AXES)).reset_index()
+    wide["generation_hash"] = wide["generation_hash"].astype("uint64")
+    joined = keys.merge(wide, on=["concept_id", "input_id", "generation_hash"], how="left")
+    return joined[list(RATING_AXES)].to_numpy(dtype=np.float64)
+
+
+def harmonic_mean_ratings(scores):
+    """Row-wise harmonic mean over rating axes; 0 if any axis is rated 0 to maintain strict evaluation."""
+    with np.errstate(divide="ignore"):
+        means = scores.shape[1] / np.sum(1 / scores, axis=1)
+    return np.where((scores == 0).any(axis=1), 0.0, means)
+
+
+def compute_win_results(data, ratings, model_name, baseline):
+    """Vectorized win/loss/tie of `model_name` against `baseline` for every row of `data`."""
+    model_ratings = lookup_ratings(data, ratings, model_name)
+    baseline_ratings = lookup_ratings(data, ratings, baseline)
+    if np.isnan(model_ratings).any() or np.isnan(baseline_ratings).any():
+        raise ValueError(f"Missing ratings for {model_name} or {baseline}; rate both methods first.")
+    model_scores = harmonic_mean_ratings(model_ratings)
+    baseline_scores = harmonic_mean_ratings(baseline_ratings)
+    return np.where(
+        np.abs(baseline_scores - model_scores) < 1e-6, "tie",  # Float comparison with epsilon
+        np.where(baseline_scores > model_scores, "baseline", "model")).tolist()
+
+
+def pair_with_baseline(data, model_name, baseline):
+    """
+    Pair every generation of `model_name` with the baseline generation of the same input.
+    After a steering-factor search each method only has rows at its own best factor, and
+    factor-independent baselines only at the first one, so the baseline generation at the
+    same factor is used when there is one and the one of any other factor otherwise.
+    """
+    keys = ["concept_id", "input_id"]
+    model_column = f"{model_name}_steered_generation"
+    baseline_column = f"{baseline}_steered_generation"
+    model_rows = data.loc[data[model_column].notna(), keys + ["factor", model_column]].reset_index(drop=True)
+    if model_name == baseline:
+        return model_rows
+    baseline_rows = data.loc[data[baseline_column].notna(), keys + ["factor", baseline_column]]
+    pairs = model_rows.reset_index().merge(baseline_rows, on=keys, suffixes=("", "_baseline"))
+    pairs["other_factor"] = pairs["factor"] != pairs["factor_baseline"]
+    pairs = pairs.sort_values(["index", "other_factor"], kind="stable").drop_duplicates("index")
+    return pairs[keys + ["factor", model_column, baseline_column]].reset_index(drop=True)
+
+
+def summarize_win_results(winning_results, baseline):
+    counter = Counter(winning_results)
+    total_samples = len(winning_results)
+    if total_samples == 0:
+        # nothing to compare against; keep the method in the results instead of dropping it.
+        return {"win_rate": np.nan, "loss_rate": np.nan, "tie_rate": np.nan, "baseline_model": baseline}
+    return {
+        "win_rate": float(counter["model"] / total_samples),
+        "loss_rate": float(counter["baseline"] / total_samples),
+        "tie_rate": float(counter["tie"] / total_samples),
+        "baseline_model": baseline,
+    }
+
 
 class WinRateEvaluator(Evaluator):
     DEFAULT_RATING = 0.0
@@ -19,6 +119,10 @@ class WinRateEvaluator(Evaluator):
         self.winrate_baseline = kwargs.get(
             "winrate_baseline", "PromptSteering")
         self.dump_dir = kwargs.get("dump_dir", None)
+        self.concept_id = kwargs.get("concept_id", None)
+        # ratings shared across methods; each generation is judged once per axis.
+        ratings = kwargs.get("ratings", None)
+        self.ratings = empty_ratings_table() if ratings is None else ratings
 
     def __str__(self):
         return 'WinRateEvaluator'
@@ -35,6 +139,7 @@ class WinRateEvaluator(Evaluator):
             rating = self.DEFAULT_RATING
         return rating
 
+    @profiled("judge_parse")
     def _get_ratings_from_completions(self, completions, min_rating=0.0, max_rating=2.0):
         ratings = []
         for completion in completions:
@@ -51,11 +156,13 @@ class WinRateEvaluator(Evaluator):
                 ratings.append(self.DEFAULT_RATING)
         return ratings
 
-    def _get_ratings_from_prompts(self, prompts, api_name, min_rating=0.0, max_rating=2.0):
+    def _get_ratings_from_prompts(self, prompts, api_names, min_rating=0.0, max_rating=2.0):
+        if not isinstance(api_names, list):
+            api_names = [api_names] * len(prompts)
+        api_names = [f"{api_name}_{self.winrate_baseline}_WinRateEvaluator" for api_name in api_names]
+
         async def process_batch():
-            return await self.lm_model.chat_completions(
-                f"{api_name}_{self.winrate_baseline}_WinRateEvaluator", prompts, batch_size=32
-            )
+            return await self.lm_model.chat_completions(api_names, prompts, batch_size=32)
 
         # If we're already in an event loop, use that
         completions = asyncio.run(process_batch())
@@ -81,13 +188,45 @@ class WinRateEvaluator(Evaluator):
             model_fluency_prompts += [UNIDIRECTIONAL_PAIRWISE_EVALUATION_FLUENCY_TEMPLATE.format(
                 sentence=generation
             )]
-        model_relevance_concept_ratings = self._get_ratings_from_prompts(model_relevance_concept_prompts, f"{column_name}_concept")
-        model_relevance_instruction_ratings = self._get_ratings_from_prompts(model_relevance_instruction_prompts, f"{column_name}_instruction")
-        model_fluency_ratings = self._get_ratings_from_prompts(model_fluency_prompts, f"{column_name}_fluency")
+        # all three axes are requested in a single event loop.
+        n = len(model_relevance_concept_prompts)
+        ratings = self._get_ratings_from_prompts(
+            model_relevance_concept_prompts + model_relevance_instruction_prompts + model_fluency_prompts,
+            [f"{column_name}_concept"] * n + [f"{column_name}_instruction"] * n + [f"{column_name}_fluency"] * n)
+        model_relevance_concept_ratings = ratings[:n]
+        model_relevance_instruction_ratings = ratings[n:2*n]
+        model_fluency_ratings = ratings[2*n:]
         return list(zip(model_relevance_concept_prompts, model_relevance_concept_ratings)), \
                list(zip(model_relevance_instruction_prompts, model_relevance_instruction_ratings)), \
                list(zip(model_fluency_prompts, model_fluency_ratings))
 
+    def rate(self, data, method_name):
+        """
+        Judge `method_name`'s generations in `data` on every axis, skipping the
+        ones already in the ratings table. Returns the newly added rating rows.
+        """
+        missing = np.isnan(lookup_ratings(data, self.ratings, method_name)).any(axis=1)
+        if not missing.any():
+            return empty_ratings_table()
+        missing_data = data[missing].drop_duplicates(
+            subset=["concept_id", "input_id", f"{method_name}_steered_generation"])
+        logger.warning(
+            f"Rating {len(missing_data)}/{len(data)} generations of {method_name} "
+            f"for concept_id: {self.concept_id}")
+        axis_ratings = self._get_all_ratings_from_data(missing_data, method_name)
+        n = len(missing_data)
+        new_ratings = pd.DataFrame({
+            "concept_id": np.tile(missing_data["concept_id"].to_numpy(dtype=np.int64), len(RATING_AXES)),
+            "input_id": np.tile(missing_data["input_id"].to_numpy(dtype=np.int64), len(RATING_AXES)),
+            "method": method_name,
+            "axis": np.repeat(RATING_AXES, n),
+            "generation_hash": np.tile(
+                hash_generations(missing_data[f"{method_name}_steered_generation"]), len(RATING_AXES)),
+            "rating": [rating for ratings in axis_ratings for _, rating in ratings],
+        })
+        self.ratings = pd.concat([self.ratings, new_ratings], ignore_index=True)
+        return new_ratings
+
     def compute_metrics(self, data):
         """
         This is a three-stage pipeline:
@@ -100,60 +239,17 @@ class WinRateEvaluator(Evaluator):
         - If no answer gets at least 1 for the first two checks, declare a tie.
         - If both answers get at least 1 for the first two checks, the answer with
           summed total score wins. If both answers have the same total score, declare a tie.
+
+        Ratings are looked up in (and added to) the shared ratings table, so
+        generations that were already judged are not sent to the judge again.
         """
         data_copy = data.copy()
         data_copy = data_copy.reset_index(drop=True)
 
-        baseline_relevance_concept_ratings, baseline_relevance_instruction_ratings, baseline_fluency_ratings = \
-            self._get_all_ratings_from_data(data_copy, self.winrate_baseline)
-        model_relevance_concept_ratings, model_relevance_instruction_ratings, model_fluency_ratings = \
-            self._get_all_ratings_from_data(data_copy, self.model_name)
-        
-        # calculate win rate.
-        winning_results = []
-        for i in range(len(baseline_relevance_concept_ratings)):
-            def harmonic_mean(scores):
-                # Return 0 if any score is 0 to maintain strict evaluation
-                if 0 in scores:
-                    return 0
-                return len(scores) / sum(1/s for s in scores)
-            
-            baseline_scores = [
-                baseline_relevance_concept_ratings[i][-1],
-                baseline_relevance_instruction_ratings[i][-1],
-                baseline_fluency_ratings[i][-1]
-            ]
-            model_scores = [
-                model_relevance_concept_ratings[i][-1],
-                model_relevance_instruction_ratings[i][-1],
-                model_fluency_ratings[i][-1]
-            ]
-            
-            baseline_score = harmonic_mean(baseline_scores)
-            model_score = harmonic_mean(model_scores)
-            
-            # Compare scores to determine winner
-            if abs(baseline_score - model_score) < 1e-6:  # Float comparison with epsilon
-                winning_results.append("tie")
-            elif baseline_score > model_score:
-                winning_results.append("baseline")
-            else:
-                winning_results.append("model")
+        self.rate(data_copy, self.winrate_baseline)
+        self.rate(data_copy, self.model_name)
+        winning_results = compute_win_results(
+            data_copy, self.ratings, self.model_name, self.winrate_baseline)
 
         data[f"{self.model_name}_win_result"] = winning_results
-        
-        counter = Counter(winning_results)
-        win_count = counter["model"]
-        loss_count = counter["baseline"]
-        tie_count = counter["tie"]
-        total_samples = len(winning_results)
-
-        metrics = {
-            "win_rate": float(win_count / total_samples),
-            "loss_rate": float(loss_count / total_samples),
-            "tie_rate": float(tie_count / total_samples),
-            "baseline_model": self.winrate_baseline,
-        }
-
-        return metrics
-            
+        return summarize_win_results(winning_results, self.winrate_baseline)
@@ -145,7 +145,7 @@ class IntegratedGradients(Model):
         data_module = make_data_module(self.tokenizer, self.model, examples)
         train_dataloader = DataLoader(
             data_module["train_dataset"], shuffle=True, batch_size=self.training_args.batch_size, 
-            collate_fn=data_module["data_collator"])
+            collate_fn=data_module["data_collator"], pin_memory=str(self.device).startswith("cuda"))
         return train_dataloader
 
     def train(self, examples, **kwargs):
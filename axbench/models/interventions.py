@@ -41,14 +41,12 @@ class TopKReLUSubspaceIntervention(
     def forward(
         self, base, source=None, subspaces=None
     ):
-        v = []
         if "subspaces" in subspaces:
-            for subspace in subspaces["subspaces"]:
-                v += [self.proj.weight[subspace]]
+            # the subspace of every example, e.g. of concepts trained together.
+            v = self.proj.weight[torch.as_tensor(subspaces["subspaces"], device=self.proj.weight.device)]
         else:
-            for i in range(base.shape[0]):
-                v += [self.proj.weight[0]]
-        v = torch.stack(v, dim=0).unsqueeze(dim=-1) # bs, h, 1
+            v = self.proj.weight[0].expand(base.shape[0], -1)
+        v = v.unsqueeze(dim=-1) # bs, h, 1
         
         # get latent
         latent = torch.relu(torch.bmm(base, v)).squeeze(dim=-1) # bs, s, 1
@@ -93,14 +91,12 @@ class TopKReLUIntervention(
     def forward(
         self, base, source=None, subspaces=None
     ):
-        v = []
         if "subspaces" in subspaces:
-            for subspace in subspaces["subspaces"]:
-                v += [self.proj.weight[subspace]]
+            # the subspace of every example, e.g. of concepts trained together.
+            v = self.proj.weight[torch.as_tensor(subspaces["subspaces"], device=self.proj.weight.device)]
         else:
-            for i in range(base.shape[0]):
-                v += [self.proj.weight[0]]
-        v = torch.stack(v, dim=0).unsqueeze(dim=-1) # bs, h, 1
+            v = self.proj.weight[0].expand(base.shape[0], -1)
+        v = v.unsqueeze(dim=-1) # bs, h, 1
         
         # get latent
         latent = torch.relu(torch.bmm(base, v)).squeeze(dim=-1) # bs, s, 1
@@ -452,14 +448,12 @@ class ProbeIntervention(
     def forward(
         self, base, source=None, subspaces=None
     ):
-        v = []
         if "subspaces" in subspaces:
-            for subspace in subspaces["subspaces"]:
-                v += [self.proj.weight[subspace]]
+            # the subspace of every example, e.g. of concepts trained together.
+            v = self.proj.weight[torch.as_tensor(subspaces["subspaces"], device=self.proj.weight.device)]
         else:
-            for i in range(base.shape[0]):
-                v += [self.proj.weight[0]]
-        v = torch.stack(v, dim=0).unsqueeze(dim=-1) # bs, h, 1
+            v = self.proj.weight[0].expand(base.shape[0], -1)
+        v = v.unsqueeze(dim=-1) # bs, h, 1
         
         # get latent
         latent = torch.bmm(base, v).squeeze(dim=-1) # bs, s
@@ -487,14 +481,12 @@ class SparseProbeIntervention(
     def forward(
         self, base, source=None, subspaces=None
     ):
-        v = []
         if "subspaces" in subspaces:
-            for subspace in subspaces["subspaces"]:
-                v += [self.proj.weight[subspace]]
+            # the subspace of every example, e.g. of concepts trained together.
+            v = self.proj.weight[torch.as_tensor(subspaces["subspaces"], device=self.proj.weight.device)]
         else:
-            for i in range(base.shape[0]):
-                v += [self.proj.weight[0]]
-        v = torch.stack(v, dim=0).unsqueeze(dim=-1) # bs, h, 1
+            v = self.proj.weight[0].expand(base.shape[0], -1)
+        v = v.unsqueeze(dim=-1) # bs, h, 1
         
         # get latent
         latent = torch.relu(torch.bmm(base, v)).squeeze(dim=-1) # bs, s, 1
@@ -530,14 +522,12 @@ class SteeringVectorIntervention(
     def forward(
         self, base, source=None, subspaces=None
     ):
-        v = []
         if "subspaces" in subspaces:
-            for subspace in subspaces["subspaces"]:
-                v += [self.proj.weight[subspace]]
+            # the subspace of every example, e.g. of concepts trained together.
+            v = self.proj.weight[torch.as_tensor(subspaces["subspaces"], device=self.proj.weight.device)]
         else:
-            for i in range(base.shape[0]):
-                v += [self.proj.weight[0]]
-        v = torch.stack(v, dim=0).unsqueeze(dim=-1) # bs, h, 1
+            v = self.proj.weight[0].expand(base.shape[0], -1)
+        v = v.unsqueeze(dim=-1) # bs, h, 1
         latent = torch.relu(torch.bmm(base, v)).squeeze(dim=-1) # bs, s, 1
         steering_vec = v.permute(0, 2, 1) # bs, 1, h
 
@@ -2,9 +2,10 @@ from ..utils.constants import (
     UNIT_1M,
     PRICING_DOLLAR_PER_1M_TOKEN,
 )
+from ..utils.profiler import profiled
 
 import httpx, asyncio
-import os, uuid, string, json, pickle
+import os, uuid, string, json, pickle, hashlib
 from pathlib import Path
 
 import logging
@@ -13,6 +14,25 @@ logging.basicConfig(format='%(asctime)s,%(msecs)03d %(levelname)-8s [%(filename)
     level=logging.WARN)
 logger = logging.getLogger(__name__)
 
+# OpenAI batch files accept at most 50,000 requests each.
+BATCH_SHARD_SIZE = 50_000
+BATCH_REQUEST_PREFIX = "requests"
+BATCH_INDEX_PREFIX = "index"
+BATCH_RESULT_PREFIX = "results"
+
+
+class BatchRequestsPending(Exception):
+    """
+    Raised by `chat_completions` in batch-file mode when some prompts are not
+    in the cache yet. Their requests are already written to the batch dir;
+    callers should skip (not rate, save or record) the unit of work that
+    needed them, and pick it up again once the results are ingested.
+    """
+    def __init__(self, n_pending):
+        super().__init__(f"{n_pending} LM requests are pending in the batch dir")
+        self.n_pending = n_pending
+
+
 def is_first_char_punctuation(s):
     if s and s[0] in string.punctuation:
         return True
@@ -128,6 +148,19 @@ class LanguageModel(object):
             if self.cache_file.exists():
                 with open(self.cache_file, "rb") as f:
                     self.cache_in_mem = pickle.load(f)
+        # batch-file mode: cache misses are written as batch requests instead of being sent.
+        self.batch_dir = None
+        if kwargs.get("batch_dir", None):
+            assert self.use_cache, "batch_dir requires use_cache, as batch results are ingested into the cache"
+            # api-level keys count calls, which shift between runs; results are ingested by prompt.
+            self.cache_level = "prompt"
+            self.batch_dir = Path(kwargs["batch_dir"])
+            self.batch_dir.mkdir(parents=True, exist_ok=True)
+            self.batch_tag = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+            self.batch_pending = {}
+            self.batch_written = set()
+            self.batch_shard = 0
+            self.batch_shard_count = 0
 
     def normalize(self, text):
         return text.strip()
@@ -137,6 +170,7 @@ class LanguageModel(object):
             return f"{prompt}"
         return f"{prompt}_____{api_count}_____{api_name}"
     
+    @profiled("lm_call")
     async def chat_completion(self, client, prompt, api_name):
         # check if the prompt is cached
         api_count = self.api_count.get(api_name, 0)
@@ -145,6 +179,9 @@ class LanguageModel(object):
             cache_key = self._get_cache_key(prompt, api_count, api_name)
             if cache_key in self.cache_in_mem:
                 return (self.cache_in_mem[cache_key], None)
+        if self.batch_dir is not None:
+            self.add_batch_request(cache_key, prompt)
+            return (None, None)
         raw_completion = await client.chat.completions.create(
             messages=[{"role": "user", "content": prompt}], model=self.model, temperature=self.temperature)
         raw_completion = raw_completion.to_dict()
@@ -175,12 +212,64 @@ class LanguageModel(object):
             # post handling for current batch
             for j, (completion, usage) in enumerate(raw_completions):
                 all_completions.append(completion)
+                if completion is None:
+                    continue # pending batch request
                 self.stats.record(
                     batch_api_names[j], usage,
                     prompt=batch_prompts[j], completion=completion)
 
+        if self.batch_dir is not None:
+            self.flush_batch_requests()
+            n_pending = sum(completion is None for completion in all_completions)
+            if n_pending > 0:
+                raise BatchRequestsPending(n_pending)
         return all_completions
 
+    def get_batch_custom_id(self, cache_key):
+        """Stable id of a cached prompt, shared by its batch request and result."""
+        return hashlib.sha256(f"{self.cache_file.name}\n{cache_key}".encode()).hexdigest()
+
+    def add_batch_request(self, cache_key, prompt):
+        custom_id = self.get_batch_custom_id(cache_key)
+        if custom_id in self.batch_written:
+            return
+        self.batch_pending[custom_id] = (cache_key, prompt)
+
+    def flush_batch_requests(self):
+        """Append pending requests to sharded JSONL request files in the OpenAI batch format."""
+        if not self.batch_pending:
+            return
+        index_path = self.batch_dir / f"{BATCH_INDEX_PREFIX}-{self.batch_tag}.jsonl"
+        pending = list(self.batch_pending.items())
+        while pending:
+            n = min(BATCH_SHARD_SIZE - self.batch_shard_count, len(pending))
+            shard_path = self.batch_dir / f"{BATCH_REQUEST_PREFIX}-{self.batch_tag}-{self.batch_shard:04d}.jsonl"
+            with open(shard_path, "a") as f_request, open(index_path, "a") as f_index:
+                for custom_id, (cache_key, prompt) in pending[:n]:
+                    f_request.write(json.dumps({
+                        "custom_id": custom_id,
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": {
+                            "model": self.model,
+                            "messages": [{"role": "user", "content": prompt}],
+                            "temperature": self.temperature,
+                        },
+                    }) + "\n")
+                    f_index.write(json.dumps({
+                        "custom_id": custom_id,
+                        "cache_file": self.cache_file.name,
+                        "cache_key": cache_key,
+                    }) + "\n")
+                    self.batch_written.add(custom_id)
+            pending = pending[n:]
+            self.batch_shard_count += n
+            if self.batch_shard_count >= BATCH_SHARD_SIZE:
+                self.batch_shard += 1
+                self.batch_shard_count = 0
+        logger.warning(f"Wrote {len(self.batch_pending)} batch requests to {self.batch_dir}")
+        self.batch_pending = {}
+
     def dump(self):
         with open(self.dump_dir / "tmp_prompt_cache.json", "w") as outfile:
             json.dump(self.stats.prompt_cache, outfile, indent=4)
@@ -189,6 +278,9 @@ class LanguageModel(object):
             f.write(json.dumps({"price": self.stats.get_total_price()}) + '\n')
 
     def save_cache(self):
+        if self.batch_dir is not None:
+            # requests of calls cut short by another call's BatchRequestsPending.
+            self.flush_batch_requests()
         if self.use_cache:
             with open(self.cache_file, "wb") as f:
                 pickle.dump(self.cache_in_mem, f, protocol=pickle.HIGHEST_PROTOCOL)
@@ -197,3 +289,67 @@ class LanguageModel(object):
         """Close the underlying HTTP client"""
         await self.client.close()
 
+
+
+def load_batch_index(batch_dir):
+    """Map custom ids of all written batch requests to their cache file and key."""
+    index = {}
+    for index_path in sorted(Path(batch_dir).glob(f"{BATCH_INDEX_PREFIX}-*.jsonl")):
+        with open(index_path) as f:
+            for line in f:
+                entry = json.loads(line)
+                index[entry["custom_id"]] = entry
+    return index
+
+
+def ingest_batch_results(batch_dir, master_data_dir, result_paths=None):
+    """
+    Load completed batch result files into the persistent language model caches,
+    so that rerunning the same job (with the same batch_dir) reads them from
+    cache. Jobs whose prompts depend on earlier completions (e.g. the judge
+    cascade, or concept genres before contents) queue their next requests on
+    that rerun and take one round per dependent step.
+
+    Args:
+        batch_dir: directory holding the request, index and (by default) result files.
+        master_data_dir: directory holding persist_lm_cache.
+        result_paths: result files in the OpenAI batch output format. Defaults to
+            every results-*.jsonl file in batch_dir.
+
+    Returns:
+        int: number of ingested completions.
+    """
+    index = load_batch_index(batch_dir)
+    if result_paths is None:
+        result_paths = sorted(Path(batch_dir).glob(f"{BATCH_RESULT_PREFIX}-*.jsonl"))
+    cache_dir = Path(master_data_dir) / "persist_lm_cache"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    caches = {}
+    n_ingested, n_failed = 0, 0
+    for result_path in result_paths:
+        with open(result_path) as f:
+            for line in f:
+                result = json.loads(line)
+                entry = index.get(result["custom_id"], None)
+                response = result.get("response", None) or {}
+                if entry is None or result.get("error", None) or response.get("status_code", None) != 200:
+                    n_failed += 1
+                    continue
+                cache_file = entry["cache_file"]
+                if cache_file not in caches:
+                    caches[cache_file] = {}
+                    if (cache_dir / cache_file).exists():
+                        with open(cache_dir / cache_file, "rb") as f_cache:
+                            caches[cache_file] = pickle.load(f_cache)
+                # same normalization as LanguageModel.normalize
+                completion = response["body"]["choices"][0]["message"]["content"].strip()
+                caches[cache_file][entry["cache_key"]] = completion
+                n_ingested += 1
+    for cache_file, cache in caches.items():
+        tmp_path = cache_dir / f"{cache_file}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_dir / cache_file)
+    if n_failed > 0:
+        logger.warning(f"Skipped {n_failed} failed or unknown batch results.")
+    return n_ingested
@@ -17,9 +17,14 @@ from ..utils.model_utils import (
 )
 from transformers import get_scheduler
 from transformers import set_seed
+from .stacked_lora import StackedLoRAModel
+from ..utils.profiler import span
 
 
 class LoRA(Model):
+    # predict_steer serves rows of all concepts passed to `load` as `concept_ids`.
+    steers_many_concepts = True
+
     def __str__(self):
         return 'LoRA'
     
@@ -48,10 +53,21 @@ class LoRA(Model):
     def load(self, dump_dir, **kwargs):
         # folder-based loading
         self.concept_id = kwargs.get("concept_id")
+        concept_ids = kwargs.get("concept_ids")
+        if concept_ids is not None:
+            # the adapters of many concepts, stacked to steer rows of all of them in the same batches.
+            self.adapter_ids = {concept_id: i for i, concept_id in enumerate(concept_ids)}
+            self.ax_model = StackedLoRAModel(
+                self.model, [Path(f"{dump_dir}/lora/{concept_id}") for concept_id in concept_ids])
+            return
         dump_dir = Path(f"{dump_dir}/lora/{self.concept_id}")
         self.ax_model = PeftModel.from_pretrained(
             self.model, dump_dir)
 
+    def unload(self):
+        """Remove the loaded adapters from the base model; returns it."""
+        return self.ax_model.unload()
+
     def train(self, examples, **kwargs):
         train_dataloader = self.make_dataloader(examples, **kwargs)
         torch.cuda.empty_cache()
@@ -65,7 +81,7 @@ class LoRA(Model):
             "linear", optimizer=optimizer,
             num_warmup_steps=0, num_training_steps=num_training_steps)
         # Main training loop.
-        rank = torch.distributed.get_rank()
+        rank = torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
         progress_bar, curr_step = tqdm(range(num_training_steps), position=rank, leave=True), 0
         
         for epoch in range(self.training_args.n_epochs):
@@ -102,7 +118,9 @@ class LoRA(Model):
 
     @torch.no_grad()
     def predict_steer(self, examples, **kwargs):
-        self.ax_model.eval()
+        stacked = isinstance(self.ax_model, StackedLoRAModel)
+        generation_model = self.model if stacked else self.ax_model
+        generation_model.eval()
         # set tokenizer padding to left
         self.tokenizer.padding_side = "left"
 
@@ -113,7 +131,7 @@ class LoRA(Model):
         all_generations = []
         all_perplexities = []
         # Main training loop.
-        rank = torch.distributed.get_rank()
+        rank = torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
         progress_bar = tqdm(range(0, len(examples), batch_size), position=rank, leave=True)
         for i in range(0, len(examples), batch_size):
             batch_examples = examples.iloc[i:i+batch_size]
@@ -122,11 +140,16 @@ class LoRA(Model):
             inputs = self.tokenizer(
                 input_strings, return_tensors="pt", padding=True, truncation=True
             ).to(self.device)
-            generations = self.ax_model.generate(
-                **inputs, 
-                max_new_tokens=eval_output_length, do_sample=True, 
-                temperature=temperature,
-            )
+            if stacked:
+                # every row is steered by the adapter of its concept.
+                self.ax_model.set_adapter_ids(torch.tensor(
+                    [self.adapter_ids[concept_id] for concept_id in batch_examples["concept_id"]], device=self.device))
+            with span("generate"):
+                generations = generation_model.generate(
+                    **inputs, 
+                    max_new_tokens=eval_output_length, do_sample=True, 
+                    temperature=temperature,
+                )
 
             # Decode and print only the generated text without prompt tokens
             input_lengths = [len(input_ids) for input_ids in inputs.input_ids]
@@ -146,7 +169,8 @@ class LoRA(Model):
             batch_attention_mask = (batch_input_ids != self.tokenizer.pad_token_id).float()
             
             # Forward pass without labels to get logits
-            outputs = self.model(input_ids=batch_input_ids, attention_mask=batch_attention_mask)
+            with span("perplexity"):
+                outputs = self.model(input_ids=batch_input_ids, attention_mask=batch_attention_mask)
             
             logits = outputs.logits[:, :-1, :].contiguous()  # Remove last token prediction
             target_ids = batch_input_ids[:, 1:].contiguous()  # Shift right by 1
@@ -165,6 +189,8 @@ class LoRA(Model):
             seq_perplexities = torch.exp(seq_losses).tolist()
             all_perplexities.extend(seq_perplexities)
             progress_bar.update(1)
+        if stacked:
+            self.ax_model.set_adapter_ids(None)
 
         return {
             "steered_generation": all_generations,
@@ -22,11 +22,28 @@ from ..utils.model_utils import (
     remove_gradient_parallel_to_decoder_directions,
     gather_residual_activations, 
     get_lr,
-    calculate_l1_losses
+    calculate_l1_losses,
+    causal_lm_losses,
+    clip_grad_norm_per_row
 )
+from ..utils.data_utils import make_data_module
 from transformers import get_scheduler
 from transformers import set_seed
-from ..scripts.inference import prepare_df
+from ..utils.model_utils import prepare_df
+from ..utils.profiler import span
+
+
+def accumulation_groups(dataloader, n_epochs, gradient_accumulation_steps):
+    """The batches of `dataloader`, epoch by epoch, in the groups accumulated into one optimizer step."""
+    for _ in range(n_epochs):
+        group = []
+        for batch in dataloader:
+            group.append(batch)
+            if len(group) == gradient_accumulation_steps:
+                yield group
+                group = []
+        if len(group) > 0:
+            yield group
 
 
 class LsReFT(Model):
@@ -83,31 +100,73 @@ class LsReFT(Model):
         self.ax_model = ax_model
 
     def train(self, examples, **kwargs):
-        train_dataloader = self.make_dataloader(examples, **kwargs)
+        self.train_concepts([examples], **kwargs)
+
+    def train_concepts(self, concept_examples, **kwargs):
+        """
+        Train the subspaces of several concepts in the same base-model passes.
+
+        Concept i of `concept_examples` is trained into row i of the
+        intervention (made with low_rank_dimension=len(concept_examples)).
+        Every concept keeps its own batches, gradient accumulation, learning
+        rate schedule and l1 warmup, as if it was trained alone; a step mixes
+        the batches of the concepts that still have data and routes every
+        example to its row. Losses, gradient clipping and decoder
+        normalisation are per row, and the rows of concepts whose data ran
+        out keep their final values, so concepts with different numbers of
+        examples can be trained together.
+        """
+        data_modules = [make_data_module(self.tokenizer, examples, **kwargs) for examples in concept_examples]
+        train_dataloaders = []
+        for data_module in data_modules:
+            g = torch.Generator()
+            g.manual_seed(self.seed)
+            train_dataloaders.append(DataLoader(
+                data_module["train_dataset"], shuffle=True, # we shuffle for examples.
+                batch_size=self.training_args.batch_size, collate_fn=list, generator=g))
+        data_collator = data_modules[0]["data_collator"]
+        num_of_concepts = len(concept_examples)
+        gradient_accumulation_steps = self.training_args.gradient_accumulation_steps
         torch.cuda.empty_cache()
 
-        # Optimizer and lr
+        # Optimizer and lr: the linear schedule of every concept scales the update of its row.
         optimizer = torch.optim.AdamW(
             self.ax_model.parameters(), 
             lr=self.training_args.lr, weight_decay=self.training_args.weight_decay)
-        num_training_steps = self.training_args.n_epochs * (len(train_dataloader) // self.training_args.gradient_accumulation_steps)
-        lr_scheduler = get_scheduler(
-            "linear", optimizer=optimizer,
-            num_warmup_steps=0, num_training_steps=num_training_steps)
-        norm_loss_fn = torch.nn.MSELoss()
+        num_training_steps = torch.tensor([
+            self.training_args.n_epochs * (len(train_dataloader) // gradient_accumulation_steps)
+            for train_dataloader in train_dataloaders], device=self.device)
         # Main training loop.
-        rank = torch.distributed.get_rank()
-        progress_bar, curr_step = tqdm(range(num_training_steps), position=rank, leave=True), 0
-        
-        for epoch in range(self.training_args.n_epochs):
-            for step, batch in enumerate(train_dataloader):
+        rank = torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
+        progress_bar, curr_step = tqdm(range(num_training_steps.max().item()), position=rank, leave=True), 0
+        concept_steps = [
+            accumulation_groups(train_dataloader, self.training_args.n_epochs, gradient_accumulation_steps)
+            for train_dataloader in train_dataloaders]
+        final_rows = {}
+
+        while True:
+            step_groups = [next(steps, None) for steps in concept_steps]
+            for i, group in enumerate(step_groups):
+                if group is None and i not in final_rows:
+                    final_rows[i] = (self.ax.proj.weight.data[i].clone(), self.ax.proj.bias.data[i].clone())
+            if len(final_rows) == num_of_concepts:
+                break
+            coeff = curr_step / num_training_steps.clamp(min=1)
+            for micro_step in range(max(len(group) for group in step_groups if group is not None)):
+                concept_batches = [
+                    group[micro_step] if group is not None and micro_step < len(group) else []
+                    for group in step_groups]
                 # prepare input
+                batch = data_collator([inst for concept_batch in concept_batches for inst in concept_batch])
                 inputs = {k: v.to(self.device) for k, v in batch.items()}
+                concept_idx = torch.tensor([
+                    i for i, concept_batch in enumerate(concept_batches) for _ in concept_batch], device=self.device)
                 unit_locations={"sources->base": (
                     None,
                     inputs["intervention_locations"].permute(1, 0, 2).tolist()
                 )}
                 subspaces = [{
+                    "subspaces": concept_idx,
                     "k": self.training_args.topk
                 }]
         
@@ -116,39 +175,56 @@ class LsReFT(Model):
                     base={
                         "input_ids": inputs["input_ids"],
                         "attention_mask": inputs["attention_mask"]
-                    }, unit_locations=unit_locations, labels=inputs["labels"],
+                    }, unit_locations=unit_locations,
                     subspaces=subspaces, use_cache=False)
                 
-                # loss
-                loss = cf_outputs.loss
+                # loss: the sum of the per-concept losses
+                loss_sums, label_counts = causal_lm_losses(cf_outputs.logits, inputs["labels"])
+                concept_loss_sums = torch.zeros(num_of_concepts, device=self.device).index_add_(0, concept_idx, loss_sums)
+                concept_label_counts = torch.zeros(num_of_concepts, device=self.device).index_add_(
+                    0, concept_idx, label_counts.float())
+                loss = (concept_loss_sums / concept_label_counts.clamp(min=1)).sum()
                 latent, non_topk_latent = self.ax_model.full_intervention_outputs[0].latent
-                l1_loss = calculate_l1_losses(
+                l1_losses = calculate_l1_losses(
                     latent, non_topk_latent,
-                    mask=inputs["intervention_masks"],
+                    mask=inputs["intervention_masks"], reduction="none",
                 )
-                coeff = curr_step/num_training_steps
-                loss += coeff*self.training_args.coeff_latent_l1_loss*l1_loss
-                loss = loss.mean()
-                loss /= self.training_args.gradient_accumulation_steps
+                concept_l1_losses = torch.zeros(num_of_concepts, device=self.device).index_add_(
+                    0, concept_idx, l1_losses.float())
+                concept_sizes = torch.bincount(concept_idx, minlength=num_of_concepts)
+                l1_loss = (concept_l1_losses / concept_sizes.clamp(min=1))
+                loss += self.training_args.coeff_latent_l1_loss*(coeff*l1_loss).sum()
+                l1_loss = l1_loss.sum()
+                loss /= gradient_accumulation_steps
                 # grads
                 loss.backward()
 
-                # Perform optimization step every gradient_accumulation_steps
-                if (step + 1) % self.training_args.gradient_accumulation_steps == 0 or (step + 1) == len(train_dataloader):
-                    torch.nn.utils.clip_grad_norm_(self.ax_model.parameters(), 1.0)
-                    set_decoder_norm_to_unit_norm(self.ax)
-                    remove_gradient_parallel_to_decoder_directions(self.ax)
-                    curr_step += 1
-                    curr_lr = get_lr(optimizer)
-                    # optim
-                    optimizer.step()
-                    lr_scheduler.step()
-                    optimizer.zero_grad()
-                    progress_bar.update(1)
-                    progress_bar.set_description(
-                        "lr %.6f || loss %.6f || l1 loss %.6f" % (
-                            curr_lr, loss, l1_loss))
+            # Perform optimization step at the end of the accumulation group of every concept
+            clip_grad_norm_per_row(self.ax, 1.0)
+            set_decoder_norm_to_unit_norm(self.ax)
+            remove_gradient_parallel_to_decoder_directions(self.ax)
+            lr_scales = ((num_training_steps - curr_step) / num_training_steps.clamp(min=1)).clamp(min=0)
+            curr_step += 1
+            curr_lr = self.training_args.lr * lr_scales.max().item()
+            # optim: an AdamW update is linear in the learning rate, so every row is scaled by its schedule.
+            params = [self.ax.proj.weight, self.ax.proj.bias]
+            params_before = [param.data.clone() for param in params]
+            optimizer.step()
+            with torch.no_grad():
+                for param, param_before in zip(params, params_before):
+                    scales = lr_scales.to(param.dtype).view(-1, *[1] * (param.dim() - 1))
+                    param.copy_(param_before + (param - param_before) * scales)
+            optimizer.zero_grad()
+            progress_bar.update(1)
+            progress_bar.set_description(
+                "lr %.6f || loss %.6f || l1 loss %.6f" % (
+                    curr_lr, loss, l1_loss))
         progress_bar.close()
+        # rows of concepts that finished early were stepped along with the others since.
+        with torch.no_grad():
+            for i, (weight, bias) in final_rows.items():
+                self.ax.proj.weight[i] = weight
+                self.ax.proj.bias[i] = bias
     
     @torch.no_grad()
     def predict_latent(self, examples, **kwargs):
@@ -178,13 +254,14 @@ class LsReFT(Model):
             
             gather_acts = gather_residual_activations(
                 self.model, self.layer, inputs)
-            outputs = self.ax(
-                gather_acts[:, kwargs["prefix_length"]:],  # no bos token
-                subspaces={
-                    "subspaces": torch.tensor([overwrite_concept_id]*len(batch["input"])).to(self.device) \
-                    if overwrite_concept_id is not None else torch.tensor(batch["concept_id"].tolist()).to(self.device),
-                    "k": 1
-                })
+            with span("intervention"):
+                outputs = self.ax(
+                    gather_acts[:, kwargs["prefix_length"]:],  # no bos token
+                    subspaces={
+                        "subspaces": torch.tensor([overwrite_concept_id]*len(batch["input"])).to(self.device) \
+                        if overwrite_concept_id is not None else torch.tensor(batch["concept_id"].tolist()).to(self.device),
+                        "k": 1
+                    })
             ax_acts = outputs.latent[0].float().detach().cpu()
 
             seq_lens = inputs["attention_mask"].sum(dim=1) - kwargs["prefix_length"] # no bos token
@@ -19,6 +19,8 @@ from ..utils.model_utils import (
     set_decoder_norm_to_unit_norm, 
     remove_gradient_parallel_to_decoder_directions,
     gather_residual_activations, 
+    gather_token_activations,
+    reduce_token_activations,
     get_lr
 )
 from ..utils.model_utils import calculate_l1_losses
@@ -86,7 +88,7 @@ class MeanEmbedding(Model):
         data_module = make_data_module(self.tokenizer, self.model, examples)
         train_dataloader = DataLoader(
             data_module["train_dataset"], shuffle=True, batch_size=self.training_args.batch_size, 
-            collate_fn=data_module["data_collator"])
+            collate_fn=data_module["data_collator"], pin_memory=str(self.device).startswith("cuda"))
         return train_dataloader
 
     def train(self, examples, **kwargs):
@@ -103,26 +105,24 @@ class MeanActivation(MeanEmbedding):
     def __str__(self):
         return 'MeanActivation'
 
+    def token_activations(self, examples, **kwargs):
+        """
+        The non-BOS token activations of `examples` and the label of every token.
+
+        Every epoch would see the same frozen activations, so they are
+        extracted once (and shared with the other methods training on them).
+        """
+        activations, lengths = gather_token_activations(
+            self.model, self.tokenizer, self.layer, examples,
+            batch_size=self.training_args.batch_size, prefix_length=kwargs["prefix_length"])
+        labels = torch.tensor(examples["labels"].to_numpy()).repeat_interleave(lengths)
+        return activations, labels.to(activations.device)
+
     @torch.no_grad()
     def train(self, examples, **kwargs):
-        train_dataloader = self.make_dataloader(examples)
         torch.cuda.empty_cache()
         self.ax.eval()
-        # Main training loop.
-        all_activations = []
-        num_training_steps = self.training_args.n_epochs * len(train_dataloader)
-        for epoch in range(self.training_args.n_epochs):
-            for batch in train_dataloader:
-                # prepare input
-                inputs = {k: v.to(self.device) for k, v in batch.items()}
-                activations = gather_residual_activations(
-                    self.model, self.layer, 
-                    {"input_ids": inputs["input_ids"], "attention_mask": inputs["attention_mask"]}
-                ).detach()
-                nonbos_mask = inputs["attention_mask"][:,kwargs["prefix_length"]:]
-                activations = activations[:,kwargs["prefix_length"]:][nonbos_mask.bool()]
-                all_activations.append(activations)
-        all_activations = torch.cat(all_activations, dim=0)
+        all_activations, _ = self.token_activations(examples, **kwargs)
         mean_activation = all_activations.mean(dim=0)
         self.ax.proj.weight.data = mean_activation.unsqueeze(0)
         set_decoder_norm_to_unit_norm(self.ax)
@@ -141,30 +141,12 @@ class DiffMean(MeanActivation):
 
     @torch.no_grad()
     def train(self, examples, **kwargs):
-        train_dataloader = self.make_dataloader(examples)
         torch.cuda.empty_cache()
         self.ax.eval()
         self.ax.to(self.device)
-        # Main training loop.
-        positive_activations = []
-        negative_activations = []
-        for _ in range(self.training_args.n_epochs):
-            for batch in train_dataloader:
-                # prepare input
-                inputs = {k: v.to(self.device) for k, v in batch.items()}
-                activations = gather_residual_activations(
-                    self.model, self.layer, 
-                    {"input_ids": inputs["input_ids"], "attention_mask": inputs["attention_mask"]}
-                ).detach()
-                nonbos_mask = inputs["attention_mask"][:,kwargs["prefix_length"]:]
-                activations = activations[:,kwargs["prefix_length"]:][nonbos_mask.bool()]
-                labels = inputs["labels"].unsqueeze(1).repeat(
-                    1, inputs["input_ids"].shape[1] - kwargs["prefix_length"])
-                positive_activations.append(activations[labels[nonbos_mask.bool()] == 1])
-                negative_activations.append(activations[labels[nonbos_mask.bool()] != 1])
-
-        mean_positive_activation = torch.cat(positive_activations, dim=0).mean(dim=0)
-        mean_negative_activation = torch.cat(negative_activations, dim=0).mean(dim=0)
+        activations, labels = self.token_activations(examples, **kwargs)
+        mean_positive_activation = activations[labels == 1].mean(dim=0)
+        mean_negative_activation = activations[labels != 1].mean(dim=0)
         self.ax.proj.weight.data = mean_positive_activation.unsqueeze(0) - mean_negative_activation.unsqueeze(0)
         set_decoder_norm_to_unit_norm(self.ax)
         logger.warning("Training finished.")
@@ -177,28 +159,11 @@ class PCA(MeanActivation):
 
     @torch.no_grad()
     def train(self, examples, **kwargs):
-        train_dataloader = self.make_dataloader(examples)
         torch.cuda.empty_cache()
         self.ax.eval()
         self.ax.to(self.device)
-        # Main training loop.
-        all_activations = []
-        
-        for _ in range(self.training_args.n_epochs):
-            for batch in train_dataloader:
-                # prepare input
-                inputs = {k: v.to(self.device) for k, v in batch.items()}
-                activations = gather_residual_activations(
-                    self.model, self.layer, 
-                    {"input_ids": inputs["input_ids"], "attention_mask": inputs["attention_mask"]}
-                ).detach()
-                nonbos_mask = inputs["attention_mask"][:,kwargs["prefix_length"]:]
-                activations = activations[:,kwargs["prefix_length"]:][nonbos_mask.bool()]
-                labels = inputs["labels"].unsqueeze(1).repeat(1, inputs["input_ids"].shape[1] - kwargs["prefix_length"])
-                label_mask = labels[nonbos_mask.bool()] == 1 # only positive examples
-                all_activations.append(activations[label_mask].detach().cpu().float().numpy())
-
-        all_activations = np.concatenate(all_activations)
+        activations, labels = self.token_activations(examples, **kwargs)
+        all_activations = activations[labels == 1].cpu().float().numpy() # only positive examples
         pca = sklearn.decomposition.PCA(n_components=2)
         pca.fit(all_activations)
         variance = pca.explained_variance_ratio_[0]
@@ -220,29 +185,15 @@ class LAT(MeanActivation):
 
     @torch.no_grad()
     def train(self, examples, **kwargs):
-        train_dataloader = self.make_dataloader(examples)
         torch.cuda.empty_cache()
         self.ax.eval()
         self.ax.to(self.device)
-        # Main training loop.
-        all_activations = []
-        
-        for _ in range(self.training_args.n_epochs):
-            for batch in train_dataloader:
-                # prepare input
-                inputs = {k: v.to(self.device) for k, v in batch.items()}
-                activations = gather_residual_activations(
-                    self.model, self.layer, 
-                    {"input_ids": inputs["input_ids"], "attention_mask": inputs["attention_mask"]}
-                ).detach()
-                nonbos_mask = inputs["attention_mask"][:,kwargs["prefix_length"]:]
-                activations = activations[:,kwargs["prefix_length"]:][nonbos_mask.bool()]
-                labels = inputs["labels"].unsqueeze(1).repeat(1, inputs["input_ids"].shape[1] - kwargs["prefix_length"])
-                label_mask = labels[nonbos_mask.bool()] == 1 # only positive examples
-                all_activations.append(activations[label_mask].detach().cpu().float().numpy())
+        activations, labels = self.token_activations(examples, **kwargs)
+        # only positive examples, once per epoch as the pairs are drawn from all of them
+        all_activations = np.tile(
+            activations[labels == 1].cpu().float().numpy(), (self.training_args.n_epochs, 1))
 
         # shuffle and take diffs of random pairs
-        all_activations = np.concatenate(all_activations)
         logger.warning(f"Shuffling {all_activations.shape[0]} activations")
         np.random.shuffle(all_activations)
         length = all_activations.shape[0] // 2
@@ -290,56 +241,21 @@ class GemmaScopeSAEDiffMean(MeanActivation):
             self.sae.to(self.device)
         super().make_model(**kwargs)
     
-    @torch.inference_mode()
+    @torch.no_grad()
     def train(self, examples, **kwargs):
-        train_dataloader = self.make_dataloader(examples)
         torch.cuda.empty_cache()
-        prefix_length = kwargs.get("prefix_length", 1)
-
-        sum_positive_acts = torch.zeros(self.sae_width).to(self.device)
-        sum_negative_acts = torch.zeros(self.sae_width).to(self.device)
-        positive_count = 0
-        negative_count = 0
-        num_training_steps = self.training_args.n_epochs * len(train_dataloader)
-        rank = torch.distributed.get_rank()
-        progress_bar, curr_step = tqdm(range(num_training_steps), position=rank, leave=True), 0
-        
-        for epoch in range(self.training_args.n_epochs):
-            for step, batch in enumerate(train_dataloader):
-                # prepare input
-                inputs = {k: v.to(self.device) for k, v in batch.items()}
-                inputs = {
-                    "input_ids": inputs["input_ids"],
-                    "attention_mask": inputs["attention_mask"],
-                }
-
-                # get SAE latents
-                act_in = gather_residual_activations(
-                    self.model, self.layer, inputs).to(dtype=torch.float32)
-                ax_acts_batch = self.sae(act_in[:, prefix_length:]) # no bos token
-                seq_lens = inputs["attention_mask"].sum(dim=1) - prefix_length # no bos token
-
-                # add avg latents for each sequence
-                for i in range(len(batch)):
-                    acts = ax_acts_batch[i, :seq_lens[i]]
-                    label = batch["labels"][i]
-                    avg_acts = acts.mean(dim=0)
-                    if label == 1:
-                        sum_positive_acts += avg_acts
-                        positive_count += 1
-                    else:
-                        sum_negative_acts += avg_acts
-                        negative_count += 1
-                
-                del ax_acts_batch
-                del act_in
-                torch.cuda.empty_cache()
-                progress_bar.update(1)
-        progress_bar.close()
+        activations, lengths = gather_token_activations(
+            self.model, self.tokenizer, self.layer, examples,
+            batch_size=self.training_args.batch_size, prefix_length=kwargs.get("prefix_length", 1))
+        # avg latents of every sequence
+        avg_acts = reduce_token_activations(
+            lambda act_in: self.sae(act_in.to(dtype=torch.float32)), activations, lengths,
+            reduce="mean", batch_size=self.training_args.batch_size)
+        labels = torch.tensor(examples["labels"].to_numpy()).to(avg_acts.device)
 
         # get latent activations
-        mean_positive_activation = sum_positive_acts / positive_count
-        mean_negative_activation = sum_negative_acts / negative_count
+        mean_positive_activation = avg_acts[labels == 1].mean(dim=0)
+        mean_negative_activation = avg_acts[labels != 1].mean(dim=0)
         mean_diff = (mean_positive_activation - mean_negative_activation) @ self.sae.W_dec
         self.ax.proj.weight.data = mean_diff.unsqueeze(0)
         self.ax.proj.bias.data = torch.zeros(1)
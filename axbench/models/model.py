@@ -13,7 +13,8 @@ from pyvene import (
 from transformers import set_seed
 import transformers, datasets
 from typing import Dict, Optional, Sequence, Union, List, Any
-from ..scripts.inference import prepare_df
+from ..utils.model_utils import prepare_df
+from ..utils.profiler import span
 
 import logging
 logging.basicConfig(format='%(asctime)s,%(msecs)03d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
@@ -88,7 +89,7 @@ class Model(BaseModel):
             data_module["train_dataset"], shuffle=True, # we shuffle for examples.
             batch_size=self.training_args.batch_size, 
             collate_fn=data_module["data_collator"],
-            generator=g)
+            generator=g, pin_memory=str(self.device).startswith("cuda"))
         return train_dataloader
     
     def train(self, examples, **kwargs):
@@ -152,7 +153,8 @@ class Model(BaseModel):
             act_in = gather_residual_activations(
                 self.model, self.layer, inputs)
             
-            ax_acts_batch = self.ax(act_in[:, kwargs["prefix_length"]:])  # no bos token
+            with span("intervention"):
+                ax_acts_batch = self.ax(act_in[:, kwargs["prefix_length"]:])  # no bos token
             # Process each sequence in the batch
             seq_lens = inputs["attention_mask"].sum(dim=1) - kwargs["prefix_length"] # no bos token
             for seq_idx, row in enumerate(batch.itertuples()):
@@ -273,7 +275,7 @@ class Model(BaseModel):
         all_perplexities = []
         all_strenghts = []
         # Main training loop.
-        rank = torch.distributed.get_rank()
+        rank = torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
         progress_bar = tqdm(range(0, len(examples), batch_size), position=rank, leave=True)
         for i in range(0, len(examples), batch_size):
             batch_examples = examples.iloc[i:i+batch_size]
@@ -292,14 +294,15 @@ class Model(BaseModel):
             inputs = self.tokenizer(
                 input_strings, return_tensors="pt", padding=True, truncation=True
             ).to(self.device)
-            _, generations = self.ax_model.generate(
-                inputs, 
-                unit_locations=None, intervene_on_prompt=True, 
-                subspaces=[{"idx": idx, "mag": mag, "max_act": max_acts, 
-                            "prefix_length": kwargs["prefix_length"]}]*self.num_of_layers,
-                max_new_tokens=eval_output_length, do_sample=True, 
-                temperature=temperature,
-            )
+            with span("generate"):
+                _, generations = self.ax_model.generate(
+                    inputs, 
+                    unit_locations=None, intervene_on_prompt=True, 
+                    subspaces=[{"idx": idx, "mag": mag, "max_act": max_acts, 
+                                "prefix_length": kwargs["prefix_length"]}]*self.num_of_layers,
+                    max_new_tokens=eval_output_length, do_sample=True, 
+                    temperature=temperature,
+                )
 
             # Decode and print only the generated text without prompt tokens
             input_lengths = [len(input_ids) for input_ids in inputs.input_ids]
@@ -319,7 +322,8 @@ class Model(BaseModel):
             batch_attention_mask = (batch_input_ids != self.tokenizer.pad_token_id).float()
             
             # Forward pass without labels to get logits
-            outputs = self.model(input_ids=batch_input_ids, attention_mask=batch_attention_mask)
+            with span("perplexity"):
+                outputs = self.model(input_ids=batch_input_ids, attention_mask=batch_attention_mask)
             
             logits = outputs.logits[:, :-1, :].contiguous()  # Remove last token prediction
             target_ids = batch_input_ids[:, 1:].contiguous()  # Shift right by 1
@@ -1,5 +1,7 @@
 from .model import Model
 import torch, transformers, datasets
+import numpy as np
+import pyarrow as pa
 from tqdm.auto import tqdm
 import os
 import pandas as pd
@@ -16,10 +18,19 @@ from .interventions import (
     ProbeIntervention,
     SparseProbeIntervention
 )
+from ..utils.data_utils import (
+    tokenize_examples,
+    tokenized_arrays,
+    intervention_positions,
+    list_column,
+    row_positions,
+    pad_tensors
+)
 from ..utils.model_utils import (
     set_decoder_norm_to_unit_norm, 
     remove_gradient_parallel_to_decoder_directions,
     gather_residual_activations, 
+    gather_token_activations,
     get_lr,
     calculate_l1_losses
 )
@@ -37,56 +48,38 @@ class DataCollator(object):
     """Collate examples for ReFT."""
     
     tokenizer: transformers.AutoTokenizer
-    data_collator: transformers.DataCollator
+    data_collator: Optional[transformers.DataCollator] = None # unused, kept for compatibility
 
     def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
-        max_intervention_len = max([len(inst["intervention_locations"][0]) for inst in instances])
-        max_seq_len = max([len(inst["input_ids"]) for inst in instances])
-        
-        for inst in instances:
-            non_pad_len = len(inst["input_ids"])
-
-            _intervention_mask = torch.ones_like(inst["intervention_locations"][0])
-            _intervention_location_paddings = torch.tensor(
-                [[len(inst["input_ids"]) for _ in range(max_intervention_len - len(inst["intervention_locations"][0]))]])
-            _intervention_mask_paddings = torch.tensor(
-                [0 for _ in range(max_intervention_len - len(inst["intervention_locations"][0]))])
-            inst["intervention_locations"] = torch.cat([inst["intervention_locations"], _intervention_location_paddings], dim=-1).int()
-            inst["intervention_masks"] = torch.cat([_intervention_mask, _intervention_mask_paddings], dim=-1).int()
-
-            _input_id_paddings = torch.tensor(
-                [self.tokenizer.pad_token_id for _ in range(max_seq_len - non_pad_len)])
-            inst["input_ids"] = torch.cat((inst["input_ids"], torch.tensor([self.tokenizer.pad_token_id]), _input_id_paddings)).int()
-            inst["attention_mask"] = (inst["input_ids"] != self.tokenizer.pad_token_id).int()
-            inst["labels"] = inst["labels"].int()
-        batch_inputs = self.data_collator(instances)
-        return batch_inputs
+        pad_token_id = self.tokenizer.pad_token_id
+        input_ids, lengths = pad_tensors([inst["input_ids"] for inst in instances], pad_token_id, extra=1)
+        intervention_locations, intervention_lengths = pad_tensors(
+            [inst["intervention_locations"] for inst in instances], 0)
+        intervention_masks = torch.arange(intervention_locations.shape[-1])[None, :] < intervention_lengths[:, None]
+        return {
+            "input_ids": input_ids,
+            "labels": torch.stack([inst["labels"] for inst in instances]).int(),
+            "intervention_locations": torch.where(
+                intervention_masks[:, None, :], intervention_locations, lengths[:, None, None]).int(),
+            "intervention_masks": intervention_masks.int(),
+            "attention_mask": (input_ids != pad_token_id).int(),
+        }
 
 
 def make_data_module(
     tokenizer: transformers.PreTrainedTokenizer, model, df, prefix_length=1
 ):
-    all_input_ids, all_labels, all_intervention_locations = [], [], []
-    for _, row in df.iterrows():
-        input_ids = tokenizer(
-            row["input"], max_length=1024, truncation=True, return_tensors="pt")["input_ids"][0]
-        base_length = len(input_ids)
-        intervention_locations = torch.tensor([[i for i in range(prefix_length, base_length)]])
-        all_input_ids.append(input_ids)
-        all_labels.append(row["labels"])
-        all_intervention_locations.append(intervention_locations)
+    input_ids, lengths, _ = tokenized_arrays(tokenize_examples(tokenizer, df, with_output=False))
+    locations, location_lengths = intervention_positions(np.full(len(lengths), prefix_length), lengths)
 
-    train_dataset = datasets.Dataset.from_dict({
-        "input_ids": all_input_ids,
-        "labels": all_labels,
-        "intervention_locations": all_intervention_locations
-    })
+    train_dataset = datasets.Dataset(pa.table({
+        "input_ids": list_column(input_ids, lengths),
+        "labels": pa.array(df["labels"].to_numpy()),
+        "intervention_locations": list_column(locations, location_lengths, nested=True),
+    }))
     train_dataset.set_format(type='torch', columns=['input_ids', 'labels', 'intervention_locations'])
 
-    data_collator_fn = transformers.DefaultDataCollator(
-        return_tensors="pt"
-    )
-    data_collator = DataCollator(tokenizer=tokenizer, data_collator=data_collator_fn)
+    data_collator = DataCollator(tokenizer=tokenizer)
     return dict(train_dataset=train_dataset, eval_dataset=None, data_collator=data_collator)
 
 
@@ -129,11 +122,21 @@ class LinearProbe(Model):
         data_module = make_data_module(self.tokenizer, self.model, examples)
         train_dataloader = DataLoader(
             data_module["train_dataset"], shuffle=True, batch_size=self.training_args.batch_size, 
-            collate_fn=data_module["data_collator"])
+            collate_fn=data_module["data_collator"], pin_memory=str(self.device).startswith("cuda"))
         return train_dataloader
 
     def train(self, examples, **kwargs):
-        train_dataloader = self.make_dataloader(examples, **kwargs)
+        # the probe only reads the frozen residuals: the base model runs once, not once per epoch.
+        activations, lengths = gather_token_activations(
+            self.model, self.tokenizer, self.layer, examples,
+            batch_size=self.training_args.batch_size, prefix_length=kwargs.get("prefix_length", 1))
+        lengths = lengths.numpy()
+        starts = np.cumsum(lengths) - lengths
+        token_labels = torch.tensor(examples["labels"].to_numpy()).repeat_interleave(
+            torch.from_numpy(lengths)).to(activations.device)
+        # batches of examples, drawn as the dataloader of the examples would.
+        train_dataloader = DataLoader(
+            range(len(examples)), shuffle=True, batch_size=self.training_args.batch_size)
         torch.cuda.empty_cache()
 
         # Optimizer and lr
@@ -146,43 +149,29 @@ class LinearProbe(Model):
             num_warmup_steps=0, num_training_steps=num_training_steps)
         criterion = torch.nn.BCELoss()
         # Main training loop.
-        rank = torch.distributed.get_rank()
+        rank = torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
         progress_bar, curr_step = tqdm(range(num_training_steps), position=rank, leave=True), 0
         
         for epoch in range(self.training_args.n_epochs):
             for batch in train_dataloader:
-                # prepare input
-                inputs = {k: v.to(self.device) for k, v in batch.items()}
-                unit_locations={"sources->base": (
-                    None,
-                    inputs["intervention_locations"].permute(1, 0, 2).tolist()
-                )}
-                subspaces = [{
-                    "k": self.training_args.topk
-                }]
+                # the tokens of the batch examples
+                batch = batch.numpy()
+                token_ids = torch.from_numpy(
+                    np.repeat(starts[batch], lengths[batch]) + row_positions(lengths[batch])).to(activations.device)
         
-                # forward (we don't care about the model outputs since no causal intervention only probing)
-                _, _ = self.ax_model(
-                    base={
-                        "input_ids": inputs["input_ids"],
-                        "attention_mask": inputs["attention_mask"]
-                    }, unit_locations=unit_locations, subspaces=subspaces, use_cache=False)
-                
-                latent = self.ax_model.full_intervention_outputs[0].latent[0] # bs, n_tokens
-                preds = torch.sigmoid(latent) # bs, n_tokens
-                expanded_labels = inputs["labels"].unsqueeze(-1).expand_as(preds) # bs, n_tokens
-                # Compute loss only on valid tokens
-                loss = criterion(
-                    preds[inputs["intervention_masks"].bool()].float(), 
-                    expanded_labels[inputs["intervention_masks"].bool()].float()
-                )
+                # forward on the packed tokens
+                latent = self.ax(
+                    activations[token_ids].unsqueeze(0), subspaces={"k": self.training_args.topk}
+                ).latent[0][0] # n_tokens
+                preds = torch.sigmoid(latent) # n_tokens
+                labels = token_labels[token_ids]
+                loss = criterion(preds.float(), labels.float())
                 l1_loss = sum(p.abs().sum() for p in self.ax.parameters())
                 loss += self.training_args.coeff_l1_loss*l1_loss
                 
                 # accuracy
                 pred_labels = (preds > 0.5).long()
-                acc = (pred_labels[inputs["intervention_masks"].bool()] == 
-                       expanded_labels[inputs["intervention_masks"].bool()]).float().mean()
+                acc = (pred_labels == labels).float().mean()
 
                 # grads
                 loss.backward()
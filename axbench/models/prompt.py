@@ -1,4 +1,5 @@
 from .model import Model
+from ..utils.profiler import span
 import torch, transformers, datasets
 from tqdm.auto import tqdm
 import os
@@ -75,10 +76,11 @@ class PromptSteering(Model):
             inputs = self.tokenizer(
                 input_strings, return_tensors="pt", padding=True, truncation=True
             ).to(self.device)
-            generations = self.model.generate(
-                **inputs, max_new_tokens=eval_output_length, do_sample=True, 
-                temperature=temperature,
-            )
+            with span("generate"):
+                generations = self.model.generate(
+                    **inputs, max_new_tokens=eval_output_length, do_sample=True, 
+                    temperature=temperature,
+                )
 
             # Decode and print only the generated text without prompt tokens
             input_lengths = [len(input_ids) for input_ids in inputs.input_ids]
@@ -94,7 +96,8 @@ class PromptSteering(Model):
             batch_attention_mask = (batch_input_ids != self.tokenizer.pad_token_id).float()
             
             # Forward pass without labels to get logits
-            outputs = self.model(input_ids=batch_input_ids, attention_mask=batch_attention_mask)
+            with span("perplexity"):
+                outputs = self.model(input_ids=batch_input_ids, attention_mask=batch_attention_mask)
             
             logits = outputs.logits[:, :-1, :].contiguous()  # Remove last token prediction
             target_ids = batch_input_ids[:, 1:].contiguous()  # Shift right by 1
@@ -193,10 +196,11 @@ class PromptDetection(Model):
             inputs = self.tokenizer(
                 template_strings, return_tensors="pt", padding=True, truncation=True
             ).to(self.device)
-            generations = self.model.generate(
-                **inputs, max_new_tokens=eval_output_length, do_sample=True, 
-                temperature=temperature,
-            )
+            with span("generate"):
+                generations = self.model.generate(
+                    **inputs, max_new_tokens=eval_output_length, do_sample=True, 
+                    temperature=temperature,
+                )
 
             # Decode and print only the generated text without prompt tokens
             input_lengths = [len(input_ids) for input_ids in inputs.input_ids]
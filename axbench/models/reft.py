@@ -1,4 +1,5 @@
 from .model import Model
+from ..utils.profiler import span
 import torch, einops
 from tqdm.auto import tqdm
 import os
@@ -21,7 +22,8 @@ from ..utils.model_utils import (
 from ..utils.data_utils import (
     parse_positions, 
     get_intervention_locations,
-    InterventionDataCollator
+    InterventionDataCollator,
+    pad_tensors
 )
 from dataclasses import dataclass
 from transformers import set_seed, get_scheduler, DataCollatorForSeq2Seq, DataCollator
@@ -37,32 +39,23 @@ class InterventionEvalDataCollator(object):
     """Collate examples for Intervention."""
     
     tokenizer: transformers.AutoTokenizer
-    data_collator: transformers.DataCollator
+    data_collator: Optional[transformers.DataCollator] = None # unused, kept for compatibility
 
     def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
         """
         intervention_locations will be something like [1,10,0,0,0] where all 0s are padding intervention locations.
         """
-        max_intervention_len = max([len(inst["intervention_locations"][0]) for inst in instances])
-        max_seq_len = max([len(inst["input_ids"]) for inst in instances])
-        
-        for inst in instances:
-            non_pad_len = len(inst["input_ids"])
-            _intervention_location_paddings = torch.tensor(
-                [[-1 for _ in range(max_intervention_len - len(inst["intervention_locations"][0]))] for _ in range(inst["intervention_locations"].shape[0])]) # pointing to the first padding token
-            inst["intervention_locations"] = torch.cat([inst["intervention_locations"], _intervention_location_paddings], dim=-1).int()
-            inst["intervention_locations"] = inst["intervention_locations"] + 1 # shift by 1 to point to the first non-padding token, and all paddings will be 0.
-
-            _input_id_paddings = torch.tensor(
-                [self.tokenizer.pad_token_id for _ in range(max_seq_len - non_pad_len)])
-            offset = max_seq_len - non_pad_len
-            inst["intervention_locations"] = inst["intervention_locations"] + offset
-            inst["input_ids"] = torch.cat((_input_id_paddings, torch.tensor([self.tokenizer.pad_token_id]), inst["input_ids"])).int()
-            
-            inst["attention_mask"] = (inst["input_ids"] != self.tokenizer.pad_token_id).int()
-
-        batch_inputs = self.data_collator(instances)
-        return batch_inputs
+        pad_token_id = self.tokenizer.pad_token_id
+        # left padded, with one more pad token in front of every example.
+        input_ids, lengths = pad_tensors([inst["input_ids"] for inst in instances], pad_token_id, extra=1, left=True)
+        intervention_locations, _ = pad_tensors([inst["intervention_locations"] for inst in instances], -1)
+        # shift by the padding, so that padded locations point to the first padding token.
+        offsets = input_ids.shape[-1] - lengths
+        return {
+            "input_ids": input_ids,
+            "intervention_locations": (intervention_locations + offsets[:, None, None]).int(),
+            "attention_mask": (input_ids != pad_token_id).int(),
+        }
 
 
 def make_eval_data_module(
@@ -103,10 +96,7 @@ def make_eval_data_module(
         type='torch', columns=[
             'input_ids', 'intervention_locations',])
 
-    data_collator_fn = transformers.DefaultDataCollator(
-        return_tensors="pt"
-    )
-    data_collator = InterventionEvalDataCollator(tokenizer=tokenizer, data_collator=data_collator_fn)
+    data_collator = InterventionEvalDataCollator(tokenizer=tokenizer)
     return dict(train_dataset=None, eval_dataset=eval_dataset, data_collator=data_collator)
 
 
@@ -118,6 +108,9 @@ def apply_chat_template(tokenizer, prompt):
 
 
 class LoReFT(Model):
+    # predict_steer serves rows of any concepts: row i applies the stacked weights of its concept_id.
+    steers_many_concepts = True
+
     def __str__(self):
         return 'LoReFT'
 
@@ -231,7 +224,8 @@ class LoReFT(Model):
         )
         train_dataloader = DataLoader(
             data_module["train_dataset"], shuffle=True, # we shuffle for examples.
-            batch_size=self.training_args.batch_size, collate_fn=data_module["data_collator"])
+            batch_size=self.training_args.batch_size, collate_fn=data_module["data_collator"],
+            pin_memory=str(self.device).startswith("cuda"))
         optimizer = torch.optim.AdamW(
             self.ax_model.parameters(), lr=self.training_args.lr, weight_decay=self.training_args.weight_decay,
             betas=(0.9, 0.999), eps=1e-8)
@@ -303,7 +297,7 @@ class LoReFT(Model):
         eval_dataloader = DataLoader(
             data_module["eval_dataset"], shuffle=False,
             batch_size=kwargs.get("batch_size"), 
-            collate_fn=data_module["data_collator"])
+            collate_fn=data_module["data_collator"], pin_memory=str(self.device).startswith("cuda"))
         
         torch.cuda.empty_cache()
         all_batch_examples = [examples.iloc[i:i+batch_size] for i in range(0, len(examples), batch_size)]
@@ -317,13 +311,14 @@ class LoReFT(Model):
             )}
             batch_examples = all_batch_examples[i]
             idx = torch.tensor(batch_examples["concept_id"].tolist()).to(self.device)
-            _, generations = self.ax_model.generate(
-                {"input_ids": inputs["input_ids"], "attention_mask": inputs["attention_mask"]}, 
-                unit_locations=unit_locations, intervene_on_prompt=True, 
-                subspaces=[{"idx": idx}]*self.number_of_interventions,
-                max_new_tokens=eval_output_length, do_sample=True, 
-                temperature=temperature,
-            )
+            with span("generate"):
+                _, generations = self.ax_model.generate(
+                    {"input_ids": inputs["input_ids"], "attention_mask": inputs["attention_mask"]}, 
+                    unit_locations=unit_locations, intervene_on_prompt=True, 
+                    subspaces=[{"idx": idx}]*self.number_of_interventions,
+                    max_new_tokens=eval_output_length, do_sample=True, 
+                    temperature=temperature,
+                )
             # Decode and print only the generated text without prompt tokens
             input_lengths = [len(input_ids) for input_ids in inputs["input_ids"]]
             generated_texts = [
@@ -342,7 +337,8 @@ class LoReFT(Model):
             batch_attention_mask = (batch_input_ids != self.tokenizer.pad_token_id).float()
             
             # Forward pass without labels to get logits
-            outputs = self.model(input_ids=batch_input_ids, attention_mask=batch_attention_mask)
+            with span("perplexity"):
+                outputs = self.model(input_ids=batch_input_ids, attention_mask=batch_attention_mask)
             
             logits = outputs.logits[:, :-1, :].contiguous()  # Remove last token prediction
             target_ids = batch_input_ids[:, 1:].contiguous()  # Shift right by 1
@@ -20,6 +20,8 @@ from .interventions import (
 from ..utils.model_utils import (
     remove_gradient_parallel_to_decoder_directions,
     gather_residual_activations, 
+    gather_token_activations,
+    reduce_token_activations,
     get_lr,
     calculate_l1_losses
 )
@@ -260,49 +262,23 @@ class GemmaScopeSAEMaxDiff(GemmaScopeSAE):
         data_module = make_data_module(self.tokenizer, self.model, examples)
         train_dataloader = DataLoader(
             data_module["train_dataset"], shuffle=True, batch_size=self.training_args.batch_size, 
-            collate_fn=data_module["data_collator"])
+            collate_fn=data_module["data_collator"], pin_memory=str(self.device).startswith("cuda"))
         return train_dataloader
     
+    @torch.no_grad()
     def train(self, examples, **kwargs):
-        train_dataloader = self.make_dataloader(examples)
         torch.cuda.empty_cache()
-        prefix_length = kwargs.get("prefix_length", 1)
-
-        sum_positive_acts = torch.zeros(self.sae_width).to(self.device)
-        sum_negative_acts = torch.zeros(self.sae_width).to(self.device)
-        positive_count = 0
-        negative_count = 0
-        
-        for epoch in range(self.training_args.n_epochs):
-            for step, batch in enumerate(train_dataloader):
-                # prepare input
-                inputs = {k: v.to(self.device) for k, v in batch.items()}
-                inputs = {
-                    "input_ids": inputs["input_ids"],
-                    "attention_mask": inputs["attention_mask"],
-                }
-
-                # get SAE latents
-                act_in = gather_residual_activations(
-                    self.model, self.layer, inputs)
-                ax_acts_batch = self.ax(act_in[:, prefix_length:])  # no bos token
-                seq_lens = inputs["attention_mask"].sum(dim=1) - prefix_length # no bos token
-
-                # add avg latents for each sequence
-                for i in range(len(batch)):
-                    acts = ax_acts_batch[i, :seq_lens[i]]
-                    label = batch["labels"][i]
-                    avg_acts = acts.mean(dim=0)
-                    if label == 1:
-                        sum_positive_acts += avg_acts
-                        positive_count += 1
-                    else:
-                        sum_negative_acts += avg_acts
-                        negative_count += 1
+        activations, lengths = gather_token_activations(
+            self.model, self.tokenizer, self.layer, examples,
+            batch_size=self.training_args.batch_size, prefix_length=kwargs.get("prefix_length", 1))
+        # avg latents of every sequence
+        avg_acts = reduce_token_activations(
+            self.ax, activations, lengths, reduce="mean", batch_size=self.training_args.batch_size)
+        labels = torch.tensor(examples["labels"].to_numpy()).to(avg_acts.device)
 
         # get latent activations
-        positive_acts = sum_positive_acts / positive_count
-        negative_acts = sum_negative_acts / negative_count
+        positive_acts = avg_acts[labels == 1].mean(dim=0)
+        negative_acts = avg_acts[labels != 1].mean(dim=0)
         max_diff = (positive_acts - negative_acts).argmax().item()
         self.top_feature = max_diff
 
@@ -390,42 +366,20 @@ class GemmaScopeSAEMaxAUC(GemmaScopeSAEMaxDiff):
     def __str__(self):
         return 'GemmaScopeSAEMaxAUC'
     
+    @torch.no_grad()
     def train(self, examples, **kwargs):
-        train_dataloader = self.make_dataloader(examples)
         torch.cuda.empty_cache()
-        prefix_length = kwargs.get("prefix_length", 1)
-
-        all_positive_acts = []
-        all_negative_acts = []
-        
-        for epoch in range(self.training_args.n_epochs):
-            for step, batch in enumerate(train_dataloader):
-                # prepare input
-                inputs = {k: v.to(self.device) for k, v in batch.items()}
-                inputs = {
-                    "input_ids": inputs["input_ids"],
-                    "attention_mask": inputs["attention_mask"],
-                }
-
-                # get SAE latents
-                act_in = gather_residual_activations(
-                    self.model, self.layer, inputs)
-                ax_acts_batch = self.ax(act_in[:, prefix_length:])  # no bos token; shape = (batch_size, seq_len, sae_width)
-                seq_lens = inputs["attention_mask"].sum(dim=1) - prefix_length # no bos token
-
-                # add max latents for each sequence
-                for i in range(seq_lens.shape[0]):
-                    acts = ax_acts_batch[i, :seq_lens[i]] # shape = (seq_len, sae_width)
-                    label = batch["labels"][i]
-                    max_acts = torch.max(acts, dim=0).values # shape = (sae_width, )
-                    if label == 1:
-                        all_positive_acts += [max_acts]
-                    else:
-                        all_negative_acts += [max_acts]
+        activations, lengths = gather_token_activations(
+            self.model, self.tokenizer, self.layer, examples,
+            batch_size=self.training_args.batch_size, prefix_length=kwargs.get("prefix_length", 1))
+        # max latents of every sequence
+        max_acts = reduce_token_activations(
+            self.ax, activations, lengths, reduce="amax", batch_size=self.training_args.batch_size)
+        labels = torch.tensor(examples["labels"].to_numpy()).to(max_acts.device)
 
         # get latent activations
-        positive_acts = torch.stack(all_positive_acts) # shape = (num_positive_examples, sae_width)
-        negative_acts = torch.stack(all_negative_acts) # shape = (num_negative_examples, sae_width)
+        positive_acts = max_acts[labels == 1] # shape = (num_positive_examples, sae_width)
+        negative_acts = max_acts[labels != 1] # shape = (num_negative_examples, sae_width)
         true_labels = torch.ones(len(positive_acts))
         false_labels = torch.zeros(len(negative_acts))
         all_labels = torch.cat([true_labels, false_labels], dim=0).detach().cpu().to(torch.float32) # shape = (num_examples, )
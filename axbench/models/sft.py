@@ -1,10 +1,20 @@
 from pathlib import Path
 from .model import Model
+from ..utils.profiler import span
 import torch, einops
 from tqdm.auto import tqdm
 import os
 import pandas as pd
+import numpy as np
+import pyarrow as pa
 from ..utils.constants import EXAMPLE_TAG
+from ..utils.data_utils import (
+    tokenize_examples,
+    tokenized_arrays,
+    prompt_masked_labels,
+    list_column,
+    pad_tensors
+)
 from torch.utils.data import DataLoader
 from ..utils.model_utils import (
     set_decoder_norm_to_unit_norm,
@@ -44,25 +54,17 @@ class TrainingArguments(transformers.TrainingArguments):
 class DataCollator(object):
     
     tokenizer: transformers.AutoTokenizer
-    data_collator: transformers.DataCollator
+    data_collator: Optional[transformers.DataCollator] = None # unused, kept for compatibility
 
     def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
-        max_seq_len = max([len(inst["input_ids"]) for inst in instances])
-        
-        for inst in instances:
-            non_pad_len = len(inst["input_ids"])
-
-            _input_id_paddings = torch.tensor(
-                [self.tokenizer.pad_token_id for _ in range(max_seq_len - non_pad_len)])
-            inst["input_ids"] = torch.cat((inst["input_ids"], torch.tensor([self.tokenizer.pad_token_id]), _input_id_paddings)).int()
-
-            _label_paddings = torch.tensor([-100 for _ in range(max_seq_len - non_pad_len+1)])
-            inst["labels"] = torch.cat((inst["labels"], _label_paddings))
-            
-            inst["attention_mask"] = (inst["input_ids"] != self.tokenizer.pad_token_id).int()
-
-        batch_inputs = self.data_collator(instances)
-        return batch_inputs
+        pad_token_id = self.tokenizer.pad_token_id
+        input_ids, _ = pad_tensors([inst["input_ids"] for inst in instances], pad_token_id, extra=1)
+        labels, _ = pad_tensors([inst["labels"] for inst in instances], -100, extra=1, dtype=torch.long)
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "attention_mask": (input_ids != pad_token_id).int(),
+        }
 
 
 def make_sft_data_module(
@@ -77,43 +79,27 @@ def make_sft_data_module(
     if not exclude_bos:
         prefix_length = 0
     
-    all_base_input_ids, all_output_ids = [], []
-    all_prompt_lengths = []
-    for _, row in df.iterrows():
-        _input, _output = row["input"], row["output"]
-        # prepare input ids
-        base_prompt = _input
-        if isinstance(_output, float):
-            _output = tokenizer.eos_token
-        base_input = base_prompt + _output
-        base_prompt_ids = tokenizer(
-            base_prompt, max_length=1024, truncation=True, return_tensors="pt")["input_ids"][0]
-        base_input_ids = tokenizer(
-            base_input, max_length=1024, truncation=True, return_tensors="pt")["input_ids"][0]
-        base_prompt_length = len(base_prompt_ids)
-        base_length = len(base_input_ids)
-
-        # output ids with prompt token mask
-        output_ids = base_input_ids.clone()
-        output_ids[:base_prompt_length] = -100
-
-        all_base_input_ids.append(base_input_ids)
-        all_output_ids.append(output_ids)
-        
-    train_dataset = datasets.Dataset.from_dict({
-        "input_ids": all_base_input_ids,
-        "labels": all_output_ids,
-    })
+    input_ids, lengths, prompt_lengths = tokenized_arrays(tokenize_examples(tokenizer, df))
+
+    # output ids with prompt token mask
+    output_ids = prompt_masked_labels(input_ids, lengths, prompt_lengths)
+
+    train_dataset = datasets.Dataset(pa.table({
+        "input_ids": list_column(input_ids, lengths),
+        "labels": list_column(output_ids, lengths),
+    }))
     train_dataset.set_format(
         type='torch', columns=['input_ids', 'labels'])
 
-    data_collator_fn = transformers.DefaultDataCollator(
-        return_tensors="pt"
-    )
-    data_collator = DataCollator(tokenizer=tokenizer, data_collator=data_collator_fn)
+    data_collator = DataCollator(tokenizer=tokenizer)
     return dict(train_dataset=train_dataset, eval_dataset=None, data_collator=data_collator)
 
 
+def uses_fsdp(lm_model_name):
+    """Whether SFT of `lm_model_name` is trained with the FSDP trainer."""
+    return "gemma-2-9b" in lm_model_name
+
+
 class SFT(Model):
 
     def __init__(self, model, tokenizer, layer, training_args=None, **kwargs):
@@ -156,7 +142,7 @@ class SFT(Model):
             num_warmup_steps=0, num_training_steps=num_training_steps)
         norm_loss_fn = torch.nn.MSELoss()
         # Main training loop.
-        rank = torch.distributed.get_rank()
+        rank = torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
         progress_bar, curr_step = tqdm(range(num_training_steps), position=rank, leave=True), 0
         
         for epoch in range(self.training_args.n_epochs):
@@ -227,7 +213,7 @@ class SFT(Model):
         trainer.train()
 
     def train(self, examples, **kwargs):
-        if "gemma-2-9b" in self.lm_model_name:
+        if uses_fsdp(self.lm_model_name):
             # huggingface trainer ith FSDP training
             self._train_fsdp(examples, **kwargs)
         else:
@@ -256,11 +242,12 @@ class SFT(Model):
                 input_strings, return_tensors="pt", padding=True, truncation=True
             ).to(self.device)
 
-            generations = self.ax_model.generate(
-                **inputs, 
-                max_new_tokens=eval_output_length, do_sample=True, 
-                temperature=temperature,
-            )
+            with span("generate"):
+                generations = self.ax_model.generate(
+                    **inputs, 
+                    max_new_tokens=eval_output_length, do_sample=True, 
+                    temperature=temperature,
+                )
 
             # Decode and print only the generated text without prompt tokens
             input_lengths = [len(input_ids) for input_ids in inputs.input_ids]
@@ -280,7 +267,8 @@ class SFT(Model):
             batch_attention_mask = (batch_input_ids != self.tokenizer.pad_token_id).float()
             
             # Forward pass without labels to get logits
-            outputs = self.model(input_ids=batch_input_ids, attention_mask=batch_attention_mask)
+            with span("perplexity"):
+                outputs = self.model(input_ids=batch_input_ids, attention_mask=batch_attention_mask)
             
             logits = outputs.logits[:, :-1, :].contiguous()  # Remove last token prediction
             target_ids = batch_input_ids[:, 1:].contiguous()  # Shift right by 1
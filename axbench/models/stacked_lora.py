@@ -0,0 +1,104 @@
+import json, math
+from pathlib import Path
+import torch
+from torch import nn
+from peft.utils import load_peft_weights
+
+import logging
+logger = logging.getLogger(__name__)
+
+# prefix and suffixes of the LoRA weights in a saved peft adapter.
+PEFT_PREFIX = "base_model.model."
+LORA_A_SUFFIX = ".lora_A.weight"
+LORA_B_SUFFIX = ".lora_B.weight"
+
+
+class StackedLoRALinear(nn.Module):
+    """
+    A linear layer with the LoRA adapters of many concepts stacked together.
+
+    Every row of a batch applies its own adapter: the A/B matrices of the
+    rows are gathered by adapter id and applied with a batched matmul, so
+    one forward (and one generate call) serves rows of many concepts.
+    Adapters of lower rank are zero-padded to the largest rank.
+    """
+    def __init__(self, base_layer, lora_A, lora_B, scaling):
+        super().__init__()
+        self.base_layer = base_layer
+        self.lora_A = nn.Parameter(lora_A, requires_grad=False) # n_adapters, rank, in_features
+        self.lora_B = nn.Parameter(lora_B, requires_grad=False) # n_adapters, out_features, rank
+        self.register_buffer("scaling", scaling, persistent=False) # n_adapters
+        self.adapter_ids = None
+
+    def forward(self, x):
+        result = self.base_layer(x)
+        if self.adapter_ids is None:
+            return result
+        lora_A = self.lora_A[self.adapter_ids] # bs, rank, in_features
+        lora_B = self.lora_B[self.adapter_ids] * self.scaling[self.adapter_ids][:, None, None] # bs, out_features, rank
+        delta = torch.bmm(torch.bmm(x.to(lora_A.dtype), lora_A.transpose(1, 2)), lora_B.transpose(1, 2))
+        return result + delta.to(result.dtype)
+
+
+def lora_scaling(config):
+    """The scaling peft applies to the B @ A update of an adapter."""
+    if config.get("use_dora") or config.get("rank_pattern") or config.get("alpha_pattern"):
+        raise ValueError("Only plain LoRA adapters (no DoRA or per-module ranks) can be stacked.")
+    if config.get("use_rslora"):
+        return config["lora_alpha"] / math.sqrt(config["r"])
+    return config["lora_alpha"] / config["r"]
+
+
+class StackedLoRAModel(object):
+    """
+    The LoRA adapters saved in `adapter_dirs`, injected into `model` as
+    `StackedLoRALinear` layers. Adapter i is the one of `adapter_dirs[i]`;
+    select the adapter of every batch row with `set_adapter_ids`, and put
+    the original layers back with `unload`.
+    """
+    def __init__(self, model, adapter_dirs):
+        self.model = model
+        configs, weights = [], []
+        for adapter_dir in adapter_dirs:
+            with open(Path(adapter_dir) / "adapter_config.json") as f:
+                configs.append(json.load(f))
+            weights.append(load_peft_weights(str(adapter_dir), device="cpu"))
+        scaling = torch.tensor([lora_scaling(config) for config in configs])
+        rank = max(config["r"] for config in configs)
+
+        module_names = sorted({
+            key[len(PEFT_PREFIX):-len(LORA_A_SUFFIX)] for adapter_weights in weights
+            for key in adapter_weights if key.endswith(LORA_A_SUFFIX)})
+        self.base_layers = {}
+        for module_name in module_names:
+            base_layer = model.get_submodule(module_name)
+            device, dtype = base_layer.weight.device, base_layer.weight.dtype
+            lora_A = torch.zeros(len(adapter_dirs), rank, base_layer.in_features, dtype=dtype)
+            lora_B = torch.zeros(len(adapter_dirs), base_layer.out_features, rank, dtype=dtype)
+            for i, adapter_weights in enumerate(weights):
+                key = PEFT_PREFIX + module_name
+                if key + LORA_A_SUFFIX in adapter_weights:
+                    adapter_rank = adapter_weights[key + LORA_A_SUFFIX].shape[0]
+                    lora_A[i, :adapter_rank] = adapter_weights[key + LORA_A_SUFFIX]
+                    lora_B[i, :, :adapter_rank] = adapter_weights[key + LORA_B_SUFFIX]
+            parent_name, _, child_name = module_name.rpartition(".")
+            setattr(model.get_submodule(parent_name), child_name, StackedLoRALinear(
+                base_layer, lora_A.to(device), lora_B.to(device), scaling.to(device, dtype)))
+            self.base_layers[module_name] = base_layer
+        logger.warning(f"Stacked {len(adapter_dirs)} LoRA adapters on {len(module_names)} modules")
+
+    def stacked_layers(self):
+        return [self.model.get_submodule(module_name) for module_name in self.base_layers]
+
+    def set_adapter_ids(self, adapter_ids):
+        """Apply adapter `adapter_ids[i]` to row i of the next batches (None: no adapter)."""
+        for layer in self.stacked_layers():
+            layer.adapter_ids = adapter_ids
+
+    def unload(self):
+        """Put the original layers back; returns the model."""
+        for module_name, base_layer in self.base_layers.items():
+            parent_name, _, child_name = module_name.rpartition(".")
+            setattr(self.model.get_submodule(parent_name), child_name, base_layer)
+        self.base_layers = {}
+        return self.model
@@ -21,6 +21,7 @@ class DatasetArgs:
     rotation_freq: Optional[int] = 1_000
     seed: Optional[int] = None
     max_concepts: Optional[int] = None
+    concept_concurrency: Optional[int] = None
     model_name: Optional[str] = None
     steering_model_name: Optional[str] = None
     n_steering_factors: Optional[int] = None
@@ -30,12 +31,15 @@ class DatasetArgs:
     steering_batch_size: Optional[int] = None
     steering_output_length: Optional[int] = None
     steering_num_of_examples: Optional[int] = None
+    steering_factor_search: Optional[bool] = False
+    steering_search_num_of_examples: Optional[int] = None
     steering_intervention_type: Optional[str] = None
     lm_model: Optional[str] = None
     run_name: Optional[str] = None
     use_bf16: Optional[bool] = False
     dataset_category: Optional[str] = "instruction"
     lm_use_cache: Optional[bool] = True
+    lm_batch_dir: Optional[str] = None
     disable_neuronpedia_max_act: Optional[bool] = False
     imbalance_factor: Optional[int] = 100
     overwrite_data_dir: Optional[str] = None
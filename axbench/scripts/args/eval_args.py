@@ -22,6 +22,9 @@ class EvalArgs:
     winrate_split_ratio: Optional[float] = None
     master_data_dir: Optional[str] = None
     prompt_steering_data_dir: Optional[str] = None
+    save_raw_roc_curves: Optional[bool] = None
+    lm_judge_cascade: Optional[bool] = None
+    lm_batch_dir: Optional[str] = None
 
     def __init__(
         self,
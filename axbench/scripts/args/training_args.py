@@ -59,6 +59,7 @@ class ModelParams:
     temperature_start: Optional[float] = 1e-2
     temperature_end: Optional[float] = 1e-7
     use_synergy: Optional[bool] = False
+    concepts_per_step: Optional[int] = 1 # concepts trained together by methods with `train_concepts`
 
 class TrainingArgs:
     def __init__(
@@ -92,7 +93,7 @@ class TrainingArgs:
             'exclude_bos', 'binarize_dataset', 'intervention_type', 'gradient_accumulation_steps',
             'coeff_latent_l1_loss', 'reft_layers', 'reft_positions', 'reft_type', 'lora_layers',
             'lora_components', 'lora_alpha', 'weight_decay', 'temperature_start', 'temperature_end',
-            'train_on_negative', 'use_synergy', 'bow_penalty', 'bow_C'
+            'train_on_negative', 'use_synergy', 'bow_penalty', 'bow_C', 'concepts_per_step'
         ]
         all_params = global_params + hierarchical_params
 
@@ -182,7 +183,8 @@ class TrainingArgs:
         bool_params = ['use_bf16', 'exclude_bos', 'binarize_dataset', 'train_on_negative', 
                        'use_synergy']
         int_params = ['layer', 'batch_size', 'n_epochs', 'topk', 'seed', 'low_rank_dimension', 
-                      'gradient_accumulation_steps', 'lora_alpha', 'max_concepts', 'max_num_of_examples']
+                      'gradient_accumulation_steps', 'lora_alpha', 'max_concepts', 'max_num_of_examples',
+                      'concepts_per_step']
         float_params = [
             'lr', 'coeff_l1_loss_null', 'coeff_l1_loss', 'coeff_l2_loss', 'coeff_norm_loss', 
             'coeff_latent_l1_loss', 'weight_decay', 'temperature_start', 'temperature_end', 
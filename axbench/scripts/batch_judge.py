@@ -0,0 +1,66 @@
+# batch_judge.py: ingest (or fake) results of offline batch LM requests.
+#
+# Language models created with `lm_batch_dir` write their cache misses to sharded
+# requests-*.jsonl files instead of calling the API; units of work (concepts,
+# judged methods) waiting on them are skipped and left pending. Submit these
+# files to the batch API, save the outputs as results-*.jsonl in the same
+# directory, then run
+#     python axbench/scripts/batch_judge.py ingest --batch_dir BATCH_DIR --master_data_dir axbench/data
+# and rerun the job with the same batch dir, which now reads them from the LM
+# cache. Repeat until no new requests are written: requests that depend on
+# earlier completions are only written once those are ingested.
+#
+# For local end-to-end tests, fake the batch outputs with
+#     python axbench/scripts/batch_judge.py fake --batch_dir BATCH_DIR --completion "Rating: 1"
+import argparse
+import json
+from pathlib import Path
+
+from axbench.models.language_models import (
+    BATCH_REQUEST_PREFIX,
+    BATCH_RESULT_PREFIX,
+    ingest_batch_results,
+)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["ingest", "fake"])
+    parser.add_argument("--batch_dir", type=str, required=True, help="Directory of the batch request files")
+    parser.add_argument("--master_data_dir", type=str, default="axbench/data", help="Directory holding persist_lm_cache")
+    parser.add_argument("--results", type=str, nargs="*", default=None, help="Result files to ingest (default: results-*.jsonl)")
+    parser.add_argument("--completion", type=str, default="Rating: 1", help="Completion returned by fake results")
+    return parser.parse_args()
+
+
+def fake_batch_results(batch_dir, completion):
+    """Write one results-*.jsonl file per request shard, answering every request with `completion`."""
+    n_results = 0
+    for request_path in sorted(Path(batch_dir).glob(f"{BATCH_REQUEST_PREFIX}-*.jsonl")):
+        result_path = request_path.with_name(
+            request_path.name.replace(BATCH_REQUEST_PREFIX, BATCH_RESULT_PREFIX, 1))
+        with open(request_path) as f_request, open(result_path, "w") as f_result:
+            for line in f_request:
+                request = json.loads(line)
+                f_result.write(json.dumps({
+                    "id": f"batch_req_{n_results}",
+                    "custom_id": request["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "body": {
+                            "model": request["body"]["model"],
+                            "choices": [{"index": 0, "message": {"role": "assistant", "content": completion}}],
+                        },
+                    },
+                    "error": None,
+                }) + "\n")
+                n_results += 1
+    return n_results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "fake":
+        print(f"Faked {fake_batch_results(args.batch_dir, args.completion)} batch results.")
+    else:
+        print(f"Ingested {ingest_batch_results(args.batch_dir, args.master_data_dir, args.results)} batch results.")
@@ -5,7 +5,8 @@
 
 import shutil
 from axbench.models.language_models import (
-    LanguageModel
+    LanguageModel,
+    BatchRequestsPending,
 )
 
 import os, argparse, yaml, json, glob, pickle, tempfile, copy
@@ -21,6 +22,8 @@ import httpx, asyncio
 import datetime
 import yaml
 from axbench.scripts.inference import LATENT_EXCLUDE_MODELS, STEERING_EXCLUDE_MODELS
+from axbench.utils.ledger import ProgressLedger, PROGRESS_LEDGER_FILE, content_checksum
+from axbench.utils.profiler import start_profiling, stop_profiling
 import axbench
 from axbench.utils.plot_utils import (
     plot_aggregated_roc, 
@@ -32,6 +35,18 @@ from axbench.templates.html_templates import (
     generate_html_with_highlight_text,
 )
 from axbench.scripts.args.eval_args import EvalArgs
+from axbench.evaluators.winrate import (
+    compute_win_results,
+    empty_ratings_table,
+    pair_with_baseline,
+    summarize_win_results,
+)
+from axbench.evaluators.latent_metrics import (
+    FUSED_LATENT_EVALUATORS, 
+    ROC_RECORD_DTYPE,
+    compute_latent_metrics,
+    interpolate_roc,
+)
 from functools import partial
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import multiprocessing
@@ -43,7 +58,9 @@ logging.basicConfig(format='%(asctime)s,%(msecs)03d %(levelname)-8s [%(filename)
     level=logging.WARN)
 logger = logging.getLogger(__name__)
 
-STATE_FILE = "evaluate_state.pkl"
+ROC_CURVES_FILE = "roc_curves.bin"
+ROC_RAW_CURVES_FILE = "roc_raw_curves.bin"
+WINRATE_RATINGS_FILE = "winrate_ratings.parquet"
 
 
 def data_generator(data_dir, mode, winrate_split_ratio=None):
@@ -86,6 +103,17 @@ def data_generator(data_dir, mode, winrate_split_ratio=None):
         yield (concept_id, df_subset)
 
 
+def steered_rows(current_df, model_name):
+    """
+    Keep the rows steered by `model_name`. With adaptive steering-factor search,
+    inference only generates for the searched factor and leaves other rows empty.
+    """
+    column = f"{model_name}_steered_generation"
+    if column not in current_df.columns:
+        return current_df
+    return current_df[current_df[column].notna()]
+
+
 def get_best_factors(aggregated_results):
     best_factors = {}
     for result in aggregated_results:
@@ -116,25 +144,64 @@ def winrate_data_generator(data_dir, aggregated_results, winrate_split_ratio):
         yield (concept_id, concept_best_df)
 
 
-def save_results(dump_dir, state, concept_id, partition, eval_results, eval_df=None):
+def evaluate_stage(partition, evaluator_name):
+    return f"evaluate_{partition}_{evaluator_name}"
+
+
+def record_results(ledger, partition, concept_id, eval_results):
+    """Record every (evaluator, method) result of a concept in the progress ledger."""
+    ledger.record_many([
+        {"stage": evaluate_stage(partition, evaluator_name), "concept_id": int(concept_id),
+         "method": model_name, "checksum": content_checksum(result)}
+        for evaluator_name, model_results in eval_results.items()
+        for model_name, result in model_results.items()])
+
+
+def migrate_state(ledger, dump_dir, partition):
+    """
+    Record the results already in `{partition}.jsonl` of a run started before
+    the ledger existed; results are only written once complete.
+    """
+    result_path = Path(dump_dir) / "evaluate" / f"{partition}.jsonl"
+    if not result_path.exists():
+        return
+    results = load_latest_results(result_path)
+    stages = {
+        evaluate_stage(partition, evaluator_name)
+        for result in results for evaluator_name in result["results"]}
+    if len(ledger.entries(stages)) > 0:
+        return
+    ledger.record_many([
+        {"stage": evaluate_stage(partition, evaluator_name), "concept_id": int(result["concept_id"]),
+         "method": model_name, "checksum": None, "migrated": True}
+        for result in results
+        for evaluator_name, model_results in result["results"].items()
+        for model_name in model_results])
+
+
+def merge_results(previous_results, eval_results):
+    """Merge new {evaluator: {method: result}} results into the previous ones of a concept."""
+    merged_results = copy.deepcopy(previous_results)
+    for evaluator_name, model_results in eval_results.items():
+        merged_results.setdefault(evaluator_name, {}).update(model_results)
+    return merged_results
+
+
+def save_results(dump_dir, concept_id, partition, eval_results, eval_df=None, previous_results=None):
     """
     Save the results dictionary to a .jsonl file.
-    Each line in the file represents one concept_id's evaluation results.
+    Each line in the file represents one concept_id's evaluation results,
+    merged with its `previous_results`; readers keep the latest line.
     """
     # handle training df first
     dump_dir = Path(dump_dir) / "evaluate"
     dump_dir.mkdir(parents=True, exist_ok=True)
     
-    # Save state
-    state_path = os.path.join(dump_dir, f"{partition}_{STATE_FILE}")
-    with open(state_path, "wb") as f:
-        pickle.dump(state, f)
-    
     # Define the output file path for JSON Lines
     result_path = Path(dump_dir) / f"{partition}.jsonl"
     result_entry = {
         "concept_id": int(concept_id),
-        "results": eval_results
+        "results": merge_results(previous_results or {}, eval_results)
     }
     with open(result_path, "a") as f:
         f.write(json.dumps(result_entry) + "\n")
@@ -146,10 +213,15 @@ def save_results(dump_dir, state, concept_id, partition, eval_results, eval_df=N
         if len(sorted_evaluator_names) == 0:
             return
         current_df = eval_df[sorted_evaluator_names[0]][sorted_model_names[0]].copy()
+        # methods may be evaluated on different rows, e.g. with adaptive factor search.
+        for model_name in sorted_model_names[1:]:
+            model_df = eval_df[sorted_evaluator_names[0]][model_name]
+            current_df = pd.concat([current_df, model_df.loc[model_df.index.difference(current_df.index)]])
         for evaluator_name in sorted_evaluator_names:
             if evaluator_name == "PerplexityEvaluator":
                 continue
-            for model_name in sorted_model_names:
+            # evaluators may have different pending methods on resume.
+            for model_name in sorted(eval_df[evaluator_name].keys()):
                 if evaluator_name == sorted_evaluator_names[0] and model_name == sorted_model_names[0]:
                     continue
                 current_df[f"{model_name}_{evaluator_name}"] = eval_df[evaluator_name][model_name][f"{model_name}_{evaluator_name}"]
@@ -172,34 +244,32 @@ def save_results(dump_dir, state, concept_id, partition, eval_results, eval_df=N
         df_path = os.path.join(dump_dir, f"{partition}_data.parquet")
         if os.path.exists(df_path):
             existing_df = pd.read_parquet(df_path)
+            # rows of a concept evaluated before gain the columns of the new methods.
+            concept_rows = existing_df["concept_id"] == concept_id
+            keys = ["concept_id", "input_id", "factor"]
+            if concept_rows.any() and all(key in current_df for key in keys) and \
+                not current_df.duplicated(keys).any() and not existing_df[concept_rows].duplicated(keys).any():
+                current_df = current_df.set_index(keys).combine_first(
+                    existing_df[concept_rows].set_index(keys)).reset_index()
+                existing_df = existing_df[~concept_rows]
             combined_df = pd.concat([existing_df, current_df], ignore_index=True)
         else:
             combined_df = current_df
         combined_df.to_parquet(df_path, index=False)
 
 
-def load_state(dump_dir, mode):
-    """
-    Load the state from a file if it exists.
-    
-    Args:
-        dump_dir (str): The directory to load the state file from.
-    
-    Returns:
-        dict: The loaded state dictionary, or None if no state file exists.
-    """
-    state_path = os.path.join(f"{dump_dir}/evaluate", f"{mode}_{STATE_FILE}")
-    if os.path.exists(state_path):
-        with open(state_path, "rb") as f:
-            return pickle.load(f)
-    return None
-
-
 def combine_scores_per_concept(concept_data):
     """Combine scores from concept and following evaluators for each method."""
     return concept_data["results"]["LMJudgeEvaluator"]
 
 
+def load_latest_results(jsonl_path):
+    """Results of `{partition}.jsonl` sorted by concept_id, keeping the latest line of every concept."""
+    return sorted({
+        result["concept_id"]: result for result in load_jsonl(jsonl_path)
+    }.values(), key=lambda result: result["concept_id"])
+
+
 def process_jsonl_file(jsonl_lines):
     for data in jsonl_lines:
         data["results"]["LMJudgeEvaluator"] = \
@@ -259,12 +329,8 @@ def plot_steering(aggregated_results, dump_dir, report_to=[], wandb_name=None, m
         logger.warning(f"Failed to plot: {e}")
 
 
-def eval_steering_single_task(args_tuple):
-    """Helper function to evaluate a single concept-model-evaluator combination"""
-    concept_id, current_df, evaluator_name, model_name, dump_dir, \
-        lm_model, winrate_baseline, lm_caches = args_tuple
-    
-    # Create LanguageModel instance within the worker process
+def create_judge_model(lm_model, dump_dir, lm_batch_dir=None):
+    """Create the judge LanguageModel (and its client) within a worker process."""
     client = AsyncOpenAI(
         api_key=os.environ.get("OPENAI_API_KEY"),
         timeout=60.0,
@@ -285,8 +351,19 @@ def eval_steering_single_task(args_tuple):
         cache_level="prompt",
         cache_tag="evaluate",
         master_data_dir="axbench/data",
-        temperature=0.7
+        temperature=0.7,
+        batch_dir=lm_batch_dir,
     )
+    return client, lm_model
+
+
+def eval_steering_single_task(args_tuple):
+    """Helper function to evaluate a single concept-model-evaluator combination"""
+    concept_id, current_df, evaluator_name, model_name, dump_dir, \
+        lm_model, winrate_baseline, lm_caches, lm_judge_cascade, lm_batch_dir = args_tuple
+    
+    # Create LanguageModel instance within the worker process
+    client, lm_model = create_judge_model(lm_model, dump_dir, lm_batch_dir)
     # overwrite cache if any.
     if bool(lm_caches):
         lm_model.cache_in_mem = lm_caches
@@ -295,8 +372,14 @@ def eval_steering_single_task(args_tuple):
         evaluator_class = getattr(axbench, evaluator_name)
         evaluator = evaluator_class(
             model_name, dump_dir=dump_dir, 
-            concept_id=concept_id, lm_model=lm_model, winrate_baseline=winrate_baseline)
-        eval_result = evaluator.compute_metrics(current_df)
+            concept_id=concept_id, lm_model=lm_model, winrate_baseline=winrate_baseline,
+            lm_judge_cascade=lm_judge_cascade)
+        try:
+            eval_result = evaluator.compute_metrics(current_df)
+        except BatchRequestsPending as e:
+            # the unit is evaluated once the batch results are ingested.
+            logger.warning(f"Deferring {evaluator} of {model_name} for concept_id {concept_id}: {e}")
+            eval_result = None
         return (concept_id, evaluator.__str__(), model_name.__str__(), eval_result, \
                 lm_model.stats.get_report(), None if bool(lm_caches) else lm_model.cache_in_mem, current_df)
     finally:
@@ -306,6 +389,42 @@ def eval_steering_single_task(args_tuple):
         asyncio.run(cleanup())
 
 
+def rate_winrate_single_task(args_tuple):
+    """Helper function to add a single concept-method combination to the win rate ratings table"""
+    concept_id, current_df, model_name, dump_dir, lm_model, winrate_baseline, ratings, lm_batch_dir = args_tuple
+
+    client, lm_model = create_judge_model(lm_model, dump_dir, lm_batch_dir)
+    try:
+        evaluator = axbench.WinRateEvaluator(
+            model_name, dump_dir=dump_dir, concept_id=concept_id, lm_model=lm_model,
+            winrate_baseline=winrate_baseline, ratings=ratings)
+        try:
+            new_ratings = evaluator.rate(current_df, model_name)
+        except BatchRequestsPending as e:
+            logger.warning(f"Deferring win rate ratings of {model_name} for concept_id {concept_id}: {e}")
+            new_ratings = None
+        return (concept_id, model_name, new_ratings, lm_model.stats.get_report())
+    finally:
+        async def cleanup():
+            await client.close()
+        asyncio.run(cleanup())
+
+
+def load_winrate_ratings(dump_dir):
+    ratings_path = Path(dump_dir) / "evaluate" / WINRATE_RATINGS_FILE
+    if ratings_path.exists():
+        return pd.read_parquet(ratings_path)
+    return empty_ratings_table()
+
+
+def save_winrate_ratings(dump_dir, ratings):
+    ratings_path = Path(dump_dir) / "evaluate" / WINRATE_RATINGS_FILE
+    ratings_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = ratings_path.with_suffix(".tmp")
+    ratings.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, ratings_path)
+
+
 def eval_steering(args):
     """
     Evaluate steering performance using multi-processing for all tasks
@@ -318,22 +437,47 @@ def eval_steering(args):
         args.data_dir, mode=args.mode, 
         winrate_split_ratio=args.winrate_split_ratio)
 
-    # Load previous state if exists
-    state = load_state(args.dump_dir, mode=args.mode)
-    start_concept_id = state.get("concept_id", 0) if state else 0
-    logger.warning(f"Starting concept_id: {start_concept_id}")
+    # Only (concept, evaluator, method) units missing from the progress ledger are evaluated.
+    ledger = ProgressLedger(Path(dump_dir) / PROGRESS_LEDGER_FILE)
+    migrate_state(ledger, dump_dir, args.mode)
+    steering_models = [model_name for model_name in args.models if model_name not in STEERING_EXCLUDE_MODELS]
+    concept_dfs = list(df_generator)
+    concept_ids = [concept_id for concept_id, _ in concept_dfs]
+    pending = {
+        evaluator_name: ledger.pending(evaluate_stage(args.mode, evaluator_name), concept_ids, steering_models)
+        for evaluator_name in args.steering_evaluators}
+    concept_dfs = [
+        (concept_id, current_df) for concept_id, current_df in concept_dfs
+        if any(int(concept_id) in pending_methods for pending_methods in pending.values())
+    ]
+    logger.warning(f"{len(concept_ids) - len(concept_dfs)} concepts are already evaluated, "
+                   f"{len(concept_dfs)} concepts to go.")
 
     # Create all evaluation tasks - flattened for maximum parallelization
     all_tasks = [
-        (concept_id, current_df, evaluator_name, model_name, args.dump_dir, \
-         args.lm_model, args.winrate_baseline, {})
-        for concept_id, current_df in df_generator
-        if concept_id >= start_concept_id
+        (concept_id, steered_rows(current_df, model_name), evaluator_name, model_name, args.dump_dir, \
+         args.lm_model, args.winrate_baseline, {}, args.lm_judge_cascade, args.lm_batch_dir)
+        for concept_id, current_df in concept_dfs
         for evaluator_name in args.steering_evaluators
-        for model_name in args.models
-        if model_name not in STEERING_EXCLUDE_MODELS
+        if evaluator_name != "WinRateEvaluator"
+        for model_name in pending[evaluator_name].get(int(concept_id), [])
     ]
 
+    # Win rates are joined from a shared ratings table, so every method
+    # (including the baseline) is only rated once per generation.
+    run_winrate = "WinRateEvaluator" in args.steering_evaluators
+    if run_winrate:
+        winrate_baseline = args.winrate_baseline if args.winrate_baseline else "PromptSteering"
+        ratings = load_winrate_ratings(dump_dir)
+        winrate_pending = pending["WinRateEvaluator"]
+        rating_tasks = [
+            (concept_id, steered_rows(current_df, model_name), model_name, args.dump_dir, \
+             args.lm_model, winrate_baseline, ratings[ratings["concept_id"] == concept_id], args.lm_batch_dir)
+            for concept_id, current_df in concept_dfs
+            if int(concept_id) in winrate_pending
+            for model_name in dict.fromkeys(winrate_pending[int(concept_id)] + [winrate_baseline])
+        ]
+
     # Group results by concept_id
     all_results = {}
     
@@ -344,9 +488,16 @@ def eval_steering(args):
     lm_reports = []
     eval_dfs = {}
     lm_caches = {}
+    # units waiting on batch requests are neither saved nor recorded, so a rerun picks them up.
+    n_deferred = 0
+    unrated = set()
     with ProcessPoolExecutor(max_workers=args.num_of_workers) as executor:
         for concept_id, evaluator_str, model_str, result, lm_report, lm_cache, current_df in executor.map(
             eval_steering_single_task, all_tasks):
+            lm_reports += [lm_report]
+            if result is None:
+                n_deferred += 1
+                continue
             if concept_id not in all_results:
                 all_results[concept_id] = {}
                 eval_dfs[concept_id] = {}
@@ -366,25 +517,63 @@ def eval_steering(args):
                 current_df[f"{model_str}_{evaluator_str}_relevance_instruction_completions"] = result["relevance_instruction_completions"]
                 current_df[f"{model_str}_{evaluator_str}_fluency_completions"] = result["fluency_completions"]
                 eval_dfs[concept_id][evaluator_str][model_str] = current_df.copy()
-            lm_reports += [lm_report]
             lm_caches.update(lm_cache)
             logger.warning(f"Completed task for concept_id: {concept_id}, model: {model_str}, evaluator: {evaluator_str}")
-
-    # Batch save all results
+        if run_winrate:
+            all_ratings = [ratings]
+            for concept_id, model_str, new_ratings, lm_report in executor.map(
+                rate_winrate_single_task, rating_tasks):
+                lm_reports += [lm_report]
+                if new_ratings is None:
+                    unrated.add((int(concept_id), model_str))
+                    continue
+                all_ratings += [new_ratings]
+                logger.warning(f"Completed ratings for concept_id: {concept_id}, model: {model_str}")
+            ratings = pd.concat(all_ratings, ignore_index=True)
+            save_winrate_ratings(dump_dir, ratings)
+
+    if run_winrate:
+        for concept_id, current_df in concept_dfs:
+            for model_name in winrate_pending.get(int(concept_id), []):
+                if {(int(concept_id), model_name), (int(concept_id), winrate_baseline)} & unrated:
+                    n_deferred += 1
+                    continue
+                # methods searched to different factors are compared on the same inputs.
+                pair_df = pair_with_baseline(current_df, model_name, winrate_baseline)
+                if len(pair_df) == 0:
+                    logger.warning(
+                        f"No generations of {model_name} and {winrate_baseline} to compare for "
+                        f"concept_id: {concept_id}; recording a NaN win rate.")
+                    winning_results = []
+                else:
+                    winning_results = compute_win_results(pair_df, ratings, model_name, winrate_baseline)
+                all_results.setdefault(concept_id, {}).setdefault("WinRateEvaluator", {})[model_name] = \
+                    summarize_win_results(winning_results, winrate_baseline)
+
+    if n_deferred > 0:
+        logger.warning(
+            f"{n_deferred} evaluations are waiting on batch requests in {args.lm_batch_dir}; "
+            f"rerun after ingesting their results.")
+
+    # Batch save all results, merged with the earlier results of each concept
+    result_path = Path(dump_dir) / "evaluate" / f"{args.mode}.jsonl"
+    previous_results = {
+        result["concept_id"]: result["results"] for result in load_latest_results(result_path)
+    } if result_path.exists() else {}
     for concept_id, eval_results in sorted(all_results.items()):
         save_results(
             dump_dir, 
-            {"concept_id": concept_id + 1}, 
             concept_id, 
             args.mode, 
             eval_results, 
-            eval_dfs[concept_id]
+            eval_dfs.get(concept_id),
+            previous_results.get(int(concept_id), {}),
         )
+        record_results(ledger, args.mode, concept_id, eval_results)
         
     # Reload for plotting and optional winrate
     try:
-        aggregated_results = process_jsonl_file(
-            load_jsonl(os.path.join(Path(dump_dir) / "evaluate" / f'{args.mode}.jsonl')))
+        aggregated_results = process_jsonl_file(load_latest_results(result_path))
     except Exception as e:
         logger.warning(f"Failed to load {args.mode}.jsonl: {e}. Aborting evaluation.")
         return
@@ -419,17 +608,120 @@ def load_jsonl(jsonl_path):
     return jsonl_data
     
 
+def build_roc_records(roc_curves, save_raw_roc_curves=False):
+    """
+    Pack (concept_id, method, roc_auc, fpr, tpr) curves into fixed-size ROC records with the
+    TPR interpolated on the common grid. Raw offsets are relative to the returned raw curves.
+    """
+    records = np.zeros(len(roc_curves), dtype=ROC_RECORD_DTYPE)
+    raw_curves = []
+    raw_offset = 0
+    for i, (concept_id, method, roc_auc, fpr, tpr) in enumerate(roc_curves):
+        records["concept_id"][i] = concept_id
+        records["method"][i] = method.encode()
+        records["roc_auc"][i] = roc_auc
+        records["tpr"][i] = interpolate_roc(fpr, tpr)
+        if save_raw_roc_curves:
+            records["raw_offset"][i] = raw_offset
+            records["raw_length"][i] = len(fpr)
+            raw_curves += [np.asarray(fpr, dtype=np.float64), np.asarray(tpr, dtype=np.float64)]
+            raw_offset += 2 * len(fpr)
+        else:
+            records["raw_offset"][i] = -1
+    return records, raw_curves
+
+
+def append_roc_records(dump_dir, partition, records, raw_curves):
+    """Append ROC records (and their raw curves, if any) to the binary sidecars of `{partition}.jsonl`."""
+    dump_dir = Path(dump_dir) / "evaluate"
+    if len(raw_curves) > 0:
+        raw_path = dump_dir / f"{partition}_{ROC_RAW_CURVES_FILE}"
+        base_offset = os.path.getsize(raw_path) // np.dtype(np.float64).itemsize if raw_path.exists() else 0
+        records = records.copy()
+        records["raw_offset"][records["raw_offset"] >= 0] += base_offset
+        with open(raw_path, "ab") as f:
+            np.concatenate(raw_curves).tofile(f)
+    with open(dump_dir / f"{partition}_{ROC_CURVES_FILE}", "ab") as f:
+        records.tofile(f)
+
+
+def load_roc_curves(dump_dir, partition="latent"):
+    """Memory-map the ROC records of `{partition}.jsonl`, or None if there are none."""
+    roc_path = Path(dump_dir) / "evaluate" / f"{partition}_{ROC_CURVES_FILE}"
+    if not roc_path.exists() or os.path.getsize(roc_path) == 0:
+        return None
+    return np.memmap(roc_path, dtype=ROC_RECORD_DTYPE, mode="r")
+
+
+def load_raw_roc_curve(dump_dir, record, partition="latent"):
+    """Read the raw (fpr, tpr) curve of a single ROC record, if it was saved."""
+    if record["raw_offset"] < 0:
+        return None
+    raw = np.memmap(
+        Path(dump_dir) / "evaluate" / f"{partition}_{ROC_RAW_CURVES_FILE}", dtype=np.float64, mode="r",
+        offset=int(record["raw_offset"]) * np.dtype(np.float64).itemsize, shape=(2 * int(record["raw_length"]),))
+    return np.array(raw[:record["raw_length"]]), np.array(raw[record["raw_length"]:])
+
+
 def plot_latent(dump_dir, report_to=[], wandb_name=None):
+    roc_curves = load_roc_curves(dump_dir, "latent")
     dump_dir = Path(dump_dir) / "evaluate"
-    # aggregate all results
-    aggregated_results = load_jsonl(os.path.join(dump_dir, 'latent.jsonl'))
+    # aggregate all results, keeping the latest entry of a concept that was re-evaluated on resume
+    aggregated_results = load_latest_results(os.path.join(dump_dir, 'latent.jsonl'))
     plot_aggregated_roc(
-        aggregated_results, write_to_path=dump_dir, report_to=report_to, wandb_name=wandb_name)
+        aggregated_results, write_to_path=dump_dir, report_to=report_to, wandb_name=wandb_name,
+        roc_curves=roc_curves)
     plot_accuracy_bars(
         aggregated_results, "HardNegativeEvaluator", write_to_path=dump_dir, 
         report_to=report_to, wandb_name=wandb_name)
 
 
+def eval_latent_shard(args_tuple):
+    """Evaluate a shard of concepts, reading only their rows from the latent parquet."""
+    latent_data_path, concept_ids, model_names, evaluator_names, save_raw_roc_curves = args_tuple
+    columns = None
+    if all(evaluator_name in FUSED_LATENT_EVALUATORS for evaluator_name in evaluator_names):
+        columns = ["concept_id", "category"] + [f"{model_name}_max_act" for model_name in model_names]
+    shard_df = pd.read_parquet(
+        latent_data_path, columns=columns, filters=[("concept_id", "in", list(concept_ids))])
+
+    # Fused evaluators are computed for the whole shard with one grouped sort per method.
+    fused_evaluators = [
+        evaluator_name for evaluator_name in evaluator_names
+        if evaluator_name in FUSED_LATENT_EVALUATORS]
+    fused_results = {}
+    if len(fused_evaluators) > 0:
+        for model_name in model_names:
+            fused_results[model_name] = compute_latent_metrics(
+                shard_df, model_name, evaluator_names=fused_evaluators)
+
+    shard_results = []
+    roc_curves = []
+    for concept_id, current_df in shard_df.groupby("concept_id"):
+        # Initialize a dictionary for storing evaluation results for this `concept_id`
+        eval_results = {}
+        for model_name in model_names:
+            for evaluator_name in evaluator_names:
+                if evaluator_name in FUSED_LATENT_EVALUATORS:
+                    eval_result = fused_results[model_name][concept_id][evaluator_name]
+                else:
+                    evaluator_class = getattr(axbench, evaluator_name)
+                    evaluator = evaluator_class(model_name)
+                    # Call each evaluator and store results
+                    eval_result = evaluator.compute_metrics(current_df)
+                if evaluator_name not in eval_results:
+                    eval_results[evaluator_name] = {}
+                eval_results[evaluator_name][model_name] = eval_result
+        # ROC curves go to the binary sidecar; latent.jsonl only keeps the scalars.
+        for model_name, eval_result in eval_results.get("AUCROCEvaluator", {}).items():
+            roc_curve = eval_result.pop("roc_curve", None)
+            if roc_curve is not None:
+                roc_curves.append((
+                    int(concept_id), model_name, eval_result["roc_auc"], roc_curve["fpr"], roc_curve["tpr"]))
+        shard_results.append((int(concept_id), eval_results))
+    return shard_results, build_roc_records(roc_curves, save_raw_roc_curves)
+
+
 def eval_latent(args):
 
     data_dir = args.data_dir
@@ -438,33 +730,63 @@ def eval_latent(args):
     if not os.path.exists(latent_data_path):
         logger.warning(f"Latent data not found at {latent_data_path}")
         return
-    df_generator = data_generator(args.data_dir, mode="latent")
 
-    state = load_state(args.dump_dir, mode="latent")
-    start_concept_id = state.get("concept_id", 0) if state else 0
-    logger.warning(f"Starting concept_id: {start_concept_id}")
-
-    for concept_id, current_df in df_generator:
-        if concept_id < start_concept_id:
-            continue
-        logger.warning(f"Evaluating concept_id: {concept_id}")
-        
-        # Initialize a dictionary for storing evaluation results for this `concept_id`
-        eval_results = {}
-        for model_name in args.models:
-            if model_name in LATENT_EXCLUDE_MODELS:
-                continue
-            for evaluator_name in args.latent_evaluators:
-                evaluator_class = getattr(axbench, evaluator_name)
-                evaluator = evaluator_class(model_name)
-                # Call each evaluator and store results
-                eval_result = evaluator.compute_metrics(current_df)
-                if evaluator.__str__() not in eval_results:
-                    eval_results[evaluator.__str__()] = {}
-                eval_results[evaluator.__str__()][model_name.__str__()] = eval_result
-        save_results(
-            dump_dir, {"concept_id": concept_id + 1}, 
-            concept_id, 'latent', eval_results, None)
+    # Only (concept, evaluator, method) units missing from the progress ledger are evaluated.
+    ledger = ProgressLedger(Path(dump_dir) / PROGRESS_LEDGER_FILE)
+    migrate_state(ledger, dump_dir, "latent")
+    concept_ids = sorted(pd.read_parquet(latent_data_path, columns=["concept_id"])["concept_id"].unique())
+    model_names = [model_name for model_name in args.models if model_name not in LATENT_EXCLUDE_MODELS]
+    pending = {
+        evaluator_name: ledger.pending(evaluate_stage("latent", evaluator_name), concept_ids, model_names)
+        for evaluator_name in args.latent_evaluators}
+    # concepts missing the same units are evaluated together.
+    pending_groups = {}
+    for concept_id in concept_ids:
+        pending_units = tuple(
+            (evaluator_name, model_name) for evaluator_name in args.latent_evaluators
+            for model_name in pending[evaluator_name].get(int(concept_id), []))
+        if len(pending_units) > 0:
+            pending_groups.setdefault(pending_units, []).append(int(concept_id))
+    n_pending = sum(len(group) for group in pending_groups.values())
+    logger.warning(f"{len(concept_ids) - n_pending} concepts are already evaluated, "
+                   f"{n_pending} concepts to go.")
+
+    if n_pending > 0:
+        if not hasattr(args, 'num_of_workers') or args.num_of_workers is None:
+            args.num_of_workers = max(1, multiprocessing.cpu_count() - 1)
+        logger.warning(f"Number of workers: {args.num_of_workers}; Number of CPUs: {multiprocessing.cpu_count()}")
+
+        # Shard concepts so every worker gets a few contiguous slices.
+        shard_size = max(1, int(np.ceil(n_pending / (args.num_of_workers * 4))))
+        shards = []
+        for pending_units, pending_concept_ids in pending_groups.items():
+            # a group evaluates the pending methods with every pending evaluator.
+            group_evaluators = list(dict.fromkeys(evaluator_name for evaluator_name, _ in pending_units))
+            group_models = list(dict.fromkeys(model_name for _, model_name in pending_units))
+            shards += [
+                (latent_data_path, pending_concept_ids[i:i+shard_size], group_models, group_evaluators,
+                 bool(getattr(args, "save_raw_roc_curves", False)))
+                for i in range(0, len(pending_concept_ids), shard_size)
+            ]
+
+        result_path = Path(dump_dir) / "evaluate" / "latent.jsonl"
+        result_path.parent.mkdir(parents=True, exist_ok=True)
+        previous_results = {
+            result["concept_id"]: result["results"] for result in load_latest_results(result_path)
+        } if result_path.exists() else {}
+        with ProcessPoolExecutor(max_workers=args.num_of_workers) as executor:
+            # Results are streamed in concept order; a concept is only recorded in the
+            # ledger once its results are appended to latent.jsonl.
+            for shard_results, (roc_records, raw_roc_curves) in executor.map(eval_latent_shard, shards):
+                append_roc_records(dump_dir, "latent", roc_records, raw_roc_curves)
+                with open(result_path, "a") as f:
+                    for concept_id, eval_results in shard_results:
+                        f.write(json.dumps({
+                            "concept_id": concept_id,
+                            "results": merge_results(previous_results.get(concept_id, {}), eval_results)}) + "\n")
+                for concept_id, eval_results in shard_results:
+                    record_results(ledger, "latent", concept_id, eval_results)
+                logger.warning(f"Evaluated concept_ids: {shard_results[0][0]} - {shard_results[-1][0]}")
 
     # Generate final plot
     logger.warning("Generating final plot...")
@@ -506,6 +828,7 @@ def main():
             additional_args = yaml.safe_load(file)
             run.summary.update(additional_args)
 
+    start_profiling(args.dump_dir, f"evaluate_{args.mode}")
     if args.mode == "latent":
         eval_latent(args)
     elif "steering" in args.mode: # steering or steering_test
@@ -513,6 +836,7 @@ def main():
     elif args.mode == "all":
         eval_latent(args)
         eval_steering(args)
+    stop_profiling()
 
     if args.report_to is not None and "wandb" in args.report_to:
         # log more metadata into wandb for visualization
@@ -524,7 +848,8 @@ def main():
         concepts = []
         if (Path(args.dump_dir) / "evaluate" / "latent.jsonl").is_file():
             latent_path = Path(args.dump_dir) / "evaluate" / "latent.jsonl"
-            latent_results = load_jsonl(latent_path)
+            # latent.jsonl is append-only, so resumed runs may be out of concept order.
+            latent_results = load_latest_results(latent_path)
             lsreft_included = "LsReFT" in latent_results[0]["results"]["AUCROCEvaluator"]
             top_logits_path = Path(args.dump_dir) / "inference" / "top_logits.jsonl"
             top_logits_results = load_jsonl(top_logits_path) if os.path.exists(top_logits_path) else None
@@ -559,7 +884,7 @@ def main():
 
         if (Path(args.dump_dir) / "evaluate" / "steering.jsonl").is_file():
             steering_path = Path(args.dump_dir) / "evaluate" / "steering.jsonl"
-            steering_results = load_jsonl(steering_path)
+            steering_results = load_latest_results(steering_path)
             best_factors = get_best_factors(steering_results)
             lsreft_included = "LsReFT" in steering_results[0]["results"]["WinRateEvaluator"]
 
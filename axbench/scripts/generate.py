@@ -16,12 +16,17 @@ import random
 import json
 import csv
 import atexit
+import collections
 import torch
 
+import numpy as np
 import pandas as pd
 from tqdm.auto import tqdm
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from axbench.utils.dataset import DatasetFactory
+from axbench.models.language_models import BatchRequestsPending
+from axbench.utils.ledger import ProgressLedger, PROGRESS_LEDGER_FILE, content_checksum
+from axbench.utils.profiler import start_profiling, stop_profiling
 from args.dataset_args import DatasetArgs
 from pathlib import Path
 from openai import AsyncOpenAI
@@ -142,17 +147,13 @@ def load_metadata_flatten(metadata_path):
 
 
 def save(
-    dump_dir, state, concept_id, 
+    dump_dir, ledger, concept_id, 
     concept, concept_genres_map, 
     ref, partition, current_df, dataset_factory):
     """
-    Save the current state, metadata, and DataFrame using Parquet format.
+    Save the metadata and DataFrame using Parquet format, then record the
+    concept as generated in the progress ledger.
     """    
-    # Save state
-    state_path = os.path.join(dump_dir, STATE_FILE)
-    with open(state_path, "wb") as f:
-        pickle.dump(state, f)
-    
     # Save metadata
     metadata_path = os.path.join(dump_dir, METADATA_FILE)
     metadata_entry = {
@@ -173,19 +174,23 @@ def save(
         df_path = os.path.join(dump_dir, f"{partition}_data_{file_index}.parquet")
     if os.path.exists(df_path):
         existing_df = pd.read_parquet(df_path)
+        # drop rows of an earlier attempt that crashed before being recorded.
+        existing_df = existing_df[existing_df["concept_id"] != concept_id]
         combined_df = pd.concat([existing_df, current_df], ignore_index=True)
     else:
-        # first time cache, we need to add global negative examples.
-        if concept_id == 0:
+        # first time cache, we need to add global negative examples. Concepts waiting on
+        # batch requests are saved later, so this may be any concept of the first file.
+        if file_index == 0:
             combined_df = pd.concat([dataset_factory.negative_df, current_df], ignore_index=True)
         else:
             combined_df = current_df
     save_df_to_parquet_safely(combined_df, df_path)
+    ledger.record("generate", concept_id, checksum=content_checksum(current_df))
 
 
 def load_state(dump_dir):
     """
-    Load the state from a file if it exists.
+    Load the legacy state from a file if it exists.
     
     Args:
         dump_dir (str): The directory to load the state file from.
@@ -203,7 +208,7 @@ def load_state(dump_dir):
 
 def load_state_latent(dump_dir, mode):
     """
-    Load the state from a file if it exists.
+    Load the legacy state from a file if it exists.
     """
     state_path = os.path.join(f"{dump_dir}/inference", f"{mode}_{STATE_FILE}")
     if os.path.exists(state_path):
@@ -213,20 +218,25 @@ def load_state_latent(dump_dir, mode):
 
 
 def create_data_latent(dataset_factory, metadata, concept_id, num_of_examples, args):
+    return asyncio.run(acreate_data_latent(dataset_factory, metadata, concept_id, num_of_examples, args))
+
+
+async def acreate_data_latent(
+    dataset_factory, metadata, concept_id, num_of_examples, args, api_tag="inference", rng=None):
     # prepare concept related data.
     concept = metadata[concept_id]["concept"]
     sae_link = metadata[concept_id]["ref"]
     sae_id = int(sae_link.split("/")[-1]) 
     concept_genres_map = metadata[concept_id]["concept_genres_map"]
     _, eval_contrast_concepts_map = \
-        dataset_factory.prepare_concepts(
+        await dataset_factory.aprepare_concepts(
             [concept], 
             concept_genres_map=concept_genres_map,
-            contrast_concepts_map={}, api_tag="inference")
-    current_df = dataset_factory.create_eval_df(
+            contrast_concepts_map={}, api_tag=api_tag)
+    current_df = await dataset_factory.acreate_eval_df(
         [concept], num_of_examples, concept_genres_map, {},
         eval_contrast_concepts_map, input_length=args.input_length, 
-        output_length=args.output_length
+        output_length=args.output_length, api_tag=api_tag, rng=rng
     )
     current_df["concept_id"] = concept_id
     current_df["sae_link"] = sae_link
@@ -234,13 +244,16 @@ def create_data_latent(dataset_factory, metadata, concept_id, num_of_examples, a
     return current_df
 
 
-def save_state_latent(dump_dir, state, partition):
-    dump_dir = Path(dump_dir) / "inference"
-    dump_dir.mkdir(parents=True, exist_ok=True)
-    # Save state
-    state_path = os.path.join(dump_dir, f"{partition}_{STATE_FILE}")
-    with open(state_path, "wb") as f:
-        pickle.dump(state, f)
+def migrate_state(ledger, stage, state, concept_ids):
+    """
+    Record the concepts below the `concept_id` watermark of a legacy state
+    file as completed, so runs started before the ledger existed resume.
+    """
+    if state is None or ledger.has_stage(stage):
+        return
+    ledger.record_many([
+        {"stage": stage, "concept_id": concept_id, "method": None, "checksum": None, "migrated": True}
+        for concept_id in concept_ids if concept_id < state.get("concept_id", 0)])
 
 
 def save_latent(
@@ -259,6 +272,7 @@ def save_latent(
         df_path = os.path.join(dump_dir, f"{partition}_eval_data_{file_index}.parquet")
     if os.path.exists(df_path):
         existing_df = pd.read_parquet(df_path)
+        existing_df = existing_df[existing_df["concept_id"] != concept_id]
         combined_df = pd.concat([existing_df, current_df], ignore_index=True)
     else:
         combined_df = current_df
@@ -302,13 +316,18 @@ def generate_latent(generate_args, args):
     # Get list of all concept_ids
     concept_ids = list(range(len(metadata)))
 
-    # Load the state if it exists.
+    # Resume from the progress ledger. The legacy state stored the last
+    # finished concept rather than the next one.
+    ledger = ProgressLedger(Path(args.dump_dir) / PROGRESS_LEDGER_FILE)
     state = load_state_latent(args.dump_dir, "latent")
-    start_concept_id = state.get("concept_id", 0) if state else 0
-    logger.warning(f"Starting concept index: {start_concept_id}")
-    if start_concept_id >= len(concept_ids):
+    if state is not None:
+        state = {"concept_id": state["concept_id"] + 1}
+    migrate_state(ledger, "generate_latent", state, concept_ids)
+    pending_concept_ids = list(ledger.pending("generate_latent", concept_ids))
+    if len(pending_concept_ids) == 0:
         logger.warning(f"Datasets for all concepts have been generated. Exiting.")
         return
+    logger.warning(f"Generating {len(pending_concept_ids)} pending concepts, starting at {pending_concept_ids[0]}.")
 
     # Create a new OpenAI client.
     client = AsyncOpenAI(
@@ -338,7 +357,12 @@ def generate_latent(generate_args, args):
     atexit.register(dataset_factory.save_cache)
     atexit.register(dataset_factory.reset_stats)
 
-    progress_bar = tqdm(range(start_concept_id, len(metadata)), desc="Processing concept")
+    if args.concept_concurrency is not None and args.concept_concurrency > 1:
+        asyncio.run(generate_latent_pipelined(
+            args, dataset_factory, metadata, pending_concept_ids, dump_dir, ledger))
+        return
+
+    progress_bar = tqdm(pending_concept_ids, desc="Processing concept")
     for start_idx in progress_bar:
         concept_id = metadata[start_idx]["concept_id"]
         current_df = create_data_latent(
@@ -346,9 +370,33 @@ def generate_latent(generate_args, args):
 
         save_latent(dump_dir, concept_id, 'latent', current_df)
         logger.warning(f"Saved inference dataset for concept {concept_id} to latent_eval_data.parquet")
-        # After processing, save state
-        current_state = {'concept_id': concept_id}
-        save_state_latent(args.dump_dir, current_state, 'latent')
+        ledger.record("generate_latent", concept_id, checksum=content_checksum(current_df))
+
+
+async def generate_latent_pipelined(args, dataset_factory, metadata, concept_ids, dump_dir, ledger):
+    """
+    Generate latent evaluation data with up to `args.concept_concurrency` concepts
+    in flight on a single event loop, saved in order as in generate_training_pipelined.
+    """
+    async def generate_concept(concept_id):
+        return await acreate_data_latent(
+            dataset_factory, metadata, concept_id, args.latent_num_of_examples, args,
+            api_tag=f"inference_concept_{concept_id}", rng=np.random.default_rng([args.seed, concept_id]))
+
+    progress_bar = tqdm(total=len(concept_ids), desc="Processing concept")
+    in_flight = collections.deque()
+    next_concept_ids = collections.deque(concept_ids)
+    while in_flight or next_concept_ids:
+        while next_concept_ids and len(in_flight) < args.concept_concurrency:
+            next_concept_id = next_concept_ids.popleft()
+            in_flight.append((next_concept_id, asyncio.ensure_future(generate_concept(next_concept_id))))
+        # save the oldest concept first; later ones keep generating meanwhile.
+        concept_id, task = in_flight.popleft()
+        current_df = await task
+        progress_bar.update(1)
+        save_latent(dump_dir, concept_id, 'latent', current_df)
+        logger.warning(f"Saved inference dataset for concept {concept_id} to latent_eval_data.parquet")
+        ledger.record("generate_latent", concept_id, checksum=content_checksum(current_df))
 
 
 def generate_training(args, generate_args):
@@ -375,13 +423,15 @@ def generate_training(args, generate_args):
     concept2id = {concept: i for i, concept in enumerate(all_concepts)}
     concepts = list(zip(all_concepts, all_refs))
 
-    # Load the state if it exists.
-    state = load_state(dump_dir)
-    start_concept_id = state.get("concept_id", 0) if state else 0
-    logger.warning(f"Starting concept index: {start_concept_id}")
-    if start_concept_id >= len(concepts):
+    # Resume from the progress ledger.
+    ledger = ProgressLedger(Path(args.dump_dir) / PROGRESS_LEDGER_FILE)
+    migrate_state(ledger, "generate", load_state(dump_dir), range(len(concepts)))
+    pending_concept_ids = list(ledger.pending("generate", range(len(concepts))))
+    if len(pending_concept_ids) == 0:
         logger.warning(f"Datasets for all concepts have been generated. Exiting.")
         return
+    start_concept_id = pending_concept_ids[0]
+    logger.warning(f"Generating {len(pending_concept_ids)} pending concepts, starting at {start_concept_id}.")
 
     # Create a new OpenAI client.
     client = AsyncOpenAI(
@@ -423,44 +473,110 @@ def generate_training(args, generate_args):
         model, client, tokenizer, args.dataset_category, num_of_examples, args.output_length, 
         dump_dir, use_cache=args.lm_use_cache, master_data_dir=args.master_data_dir,
         seed=args.seed, lm_model=args.lm_model, start_concept_id=start_concept_id, is_chat_model=is_chat_model,
-        include_system_prompt=include_system_prompt,
+        include_system_prompt=include_system_prompt, lm_batch_dir=args.lm_batch_dir,
     )
     atexit.register(dataset_factory.save_cache)
     atexit.register(dataset_factory.reset_stats)
 
-    progress_bar = tqdm(range(start_concept_id, len(concepts)), desc="Processing concept")
+    if args.concept_concurrency is not None and args.concept_concurrency > 1:
+        asyncio.run(generate_training_pipelined(
+            args, dataset_factory, concepts, pending_concept_ids, dump_dir, ledger))
+        logger.warning(f"Finished creating dataset.")
+        return
+
+    progress_bar = tqdm(pending_concept_ids, desc="Processing concept")
     only_one_concept = True if len(concepts) == 1 else False
-    data_concept_id = start_concept_id
     for concept_id in progress_bar:
+        data_concept_id = concept_id
         concept, ref = concepts[concept_id]
         print(f"Generating for concept: {concept}...")
 
-        # prepare concept related data.
-        concept_genres_map = \
-            dataset_factory.prepare_genre_concepts([concept])
-        # generate with retry mechanism.
-        # try:
-        current_df = dataset_factory.create_train_df(
-            concept, num_of_examples, concept_genres_map,
-            output_length=args.output_length,
-            current_concept_id=data_concept_id,
-            only_one_concept=only_one_concept,
-        )
+        try:
+            # prepare concept related data.
+            concept_genres_map = \
+                dataset_factory.prepare_genre_concepts([concept])
+            # generate with retry mechanism.
+            # try:
+            current_df = dataset_factory.create_train_df(
+                concept, num_of_examples, concept_genres_map,
+                output_length=args.output_length,
+                current_concept_id=data_concept_id,
+                only_one_concept=only_one_concept,
+                # in batch mode, concepts are redone in later runs; their prompts must not
+                # depend on which concepts were generated before.
+                rng=np.random.default_rng([args.seed, concept_id]) if args.lm_batch_dir else None,
+            )
+        except BatchRequestsPending as e:
+            # the concept is generated once the batch results are ingested.
+            logger.warning(f"Deferring concept {concept_id}: {e}")
+            continue
         current_df["concept_id"] = data_concept_id
         # except Exception as e:
         #     logger.warning(f"Failed to create training data for group {concept_id}: {e}")
         #     continue # continue to the next group.
         
-        # Save the generated DataFrame, metadata, and current state
+        # Save the generated DataFrame and metadata, and record the concept
         save(
-            dump_dir, {"concept_id": concept_id + 1}, data_concept_id,
+            dump_dir, ledger, data_concept_id,
             concept, concept_genres_map, 
             ref, "train", current_df, dataset_factory)
-        data_concept_id += 1
 
     logger.warning(f"Finished creating dataset.")
 
 
+async def generate_training_pipelined(args, dataset_factory, concepts, concept_ids, dump_dir, ledger):
+    """
+    Generate training data with up to `args.concept_concurrency` concepts in
+    flight on a single event loop, so LM calls of different concepts overlap.
+
+    Concepts are still saved strictly in order and each one is recorded in
+    the ledger once saved, so a crash only redoes the concepts in flight.
+    Each concept gets its own api tag and random generator, which makes the
+    output independent of how the concepts interleave.
+    """
+    only_one_concept = True if len(concepts) == 1 else False
+
+    async def generate_concept(concept_id):
+        concept, _ = concepts[concept_id]
+        api_tag = f"concept_{concept_id}"
+        try:
+            concept_genres_map = await dataset_factory.aprepare_genre_concepts(
+                [concept], api_tag=api_tag)
+            current_df = await dataset_factory.acreate_train_df(
+                concept, args.num_of_examples, concept_genres_map,
+                output_length=args.output_length,
+                current_concept_id=concept_id,
+                only_one_concept=only_one_concept,
+                api_tag=api_tag,
+                rng=np.random.default_rng([args.seed, concept_id]),
+            )
+        except BatchRequestsPending as e:
+            # the concept is generated once the batch results are ingested.
+            logger.warning(f"Deferring concept {concept_id}: {e}")
+            return None, None
+        current_df["concept_id"] = concept_id
+        return concept_genres_map, current_df
+
+    progress_bar = tqdm(total=len(concept_ids), desc="Processing concept")
+    in_flight = collections.deque()
+    next_concept_ids = collections.deque(concept_ids)
+    while in_flight or next_concept_ids:
+        while next_concept_ids and len(in_flight) < args.concept_concurrency:
+            next_concept_id = next_concept_ids.popleft()
+            in_flight.append((next_concept_id, asyncio.ensure_future(generate_concept(next_concept_id))))
+        # save the oldest concept first; later ones keep generating meanwhile.
+        concept_id, task = in_flight.popleft()
+        concept_genres_map, current_df = await task
+        progress_bar.update(1)
+        if current_df is None:
+            continue
+        concept, ref = concepts[concept_id]
+        save(
+            dump_dir, ledger, concept_id,
+            concept, concept_genres_map, 
+            ref, "train", current_df, dataset_factory)
+
+
 def generate_dpo_training(args, generate_args):
     raise NotImplementedError("DPO training is not implemented yet.")
 
@@ -482,6 +598,7 @@ def main():
     logger.warning("Generating datasets with the following configuration:")
     logger.warning(generate_args)
 
+    start_profiling(generate_args.dump_dir, f"generate_{generate_args.mode}")
     if generate_args.mode == "training":
         generate_training(generate_args, inference_args)
     elif generate_args.mode == "latent":
@@ -490,6 +607,7 @@ def main():
         generate_dpo_training(generate_args, inference_args)
     else:
         raise ValueError(f"Invalid mode: {generate_args.mode}")
+    stop_profiling()
 
 
 if __name__ == "__main__":
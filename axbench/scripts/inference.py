@@ -3,8 +3,11 @@
 # example launch command:
 #     torchrun --nproc_per_node=NUM_GPUS axbench/scripts/inference.py --config axbench/demo/sweep/inference.yaml --mode latent
 import os, argparse, yaml, json, glob, pickle, time, itertools
-import shutil
+import shutil, queue, threading, heapq, copy
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm.auto import tqdm
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
@@ -16,7 +19,13 @@ from axbench.utils.dataset import (
     SteeringDatasetFactory
 )
 from axbench.utils.constants import * 
-from axbench.utils.model_utils import get_prefix_length, get_suffix_length
+from axbench.utils.model_utils import get_prefix_length, get_suffix_length, get_chat_template_formatter, prepare_df
+from axbench.utils.factor_search import golden_section_factor_search
+from axbench.utils.work_queue import ConceptWorkQueue
+from axbench.utils.ledger import ProgressLedger, PROGRESS_LEDGER_FILE, content_checksum
+from axbench.utils.profiler import start_profiling, stop_profiling, span, profile_tags, profiled
+from axbench.evaluators.lm_judge import LMJudgeEvaluator
+from axbench.models.language_models import LanguageModel, BatchRequestsPending
 from axbench.scripts.args.dataset_args import DatasetArgs
 from axbench.scripts.args.training_args import TrainingArgs
 from transformers import set_seed
@@ -41,6 +50,21 @@ METADATA_FILE = "metadata.jsonl"
 STEERING_EXCLUDE_MODELS = {"IntegratedGradients", "InputXGradients", "PromptDetection", "BoW"}
 LATENT_EXCLUDE_MODELS = {"PromptSteering", "PromptBaseline", "DiReFT", "LoReFT", "LoRA", "SFT"}
 LATENT_PROMPT_PREFIX = "Generate a random sentence."
+# methods whose generations do not depend on the steering factor.
+FACTOR_INDEPENDENT_STEERING_MODELS = {"PromptSteering", "PromptBaseline", "LoReFT", "LoRA", "SFT"}
+FACTOR_SEARCH_FILE = "steering_factor_search.jsonl"
+DEFAULT_FACTOR_SEARCH_NUM_OF_EXAMPLES = 4
+# concepts of steering data prepared ahead of the device.
+STEERING_PREFETCH_SIZE = 2
+# concepts claimed from the queue (and prompted for) at once by the steering producer.
+STEERING_CLAIM_SIZE = 8
+# concepts steered together by methods that serve many concepts in one batch (e.g. stacked LoRA adapters).
+STEERING_GROUP_SIZE = STEERING_CLAIM_SIZE
+CONCEPT_QUEUE_FILE = "concept_queue.sqlite"
+# rank files (and the merged file) are kept sorted by these columns, so rank 0 merges them by streaming.
+PARTITION_SORT_BY = {"steering": ['concept_id', 'input_id', 'factor'], "latent": ['concept_id']}
+# rows per record batch (and per row group) read and written while merging.
+MERGE_BATCH_SIZE = 65536
 
 
 def load_config(config_path):
@@ -95,6 +119,7 @@ def load_metadata_flatten(metadata_path):
     return metadata
 
 
+@profiled("parquet_write")
 def save(
     dump_dir, partition,
     current_df, rank, subfolder="inference"):
@@ -106,11 +131,191 @@ def save(
     
     if os.path.exists(df_path):
         existing_df = pd.read_parquet(df_path)
+        # drop rows of an earlier attempt that crashed before being recorded.
+        concept_ids = current_df["concept_id"].unique()
+        existing_df = existing_df[~existing_df["concept_id"].isin(concept_ids)]
         combined_df = pd.concat([existing_df, current_df], ignore_index=True)
     else:
         combined_df = current_df
     
-    combined_df.to_parquet(df_path, engine='pyarrow')
+    # sorted rank files are merged as streams by rank 0.
+    sort_by = PARTITION_SORT_BY.get(partition, ['concept_id'])
+    combined_df = combined_df.sort_values(by=sort_by, kind="stable")
+    combined_df.to_parquet(df_path, engine='pyarrow', index=False, row_group_size=MERGE_BATCH_SIZE)
+
+
+def method_columns(df, model_name):
+    return [column for column in df.columns if column.startswith(f"{model_name}_")]
+
+
+def record_methods(ledger, stage, concept_id, model_names, current_df, rank):
+    ledger.record_many([
+        {"stage": stage, "concept_id": int(concept_id), "method": model_name,
+         "checksum": content_checksum(current_df[method_columns(current_df, model_name)]), "rank": rank}
+        for model_name in model_names])
+
+
+def migrate_state(ledger, stage, dump_dir, partition, model_names):
+    """
+    Record the methods found in the outputs of a run started before the
+    ledger existed, from the merged file and any unmerged rank files.
+    """
+    if ledger.has_stage(stage):
+        return
+    inference_dir = Path(dump_dir) / "inference"
+    df_paths = [(None, inference_dir / f"{partition}_data.parquet")] + [
+        (int(df_path.name.split("_")[1]), df_path)
+        for df_path in sorted(inference_dir.glob(f"rank_*_{partition}_data.parquet"))]
+    entries = []
+    for rank, df_path in df_paths:
+        if not df_path.exists():
+            continue
+        columns = pq.read_schema(df_path).names
+        concept_ids = sorted(pd.read_parquet(df_path, columns=["concept_id"])["concept_id"].unique())
+        for concept_id in concept_ids:
+            for model_name in model_names:
+                if any(column.startswith(f"{model_name}_") for column in columns):
+                    entries.append({
+                        "stage": stage, "concept_id": int(concept_id), "method": model_name,
+                        "checksum": None, "migrated": True, **({} if rank is None else {"rank": rank})})
+    if len(entries) > 0:
+        ledger.record_many(entries)
+
+
+def load_saved_ranks(ledger, stage):
+    """The rank whose file holds the latest rows of each recorded concept (None once merged)."""
+    saved_ranks = {}
+    for entry in ledger.entries(stage):
+        saved_ranks[entry["concept_id"]] = entry.get("rank")
+    return saved_ranks
+
+
+@profiled("parquet_read")
+def load_saved_rows(dump_dir, partition, concept_id, saved_ranks):
+    """
+    Rows of a concept saved by an earlier run, so that only its missing
+    methods are computed; None if the concept has no saved rows.
+    """
+    if concept_id not in saved_ranks:
+        return None
+    inference_dir = Path(dump_dir) / "inference"
+    df_paths = [inference_dir / f"{partition}_data.parquet"]
+    if saved_ranks[concept_id] is not None:
+        df_paths.insert(0, inference_dir / f"rank_{saved_ranks[concept_id]}_{partition}_data.parquet")
+    for df_path in df_paths:
+        if df_path.exists():
+            current_df = pd.read_parquet(df_path, filters=[("concept_id", "==", concept_id)])
+            if len(current_df) > 0:
+                return current_df.reset_index(drop=True)
+    return None
+
+
+def scan_sorted(df_path, sort_by):
+    """
+    Whether the rows of a parquet file are sorted by `sort_by`, and the set
+    of its concept ids; reads the key columns one record batch at a time.
+    """
+    is_sorted, concept_ids, previous = True, set(), None
+    for batch in pq.ParquetFile(df_path).iter_batches(batch_size=MERGE_BATCH_SIZE, columns=sort_by):
+        keys = batch.to_pandas()
+        concept_ids.update(keys["concept_id"].unique().tolist())
+        if is_sorted:
+            # a file is sorted if every batch is, starting from the last row of the one before.
+            keys = pd.concat([previous, keys], ignore_index=True) if previous is not None else keys
+            order = keys.sort_values(by=sort_by, kind="stable").index
+            is_sorted = bool((order == np.arange(len(keys))).all())
+            previous = keys.iloc[-1:]
+    return is_sorted, concept_ids
+
+
+def concept_runs(df_path, keep_concept_ids, schema, exclude=False):
+    """
+    Stream the rows of the concepts in `keep_concept_ids` (or of the ones not
+    in it, with `exclude`) of a parquet file sorted by concept_id, conformed
+    to `schema`, as (concept_id, record batch) runs of a single concept.
+    """
+    keep_concept_ids = np.array(sorted(keep_concept_ids))
+    for batch in pq.ParquetFile(df_path).iter_batches(batch_size=MERGE_BATCH_SIZE):
+        concept_ids = batch.column("concept_id").to_numpy(zero_copy_only=False)
+        mask = np.isin(concept_ids, keep_concept_ids, invert=exclude)
+        if not mask.any():
+            continue
+        batch, concept_ids = batch.filter(pa.array(mask)), concept_ids[mask]
+        columns = [
+            batch.column(field.name).cast(field.type) if field.name in batch.schema.names
+            else pa.nulls(len(batch), field.type) for field in schema]
+        batch = pa.RecordBatch.from_arrays(columns, schema=schema)
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(concept_ids)) + 1, [len(concept_ids)]])
+        for start, end in zip(starts[:-1], starts[1:]):
+            yield concept_ids[start], batch.slice(start, end - start)
+
+
+def merge_schema(df_paths):
+    """The schema of the rows of all `df_paths`, like the columns of their `pd.concat`."""
+    schemas = []
+    for df_path in df_paths:
+        schema = pq.read_schema(df_path)
+        schemas.append(pa.schema([field for field in schema if not field.name.startswith("__index_level_")]))
+    return pa.unify_schemas(schemas, promote_options="permissive")
+
+
+@profiled("parquet_merge")
+def merge_rank_files(dump_dir, partition, saved_ranks, sort_by):
+    """
+    Merge the per-rank files into the merged file of `partition`. The rows of
+    a concept come from the rank that recorded it last; they replace the
+    concept's rows of earlier merges.
+
+    Rank files and the merged file are sorted by `sort_by`, and every concept
+    comes from exactly one of them, so they are merged as record batch streams
+    ordered by concept_id: memory is bounded by a few batches, whatever the
+    size of the run.
+    """
+    inference_dir = Path(dump_dir) / "inference"
+    merged_path = inference_dir / f"{partition}_data.parquet"
+    rank_files = sorted(
+        inference_dir.glob(f"rank_*_{partition}_data.parquet"), key=lambda f: int(f.name.split("_")[1]))
+    if len(rank_files) > 0:
+        rank_concept_ids, new_concept_ids = [], set()
+        for rank_file in rank_files:
+            rank = int(rank_file.name.split("_")[1])
+            is_sorted, concept_ids = scan_sorted(rank_file, sort_by)
+            if not is_sorted:
+                # rank files of runs from before they were kept sorted.
+                logger.warning(f"Sorting {rank_file} before merging.")
+                df = pd.read_parquet(rank_file).sort_values(by=sort_by, kind="stable")
+                df.to_parquet(rank_file, engine='pyarrow', index=False, row_group_size=MERGE_BATCH_SIZE)
+            # rows not recorded by this rank crashed mid-concept or were redone elsewhere.
+            concept_ids = {concept_id for concept_id in concept_ids if saved_ranks.get(concept_id, -1) == rank}
+            rank_concept_ids.append(concept_ids)
+            new_concept_ids.update(concept_ids)
+        df_paths = ([merged_path] if merged_path.exists() else []) + rank_files
+        schema = merge_schema(df_paths)
+        streams = [
+            concept_runs(rank_file, concept_ids, schema)
+            for rank_file, concept_ids in zip(rank_files, rank_concept_ids)]
+        if merged_path.exists():
+            streams.insert(0, concept_runs(merged_path, new_concept_ids, schema, exclude=True))
+
+        tmp_path = merged_path.with_suffix(".parquet.tmp")
+        with pq.ParquetWriter(tmp_path, schema) as writer:
+            batches, n_rows = [], 0
+            for _, batch in heapq.merge(*streams, key=lambda run: run[0]):
+                batches.append(batch)
+                n_rows += len(batch)
+                if n_rows >= MERGE_BATCH_SIZE:
+                    writer.write_table(pa.Table.from_batches(batches, schema=schema))
+                    batches, n_rows = [], 0
+            writer.write_table(pa.Table.from_batches(batches, schema=schema))
+        os.replace(tmp_path, merged_path)
+        logger.warning(f"Saved combined {partition} inference results to {merged_path}")
+    else:
+        logger.warning("No results to merge.")
+
+    # Delete per-rank files
+    for rank_file in rank_files:
+        os.remove(rank_file)
+        logger.warning(f"Deleted {rank_file}")
 
 
 def partition_concept_ids(concept_ids, world_size):
@@ -126,6 +331,7 @@ def partition_concept_ids(concept_ids, world_size):
     return concept_ids_per_rank
 
 
+@profiled("create_data")
 def create_data_latent(dataset_factory, metadata, concept_id, num_of_examples, args):
     # prepare concept related data.
     concept = metadata[concept_id]["concept"]
@@ -148,6 +354,7 @@ def create_data_latent(dataset_factory, metadata, concept_id, num_of_examples, a
     return current_df
 
 
+@profiled("create_data")
 def create_data_steering(
     dataset_factory, metadata, concept_id, num_of_examples, 
     n_steering_factors, steering_datasets, args):
@@ -167,29 +374,157 @@ def create_data_steering(
     return current_df, (concept_id, sae_link, sae_id)
 
 
-def prepare_df(current_df, tokenizer, is_chat_model, model_name):
-    suffix_length, _ = get_suffix_length(tokenizer)
-    if is_chat_model:
-        if model_name == "meta-llama/Llama-3.1-8B-Instruct":
-            def apply_chat_template(row):
-                messages = [
-                    {"role": "system", "content": "You are a helpful assistant."}, 
-                    {"role": "user", "content": row["input"]},
-                    {"role": "assistant", "content": row["output"]}
-                ]
-                tokens = tokenizer.apply_chat_template(messages, tokenize=True)[1:-suffix_length]
-                return tokenizer.decode(tokens)
-            current_df['input'] = current_df.apply(apply_chat_template, axis=1)
-        else:
-            def apply_chat_template(row):
-                messages = [
-                    {"role": "user", "content": row["input"]},
-                    {"role": "assistant", "content": row["output"]}
-                ]
-                tokens = tokenizer.apply_chat_template(messages, tokenize=True)[1:-suffix_length]
-                return tokenizer.decode(tokens)
-            current_df['input'] = current_df.apply(apply_chat_template, axis=1)
-    return current_df
+def iterate_in_background(items, max_prefetch):
+    """
+    Iterate `items` in a background thread, keeping up to `max_prefetch` of
+    them ready for the consumer. Errors of the producer are raised in the
+    consumer, and the producer stops once the consumer stops iterating.
+    """
+    data_queue = queue.Queue(maxsize=max_prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                data_queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((done, e))
+            return
+        put((done, None))
+
+    def consume():
+        try:
+            while True:
+                item, error = data_queue.get()
+                if item is done:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:
+            stop.set()
+
+    # the producer starts right away, not at the first iteration.
+    threading.Thread(target=produce, daemon=True).start()
+    return consume()
+
+
+def group_items(items, group_size):
+    """Lists of `group_size` consecutive items (fewer for the last one)."""
+    items = iter(items)
+    while True:
+        group = list(itertools.islice(items, group_size))
+        if len(group) == 0:
+            return
+        yield group
+
+
+def produce_data_steering(
+    dataset_factory, metadata, concept_ids, num_of_examples, 
+    n_steering_factors, steering_datasets, args, chunk_size=None, load_saved_rows=None, defer=None):
+    # concept_ids are taken `chunk_size` at a time (all at once by default).
+    # concepts waiting on batch LM requests are passed to `defer` instead of being yielded.
+    concept_ids = iter(concept_ids)
+    while True:
+        chunk = list(itertools.islice(concept_ids, chunk_size))
+        if len(chunk) == 0:
+            return
+        # concepts with saved rows reuse them instead of new data.
+        saved_dfs = {
+            concept_id: load_saved_rows(concept_id) if load_saved_rows else None for concept_id in chunk}
+        # steering prompts of the chunk are generated in one bulk LM call.
+        if (dataset_factory.has_prompt_steering and "AlpacaEval" in steering_datasets) or \
+            "AlpacaEval_Suppress" in steering_datasets or "AlpacaEval_Synergy" in steering_datasets:
+            try:
+                dataset_factory.prefetch_steering_prompts(
+                    [metadata[concept_id]["concept"] for concept_id in chunk if saved_dfs[concept_id] is None])
+            except BatchRequestsPending:
+                pass # the concepts missing prompts are deferred below.
+        for concept_id in chunk:
+            if saved_dfs[concept_id] is not None:
+                sae_link = metadata[concept_id]["ref"]
+                yield concept_id, saved_dfs.pop(concept_id), sae_link, int(sae_link.split("/")[-1])
+                continue
+            try:
+                current_df, (_, sae_link, sae_id) = create_data_steering(
+                    dataset_factory, metadata, concept_id, num_of_examples,
+                    n_steering_factors, steering_datasets, args
+                )
+            except BatchRequestsPending as e:
+                logger.warning(f"Deferring concept {concept_id}: {e}")
+                if defer is not None:
+                    defer(concept_id)
+                continue
+            yield concept_id, current_df, sae_link, sae_id
+
+
+def predict_steer_rows(benchmark_model, model_name, rows, **kwargs):
+    """Run predict_steer on `rows` and return the outputs as `{model_name}_*` columns."""
+    results = benchmark_model.predict_steer(rows, **kwargs)
+    return pd.DataFrame({f"{model_name}_{k}": v for k, v in results.items()}, index=rows.index)
+
+
+def search_steering_factor(
+    benchmark_model, model_name, current_df, lm_judge, concept_id, dump_dir,
+    num_of_probe_examples=None, **kwargs):
+    """
+    Steer `current_df` with a single, searched steering factor.
+
+    A golden-section search over the factor grid generates and judges only the
+    first `num_of_probe_examples` inputs for each probed factor. All remaining
+    inputs are then steered with the best factor, reusing the probe generations.
+    Rows with other factors are not part of the returned frame.
+    """
+    if num_of_probe_examples is None:
+        num_of_probe_examples = DEFAULT_FACTOR_SEARCH_NUM_OF_EXAMPLES
+    factors = sorted(current_df["factor"].unique().tolist())
+    is_probe = current_df["input_id"] < num_of_probe_examples
+    probe_results = {}
+
+    def evaluate(factor):
+        rows = current_df[is_probe & (current_df["factor"] == factor)]
+        probe_results[factor] = predict_steer_rows(benchmark_model, model_name, rows, **kwargs)
+        evaluator = LMJudgeEvaluator(model_name, lm_model=lm_judge, concept_id=concept_id)
+        metrics = evaluator.compute_metrics(pd.concat([rows, probe_results[factor]], axis=1))
+        return float(np.mean(metrics["lm_judge_rating"]))
+
+    if model_name in FACTOR_INDEPENDENT_STEERING_MODELS:
+        best_factor, scores = factors[0], {}
+    else:
+        best_factor, scores = golden_section_factor_search(factors, evaluate)
+    logger.warning(
+        f"Searched {len(scores)}/{len(factors)} factors for {model_name} on concept {concept_id}, "
+        f"best factor: {best_factor}")
+
+    rows = current_df[current_df["factor"] == best_factor]
+    if best_factor in probe_results:
+        rows = rows[rows["input_id"] >= num_of_probe_examples]
+    results_df = probe_results.get(best_factor)
+    if len(rows) > 0:
+        results_df = pd.concat([results_df, predict_steer_rows(benchmark_model, model_name, rows, **kwargs)])
+
+    search_path = Path(dump_dir) / "inference" / FACTOR_SEARCH_FILE
+    search_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(search_path, "a") as f:
+        f.write(json.dumps({
+            "concept_id": int(concept_id),
+            "model": model_name,
+            "best_factor": best_factor,
+            "factors": list(scores.keys()),
+            "lm_judge_rating": list(scores.values()),
+        }) + "\n")
+    return results_df
 
 
 def infer_steering(args, rank, world_size, device, logger, training_args, generate_args):
@@ -204,27 +539,34 @@ def infer_steering(args, rank, world_size, device, logger, training_args, genera
     steering_factors = args.steering_factors
     steering_datasets = args.steering_datasets
 
-    state = load_state(args.dump_dir, "steering", rank)
-    last_concept_id_processed = state.get("last_concept_id", None) if state else None
-    logger.warning(f"Rank {rank} last concept_id processed: {last_concept_id_processed}")
-
     # Get list of all concept_ids
     concept_ids = [metadata[i]["concept_id"] for i in range(len(metadata))]
 
-    # Partition concept_ids among ranks sequentially
-    concept_ids_per_rank = partition_concept_ids(concept_ids, world_size)
-    my_concept_ids = concept_ids_per_rank[rank]
-
-    if last_concept_id_processed is not None:
-        if last_concept_id_processed in my_concept_ids:
-            idx = my_concept_ids.index(last_concept_id_processed)
-            my_concept_ids = my_concept_ids[idx+1:]
-        else:
-            # If last_concept_id_processed is not in my_concept_ids, process all
-            pass
-
-    if len(my_concept_ids) == 0:
+    # Only (concept, method) units missing from the progress ledger are inferred.
+    ledger = ProgressLedger(Path(dump_dir) / PROGRESS_LEDGER_FILE)
+    model_names = [model_name for model_name in args.models if model_name not in STEERING_EXCLUDE_MODELS]
+    if rank == 0:
+        migrate_state(ledger, "inference_steering", dump_dir, "steering", model_names)
+    dist.barrier()
+    # rank 0 reads the pending units for all ranks, so every rank opens the same queue.
+    pending_methods = [ledger.pending("inference_steering", concept_ids, model_names) if rank == 0 else None]
+    dist.broadcast_object_list(pending_methods, src=0)
+    pending_methods = pending_methods[0]
+    saved_ranks = load_saved_ranks(ledger, "inference_steering")
+
+    # Ranks pull concept_ids from a shared queue; completed concepts are never handed out again.
+    # Each set of pending units gets its own queue, so added or invalidated methods queue finished concepts again;
+    # finished queues are deleted.
+    concept_queue = ConceptWorkQueue(
+        Path(dump_dir) / "inference" / f"steering_{content_checksum(pending_methods)[:8]}_{CONCEPT_QUEUE_FILE}",
+        list(pending_methods.keys()), f"rank_{rank}")
+    queue_status = concept_queue.status()
+    logger.warning(f"Rank {rank} concept queue status: {queue_status}")
+    if queue_status["pending"] + queue_status["running"] == 0:
         logger.warning(f"Rank {rank} has no concepts to process. Exiting.")
+        dist.barrier()
+        if rank == 0:
+            concept_queue.remove_if_done()
         return
 
     # Create a new OpenAI client.
@@ -241,6 +583,11 @@ def infer_steering(args, rank, world_size, device, logger, training_args, genera
         max_retries=3,
     )
 
+    lm_judge = None
+    if args.steering_factor_search:
+        lm_judge = LanguageModel(
+            args.lm_model, lm_client, dump_dir, use_cache=False, temperature=0.7)
+
     # Initialize the dataset factory with the tokenizer.
     tokenizer = AutoTokenizer.from_pretrained(
         args.steering_model_name, use_fast=False, model_max_length=1024)
@@ -252,10 +599,12 @@ def infer_steering(args, rank, world_size, device, logger, training_args, genera
             has_prompt_steering = True
         else:
             has_prompt_steering = False
+    # the factory formats prompts in the background producer below, so it gets its own tokenizer
+    # (and chat template formatters): tokenizers are not safe to share across threads.
     dataset_factory = SteeringDatasetFactory(
-        tokenizer, dump_dir,
+        copy.deepcopy(tokenizer), dump_dir,
         master_data_dir=args.master_data_dir, lm_client=lm_client,
-        lm_model=args.lm_model,
+        lm_model=args.lm_model, lm_batch_dir=args.lm_batch_dir,
         has_prompt_steering=has_prompt_steering
     )
     is_chat_model = True if args.model_name in CHAT_MODELS else False
@@ -263,6 +612,16 @@ def infer_steering(args, rank, world_size, device, logger, training_args, genera
     if is_chat_model:
         prefix_length = get_prefix_length(tokenizer)
         logger.warning(f"Chat model prefix length: {prefix_length}")
+
+    # Prepare data per concept in the background, overlapping model loading and inference.
+    data_per_concept = iterate_in_background(
+        produce_data_steering(
+            dataset_factory, metadata, concept_queue, num_of_examples,
+            steering_factors, steering_datasets, args, chunk_size=STEERING_CLAIM_SIZE,
+            load_saved_rows=lambda concept_id: load_saved_rows(dump_dir, "steering", concept_id, saved_ranks),
+            # deferred concepts stay pending in the ledger; the queue of this run is done with them.
+            defer=concept_queue.complete,
+        ), STEERING_PREFETCH_SIZE)
         
     # Load model instance onto device
     if args.use_bf16:
@@ -283,116 +642,122 @@ def infer_steering(args, rank, world_size, device, logger, training_args, genera
     if need_resize:
         model_instance.resize_token_embeddings(len(tokenizer))
 
-    # Prepare data per concept
-    data_per_concept = {}
-    for concept_id in my_concept_ids:
-        current_df, (_, sae_link, sae_id) = create_data_steering(
-            dataset_factory, metadata, concept_id, num_of_examples,
-            steering_factors, steering_datasets, args
+    def load_benchmark_model(model_name, concept_id, concept_ids=None):
+        model_class = getattr(axbench, model_name)
+        logger.warning(f"Loading {model_class} on {device}.")
+        benchmark_model = model_class(
+            model_instance, tokenizer, layer=layer,
+            training_args=training_args.models[model_name] if model_name not in {"PromptSteering", "GemmaScopeSAE"} else None, # we init with training args as well
+            low_rank_dimension=len(metadata),
+            device=device, steering_layers=steering_layers,
         )
-        data_per_concept[concept_id] = (current_df, sae_link, sae_id)
-
-    # Now loop over concept_ids and use preloaded models
-    for concept_id in my_concept_ids:
-        current_df, sae_link, sae_id = data_per_concept[concept_id]
-        for model_name in args.models:
-            if model_name in STEERING_EXCLUDE_MODELS:
-                continue
-            model_class = getattr(axbench, model_name)
-            logger.warning(f"Loading {model_class} on {device}.")
-
-            benchmark_model = model_class(
-                model_instance, tokenizer, layer=layer,
-                training_args=training_args.models[model_name] if model_name not in {"PromptSteering", "GemmaScopeSAE"} else None, # we init with training args as well
-                low_rank_dimension=len(metadata),
-                device=device, steering_layers=steering_layers,
-            )
-            benchmark_model.load(
-                dump_dir=train_dir, sae_path=metadata[0]["ref"], mode="steering",
-                intervention_type=args.steering_intervention_type,
-                concept_id=concept_id
-            )
-            benchmark_model.to(device)
-            if hasattr(benchmark_model, 'ax') and args.use_bf16:
-                benchmark_model.ax.eval()
-                benchmark_model.ax.to(torch.bfloat16)
-            # Pre-compute mean activations once
-            if model_name not in {"LoReFT", "BoW"} and model_name not in LATENT_EXCLUDE_MODELS:
-                benchmark_model.pre_compute_mean_activations(
-                    os.path.join(dump_dir, "inference"), 
-                    master_data_dir=args.master_data_dir,
-                    disable_neuronpedia_max_act=args.disable_neuronpedia_max_act,
-                    metadata=metadata,
-                )
-            logger.warning(f"Inference steering with {model_name} on {device} for concept {concept_id}.")
-            # Run prediction
-            results = benchmark_model.predict_steer(
-                current_df, concept_id=concept_id, sae_link=sae_link, sae_id=sae_id,
-                batch_size=args.steering_batch_size,
-                eval_output_length=args.steering_output_length, 
-                temperature=args.temperature,
-                prefix_length=prefix_length,
-                positions=training_args.models[model_name].intervention_positions if model_name not in {"PromptSteering", "GemmaScopeSAE"} else None,
-                use_synergy=training_args.models[model_name].use_synergy if model_name in {"LsReFT"} else False,
+        benchmark_model.load(
+            dump_dir=train_dir, sae_path=metadata[0]["ref"], mode="steering",
+            intervention_type=args.steering_intervention_type,
+            concept_id=concept_id, concept_ids=concept_ids
+        )
+        benchmark_model.to(device)
+        if hasattr(benchmark_model, 'ax') and args.use_bf16:
+            benchmark_model.ax.eval()
+            benchmark_model.ax.to(torch.bfloat16)
+        # Pre-compute mean activations once
+        if model_name not in {"LoReFT", "BoW"} and model_name not in LATENT_EXCLUDE_MODELS:
+            benchmark_model.pre_compute_mean_activations(
+                os.path.join(dump_dir, "inference"), 
+                master_data_dir=args.master_data_dir,
                 disable_neuronpedia_max_act=args.disable_neuronpedia_max_act,
+                metadata=metadata,
             )
-            # Store the results in current_df
-            for k, v in results.items():
-                current_df[f"{model_name}_{k}"] = v
-            del benchmark_model
-            torch.cuda.empty_cache()
-        save(dump_dir, 'steering', current_df, rank)
-        logger.warning(f"Saved inference results for concept {concept_id} to rank_{rank}_steering_data.parquet")
-        # After processing, save state
-        current_state = {'last_concept_id': concept_id}
-        save_state(args.dump_dir, current_state, 'steering', rank)
+        return benchmark_model
+
+    def predict_kwargs(model_name, concept_id, sae_link, sae_id):
+        return dict(
+            concept_id=concept_id, sae_link=sae_link, sae_id=sae_id,
+            batch_size=args.steering_batch_size,
+            eval_output_length=args.steering_output_length, 
+            temperature=args.temperature,
+            prefix_length=prefix_length,
+            positions=training_args.models[model_name].intervention_positions if model_name not in {"PromptSteering", "GemmaScopeSAE"} else None,
+            use_synergy=training_args.models[model_name].use_synergy if model_name in {"LsReFT"} else False,
+            disable_neuronpedia_max_act=args.disable_neuronpedia_max_act,
+        )
+
+    def release(model_name, benchmark_model):
+        if model_name == "LoRA":
+            # take the adapters out of the shared base model.
+            benchmark_model.unload()
+        del benchmark_model
+        torch.cuda.empty_cache()
+
+    # Now loop over the prepared concepts, a group at a time; methods that steer many
+    # concepts at once generate for the rows of all concepts of the group in the same batches.
+    for concept_group in group_items(data_per_concept, STEERING_GROUP_SIZE):
+        # saved rows may lack a finished method if its file is gone; it is redone then.
+        concept_model_names = {
+            concept_id: [
+                model_name for model_name in model_names
+                if model_name in pending_methods[concept_id] or len(method_columns(current_df, model_name)) == 0]
+            for concept_id, current_df, _, _ in concept_group}
+        for model_name in model_names:
+            method_group = [item for item in concept_group if model_name in concept_model_names[item[0]]]
+            if len(method_group) == 0:
+                continue
+            if getattr(getattr(axbench, model_name), "steers_many_concepts", False) and not args.steering_factor_search:
+                concept_ids = [concept_id for concept_id, _, _, _ in method_group]
+                _, _, sae_link, sae_id = method_group[0]
+                logger.warning(f"Inference steering with {model_name} on {device} for concepts {concept_ids}.")
+                benchmark_model = load_benchmark_model(model_name, concept_ids[0], concept_ids)
+                with profile_tags(concept_id=concept_ids, method=model_name), span("predict_steer"):
+                    results = benchmark_model.predict_steer(
+                        pd.concat([current_df for _, current_df, _, _ in method_group], ignore_index=True),
+                        **predict_kwargs(model_name, concept_ids[0], sae_link, sae_id))
+                # Store the results of every concept in its current_df
+                offset = 0
+                for _, current_df, _, _ in method_group:
+                    for k, v in results.items():
+                        current_df[f"{model_name}_{k}"] = v[offset:offset + len(current_df)]
+                    offset += len(current_df)
+                release(model_name, benchmark_model)
+                continue
+            for concept_id, current_df, sae_link, sae_id in method_group:
+                benchmark_model = load_benchmark_model(model_name, concept_id)
+                logger.warning(f"Inference steering with {model_name} on {device} for concept {concept_id}.")
+                kwargs = predict_kwargs(model_name, concept_id, sae_link, sae_id)
+                if args.steering_factor_search:
+                    # only rows of the searched factor get generations; the rest stay empty.
+                    with profile_tags(concept_id=concept_id, method=model_name), span("factor_search"):
+                        results_df = search_steering_factor(
+                            benchmark_model, model_name, current_df, lm_judge, concept_id, dump_dir,
+                            num_of_probe_examples=args.steering_search_num_of_examples, **kwargs)
+                    for column in results_df.columns:
+                        current_df[column] = results_df[column]
+                else:
+                    # Run prediction
+                    with profile_tags(concept_id=concept_id, method=model_name), span("predict_steer"):
+                        results = benchmark_model.predict_steer(current_df, **kwargs)
+                    # Store the results in current_df
+                    for k, v in results.items():
+                        current_df[f"{model_name}_{k}"] = v
+                release(model_name, benchmark_model)
+        for concept_id, current_df, _, _ in concept_group:
+            with profile_tags(concept_id=concept_id):
+                save(dump_dir, 'steering', current_df, rank)
+            logger.warning(f"Saved inference results for concept {concept_id} to rank_{rank}_steering_data.parquet")
+            # After processing, record the methods and mark the concept as done
+            record_methods(ledger, "inference_steering", concept_id, concept_model_names[concept_id], current_df, rank)
+            concept_queue.complete(concept_id)
+    concept_queue.close()
 
     # Synchronize all processes
     dist.barrier()
 
     # Rank 0 merges results
     if rank == 0:
+        concept_queue.remove_if_done()
         logger.warning("Rank 0 is merging results.")
-        # Merge per-rank results
-        all_parquet_files = list((Path(dump_dir) / "inference").glob("rank_*_steering_data.parquet"))
-        # Parse filenames to extract rank
-        import re
-        pattern = re.compile(r'rank_(\d+)_steering_data\.parquet')
-
-        file_info_list = []
-        for parquet_file in all_parquet_files:
-            match = pattern.match(parquet_file.name)
-            if match:
-                rank_str = match.group(1)
-                rank_int = int(rank_str)
-                file_info_list.append({
-                    'rank': rank_int,
-                    'file': parquet_file
-                })
-            else:
-                logger.warning(f"Filename {parquet_file.name} does not match the expected pattern.")
-
-        # Sort the file_info_list by rank
-        file_info_list.sort(key=lambda x: x['rank'])
-
-        # Read and concatenate dataframes
-        dfs = []
-        for info in file_info_list:
-            df = pd.read_parquet(info['file'])
-            dfs.append(df)
-        if len(dfs) > 0:
-            combined_df = pd.concat(dfs, ignore_index=True)
-            # Optionally sort combined_df by 'concept_id' if needed
-            combined_df = combined_df.sort_values(by=['concept_id', 'input_id', 'factor']).reset_index(drop=True)
-            combined_df.to_parquet(Path(dump_dir) / "inference" / "steering_data.parquet", engine='pyarrow')
-            logger.warning(f"Saved combined steering inference results to {Path(dump_dir) / 'inference' / 'steering_data.parquet'}")
-        else:
-            logger.warning("No results to merge.")
-
-        # Optionally, delete per-rank files
-        for info in file_info_list:
-            os.remove(info['file'])
-            logger.warning(f"Deleted {info['file']}")
+        merge_rank_files(
+            dump_dir, "steering", load_saved_ranks(ledger, "inference_steering"),
+            sort_by=PARTITION_SORT_BY["steering"])
 
 
 def infer_latent(args, rank, world_size, device, logger, training_args, generate_args):
@@ -404,27 +769,34 @@ def infer_latent(args, rank, world_size, device, logger, training_args, generate
     metadata = load_metadata_flatten(data_dir)
     layer = config["layer"] if config else 0  # default layer for prompt baselines
 
-    state = load_state(args.dump_dir, "latent", rank)
-    last_concept_id_processed = state.get("last_concept_id", None) if state else None
-    logger.warning(f"Rank {rank} last concept_id processed: {last_concept_id_processed}")
-
     # Get list of all concept_ids
     concept_ids = [metadata[i]["concept_id"] for i in range(len(metadata))]
 
-    # Partition concept_ids among ranks sequentially
-    concept_ids_per_rank = partition_concept_ids(concept_ids, world_size)
-    my_concept_ids = concept_ids_per_rank[rank]
-
-    if last_concept_id_processed is not None:
-        if last_concept_id_processed in my_concept_ids:
-            idx = my_concept_ids.index(last_concept_id_processed)
-            my_concept_ids = my_concept_ids[idx+1:]
-        else:
-            # If last_concept_id_processed is not in my_concept_ids, process all
-            pass
-
-    if len(my_concept_ids) == 0:
+    # Only (concept, method) units missing from the progress ledger are inferred.
+    ledger = ProgressLedger(Path(dump_dir) / PROGRESS_LEDGER_FILE)
+    model_names = [model_name for model_name in args.models if model_name not in LATENT_EXCLUDE_MODELS]
+    if rank == 0:
+        migrate_state(ledger, "inference_latent", dump_dir, "latent", model_names)
+    dist.barrier()
+    # rank 0 reads the pending units for all ranks, so every rank opens the same queue.
+    pending_methods = [ledger.pending("inference_latent", concept_ids, model_names) if rank == 0 else None]
+    dist.broadcast_object_list(pending_methods, src=0)
+    pending_methods = pending_methods[0]
+    saved_ranks = load_saved_ranks(ledger, "inference_latent")
+
+    # Ranks pull concept_ids from a shared queue; completed concepts are never handed out again.
+    # Each set of pending units gets its own queue, so added or invalidated methods queue finished concepts again;
+    # finished queues are deleted.
+    concept_queue = ConceptWorkQueue(
+        Path(dump_dir) / "inference" / f"latent_{content_checksum(pending_methods)[:8]}_{CONCEPT_QUEUE_FILE}",
+        list(pending_methods.keys()), f"rank_{rank}")
+    queue_status = concept_queue.status()
+    logger.warning(f"Rank {rank} concept queue status: {queue_status}")
+    if queue_status["pending"] + queue_status["running"] == 0:
         logger.warning(f"Rank {rank} has no concepts to process. Exiting.")
+        dist.barrier()
+        if rank == 0:
+            concept_queue.remove_if_done()
         return
 
     # Create a new OpenAI client.
@@ -494,12 +866,19 @@ def infer_latent(args, rank, world_size, device, logger, training_args, generate
         return
 
     # Now loop over concept_ids and use preloaded models
-    cache_df = {}
-    for concept_id in my_concept_ids:
-        for model_name in args.models:
+    for concept_id in concept_queue:
+        # concepts with saved rows reuse them instead of new data.
+        current_df = load_saved_rows(dump_dir, "latent", concept_id, saved_ranks)
+        if current_df is None:
+            current_df = create_data_latent(
+                dataset_factory, metadata, concept_id, num_of_examples, args)
+            current_df = prepare_df(current_df, tokenizer, is_chat_model, args.model_name)
+        # saved rows may lack a finished method if its file is gone; it is redone then.
+        concept_model_names = [
+            model_name for model_name in model_names
+            if model_name in pending_methods[concept_id] or len(method_columns(current_df, model_name)) == 0]
+        for model_name in concept_model_names:
             # load model on the fly to save memory
-            if model_name in LATENT_EXCLUDE_MODELS:
-                continue
             model_class = getattr(axbench, model_name)
             logger.warning(f"Loading {model_class} on {device}.")
             benchmark_model = model_class(
@@ -516,19 +895,11 @@ def infer_latent(args, rank, world_size, device, logger, training_args, generate
                 benchmark_model.ax.eval()
                 benchmark_model.ax.to(torch.bfloat16)
 
-            dataset_category = generate_args.dataset_category
-            if (concept_id, dataset_category) not in cache_df:
-                current_df = create_data_latent(
-                    dataset_factory, metadata, concept_id, num_of_examples, args)
-                logger.warning(f"Inference latent with {model_name} on {device} for concept {concept_id}.")
-                current_df = prepare_df(current_df, tokenizer, is_chat_model, args.model_name)
-                cache_df[(concept_id, dataset_category)] = current_df
-            else:
-                current_df = cache_df[(concept_id, dataset_category)]
-
-            results = benchmark_model.predict_latent(
-                current_df, batch_size=args.latent_batch_size, prefix_length=prefix_length
-            )
+            logger.warning(f"Inference latent with {model_name} on {device} for concept {concept_id}.")
+            with profile_tags(concept_id=concept_id, method=model_name), span("predict_latent"):
+                results = benchmark_model.predict_latent(
+                    current_df, batch_size=args.latent_batch_size, prefix_length=prefix_length
+                )
             # Store the results in current_df
             for k, v in results.items():
                 if k == "tokens":
@@ -540,56 +911,23 @@ def infer_latent(args, rank, world_size, device, logger, training_args, generate
                     current_df[f"{model_name}_{k}"] = v
             del benchmark_model
             torch.cuda.empty_cache()
-        save(dump_dir, 'latent', current_df, rank)
+        with profile_tags(concept_id=concept_id):
+            save(dump_dir, 'latent', current_df, rank)
         logger.warning(f"Saved inference results for concept {concept_id} to rank_{rank}_latent_data.parquet")
-        # After processing, save state
-        current_state = {'last_concept_id': concept_id}
-        save_state(args.dump_dir, current_state, 'latent', rank)
+        # After processing, record the methods and mark the concept as done
+        record_methods(ledger, "inference_latent", concept_id, concept_model_names, current_df, rank)
+        concept_queue.complete(concept_id)
+    concept_queue.close()
 
     # Synchronize all processes
     dist.barrier()
 
     # Rank 0 merges results
     if rank == 0:
+        concept_queue.remove_if_done()
         logger.warning("Rank 0 is merging results.")
-        # Merge per-rank results
-        all_parquet_files = list((Path(dump_dir) / "inference").glob("rank_*_latent_data.parquet"))
-        # Parse filenames to extract rank
-        import re
-        pattern = re.compile(r'rank_(\d+)_latent_data\.parquet')
-
-        file_info_list = []
-        for parquet_file in all_parquet_files:
-            match = pattern.match(parquet_file.name)
-            if match:
-                rank_str = match.group(1)
-                rank_int = int(rank_str)
-                file_info_list.append({
-                    'rank': rank_int,
-                    'file': parquet_file
-                })
-            else:
-                logger.warning(f"Filename {parquet_file.name} does not match the expected pattern.")
-
-        # Sort the file_info_list by rank
-        file_info_list.sort(key=lambda x: x['rank'])
-
-        # Read and concatenate dataframes
-        dfs = []
-        for info in file_info_list:
-            df = pd.read_parquet(info['file'])
-            dfs.append(df)
-        if len(dfs) > 0:
-            combined_df = pd.concat(dfs, ignore_index=True)
-            combined_df.to_parquet(Path(dump_dir) / "inference" / "latent_data.parquet", engine='pyarrow')
-            logger.warning(f"Saved combined latent inference results to {Path(dump_dir) / 'inference' / 'latent_data.parquet'}")
-        else:
-            logger.warning("No results to merge.")
-
-        # Optionally, delete per-rank files
-        for info in file_info_list:
-            os.remove(info['file'])
-            logger.warning(f"Deleted {info['file']}")
+        merge_rank_files(
+            dump_dir, "latent", load_saved_ranks(ledger, "inference_latent"), sort_by=PARTITION_SORT_BY["latent"])
 
         # Save top logits (optional)
         logger.warning("Saving top logits...")
@@ -995,6 +1333,7 @@ def main():
     logger.addHandler(file_handler)
     """
 
+    start_profiling(args.dump_dir, f"inference_{args.mode}", rank)
     if args.mode == "latent":
         infer_latent(args, rank, world_size, device, logger, training_args, generate_args)
     elif args.mode == "latent_imbalance":
@@ -1007,6 +1346,7 @@ def main():
     elif args.mode == "all":
         infer_latent(args, rank, world_size, device, logger, training_args, generate_args)
         infer_steering(args, rank, world_size, device, logger, training_args, generate_args)
+    stop_profiling()
 
     # Finalize the process group
     dist.destroy_process_group()
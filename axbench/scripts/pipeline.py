@@ -0,0 +1,38 @@
+# run generate -> train -> inference -> evaluate, re-running only what changed.
+#
+# example launch command:
+#     python axbench/scripts/pipeline.py --config axbench/demo/sweep/simple.yaml --dump_dir axbench/demo --nproc_per_node 2
+
+import argparse
+
+from axbench.utils.pipeline import StageRunner, default_stages, load_pipeline_config
+
+import logging
+logging.basicConfig(format='%(asctime)s,%(msecs)03d %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s',
+    datefmt='%Y-%m-%d:%H:%M:%S',
+    level=logging.WARN)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the AxBench stage DAG.")
+    parser.add_argument("--config", type=str, required=True, help="The sweep YAML config.")
+    parser.add_argument("--dump_dir", type=str, required=True, help="The output directory of the run.")
+    parser.add_argument("--stages", type=str, nargs="+", default=None, help="Only run these stages.")
+    parser.add_argument("--nproc_per_node", type=int, default=1, help="Processes of the distributed stages.")
+    parser.add_argument("--max_workers", type=int, default=2, help="Stages running at the same time.")
+    parser.add_argument("--shared_dir", type=str, default=None,
+                        help="Directory with the outputs shared by the runs of a sweep.")
+    parser.add_argument("--dry_run", action="store_true", help="Only report the stages that would run.")
+    args = parser.parse_args()
+
+    runner = StageRunner(
+        default_stages(args.config, args.dump_dir, args.nproc_per_node),
+        load_pipeline_config(args.config), args.dump_dir,
+        max_workers=args.max_workers, shared_dir=args.shared_dir)
+    ran = runner.run(args.stages, dry_run=args.dry_run)
+    logger.warning(f"{'Would run' if args.dry_run else 'Ran'} stages: {', '.join(ran) if ran else 'none'}")
+
+
+if __name__ == "__main__":
+    main()
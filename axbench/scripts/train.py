@@ -9,6 +9,10 @@ import yaml
 import json
 import glob
 import pickle
+import bisect
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import shutil
 import requests
@@ -20,12 +24,17 @@ from pathlib import Path
 from args.training_args import TrainingArgs
 from args.dataset_args import DatasetArgs
 from axbench.utils.constants import * 
-from axbench.utils.model_utils import get_prefix_length, get_suffix_length
+from axbench.utils.model_utils import get_prefix_length, get_suffix_length, get_chat_template_formatter
 from transformers import set_seed
 import torch.distributed as dist
 import sys
 from torch.utils.data import DataLoader
 from axbench.models.sae import save_pruned_sae
+from axbench.utils.work_queue import ConceptWorkQueue
+from axbench.utils.ledger import ProgressLedger, PROGRESS_LEDGER_FILE, content_checksum
+from axbench.utils.weight_snapshot import WeightSnapshot
+from axbench.models.sft import uses_fsdp
+from axbench.utils.profiler import start_profiling, stop_profiling, span, profile_tags
 
 # all supported methods
 import axbench
@@ -36,8 +45,10 @@ import logging
 logger = logging.getLogger(__name__)
 
 CONFIG_FILE = "config.json"
-STATE_FILE = "train_state.pkl"
 METADATA_FILE = "metadata.jsonl"
+CONCEPT_QUEUE_FILE = "concept_queue.sqlite"
+# methods whose per-rank artifacts rank 0 merges at the same time.
+MERGE_WORKERS = 4
 
 
 def data_generator(data_dir):
@@ -94,6 +105,7 @@ def prepare_df(
     suffix_length, suffix_str = get_suffix_length(tokenizer)
     print(f"Suffix length for {model_name}: {suffix_length}, Suffix string: {suffix_str}")
     genre = metadata["concept_genres_map"][concept][0]
+    system_prompt = "You are a helpful assistant." if model_name == "meta-llama/Llama-3.1-8B-Instruct" else None
     # assign input and output containing concept with 1, otherwise 0
     positive_df = original_df[(original_df["output_concept"] == concept) & (original_df["category"] == "positive")]
     negative_df = negative_df[(negative_df["concept_genre"] == genre)]
@@ -101,37 +113,15 @@ def prepare_df(
         positive_df = positive_df.head(max_num_of_examples // 2)
         negative_df = negative_df.head(max_num_of_examples // 2)
     if binarize:
+        positive_df = positive_df.copy()
+        negative_df = negative_df.copy()
         if is_chat_model:
-            if model_name == "meta-llama/Llama-3.1-8B-Instruct":
-                def apply_chat_template(row):
-                    messages = [
-                        {"role": "system", "content": "You are a helpful assistant."}, 
-                        {"role": "user", "content": row["input"]},
-                        {"role": "assistant", "content": row["output"]}
-                    ]
-                    nobos = tokenizer.apply_chat_template(
-                        messages, tokenize=True, add_generation_prompt=True)[1:-suffix_length]
-                    return tokenizer.decode(nobos)
-                positive_df = positive_df.copy()
-                negative_df = negative_df.copy()
-                positive_df['combined'] = positive_df.apply(apply_chat_template, axis=1)
-                negative_df['combined'] = negative_df.apply(apply_chat_template, axis=1)
-            else:
-                def apply_chat_template(row):
-                    messages = [
-                        {"role": "user", "content": row["input"]},
-                        {"role": "assistant", "content": row["output"]}
-                    ]
-                    nobos = tokenizer.apply_chat_template(
-                        messages, tokenize=True, add_generation_prompt=True)[1:-suffix_length]
-                    return tokenizer.decode(nobos)
-                positive_df = positive_df.copy()
-                negative_df = negative_df.copy()
-                positive_df['combined'] = positive_df.apply(apply_chat_template, axis=1)
-                negative_df['combined'] = negative_df.apply(apply_chat_template, axis=1)
+            formatter = get_chat_template_formatter(
+                tokenizer, system_prompt=system_prompt, with_output=True, 
+                add_generation_prompt=True, strip_suffix=True)
+            positive_df['combined'] = formatter(positive_df['input'], positive_df['output'])
+            negative_df['combined'] = formatter(negative_df['input'], negative_df['output'])
         else:
-            positive_df = positive_df.copy()
-            negative_df = negative_df.copy()
             positive_df['combined'] = positive_df['input'] + positive_df['output']
             negative_df['combined'] = negative_df['input'] + negative_df['output']
         positive_df = pd.DataFrame(positive_df[['combined']]).rename(columns={'combined': 'input'})
@@ -146,70 +136,293 @@ def prepare_df(
         else:
             all_df = positive_df
         if is_chat_model:
+            formatter = get_chat_template_formatter(tokenizer, system_prompt=system_prompt)
+            all_df['input'] = formatter(all_df['input'])
             if model_name == "meta-llama/Llama-3.1-8B-Instruct":
-                def apply_chat_template(row):
-                    messages = [
-                        {"role": "system", "content": "You are a helpful assistant."}, 
-                        {"role": "user", "content": row["input"]},
-                    ]
-                    nobos = tokenizer.apply_chat_template(messages, tokenize=True, add_generation_prompt=True)[1:]
-                    return tokenizer.decode(nobos)
-                all_df['input'] = all_df.apply(apply_chat_template, axis=1)
-
                 # handling output separately.
-                def apply_chat_template_for_output(row):
-                    if len(tokenizer.tokenize(row["output"])) < output_length:
-                        return row["output"] + suffix_str
-                    else:
-                        return row["output"]
-                all_df['output'] = all_df.apply(apply_chat_template_for_output, axis=1)
-            else:
-                def apply_chat_template(row):
-                    messages = [{"role": "user", "content": row["input"]}]
-                    nobos = tokenizer.apply_chat_template(messages, tokenize=True, add_generation_prompt=True)[1:]
-                    return tokenizer.decode(nobos)
-                all_df['input'] = all_df.apply(apply_chat_template, axis=1)
+                output_lengths = np.array([
+                    len(ids) for ids in tokenizer(all_df['output'].tolist(), add_special_tokens=False)["input_ids"]])
+                all_df['output'] = np.where(
+                    output_lengths < output_length, all_df['output'] + suffix_str, all_df['output'])
         return all_df # do nothing, the task will be standard instruction tuning.
 
 
-def partition_list(lst, n):
+def merge_concept_blocks(tensors, ranges, dim=0):
+    """
+    Concatenate the per-concept blocks of `tensors` along `dim`: `ranges`
+    are the `(start, end)` rows of the blocks, in rows of the concatenated
+    `tensors` and in output order. Rows in no range (e.g. of a superseded
+    concept) are dropped. Every block is copied once, straight from its
+    shard into the output, so with memory-mapped shards only the output is
+    held in memory.
     """
-    Partition a list into n approximately equal slices.
+    sizes = [tensor.shape[dim] for tensor in tensors]
+    total = sum(sizes)
+    coalesced = []
+    for start, end in ranges:
+        if end > total:
+            raise ValueError(f"Rows {start}:{end} are out of the {total} saved rows.")
+        if len(coalesced) > 0 and coalesced[-1][1] == start:
+            coalesced[-1] = (coalesced[-1][0], end)
+        else:
+            coalesced.append((start, end))
 
-    Args:
-        lst (list): The list to partition.
-        n (int): The number of partitions.
+    shape = list(tensors[0].shape)
+    shape[dim] = sum(end - start for start, end in coalesced)
+    dtype = functools.reduce(torch.promote_types, [tensor.dtype for tensor in tensors])
+    merged = torch.empty(shape, dtype=dtype)
+    offsets = list(itertools.accumulate(sizes, initial=0))
+    out_start = 0
+    for start, end in coalesced:
+        # a range may span the end of one shard and the start of the next.
+        while start < end:
+            i = bisect.bisect_right(offsets, start) - 1
+            length = min(end, offsets[i + 1]) - start
+            merged.narrow(dim, out_start, length).copy_(tensors[i].narrow(dim, start - offsets[i], length))
+            start, out_start = start + length, out_start + length
+    return merged
+
+
+def load_shard(path):
+    """The tensor (or dict of tensors) saved in `path`, memory-mapped instead of read."""
+    return torch.load(path, mmap=True)
+
+
+def shard_rows(shard):
+    """Rows of a tensor shard, or of the tensors of a dict shard."""
+    return next(iter(shard.values())).shape[0] if isinstance(shard, dict) else shard.shape[0]
 
-    Returns:
-        list of lists: A list containing n sublists.
-    """
-    k, m = divmod(len(lst), n)
-    return [lst[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n)]
 
+def merge_shards(shards, ranges, dim=0):
+    """`merge_concept_blocks` of tensor shards, or of every key of dict shards."""
+    if isinstance(shards[0], dict):
+        return {key: merge_concept_blocks([shard[key] for shard in shards], ranges, dim=dim) for key in shards[0].keys()}
+    return merge_concept_blocks(shards, ranges, dim=dim)
 
-def load_state(dump_dir, rank):
+
+def artifact_rows(dump_dir, model_name):
     """
-    Load the state from a file if it exists.
+    Rows saved so far to the artifacts of `model_name`: of its weight file,
+    or else one per entry of its top features file.
     """
-    state_path = os.path.join(f"{dump_dir}", f"{STATE_FILE}_rank_{rank}")
-    if os.path.exists(state_path):
-        with open(state_path, "rb") as f:
-            return pickle.load(f)
-    return None
+    weight_file = dump_dir / f"{model_name}_weight.pt"
+    if weight_file.exists():
+        return shard_rows(load_shard(weight_file))
+    top_features_file = dump_dir / f"{model_name}_top_features.json"
+    if top_features_file.exists():
+        with open(top_features_file, "r") as f:
+            return len(json.load(f))
+    return 0
 
 
-def save_state(dump_dir, state, concept_metadata, rank):
-    dump_dir = Path(dump_dir)
-    dump_dir.mkdir(parents=True, exist_ok=True)
-    # Save state
-    state_path = os.path.join(dump_dir, f"{STATE_FILE}_rank_{rank}")
-    with open(state_path, "wb") as f:
-        pickle.dump(state, f)
+def saved_rows(rows_before, rows_after, n_concepts):
+    """The `[start, end)` rows that a save of `n_concepts` concepts appended, one equal block per concept."""
+    if rows_after == rows_before:
+        return [None] * n_concepts # nothing saved to rank files, e.g. folder-based methods.
+    block_size = (rows_after - rows_before) // n_concepts
+    return [[rows_before + i * block_size, rows_before + (i + 1) * block_size] for i in range(n_concepts)]
+
 
-    # Save metadata again
-    metadata_path = os.path.join(dump_dir, f"rank_{rank}_{METADATA_FILE}")
-    with open(metadata_path, "a") as f:
-        f.write(json.dumps(concept_metadata) + "\n")
+def migrate_state(ledger, dump_dir, model_names, world_size):
+    """
+    Record the concepts of a run started before the ledger existed as trained
+    for every method: merged ones first, then the ones still in rank files.
+    """
+    if ledger.has_stage("train"):
+        return
+    entries, concept_ids = [], []
+    metadata_path = os.path.join(dump_dir, METADATA_FILE)
+    if os.path.exists(metadata_path):
+        concept_ids = sorted({entry["concept_id"] for entry in load_metadata(metadata_path)})
+        entries += [
+            {"stage": "train", "concept_id": concept_id, "method": model_name, "checksum": None, "migrated": True}
+            for concept_id in concept_ids for model_name in model_names]
+        entries += [
+            {"stage": "train_merge", "concept_id": None, "method": model_name, "checksum": None, "migrated": True}
+            for model_name in model_names]
+    for rank in range(world_size):
+        metadata_path = os.path.join(dump_dir, f"rank_{rank}_{METADATA_FILE}")
+        if not os.path.exists(metadata_path):
+            continue
+        # rank metadata files keep every concept of the rank, merged or not.
+        entries += [
+            {"stage": "train", "concept_id": entry["concept_id"], "method": model_name,
+             "checksum": None, "rank": rank, "migrated": True}
+            for entry in load_metadata(metadata_path) if entry["concept_id"] not in set(concept_ids)
+            for model_name in model_names]
+    if len(entries) > 0:
+        ledger.record_many(entries)
+
+
+def concept_row_ranges(merged_concept_ids, rank_blocks, merged_rows, rank_rows):
+    """
+    Rows of the latest block of every concept, sorted by concept_id, in rows
+    of the merged artifact (`merged_rows` rows) followed by the per-rank
+    artifacts (`rank_rows[rank]` rows each, rank by rank).
+
+    The merged artifact holds one equal block per merged concept. Rank
+    blocks are at the rows recorded in the ledger, so rows saved without a
+    record (e.g. by a rank stopped in between) are dropped; blocks recorded
+    before the ledger kept rows are equal blocks in ledger order. Raises
+    ValueError if the saved rows do not match the ledger.
+    """
+    offsets = list(itertools.accumulate(rank_rows, initial=merged_rows))
+    blocks = {}
+    if len(merged_concept_ids) > 0:
+        if merged_rows % len(merged_concept_ids) != 0:
+            raise ValueError(f"Cannot split {merged_rows} merged rows into {len(merged_concept_ids)} concept blocks.")
+        block_size = merged_rows // len(merged_concept_ids)
+        for i, concept_id in enumerate(merged_concept_ids):
+            blocks[concept_id] = (i * block_size, (i + 1) * block_size)
+    for rank, concept_blocks in sorted(rank_blocks.items()):
+        if any(rows is None for _, rows in concept_blocks):
+            if rank_rows[rank] % len(concept_blocks) != 0:
+                raise ValueError(
+                    f"Cannot split {rank_rows[rank]} rows of rank {rank} into {len(concept_blocks)} concept blocks.")
+            block_size = rank_rows[rank] // len(concept_blocks)
+            concept_blocks = [
+                (concept_id, (i * block_size, (i + 1) * block_size)) for i, (concept_id, _) in enumerate(concept_blocks)]
+        for concept_id, (start, end) in concept_blocks:
+            if end > rank_rows[rank]:
+                raise ValueError(
+                    f"Rows {start}:{end} of concept {concept_id} are missing from the {rank_rows[rank]} rows of rank {rank}.")
+            blocks[concept_id] = (offsets[rank] + start, offsets[rank] + end)
+    return [blocks[concept_id] for concept_id in sorted(blocks)]
+
+
+def model_checksum(benchmark_model, row=None):
+    """Checksum of a trained projection (or of its `row`-th concept), for methods that have one."""
+    proj = getattr(getattr(benchmark_model, "ax", None), "proj", None)
+    weight = getattr(proj, "weight", None)
+    if not isinstance(weight, torch.Tensor):
+        return None
+    return content_checksum(weight if row is None else weight[row:row + 1])
+
+
+def claim_concept_groups(concept_queue, group_size):
+    """Claim concepts from the queue `group_size` at a time."""
+    while True:
+        concept_group = []
+        while len(concept_group) < group_size:
+            concept_id = concept_queue.claim()
+            if concept_id is None:
+                break
+            concept_group.append(concept_id)
+        if len(concept_group) == 0:
+            return
+        yield concept_group
+
+
+def load_merge_order(ledger, model_name, world_size):
+    """
+    Concept ids of the blocks of the merged artifacts of `model_name`, and
+    the `(concept_id, rows)` blocks of its per-rank artifacts by rank, read
+    from the ledger.
+
+    Ranks record every concept with the `[start, end)` rows its save
+    appended to their rank files (None before the ledger kept rows); every
+    merge is marked with a "train_merge" entry. A retrained concept appears
+    twice; its latest rows win.
+    """
+    merged_concept_ids, rank_blocks = set(), {rank: [] for rank in range(world_size)}
+    for entry in ledger.entries({"train", "train_merge"}):
+        if entry["method"] != model_name:
+            continue
+        if entry["stage"] == "train_merge":
+            for concept_blocks in rank_blocks.values():
+                merged_concept_ids.update(concept_id for concept_id, _ in concept_blocks)
+                concept_blocks.clear()
+        elif entry.get("rank") in rank_blocks:
+            rows = entry.get("rows")
+            rank_blocks[entry["rank"]].append((entry["concept_id"], tuple(rows) if rows is not None else None))
+        elif "rank" not in entry:
+            merged_concept_ids.add(entry["concept_id"]) # merged before the ledger existed.
+    return sorted(merged_concept_ids), rank_blocks
+
+
+def merge_method_files(dump_dir, model_name, merged_concept_ids, rank_blocks, world_size):
+    """
+    Merge the per-rank artifacts of `model_name` into its merged artifacts,
+    with the blocks of earlier merges, sorted by concept_id. Shards are
+    memory-mapped and copied block by block into the merged tensors.
+    Returns the per-rank files to delete once the merge is recorded.
+    """
+    # ranks process concepts in any order, the merged artifacts are sorted by concept_id.
+    def merge_plan(merged, rank_artifacts, rows):
+        """The existing artifacts to merge, and the rows of every concept block in their concatenation."""
+        ranges = concept_row_ranges(
+            merged_concept_ids if merged is not None else [], rank_blocks,
+            rows(merged) if merged is not None else 0,
+            [rows(artifact) if artifact is not None else 0 for artifact in rank_artifacts])
+        artifacts = [artifact for artifact in [merged] + rank_artifacts if artifact is not None]
+        return artifacts, ranges
+    def load_merged(merged_file, load):
+        return load(merged_file) if len(merged_concept_ids) > 0 and merged_file.exists() else None
+
+    # merge pruned SAEs
+    sae_files = [dump_dir / f"rank_{r}_{model_name}.pt" for r in range(world_size)]
+    sae_files_existing = [f for f in sae_files if f.exists()]
+    if not sae_files_existing:
+        logger.warning(f"No SAE files found for model {model_name}. Skipping.")
+    else:
+        # the merged SAE is rebuilt from the newly trained concepts only.
+        sae_weights, ranges = merge_plan(
+            None, [load_shard(f) if f.exists() else None for f in sae_files],
+            lambda sae_weight: sae_weight["W_dec"].shape[0])
+        combined_sae_params = {"b_dec": sae_weights[0]["b_dec"].clone()}
+        for k in ["W_dec", "W_enc", "b_enc", "threshold"]:
+            combined_sae_params[k] = merge_concept_blocks(
+                [sae_weight[k] for sae_weight in sae_weights], ranges, dim=1 if k == "W_enc" else 0)
+        torch.save(combined_sae_params, dump_dir / f"{model_name}.pt")
+        logger.warning(f"Saved merged SAE weights for model {model_name}")
+
+    # merge top features
+    def load_json(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    top_features_files = [dump_dir / f"rank_{r}_{model_name}_top_features.json" for r in range(world_size)]
+    top_features_files_existing = [f for f in top_features_files if f.exists()]
+    if not top_features_files_existing:
+        logger.warning(f"No top features files found for model {model_name}. Skipping.")
+    else:
+        top_features, ranges = merge_plan(
+            load_merged(dump_dir / f"{model_name}_top_features.json", load_json),
+            [load_json(f) if f.exists() else None for f in top_features_files], len)
+        top_features = list(itertools.chain.from_iterable(top_features))
+        combined_top_features = [top_feature for start, end in ranges for top_feature in top_features[start:end]]
+        with open(dump_dir / f"{model_name}_top_features.json", "w") as f:
+            json.dump(combined_top_features, f)
+        logger.warning(f"Saved merged top features for model {model_name}")
+
+    # Collect per-rank weight and bias files
+    weight_files = [dump_dir / f"rank_{r}_{model_name}_weight.pt" for r in range(world_size)]
+    bias_files = [dump_dir / f"rank_{r}_{model_name}_bias.pt" for r in range(world_size)]
+
+    # Check if files exist
+    weight_files_existing = [f for f in weight_files if f.exists()]
+    bias_files_existing = [f for f in bias_files if f.exists()]
+
+    if not weight_files_existing or not bias_files_existing:
+        logger.warning(f"No weight or bias files found for model {model_name}. Skipping.")
+    else:
+        # Map weights and biases, after the ones of earlier merges, and copy their blocks in concept order
+        weight_file = dump_dir / f"{model_name}_weight.pt"
+        bias_file = dump_dir / f"{model_name}_bias.pt"
+        merged_weight = merge_shards(*merge_plan(
+            load_merged(weight_file, load_shard), [load_shard(f) if f.exists() else None for f in weight_files],
+            shard_rows))
+        merged_bias = merge_shards(*merge_plan(
+            load_merged(bias_file, load_shard), [load_shard(f) if f.exists() else None for f in bias_files],
+            shard_rows))
+
+        # Save merged weight and bias files, replacing the mapped ones only once written
+        for merged, merged_file in [(merged_weight, weight_file), (merged_bias, bias_file)]:
+            tmp_file = merged_file.with_suffix(".pt.tmp")
+            torch.save(merged, tmp_file)
+            os.replace(tmp_file, merged_file)
+        logger.warning(f"Saved merged weights and biases for model {model_name}")
+
+    return weight_files_existing + bias_files_existing + top_features_files_existing
 
 def main():
    
@@ -276,6 +489,7 @@ def main():
 
     dump_dir = Path(args.dump_dir) / "train"
     dump_dir.mkdir(parents=True, exist_ok=True)
+    start_profiling(args.dump_dir, "train", rank)
     
     # save pruned SAE
     sae_params = None # TODO: this is a workaround to avoid breaking the code.
@@ -286,18 +500,26 @@ def main():
     tokenizer = AutoTokenizer.from_pretrained(args.model_name, model_max_length=512)
     tokenizer.padding_side = "right"
 
-    # Partition df_list among ranks
-    df_list_per_rank = partition_list(df_list, world_size)
-    my_df_list = df_list_per_rank[rank]
-
-    # Load model instance onto device
-    if args.use_bf16:
-        logger.warning(f"Using bfloat16 for model {args.model_name}")
-    model_instance = AutoModelForCausalLM.from_pretrained(
-        args.model_name, torch_dtype=torch.bfloat16 if args.use_bf16 else None)
-    is_chat_model = True if args.model_name in CHAT_MODELS else False
-    model_instance = model_instance.eval()
-    model_instance.to(device)
+    # Only (concept, method) units missing from the progress ledger are trained.
+    ledger = ProgressLedger(Path(args.dump_dir) / PROGRESS_LEDGER_FILE)
+    model_names = sorted(args.models.keys())
+    if rank == 0:
+        migrate_state(ledger, dump_dir, model_names, world_size)
+    dist.barrier()
+    concept_dfs = {int(concept_id): concept_df for concept_id, concept_df in df_list}
+    # rank 0 reads the pending units for all ranks, so every rank opens the same queue.
+    pending_methods = [ledger.pending("train", concept_dfs.keys(), model_names) if rank == 0 else None]
+    dist.broadcast_object_list(pending_methods, src=0)
+    pending_methods = pending_methods[0]
+    logger.warning(f"Rank {rank} found {len(pending_methods)} concepts with untrained methods.")
+
+    # Ranks pull concepts from a shared queue; completed concepts are never handed out again.
+    # Each set of pending units gets its own queue, so added or invalidated methods queue finished concepts again;
+    # finished queues are deleted.
+    concept_queue = ConceptWorkQueue(
+        dump_dir / f"{content_checksum(pending_methods)[:8]}_{CONCEPT_QUEUE_FILE}",
+        list(pending_methods.keys()), f"rank_{rank}")
+    logger.warning(f"Rank {rank} concept queue status: {concept_queue.status()}")
 
     if tokenizer.unk_token == None and tokenizer.pad_token == None:
         # raw llama3
@@ -306,107 +528,165 @@ def main():
         need_resize = True
     else:
         need_resize = False
-    if need_resize:
-        model_instance.resize_token_embeddings(len(tokenizer))
+
+    def load_model_instance():
+        # Load model instance onto device
+        if args.use_bf16:
+            logger.warning(f"Using bfloat16 for model {args.model_name}")
+        model_instance = AutoModelForCausalLM.from_pretrained(
+            args.model_name, torch_dtype=torch.bfloat16 if args.use_bf16 else None)
+        model_instance = model_instance.eval()
+        model_instance.to(device)
+        if need_resize:
+            model_instance.resize_token_embeddings(len(tokenizer))
+        return model_instance
+
+    model_instance = load_model_instance()
+    is_chat_model = True if args.model_name in CHAT_MODELS else False
+
+    # Methods training the base model are undone from a CPU copy of its weights, not by reloading it.
+    # FSDP renames and flattens the parameters SFT trains, so the base model is reloaded after it instead.
+    reload_after_sft = "SFT" in model_names and uses_fsdp(args.model_name)
+    snapshot_methods = {"LoRA"} if reload_after_sft else {"SFT", "LoRA"}
+    weight_snapshot = WeightSnapshot(model_instance) if snapshot_methods & set(model_names) else None
 
     prefix_length = 1 # prefix is default to 1 for all models due to theBOS token.
     if is_chat_model:
         prefix_length = get_prefix_length(tokenizer)
         logger.warning(f"Chat model prefix length: {prefix_length}")
 
-    state = load_state(dump_dir, rank)
-    last_concept_id = state.get("last_concept_id", None) if state else None
-    logger.warning(f"Rank {rank} last concept_id processed: {last_concept_id}")
-
-    # Run training for assigned concept_ids
+    # Methods with `train_concepts` train `concepts_per_step` rank-1 concepts in the same base-model passes.
+    concepts_per_step = {
+        model_name: args.models[model_name].concepts_per_step for model_name in model_names
+        if (args.models[model_name].concepts_per_step or 1) > 1 and (args.models[model_name].low_rank_dimension or 1) == 1
+        and hasattr(getattr(axbench, model_name), "train_concepts")}
+    if concepts_per_step:
+        logger.warning(f"Training concepts jointly: {concepts_per_step}")
+
+    def make_benchmark_model(model_name, concept_id, low_rank_dimension):
+        benchmark_model = getattr(axbench, model_name)(
+            model_instance, tokenizer, layer=args.layer,
+            training_args=args.models[model_name],
+            lm_model_name=args.model_name,
+            device=device, seed=args.seed, 
+        )
+        benchmark_model.make_model(
+            mode="train",
+            low_rank_dimension=low_rank_dimension,
+            dtype=torch.bfloat16 if args.use_bf16 else None,
+            intervention_type=args.models[model_name].intervention_type,
+            concept_id=concept_id,
+            sae_params=sae_params,
+            metadata_path=metadata_path,
+            dump_dir=dump_dir,
+            model_params=args.models[model_name]
+        )
+        if model_name not in {"LoReFT", "LoRA", "SFT", "BoW"} and args.use_bf16:
+            benchmark_model.ax.to(torch.bfloat16)
+        return benchmark_model
+
+    def train_kwargs(model_name):
+        return {
+            "prefix_length": prefix_length,
+            "positions": args.models[model_name].intervention_positions,
+            "exclude_bos": args.models[model_name].exclude_bos,
+            "metadata_path": metadata_path,
+        }
+
+    def prepare_concept_df(model_name, concept_id):
+        return prepare_df(
+            concept_dfs[concept_id].copy(), negative_df, metadata[concept_id]["concept"], metadata[concept_id], tokenizer, 
+            binarize=args.models[model_name].binarize_dataset, 
+            train_on_negative=args.models[model_name].train_on_negative,
+            is_chat_model=is_chat_model,
+            output_length=generate_args.output_length,
+            model_name=args.model_name,
+            max_num_of_examples=args.max_num_of_examples,
+        )
+
+    # Run training for claimed concept_ids
     # logger.warning(metadata)
 
-    for concept_id, concept_df in my_df_list:
-        concept_id = int(concept_id)
-        if last_concept_id is not None and concept_id <= last_concept_id:
-            logger.warning(f"Rank {rank} skipping concept_id {concept_id} because it is already processed")
-            continue
-        logger.warning(f"Training models for concept_id {concept_id} on rank {rank}")
-        for model_name in sorted(args.models.keys()):
-            concept = metadata[concept_id]["concept"]
-            logger.warning(f"Training {model_name} with concept {concept}")
-            benchmark_model = getattr(axbench, model_name)(
-                model_instance, tokenizer, layer=args.layer,
-                training_args=args.models[model_name],
-                lm_model_name=args.model_name,
-                device=device, seed=args.seed, 
-            )
-            low_rank_dimension = args.models[model_name].low_rank_dimension \
-                if args.models[model_name].low_rank_dimension else 1
-            benchmark_model.make_model(
-                mode="train",
-                low_rank_dimension=low_rank_dimension,
-                dtype=torch.bfloat16 if args.use_bf16 else None,
-                intervention_type=args.models[model_name].intervention_type,
-                concept_id=concept_id,
-                sae_params=sae_params,
-                metadata_path=metadata_path,
-                dump_dir=dump_dir,
-                model_params=args.models[model_name]
-            )
-            if model_name not in {"LoReFT", "LoRA", "SFT", "BoW"} and args.use_bf16:
-                benchmark_model.ax.to(torch.bfloat16)
-            kwargs = {
-                "prefix_length": prefix_length,
-                "positions": args.models[model_name].intervention_positions,
-                "exclude_bos": args.models[model_name].exclude_bos,
-                "metadata_path": metadata_path,
-            }
-            prepared_df = concept_df.copy()
-            prepared_df = prepare_df(
-                prepared_df, negative_df, concept, metadata[concept_id], tokenizer, 
-                binarize=args.models[model_name].binarize_dataset, 
-                train_on_negative=args.models[model_name].train_on_negative,
-                is_chat_model=is_chat_model,
-                output_length=generate_args.output_length,
-                model_name=args.model_name,
-                max_num_of_examples=args.max_num_of_examples,
-            )
-            benchmark_model.train(prepared_df, **kwargs)
-            benchmark_model.save(dump_dir, model_name=f"rank_{rank}_{model_name}")
-            if model_name == "SFT":
-                # we need to reload the original model after SFT.
-                if args.use_bf16:
-                    logger.warning(f"Using bfloat16 for model {args.model_name}")
-                model_instance = AutoModelForCausalLM.from_pretrained(
-                    args.model_name, torch_dtype=torch.bfloat16 if args.use_bf16 else None)
-                is_chat_model = True if args.model_name in CHAT_MODELS else False
-                model_instance = model_instance.eval()
-                model_instance.to(device)
-            if model_name == "LoRA":
-                model_instance = benchmark_model.ax_model.unload()
-            logger.warning(f"Saved weights and biases for model {model_name} on rank {rank}")
-            # Clean up
-            del benchmark_model
-            torch.cuda.empty_cache()
-        # After processing, save state
-        current_state = {'last_concept_id': concept_id}
-        save_state(dump_dir, current_state, metadata[concept_id], rank)
+    for concept_group in claim_concept_groups(concept_queue, max(concepts_per_step.values(), default=1)):
+        for concept_id in concept_group:
+            logger.warning(f"Training models for concept_id {concept_id} on rank {rank}")
+            for model_name in pending_methods[concept_id]:
+                if model_name in concepts_per_step:
+                    continue
+                concept = metadata[concept_id]["concept"]
+                logger.warning(f"Training {model_name} with concept {concept}")
+                low_rank_dimension = args.models[model_name].low_rank_dimension \
+                    if args.models[model_name].low_rank_dimension else 1
+                with profile_tags(concept_id=concept_id, method=model_name):
+                    benchmark_model = make_benchmark_model(model_name, concept_id, low_rank_dimension)
+                    with span("train"):
+                        benchmark_model.train(prepare_concept_df(model_name, concept_id), **train_kwargs(model_name))
+                    with span("save_weights"):
+                        rows_before = artifact_rows(dump_dir, f"rank_{rank}_{model_name}")
+                        benchmark_model.save(dump_dir, model_name=f"rank_{rank}_{model_name}")
+                        rows = saved_rows(rows_before, artifact_rows(dump_dir, f"rank_{rank}_{model_name}"), 1)
+                # the record points the merge at the rows just saved, so rows saved without one are never merged.
+                ledger.record(
+                    "train", concept_id, method=model_name, checksum=model_checksum(benchmark_model), rank=rank,
+                    rows=rows[0])
+                if model_name == "LoRA":
+                    model_instance = benchmark_model.ax_model.unload()
+                if model_name == "SFT" and reload_after_sft:
+                    # we need to reload the original model after SFT.
+                    model_instance = load_model_instance()
+                    if weight_snapshot is not None:
+                        weight_snapshot.track(model_instance)
+                elif weight_snapshot is not None:
+                    # undo what the method did to the base model, e.g. SFT.
+                    weight_snapshot.restore()
+                logger.warning(f"Saved weights and biases for model {model_name} on rank {rank}")
+                # Clean up
+                del benchmark_model
+                torch.cuda.empty_cache()
+
+        for model_name, num_of_concepts in concepts_per_step.items():
+            joint_concept_ids = [concept_id for concept_id in concept_group if model_name in pending_methods[concept_id]]
+            for i in range(0, len(joint_concept_ids), num_of_concepts):
+                step_concept_ids = joint_concept_ids[i:i + num_of_concepts]
+                logger.warning(f"Training {model_name} jointly with concepts {step_concept_ids}")
+                # row i of the intervention is the subspace of the i-th concept.
+                with profile_tags(concept_id=step_concept_ids, method=model_name):
+                    benchmark_model = make_benchmark_model(model_name, step_concept_ids[0], len(step_concept_ids))
+                    with span("train"):
+                        benchmark_model.train_concepts(
+                            [prepare_concept_df(model_name, concept_id) for concept_id in step_concept_ids],
+                            **train_kwargs(model_name))
+                    with span("save_weights"):
+                        rows_before = artifact_rows(dump_dir, f"rank_{rank}_{model_name}")
+                        benchmark_model.save(dump_dir, model_name=f"rank_{rank}_{model_name}")
+                        rows = saved_rows(
+                            rows_before, artifact_rows(dump_dir, f"rank_{rank}_{model_name}"), len(step_concept_ids))
+                for row, concept_id in enumerate(step_concept_ids):
+                    ledger.record(
+                        "train", concept_id, method=model_name, checksum=model_checksum(benchmark_model, row), rank=rank,
+                        rows=rows[row])
+                logger.warning(f"Saved weights and biases for model {model_name} on rank {rank}")
+                del benchmark_model
+                torch.cuda.empty_cache()
+
+        for concept_id in concept_group:
+            concept_queue.complete(concept_id)
+    concept_queue.close()
 
     # Synchronize all processes
     dist.barrier()
 
     # Rank 0 merges results
     if rank == 0:
+        concept_queue.remove_if_done()
         logger.warning("Rank 0 is merging results.")
 
-        # Merging metadata
-        metadata_entries = []
-        for r in range(world_size):
-            metadata_path = os.path.join(dump_dir, f"rank_{r}_{METADATA_FILE}")
-            with open(metadata_path, "r") as f:
-                for line in f:
-                    metadata_entry = json.loads(line)
-                    metadata_entries.append(metadata_entry)
+        # Merging metadata: every concept with a trained method, sorted by concept_id.
+        trained_concept_ids = sorted({concept_id for concept_id, _ in ledger.completed("train")})
         metadata_path = os.path.join(dump_dir, METADATA_FILE)
-        with open(metadata_path, "a") as f:
-            for metadata_entry in metadata_entries:
-                f.write(json.dumps(metadata_entry) + "\n")
+        with open(metadata_path, "w") as f:
+            for concept_id in trained_concept_ids:
+                f.write(json.dumps(metadata[concept_id]) + "\n")
 
         # Save other config
         config = {"model_name": args.model_name,
@@ -416,99 +696,30 @@ def main():
         with open(config_path, 'w') as f:
             json.dump(config, f)
 
-        for model_name in sorted(args.models.keys()):
-            # merge pruned SAEs
-            sae_files = [dump_dir / f"rank_{r}_{model_name}.pt" for r in range(world_size)]
-            sae_files_existing = [f for f in sae_files if f.exists()]
-            if not sae_files_existing:
-                logger.warning(f"No SAE files found for model {model_name}. Skipping.")
-            else:
-                sae_weights = [torch.load(f) for f in sae_files_existing]
-                combined_sae_params = {
-                    "b_dec": sae_weights[0]["b_dec"],
-                    "W_dec": [],
-                    "W_enc": [],
-                    "b_enc": [],
-                    "threshold": [],
-                }
-                for sae_weight in sae_weights:
-                    combined_sae_params["W_dec"].append(sae_weight["W_dec"])
-                    combined_sae_params["W_enc"].append(sae_weight["W_enc"])
-                    combined_sae_params["b_enc"].append(sae_weight["b_enc"])
-                    combined_sae_params["threshold"].append(sae_weight["threshold"])
-                for k, v in combined_sae_params.items():
-                    if k == "b_dec":
-                        continue
-                    if k == "W_enc":
-                        combined_sae_params[k] = torch.cat(v, dim=1)
-                    else:
-                        combined_sae_params[k] = torch.cat(v, dim=0)
-                torch.save(combined_sae_params, dump_dir / f"{model_name}.pt")
-                logger.warning(f"Saved merged SAE weights for model {model_name}")
-            
-            # merge top features
-            top_features_files = [dump_dir / f"rank_{r}_{model_name}_top_features.json" for r in range(world_size)]
-            top_features_files_existing = [f for f in top_features_files if f.exists()]
-            if not top_features_files_existing:
-                logger.warning(f"No top features files found for model {model_name}. Skipping.")
-            else:
-                combined_top_features = []
-                for top_feature_file in top_features_files:
-                    with open(top_feature_file, "r") as f:
-                        top_feature = json.load(f)
-                        combined_top_features.extend(top_feature)
-                with open(dump_dir / f"{model_name}_top_features.json", "w") as f:
-                    json.dump(combined_top_features, f)
-                logger.warning(f"Saved merged top features for model {model_name}")
-
-            # Collect per-rank weight and bias files
-            weight_files = [dump_dir / f"rank_{r}_{model_name}_weight.pt" for r in range(world_size)]
-            bias_files = [dump_dir / f"rank_{r}_{model_name}_bias.pt" for r in range(world_size)]
-
-            # Check if files exist
-            weight_files_existing = [f for f in weight_files if f.exists()]
-            bias_files_existing = [f for f in bias_files if f.exists()]
-
-            if not weight_files_existing or not bias_files_existing:
-                logger.warning(f"No weight or bias files found for model {model_name}. Skipping.")
+        # merge the artifacts of every method in parallel; record each merge in method order.
+        merge_orders = {}
+        for model_name in model_names:
+            merged_concept_ids, rank_blocks = load_merge_order(ledger, model_name, world_size)
+            if not any(rank_blocks.values()):
+                logger.warning(f"No newly trained concepts for model {model_name}. Skipping.")
                 continue
-
-            # Load weights and biases
-            weights = [torch.load(f) for f in weight_files_existing]
-            biases = [torch.load(f) for f in bias_files_existing]
-
-            # Concatenate weights and biases
-            if isinstance(weights[0], dict):
-                merged_weight = {}
-                for key in weights[0].keys():
-                    weight_tensors = [w[key] for w in weights]
-                    merged_weight[key] = torch.cat(weight_tensors, dim=0)
-            else:
-                merged_weight = torch.cat(weights, dim=0)
-
-            # Handle dictionary biases
-            if isinstance(biases[0], dict):
-                merged_bias = {}
-                for key in biases[0].keys():
-                    bias_tensors = [b[key] for b in biases]
-                    merged_bias[key] = torch.cat(bias_tensors, dim=0)
-            else:
-                merged_bias = torch.cat(biases, dim=0)
-
-            # Save merged weight and bias files
-            weight_file = dump_dir / f"{model_name}_weight.pt"
-            bias_file = dump_dir / f"{model_name}_bias.pt"
-            torch.save(merged_weight, weight_file)
-            torch.save(merged_bias, bias_file)
-            logger.warning(f"Saved merged weights and biases for model {model_name}")
-
-            # Optionally delete per-rank files
-            for f in weight_files_existing + bias_files_existing:
-                try:
-                    f.unlink()
-                    logger.warning(f"Deleted file {f.name}")
-                except Exception as e:
-                    logger.error(f"Error deleting file {f.name}: {e}")
+            merge_orders[model_name] = (merged_concept_ids, rank_blocks)
+        def merge(model_name):
+            with span("merge", method=model_name):
+                return merge_method_files(dump_dir, model_name, *merge_orders[model_name], world_size)
+        with ThreadPoolExecutor(max_workers=MERGE_WORKERS) as executor:
+            merged_rank_files = executor.map(merge, list(merge_orders))
+            for model_name, rank_files in zip(list(merge_orders), merged_rank_files):
+                # Mark the merge, then delete the merged per-rank files
+                ledger.record("train_merge", None, method=model_name)
+                for f in rank_files:
+                    try:
+                        f.unlink()
+                        logger.warning(f"Deleted file {f.name}")
+                    except Exception as e:
+                        logger.error(f"Error deleting file {f.name}: {e}")
+
+    stop_profiling()
 
     # Finalize the process group
     dist.destroy_process_group()
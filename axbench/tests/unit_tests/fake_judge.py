@@ -0,0 +1,49 @@
+import zlib
+
+from axbench.evaluators.prompt_templates import (
+    UNIDIRECTIONAL_PAIRWISE_EVALUATION_CONCEPT_RELEVANCE_TEMPLATE,
+    UNIDIRECTIONAL_PAIRWISE_EVALUATION_INSTRUCTION_RELEVANCE_TEMPLATE,
+    UNIDIRECTIONAL_PAIRWISE_EVALUATION_FLUENCY_TEMPLATE,
+)
+
+# judge prompts are told apart by the fixed text before their first field.
+AXIS_PREFIXES = {
+    "concept": UNIDIRECTIONAL_PAIRWISE_EVALUATION_CONCEPT_RELEVANCE_TEMPLATE.split("{")[0],
+    "instruction": UNIDIRECTIONAL_PAIRWISE_EVALUATION_INSTRUCTION_RELEVANCE_TEMPLATE.split("{")[0],
+    "fluency": UNIDIRECTIONAL_PAIRWISE_EVALUATION_FLUENCY_TEMPLATE.split("{")[0],
+}
+
+
+def hashed_rating(levels):
+    """A rating picked from `levels` that only depends on the prompt."""
+    return lambda prompt: levels[zlib.crc32(prompt.encode()) % len(levels)]
+
+
+# every axis rates on its own levels, so per-axis results cannot be mixed up.
+DEFAULT_AXIS_RATINGS = {
+    "concept": hashed_rating([0.0, 1.0, 2.0]),
+    "instruction": hashed_rating([0.5, 1.5]),
+    "fluency": hashed_rating([0.0, 0.5, 1.5, 2.0]),
+}
+
+
+class FakeJudge(object):
+    """
+    Deterministic stand-in for the judge LanguageModel. `ratings` maps an axis
+    (concept, instruction or fluency) to a function of the prompt, overriding
+    DEFAULT_AXIS_RATINGS. Every prompt it was asked is kept in `prompts`.
+    """
+    def __init__(self, ratings=None):
+        self.ratings = {**DEFAULT_AXIS_RATINGS, **(ratings or {})}
+        self.prompts = []
+
+    @staticmethod
+    def axis(prompt):
+        for axis, prefix in AXIS_PREFIXES.items():
+            if prompt.startswith(prefix):
+                return axis
+        raise ValueError(f"Not a judge prompt: {prompt[:80]}")
+
+    async def chat_completions(self, api_names, prompts, batch_size=32):
+        self.prompts += prompts
+        return [f"Rating: {self.ratings[self.axis(prompt)](prompt)}" for prompt in prompts]
@@ -0,0 +1,32 @@
+import json
+import unittest
+
+from axbench.benchmarks.bench_suite import parse_args, run, compare
+from axbench.benchmarks.synthetic import make_latent_df, LATENT_CATEGORIES
+
+
+class TestBenchmarkSuite(unittest.TestCase):
+    def test_synthetic_latent_data(self):
+        df = make_latent_df(n_concepts=3, n_examples=8)
+        self.assertEqual(len(df), 24)
+        self.assertEqual(sorted(df["concept_id"].unique()), [0, 1, 2])
+        self.assertEqual(set(df["category"]), set(LATENT_CATEGORIES))
+
+    def test_results_are_json_and_comparable(self):
+        args = parse_args([
+            "--only", "gather_residual_activations", "latent_evaluators", "chat_completions",
+            "--archs", "llama", "--n_concepts", "2", "--n_examples", "8", "--n_prompts", "4", "--repeat", "1"])
+        results = json.loads(json.dumps(run(args)))
+        self.assertEqual(
+            [result["benchmark"] for result in results],
+            ["gather_residual_activations"] + ["latent_evaluators"] * 4 + ["chat_completions"])
+        self.assertEqual(results[0]["arch"], "llama")
+        self.assertTrue(all(result["seconds"] > 0 for result in results))
+        baseline = [{**result, "seconds": result["seconds"] * 2} for result in results[1:]]
+        compared = compare(results, baseline)
+        self.assertNotIn("ratio", compared[0])
+        self.assertEqual([result["ratio"] for result in compared[1:]], [0.5] * 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+import gc
+import unittest
+import weakref
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers
+from transformers import PreTrainedTokenizerFast
+
+from axbench.utils.model_utils import ChatTemplateFormatter, get_chat_template_formatter
+
+
+GEMMA_CHAT_TEMPLATE = (
+    "{{ bos_token }}{% if messages[0]['role'] == 'system' %}{{ raise_exception('System role not supported') }}{% endif %}"
+    "{% for message in messages %}{% if (message['role'] == 'assistant') %}{% set role = 'model' %}"
+    "{% else %}{% set role = message['role'] %}{% endif %}"
+    "{{ '<start_of_turn>' + role + '\n' + message['content'] | trim + '<end_of_turn>\n' }}{% endfor %}"
+    "{% if add_generation_prompt %}{{'<start_of_turn>model\n'}}{% endif %}"
+)
+LLAMA_CHAT_TEMPLATE = (
+    "{{- bos_token }}{%- if messages[0]['role'] == 'system' %}{%- set system_message = messages[0]['content']|trim %}"
+    "{%- set messages = messages[1:] %}{%- else %}{%- set system_message = '' %}{%- endif %}"
+    "{{- '<|start_header_id|>system<|end_header_id|>\n\n' }}{{- 'Cutting Knowledge Date: December 2023\n' }}"
+    "{{- 'Today Date: 26 Jul 2024\n\n' }}{{- system_message }}{{- '<|eot_id|>' }}"
+    "{%- for message in messages %}{{- '<|start_header_id|>' + message['role'] + '<|end_header_id|>\n\n'"
+    "+ message['content'] | trim + '<|eot_id|>' }}{%- endfor %}"
+    "{%- if add_generation_prompt %}{{- '<|start_header_id|>assistant<|end_header_id|>\n\n' }}{%- endif %}"
+)
+SPECIAL_TOKENS = ["<bos>", "<eos>", "<pad>", "<start_of_turn>", "<end_of_turn>", "<|start_header_id|>", "<|end_header_id|>", "<|eot_id|>"]
+TEXTS = [
+    "Write a short poem about the sea.", "  Leading and trailing spaces  ", "Line one\nLine two\n\n",
+    "def add(a, b):\n    return a + b", "Émojis 🎉 and accents: café", "",
+]
+
+
+def create_tokenizer(chat_template):
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(
+        TEXTS * 10, trainers.BpeTrainer(
+            vocab_size=300, special_tokens=SPECIAL_TOKENS, initial_alphabet=pre_tokenizers.ByteLevel.alphabet()))
+    return PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<bos>", eos_token="<eos>", pad_token="<pad>",
+        chat_template=chat_template, clean_up_tokenization_spaces=False)
+
+
+class TestChatTemplate(unittest.TestCase):
+    def test_matches_apply_chat_template(self):
+        outputs = TEXTS[::-1]
+        for name, chat_template, system_prompt in [
+            ("gemma", GEMMA_CHAT_TEMPLATE, None), ("llama", LLAMA_CHAT_TEMPLATE, "You are a helpful assistant.")]:
+            tokenizer = create_tokenizer(chat_template)
+            for kwargs in [
+                {"add_generation_prompt": True},
+                {"with_output": True, "add_generation_prompt": False, "strip_suffix": True},
+                {"with_output": True, "add_generation_prompt": True, "strip_suffix": True},
+            ]:
+                with self.subTest(template=name, **kwargs):
+                    formatter = ChatTemplateFormatter(tokenizer, system_prompt=system_prompt, **kwargs)
+                    self.assertIsNotNone(formatter.pieces)
+                    self.assertTrue(formatter.trim_content)
+                    formatted = formatter(TEXTS, outputs)
+                    expected = [formatter.format_one(prompt, output) for prompt, output in zip(TEXTS, outputs)]
+                    self.assertEqual(formatted, expected)
+                    self.assertIsNotNone(formatter.pieces)
+
+    def test_mismatch_falls_back(self):
+        formatter = ChatTemplateFormatter(create_tokenizer(GEMMA_CHAT_TEMPLATE))
+        formatter.pieces = ["wrong prefix ", ""]
+        formatted = formatter(TEXTS)
+        self.assertIsNone(formatter.pieces)
+        self.assertEqual(formatted, [formatter.format_one(prompt) for prompt in TEXTS])
+
+    def test_mismatch_in_later_rows_falls_back(self):
+        # rows the template renders differently, past the first rows of the batch.
+        class LateMismatchFormatter(ChatTemplateFormatter):
+            def format_one(self, prompt, output=None):
+                formatted = super().format_one(prompt, output)
+                return formatted + "!" if prompt.startswith("late") else formatted
+        formatter = LateMismatchFormatter(create_tokenizer(GEMMA_CHAT_TEMPLATE))
+        prompts = TEXTS[:4] + [f"late {i}" for i in range(40)]
+        formatted = formatter(prompts)
+        self.assertIsNone(formatter.pieces)
+        self.assertEqual(formatted, [formatter.format_one(prompt) for prompt in prompts])
+
+    def test_formatters_are_cached(self):
+        tokenizer = create_tokenizer(GEMMA_CHAT_TEMPLATE)
+        self.assertIs(get_chat_template_formatter(tokenizer), get_chat_template_formatter(tokenizer))
+        self.assertIsNot(
+            get_chat_template_formatter(tokenizer), get_chat_template_formatter(tokenizer, strip_suffix=True))
+        # the formatters live and die with their tokenizer.
+        other_tokenizer = create_tokenizer(GEMMA_CHAT_TEMPLATE)
+        self.assertIsNot(get_chat_template_formatter(tokenizer), get_chat_template_formatter(other_tokenizer))
+        tokenizer_ref = weakref.ref(tokenizer)
+        del tokenizer
+        gc.collect()
+        self.assertIsNone(tokenizer_ref())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+
+import pandas as pd
+import torch
+import transformers
+from tokenizers import processors
+
+from axbench.utils.data_utils import (
+    make_data_module, tokenize_examples, get_intervention_locations, parse_positions, _tokenized_cache)
+from axbench.models.probe import make_data_module as make_probe_data_module
+from axbench.models.sft import make_sft_data_module
+from axbench.tests.unit_tests.test_chat_template import create_tokenizer, GEMMA_CHAT_TEMPLATE, TEXTS
+from axbench.benchmarks.bench_collators import COLLATORS, PadTokenizer, make_instances, select
+
+
+def reference_rows(tokenizer, df, positions, prefix_length=1):
+    """The per-row tokenization make_data_module used to do."""
+    rows = []
+    for _, row in df.iterrows():
+        output = tokenizer.eos_token if isinstance(row["output"], float) else row["output"]
+        prompt_ids = tokenizer(row["input"], max_length=1024, truncation=True, return_tensors="pt")["input_ids"][0]
+        input_ids = tokenizer(row["input"] + output, max_length=1024, truncation=True, return_tensors="pt")["input_ids"][0]
+        labels = input_ids.clone()
+        labels[:len(prompt_ids)] = -100
+        if positions == "all_prompt":
+            locations = [list(range(prefix_length, len(prompt_ids)))]
+        elif positions == "all":
+            locations = [list(range(prefix_length, len(input_ids)))]
+        else:
+            first_n, last_n = parse_positions(positions)
+            locations = get_intervention_locations(
+                last_position=len(prompt_ids) - prefix_length, first_n=first_n, last_n=last_n,
+                pad_mode="last", num_interventions=1, share_weights=True)
+            locations = [[location + prefix_length for location in locations[0]]]
+        rows.append({
+            "input_ids": input_ids, "labels": labels, "prompt_ids": prompt_ids,
+            "intervention_locations": torch.tensor(locations, dtype=torch.long),
+            "prompt_lengths": torch.tensor(len(prompt_ids) - 1)})
+    return rows
+
+
+class TestMakeDataModule(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tokenizer = create_tokenizer(GEMMA_CHAT_TEMPLATE)
+        cls.tokenizer._tokenizer.post_processor = processors.TemplateProcessing(
+            single="<bos> $A", special_tokens=[("<bos>", cls.tokenizer.bos_token_id)])
+        prompts = TEXTS + ["The se", "<start_of_turn>user\nhi<end_of_turn>\n<start_of_turn>model\n", "a"]
+        # outputs merging with the end of the prompt, missing outputs and empty prompts.
+        outputs = ["a", float("nan"), " two", "<eos>", "", "x y z", "a poem", "Sure!<end_of_turn>", "dd"]
+        cls.df = pd.DataFrame({"input": prompts, "output": outputs, "labels": list(range(len(prompts)))})
+
+    def test_matches_per_row_tokenization(self):
+        for positions in ["all", "all_prompt", "f1+l1", "f3+l3", "l2"]:
+            with self.subTest(positions=positions):
+                dataset = make_data_module(self.tokenizer, self.df, positions=positions)["train_dataset"]
+                self.assertEqual(len(dataset), len(self.df))
+                for row, expected in zip(dataset, reference_rows(self.tokenizer, self.df, positions)):
+                    for column in ["input_ids", "labels", "intervention_locations", "prompt_lengths"]:
+                        self.assertTrue(torch.equal(row[column], expected[column]), column)
+
+    def test_probe_and_sft_data_modules(self):
+        expected_rows = reference_rows(self.tokenizer, self.df, "all")
+        for row, expected, label in zip(
+            make_sft_data_module(self.tokenizer, self.df)["train_dataset"], expected_rows, self.df["labels"]):
+            self.assertTrue(torch.equal(row["input_ids"], expected["input_ids"]))
+            self.assertTrue(torch.equal(row["labels"], expected["labels"]))
+        for row, expected, label in zip(
+            make_probe_data_module(self.tokenizer, None, self.df)["train_dataset"], expected_rows, self.df["labels"]):
+            self.assertTrue(torch.equal(row["input_ids"], expected["prompt_ids"]))
+            self.assertEqual(row["labels"].item(), label)
+            self.assertEqual(row["intervention_locations"].tolist(), [list(range(1, len(expected["prompt_ids"])))])
+
+    def test_tokenized_examples_are_cached(self):
+        _tokenized_cache.clear()
+        table = tokenize_examples(self.tokenizer, self.df)
+        self.assertIs(tokenize_examples(self.tokenizer, self.df.copy()), table)
+        self.assertIsNot(tokenize_examples(self.tokenizer, self.df.assign(output="other")), table)
+        self.assertEqual(len(_tokenized_cache), 2)
+
+
+class TestCollators(unittest.TestCase):
+    def test_match_per_instance_padding(self):
+        instances = make_instances(12, 40)
+        # a batch of equal lengths needs no padding.
+        same_length = [{**inst, "input_ids": inst["input_ids"][:8], "labels": inst["labels"][:8]} for inst in instances[:3]]
+        for name, (legacy_cls, collator_cls, fields) in COLLATORS.items():
+            legacy = legacy_cls(tokenizer=PadTokenizer(), data_collator=transformers.DefaultDataCollator(return_tensors="pt"))
+            collator = collator_cls(tokenizer=PadTokenizer())
+            for batch in [instances[:5], instances[5:], same_length]:
+                with self.subTest(collator=name, batch_size=len(batch)):
+                    expected, collated = legacy(select(batch, fields)), collator(select(batch, fields))
+                    self.assertEqual(sorted(collated), sorted(expected))
+                    for key in expected:
+                        self.assertEqual(collated[key].dtype, expected[key].dtype, key)
+                        self.assertTrue(torch.equal(collated[key], expected[key]), key)
+
+
+if __name__ == "__main__":
+    unittest.main()
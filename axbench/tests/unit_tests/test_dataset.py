@@ -1,9 +1,11 @@
+import asyncio
 import unittest
 from unittest.mock import MagicMock, patch
 import os
 from pathlib import Path
 import shutil
 import torch
+import numpy as np
 from datasets import Dataset
 from axbench.utils.dataset import DatasetFactory
 import pandas as pd
@@ -211,6 +213,67 @@ class TestDatasetFactory(unittest.TestCase):
                 for col in required_columns:
                     self.assertIn(col, result_df.columns)
 
+    def test_negative_pool_cache(self):
+        """Test the shared negative pool is generated once and reused across runs"""
+        self.mock_model.name_or_path = "mock/model"
+
+        def create_factory():
+            with patch('axbench.utils.dataset.load_from_disk') as mock_load:
+                mock_load.side_effect = [self.mock_seed_sentences, self.mock_seed_instructions]
+                return DatasetFactory(
+                    model=self.mock_model, client=self.mock_client, tokenizer=self.mock_tokenizer,
+                    dataset_category="instruction", num_of_examples=10, output_length=32,
+                    dump_dir=str(self.cache_dir), master_data_dir=str(self.master_data_dir),
+                    use_cache=True, seed=42
+                )
+
+        with patch('axbench.utils.dataset.get_model_continues') as mock_continues:
+            mock_continues.side_effect = lambda model, tokenizer, prompts, **kwargs: [
+                f"output of {prompt}" for prompt in prompts]
+            first_df = create_factory().negative_df
+            self.assertEqual(mock_continues.call_count, 3)
+            second_df = create_factory().negative_df
+            self.assertEqual(mock_continues.call_count, 3)
+        pd.testing.assert_frame_equal(first_df, second_df)
+        self.assertEqual(len(first_df), 3 * 5)
+
+    def test_acreate_eval_df(self):
+        """Test concepts of acreate_eval_df share one event loop and request their categories together"""
+        in_flight = {"now": 0, "max": 0}
+
+        def fake_functor(name):
+            async def functor(*args, **kwargs):
+                in_flight["now"] += 1
+                in_flight["max"] = max(in_flight["max"], in_flight["now"])
+                await asyncio.sleep(0)
+                in_flight["now"] -= 1
+                if name == "hard negative":
+                    return None, [
+                        (content, [meaning], f"{meaning} output of {content}")
+                        for meaning, content in zip(kwargs["polysemantic_concepts"], kwargs["content"])]
+                return [f"{name} output of {content} ({kwargs['api_tag']})" for content in kwargs["content"]]
+            return functor
+
+        concept_genres_map = {"concept1": ["text"], "concept2": ["math"]}
+
+        async def create(concepts):
+            return await asyncio.gather(*[self.dataset_factory.acreate_eval_df(
+                [concept], 6, concept_genres_map, {}, {concept: ["meaning1", "meaning2"]},
+                api_tag=concept, rng=np.random.default_rng(i)) for i, concept in enumerate(concepts)])
+
+        with patch('axbench.utils.dataset.response_with_concept', fake_functor("positive")), \
+             patch('axbench.utils.dataset.response_without_concept', fake_functor("negative")), \
+             patch('axbench.utils.dataset.response_with_polysemantic_concepts', fake_functor("hard negative")):
+            concept1_df, concept2_df = asyncio.run(create(["concept1", "concept2"]))
+            # positive, negative and one hard negative request for each of the two concepts.
+            self.assertEqual(in_flight["max"], 2 * 3)
+            alone_df, = asyncio.run(create(["concept1"]))
+        pd.testing.assert_frame_equal(concept1_df, alone_df)
+        self.assertEqual(concept1_df["category"].value_counts().to_dict(), {
+            "positive": 6, "negative": 6, "hard negative": 2})
+        self.assertTrue(concept2_df["output"].str.endswith("(concept2)").iloc[:12].all())
+        self.assertEqual(concept2_df["output_concept"].tolist()[-2:], ["meaning1", "meaning2"])
+
     def tearDown(self):
         """Clean up after each test"""
         torch.cuda.empty_cache()
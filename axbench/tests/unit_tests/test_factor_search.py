@@ -0,0 +1,37 @@
+import unittest
+import numpy as np
+
+from axbench.utils.factor_search import golden_section_factor_search
+
+
+class TestFactorSearch(unittest.TestCase):
+    def setUp(self):
+        self.factors = [0.2, 0.4, 0.6, 0.8, 1.0, 1.2, 1.4, 1.6, 1.8, 2.0, 2.5, 3.0, 4.0, 5.0]
+
+    def test_unimodal_matches_grid_argmax(self):
+        for peak in self.factors + [0.0, 6.0]:
+            with self.subTest(peak=peak):
+                calls = []
+                def evaluate(factor):
+                    calls.append(factor)
+                    return -abs(factor - peak)
+                best_factor, scores = golden_section_factor_search(self.factors, evaluate)
+                grid_scores = [evaluate(factor) for factor in self.factors]
+                self.assertEqual(best_factor, self.factors[np.argmax(grid_scores)])
+                # every factor is evaluated at most once and far fewer than the full grid.
+                probed = calls[:-len(self.factors)]
+                self.assertEqual(len(probed), len(set(probed)))
+                self.assertEqual(list(scores.keys()), probed)
+                self.assertLessEqual(len(probed), 8)
+
+    def test_flat_scores_pick_smallest_factor(self):
+        best_factor, _ = golden_section_factor_search(self.factors[::-1], lambda factor: 1.0)
+        self.assertEqual(best_factor, min(self.factors))
+
+    def test_short_grids(self):
+        self.assertEqual(golden_section_factor_search([1.0], lambda factor: 0.0)[0], 1.0)
+        self.assertEqual(golden_section_factor_search([2.0, 1.0], lambda factor: factor)[0], 2.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import unittest
+
+import pandas as pd
+import torch
+from tokenizers import processors
+from torch.utils.data import DataLoader
+from transformers import Gemma2Config, Gemma2ForCausalLM, get_scheduler
+
+from axbench.models.probe import LinearProbe
+from axbench.models.mean import DiffMean
+from axbench.scripts.args.training_args import ModelParams
+from axbench.utils.model_utils import (
+    gather_residual_activations, gather_token_activations, reduce_token_activations,
+    set_decoder_norm_to_unit_norm, remove_gradient_parallel_to_decoder_directions, _activation_cache)
+from axbench.tests.unit_tests.test_chat_template import create_tokenizer, GEMMA_CHAT_TEMPLATE, TEXTS
+
+
+def reference_train(probe, examples):
+    """The per-step `IntervenableModel` forward LinearProbe.train used to do."""
+    train_dataloader = probe.make_dataloader(examples)
+    optimizer = torch.optim.AdamW(probe.ax.parameters(), lr=probe.training_args.lr, weight_decay=probe.training_args.weight_decay)
+    lr_scheduler = get_scheduler(
+        "linear", optimizer=optimizer, num_warmup_steps=0,
+        num_training_steps=probe.training_args.n_epochs * len(train_dataloader))
+    for _ in range(probe.training_args.n_epochs):
+        for inputs in train_dataloader:
+            probe.ax_model(
+                base={"input_ids": inputs["input_ids"], "attention_mask": inputs["attention_mask"]},
+                unit_locations={"sources->base": (None, inputs["intervention_locations"].permute(1, 0, 2).tolist())},
+                subspaces=[{"k": probe.training_args.topk}], use_cache=False)
+            preds = torch.sigmoid(probe.ax_model.full_intervention_outputs[0].latent[0])
+            mask = inputs["intervention_masks"].bool()
+            loss = torch.nn.BCELoss()(preds[mask].float(), inputs["labels"].unsqueeze(-1).expand_as(preds)[mask].float())
+            loss += probe.training_args.coeff_l1_loss * sum(p.abs().sum() for p in probe.ax.parameters())
+            loss.backward()
+            set_decoder_norm_to_unit_norm(probe.ax)
+            remove_gradient_parallel_to_decoder_directions(probe.ax)
+            optimizer.step()
+            lr_scheduler.step()
+            optimizer.zero_grad()
+
+
+class TestFrozenActivations(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        torch.manual_seed(0)
+        cls.tokenizer = create_tokenizer(GEMMA_CHAT_TEMPLATE)
+        cls.tokenizer._tokenizer.post_processor = processors.TemplateProcessing(
+            single="<bos> $A", special_tokens=[("<bos>", cls.tokenizer.bos_token_id)])
+        cls.model = Gemma2ForCausalLM(Gemma2Config(
+            vocab_size=len(cls.tokenizer), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+            num_attention_heads=2, num_key_value_heads=1, head_dim=16, pad_token_id=cls.tokenizer.pad_token_id)).eval()
+        cls.training_args = ModelParams(
+            batch_size=3, n_epochs=3, topk=1, lr=0.01, weight_decay=0.0, coeff_l1_loss=0.001)
+        inputs = [TEXTS[i % (len(TEXTS) - 1)] * (1 + i % 3) for i in range(8)]
+        cls.examples = pd.DataFrame({"input": inputs, "output": "", "labels": [i % 2 for i in range(8)]})
+
+    def setUp(self):
+        _activation_cache.clear()
+
+    def make_method(self, method_class):
+        method = method_class(self.model, self.tokenizer, layer=1, training_args=self.training_args, device="cpu")
+        method.make_model(mode="train", low_rank_dimension=1)
+        return method
+
+    def test_token_activations_match_unpadded_forwards(self):
+        activations, lengths = gather_token_activations(
+            self.model, self.tokenizer, 1, self.examples, batch_size=3, prefix_length=1)
+        expected = [
+            gather_residual_activations(self.model, 1, self.tokenizer(text, return_tensors="pt"))[0, 1:]
+            for text in self.examples["input"]]
+        self.assertEqual(lengths.tolist(), [len(e) for e in expected])
+        self.assertTrue(torch.allclose(activations, torch.cat(expected), atol=1e-5))
+        means = reduce_token_activations(lambda x: x, activations, lengths, reduce="mean", batch_size=3)
+        self.assertTrue(torch.allclose(means, torch.stack([e.mean(dim=0) for e in expected]), atol=1e-5))
+
+    def test_linear_probe_matches_per_step_forwards(self):
+        expected = self.make_method(LinearProbe)
+        initial_weights = {k: v.clone() for k, v in expected.ax.state_dict().items()}
+        torch.manual_seed(1)
+        reference_train(expected, self.examples)
+
+        probe = self.make_method(LinearProbe)
+        probe.ax.load_state_dict(initial_weights)
+        torch.manual_seed(1)
+        probe.train(self.examples, prefix_length=1)
+        self.assertTrue(torch.allclose(probe.ax.proj.weight, expected.ax.proj.weight, atol=1e-5))
+        self.assertFalse(torch.allclose(probe.ax.proj.weight, initial_weights["proj.weight"], atol=1e-3))
+
+    def test_methods_share_one_extraction(self):
+        calls = []
+        handle = self.model.model.layers[1].register_forward_hook(lambda *args: calls.append(1))
+        try:
+            self.make_method(LinearProbe).train(self.examples, prefix_length=1)
+            self.make_method(DiffMean).train(self.examples, prefix_length=1)
+        finally:
+            handle.remove()
+        # one forward per batch of examples, for all epochs and both methods.
+        self.assertEqual(len(calls), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
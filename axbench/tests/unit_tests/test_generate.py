@@ -0,0 +1,42 @@
+import json
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+import pandas as pd
+
+from axbench.utils.ledger import ProgressLedger
+
+# generate.py is a script; its helpers are imported from the scripts directory.
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "scripts"))
+from generate import save
+
+
+def concept_df(concept_id):
+    return pd.DataFrame({
+        "input": [f"input {concept_id} {i}" for i in range(2)], "output_concept": f"concept {concept_id}",
+        "concept_genre": "text", "category": "positive", "concept_id": concept_id})
+
+
+class TestGenerateSave(unittest.TestCase):
+    def test_negatives_with_deferred_first_concept(self):
+        negative_df = concept_df(-1).assign(output_concept=pd.NA, category="negative")
+        dataset_factory = SimpleNamespace(negative_df=negative_df)
+        with tempfile.TemporaryDirectory() as dump_dir:
+            ledger = ProgressLedger(Path(dump_dir) / "progress.jsonl")
+            # concept 0 waits on batch requests, so concept 1 is saved first.
+            for concept_id in [1, 0]:
+                save(dump_dir, ledger, concept_id, f"concept {concept_id}", {}, "null", "train",
+                     concept_df(concept_id), dataset_factory)
+            df = pd.read_parquet(Path(dump_dir) / "train_data.parquet")
+            self.assertEqual(df["concept_id"].tolist(), [-1, -1, 1, 1, 0, 0])
+            self.assertEqual((df["category"] == "negative").sum(), 2)
+            self.assertEqual(ledger.completed("generate"), {(0, None), (1, None)})
+            with open(Path(dump_dir) / "metadata.jsonl") as f:
+                self.assertEqual([json.loads(line)["concept_id"] for line in f], [1, 0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+import unittest
+import tempfile
+import threading
+import time
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import pandas as pd
+
+from axbench.scripts import inference
+from axbench.scripts.inference import (
+    iterate_in_background, save, load_saved_ranks, load_saved_rows, merge_rank_files, record_methods
+)
+from axbench.utils.dataset import SteeringDatasetFactory
+from axbench.utils.ledger import ProgressLedger
+
+
+class TestSteeringPrefetch(unittest.TestCase):
+    def test_iterates_in_order(self):
+        self.assertEqual(list(iterate_in_background(range(10), 2)), list(range(10)))
+
+    def test_producer_starts_before_iteration(self):
+        started = threading.Event()
+        def items():
+            started.set()
+            yield 1
+        iterator = iterate_in_background(items(), 1)
+        self.assertTrue(started.wait(timeout=5))
+        self.assertEqual(list(iterator), [1])
+
+    def test_producer_is_bounded_and_stops(self):
+        produced = []
+        def items():
+            for i in range(100):
+                produced.append(i)
+                yield i
+        iterator = iterate_in_background(items(), 2)
+        self.assertEqual(next(iterator), 0)
+        time.sleep(0.2)
+        # one item consumed, two queued and one waiting to be queued.
+        self.assertLessEqual(len(produced), 4)
+        iterator.close()
+        time.sleep(0.2)
+        self.assertLessEqual(len(produced), 4)
+
+    def test_errors_reach_the_consumer(self):
+        def items():
+            yield 1
+            raise ValueError("producer failed")
+        iterator = iterate_in_background(items(), 2)
+        self.assertEqual(next(iterator), 1)
+        with self.assertRaises(ValueError):
+            next(iterator)
+
+    def test_steering_prompts_are_fetched_in_bulk(self):
+        factory = SteeringDatasetFactory(MagicMock(), None)
+        requests = []
+        async def chat_completions(api_name, prompts):
+            requests.append(prompts)
+            return [f" prompt {i} " for i in range(len(prompts))]
+        factory.lm_model = MagicMock(chat_completions=chat_completions)
+        self.assertEqual(factory.prefetch_steering_prompts(["a", "b", "a"]), ["prompt 0", "prompt 1", "prompt 0"])
+        self.assertEqual(factory.prefetch_steering_prompts(["b", "c"]), ["prompt 1", "prompt 0"])
+        self.assertEqual([len(prompts) for prompts in requests], [2, 1])
+
+
+def concept_df(concept_id, **columns):
+    return pd.DataFrame({"concept_id": [concept_id] * 2, "input_id": [0, 1], **columns})
+
+
+class TestInferenceResume(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dump_dir = self.tmp_dir.name
+        self.ledger = ProgressLedger(Path(self.dump_dir) / "progress.jsonl")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def save_concept(self, current_df, model_names, rank):
+        save(self.dump_dir, "latent", current_df, rank)
+        record_methods(self.ledger, "inference_latent", current_df["concept_id"][0], model_names, current_df, rank)
+
+    def test_added_method_reuses_saved_rows(self):
+        self.save_concept(concept_df(0, LsReFT_max_act=[1.0, 2.0]), ["LsReFT"], rank=0)
+        self.save_concept(concept_df(1, LsReFT_max_act=[3.0, 4.0]), ["LsReFT"], rank=1)
+        merge_rank_files(self.dump_dir, "latent", load_saved_ranks(self.ledger, "inference_latent"), ["concept_id"])
+
+        # a second run adds a method to concept 1 only.
+        saved_ranks = load_saved_ranks(self.ledger, "inference_latent")
+        self.assertIsNone(load_saved_rows(self.dump_dir, "latent", 2, saved_ranks))
+        current_df = load_saved_rows(self.dump_dir, "latent", 1, saved_ranks)
+        self.assertEqual(current_df["LsReFT_max_act"].tolist(), [3.0, 4.0])
+        current_df["SAE_max_act"] = [5.0, 6.0]
+        self.save_concept(current_df, ["SAE"], rank=0)
+        merge_rank_files(self.dump_dir, "latent", load_saved_ranks(self.ledger, "inference_latent"), ["concept_id"])
+
+        merged_df = pd.read_parquet(Path(self.dump_dir) / "inference" / "latent_data.parquet")
+        self.assertEqual(merged_df["concept_id"].tolist(), [0, 0, 1, 1])
+        self.assertEqual(merged_df["LsReFT_max_act"].tolist(), [1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(merged_df["SAE_max_act"].tolist()[2:], [5.0, 6.0])
+        self.assertFalse(any((Path(self.dump_dir) / "inference").glob("rank_*")))
+
+    def test_unrecorded_rows_are_dropped(self):
+        # rank 1 crashed after saving concept 0, which rank 0 then redid.
+        save(self.dump_dir, "latent", concept_df(0, LsReFT_max_act=[9.0, 9.0]), 1)
+        self.save_concept(concept_df(0, LsReFT_max_act=[1.0, 2.0]), ["LsReFT"], rank=0)
+        merge_rank_files(self.dump_dir, "latent", load_saved_ranks(self.ledger, "inference_latent"), ["concept_id"])
+        merged_df = pd.read_parquet(Path(self.dump_dir) / "inference" / "latent_data.parquet")
+        self.assertEqual(merged_df["LsReFT_max_act"].tolist(), [1.0, 2.0])
+
+
+    def test_streaming_merge_matches_sorting_all_rows(self):
+        sort_by = ["concept_id", "input_id", "factor"]
+        rng = np.random.default_rng(0)
+        def steering_df(concept_id, model_name):
+            df = pd.DataFrame({
+                "concept_id": concept_id, "input_id": np.repeat(np.arange(3), 2), "factor": np.tile([1.0, 0.5], 3)})
+            df[f"{model_name}_steered_generation"] = [f"{model_name} {concept_id} {i}" for i in range(6)]
+            df[f"{model_name}_perplexity"] = rng.random(6)
+            return df.sample(frac=1, random_state=concept_id).reset_index(drop=True)
+
+        inference_dir = Path(self.dump_dir) / "inference"
+        inference_dir.mkdir()
+        # rows of an earlier merge, partly superseded by the new rows.
+        merged_df = pd.concat([steering_df(concept_id, "LoRA") for concept_id in [0, 2, 5]], ignore_index=True)
+        merged_df.sort_values(by=sort_by, kind="stable").to_parquet(inference_dir / "steering_data.parquet")
+        saved_ranks = {0: None, 2: None, 5: None}
+        rank_dfs = {0: [], 1: []}
+        for concept_id, rank in [(4, 0), (2, 1), (1, 0), (3, 1), (6, 0)]:
+            rank_dfs[rank].append(steering_df(concept_id, "SFT"))
+            with patch.object(inference, "MERGE_BATCH_SIZE", 4):
+                save(self.dump_dir, "steering", rank_dfs[rank][-1], rank)
+            saved_ranks[concept_id] = rank
+        # a concept rank 1 saved but did not record, and a rank file of an older run (unsorted).
+        pd.concat(rank_dfs[1] + [steering_df(7, "SFT")], ignore_index=True).to_parquet(
+            inference_dir / "rank_1_steering_data.parquet")
+
+        new_df = pd.concat(rank_dfs[0] + rank_dfs[1], ignore_index=True)
+        expected_df = pd.concat([merged_df[~merged_df["concept_id"].isin(new_df["concept_id"])], new_df], ignore_index=True)
+        expected_df = expected_df.sort_values(by=sort_by, kind="stable").reset_index(drop=True)
+        with patch.object(inference, "MERGE_BATCH_SIZE", 5):
+            merge_rank_files(self.dump_dir, "steering", saved_ranks, sort_by)
+        actual_df = pd.read_parquet(inference_dir / "steering_data.parquet")
+        pd.testing.assert_frame_equal(actual_df, expected_df)
+        self.assertFalse(any(inference_dir.glob("rank_*")))
+
+
+if __name__ == "__main__":
+    unittest.main()
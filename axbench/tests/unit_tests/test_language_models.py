@@ -0,0 +1,124 @@
+import unittest
+import asyncio
+import json
+import os
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from axbench.models.language_models import LanguageModel, BatchRequestsPending
+from axbench.evaluators.lm_judge import LMJudgeEvaluator
+from axbench.scripts.batch_judge import fake_batch_results, ingest_batch_results
+from axbench.scripts.evaluate import eval_steering, load_latest_results
+from axbench.utils.ledger import ProgressLedger, PROGRESS_LEDGER_FILE
+import pandas as pd
+
+
+class OfflineClient:
+    """A client that fails on every request; batch mode must never call it."""
+    class chat:
+        class completions:
+            @staticmethod
+            async def create(**kwargs):
+                raise AssertionError("unexpected interactive request")
+
+
+class TestBatchMode(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name)
+        self.batch_dir = self.root / "batch"
+        self.data = pd.DataFrame({
+            "concept_id": 0, "input_id": range(5), "factor": [0.5, 0.5, 1.0, 1.0, 1.0],
+            "input_concept": "cats", "original_prompt": "Tell me a story.",
+            "LsReFT_steered_generation": [f"generation {i}" for i in range(5)],
+        })
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def create_lm(self, batch_dir=None):
+        return LanguageModel(
+            "gpt-4o-mini", OfflineClient(), dump_dir=self.root / "dump",
+            use_cache=True, cache_level="prompt", cache_tag="evaluate",
+            master_data_dir=self.root / "data", temperature=0.7, batch_dir=batch_dir)
+
+    def test_batch_round_trip(self):
+        # 1. cache misses are written as batch requests, and nothing is rated.
+        evaluator = LMJudgeEvaluator("LsReFT", lm_model=self.create_lm(self.batch_dir))
+        with self.assertRaises(BatchRequestsPending):
+            evaluator.compute_metrics(self.data)
+        # requesting the same prompts again does not duplicate requests.
+        with self.assertRaises(BatchRequestsPending):
+            evaluator.compute_metrics(self.data)
+        request_files = list(self.batch_dir.glob("requests-*.jsonl"))
+        requests = [json.loads(line) for path in request_files for line in open(path)]
+        self.assertEqual(len(requests), 3 * len(self.data))
+        self.assertEqual(len({request["custom_id"] for request in requests}), len(requests))
+        self.assertEqual(requests[0]["url"], "/v1/chat/completions")
+
+        # 2. fake the batch outputs and ingest them into the LM cache.
+        self.assertEqual(fake_batch_results(self.batch_dir, "Rating: 2"), len(requests))
+        self.assertEqual(ingest_batch_results(self.batch_dir, self.root / "data"), len(requests))
+
+        # 3. the evaluator now runs entirely from cache.
+        lm_model = self.create_lm()
+        metrics = LMJudgeEvaluator("LsReFT", lm_model=lm_model).compute_metrics(self.data)
+        self.assertEqual(metrics["lm_judge_rating"], [2.0, 2.0])
+        self.assertEqual(lm_model.stats.total_cache_hit, 3 * len(self.data))
+
+    def count_requests(self):
+        return sum(len(open(path).readlines()) for path in self.batch_dir.glob("requests-*.jsonl"))
+
+    def test_eval_steering_rounds(self):
+        # generate -> ingest -> rerun the evaluate stage until no new requests are written.
+        data = pd.concat([self.data.assign(concept_id=concept_id) for concept_id in [0, 1]], ignore_index=True)
+        data["PromptSteering_steered_generation"] = [f"prompt generation {i}" for i in range(len(data))]
+        # win rates share the judge prompts, so only the cascade alone needs a second round.
+        for lm_judge_cascade, evaluators, n_rounds in [
+            (False, ["LMJudgeEvaluator", "WinRateEvaluator"], 1), (True, ["LMJudgeEvaluator"], 2)]:
+            with self.subTest(lm_judge_cascade=lm_judge_cascade), tempfile.TemporaryDirectory() as root:
+                self.batch_dir = Path(root) / "batch"
+                (Path(root) / "inference").mkdir()
+                data.to_parquet(Path(root) / "inference" / "steering_data.parquet")
+                args = SimpleNamespace(
+                    data_dir=str(Path(root) / "inference"), dump_dir=root, mode="steering",
+                    winrate_split_ratio=None, models=["LsReFT", "PromptSteering"],
+                    steering_evaluators=evaluators,
+                    winrate_baseline="PromptSteering", lm_model="gpt-4o-mini",
+                    lm_judge_cascade=lm_judge_cascade, lm_batch_dir=str(self.batch_dir),
+                    num_of_workers=1, report_to=[], wandb_name=None)
+                ledger_path = Path(root) / PROGRESS_LEDGER_FILE
+                cwd = os.getcwd()
+                # the judge caches live under the relative axbench/data.
+                os.chdir(root)
+                try:
+                    with patch.dict(os.environ, {"OPENAI_API_KEY": "unused"}):
+                        for _ in range(n_rounds):
+                            n_requests = self.count_requests()
+                            eval_steering(args)
+                            self.assertGreater(self.count_requests(), n_requests)
+                            # units waiting on requests are neither saved nor recorded.
+                            self.assertFalse((Path(root) / "evaluate" / "steering.jsonl").exists())
+                            self.assertEqual(len(ProgressLedger(ledger_path).entries()), 0)
+                            fake_batch_results(self.batch_dir, "Rating: 2")
+                            ingest_batch_results(self.batch_dir, Path(root) / "axbench" / "data")
+                        n_requests = self.count_requests()
+                        eval_steering(args)
+                finally:
+                    os.chdir(cwd)
+                self.assertEqual(self.count_requests(), n_requests)
+                results = load_latest_results(Path(root) / "evaluate" / "steering.jsonl")
+                self.assertEqual([result["concept_id"] for result in results], [0, 1])
+                for result in results:
+                    for method in ["LsReFT", "PromptSteering"]:
+                        self.assertEqual(
+                            result["results"]["LMJudgeEvaluator"][method]["lm_judge_rating"], [2.0, 2.0])
+                    if "WinRateEvaluator" in evaluators:
+                        self.assertEqual(result["results"]["WinRateEvaluator"]["LsReFT"]["tie_rate"], 1.0)
+                self.assertEqual(len(ProgressLedger(ledger_path).entries()), len(evaluators) * 2 * 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
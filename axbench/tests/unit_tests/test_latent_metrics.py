@@ -0,0 +1,198 @@
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from sklearn.metrics import roc_curve, auc, precision_recall_fscore_support, precision_recall_curve
+
+from axbench.evaluators.aucroc import AUCROCEvaluator
+from axbench.evaluators.hard_negative import HardNegativeEvaluator
+from axbench.evaluators.latent_stats import LatentStatsEvaluator
+from axbench.evaluators.latent_metrics import compute_latent_metrics, interpolate_roc
+from axbench.scripts.evaluate import build_roc_records, append_roc_records, load_roc_curves
+from axbench.utils.plot_utils import collect_roc_curves
+
+
+def reference_aucroc(data, model_name):
+    # sklearn-based reference implementation of AUCROCEvaluator.
+    class_labels = {"positive": 1, "negative": 0, "hard negative seen": 0, "hard negative unseen": 0}
+    data = data.copy()
+    max_acts = data[f'{model_name}_max_act']
+    data['normalized_max'] = (max_acts - max_acts.min()) / (max_acts.max() - max_acts.min())
+    data['label'] = data['category'].map(class_labels)
+    filtered_data = data.dropna(subset=['label'])
+    filtered_data.loc[:, 'normalized_max'] = filtered_data['normalized_max'].fillna(0)
+    fpr, tpr, thresholds = roc_curve(filtered_data['label'], filtered_data['normalized_max'])
+    return {
+        "max_act": float(max_acts.max()),
+        "roc_auc": float(auc(fpr, tpr)),
+        "optimal_threshold": float(thresholds[np.argmax(tpr - fpr)]),
+        "roc_curve": {"fpr": fpr.tolist(), "tpr": tpr.tolist()}
+    }
+
+
+def reference_hard_negative(data, model_name):
+    # sklearn-based reference implementation of HardNegativeEvaluator.
+    class_labels = {"positive": 1, "negative": 0, "hard negative": 0}
+    data = data.copy()
+    max_acts = data[f'{model_name}_max_act']
+    data['normalized_max'] = (max_acts - max_acts.min()) / (max_acts.max() - max_acts.min())
+    data['normalized_max'] = data['normalized_max'].fillna(0)
+    data['label'] = data['category'].map(class_labels)
+    train_data = data[data['category'].isin(['positive', 'negative'])].dropna(subset=['label'])
+    fpr, tpr, thresholds = roc_curve(train_data['label'], train_data['normalized_max'])
+    optimal_threshold = thresholds[np.argmax(tpr - fpr)]
+    if np.isinf(float(optimal_threshold)):
+        return {}
+    accuracies = []
+    for category in ['positive', 'hard negative']:
+        class_data = data[data['category'] == category]
+        if len(class_data) == 0:
+            return {}
+        predictions = (class_data['normalized_max'] >= optimal_threshold).astype(int)
+        accuracies.append(float((predictions == class_data['label']).mean()))
+    return {"macro_avg_accuracy": float(np.mean(accuracies))}
+
+
+def reference_latent_stats(data, model_name):
+    # sklearn-based reference implementation of LatentStatsEvaluator.
+    class_labels = {"positive": 1, "negative": 0, "hard negative": 0}
+    data = data.copy()
+    max_acts = data[f'{model_name}_max_act']
+    max_act, min_act = max_acts.max(), max_acts.min()
+    data['normalized_max'] = (max_acts - min_act) / (max_act - min_act)
+    data['normalized_max'] = data['normalized_max'].fillna(0)
+    data['label'] = data['category'].map(class_labels)
+    train_data = data[data['category'].isin(['positive', 'negative'])].dropna(subset=['label'])
+    fpr, tpr, thresholds = roc_curve(train_data['label'], train_data['normalized_max'])
+    optimal_roc_threshold = thresholds[np.argmax(tpr - fpr)]
+    precision, recall, thresholds = precision_recall_curve(train_data['label'], train_data['normalized_max'])
+    pr_auc = auc(recall, precision)
+    f1_scores = np.zeros_like(precision)
+    mask = (precision + recall) > 0
+    f1_scores[mask] = 2 * (precision[mask] * recall[mask]) / (precision[mask] + recall[mask])
+    optimal_pr_threshold = thresholds[np.argmax(f1_scores)]
+    accuracies = {}
+    for category in ['positive', 'negative', 'hard negative']:
+        class_data = data[data['category'] == category]
+        if len(class_data) > 0:
+            predictions = (class_data['normalized_max'] >= optimal_pr_threshold).astype(int)
+            accuracies[category] = float((predictions == class_data['label']).mean())
+        else:
+            accuracies[category] = np.nan
+    true_labels = data['label']
+    predictions = (data['normalized_max'] >= optimal_pr_threshold).astype(int)
+    precision, recall, f1, _ = precision_recall_fscore_support(
+        true_labels, predictions, average='binary', zero_division=0.0)
+    return {
+        "positive_accuracy": accuracies["positive"],
+        "negative_accuracy": accuracies["negative"],
+        "hard_negative_accuracy": accuracies["hard negative"],
+        "precision": float(precision),
+        "recall": float(recall),
+        "f1": float(f1),
+        "macro_avg_accuracy_fixed": float(np.mean(list(accuracies.values()))),
+        "overall_accuracy": float((predictions == true_labels).mean()),
+        "max_act_val": float(max_act),
+        "min_act_val": float(min_act),
+        "optimal_roc_threshold": float(optimal_roc_threshold),
+        "optimal_pr_threshold": float(optimal_pr_threshold),
+        "pr_auc": float(pr_auc),
+    }
+
+
+class TestLatentMetrics(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        dfs = []
+        for concept_id in range(12):
+            n_pos, n_neg, n_hard = rng.integers(5, 40, size=3)
+            if concept_id == 3:
+                n_hard = 0
+            categories = ["positive"] * n_pos + ["negative"] * n_neg + ["hard negative"] * n_hard
+            df = pd.DataFrame({"category": categories})
+            df["concept_id"] = concept_id
+            labels = (df["category"] == "positive").to_numpy()
+            # continuous, heavily tied and rounded float32 activations.
+            df["Smooth_max_act"] = rng.normal(size=len(df)) + labels * (concept_id % 4)
+            df["Tied_max_act"] = rng.integers(0, 4, size=len(df)).astype(np.float64) + labels
+            df["Float32_max_act"] = np.round(rng.gamma(2.0, size=len(df)) + labels, 2).astype(np.float32)
+            if concept_id == 5:
+                df["Tied_max_act"] = 1.0  # constant activations normalise to NaN
+            if concept_id == 7:
+                df.loc[df.index[:3], "Smooth_max_act"] = np.nan
+            dfs.append(df)
+        self.data = pd.concat(dfs, ignore_index=True)
+        self.model_names = ["Smooth", "Tied", "Float32"]
+
+    def assertMetricsEqual(self, expected, actual):
+        self.assertEqual(set(expected.keys()), set(actual.keys()))
+        for key, value in expected.items():
+            if isinstance(value, dict):
+                self.assertMetricsEqual(value, actual[key])
+            elif isinstance(value, float) and np.isnan(value):
+                self.assertTrue(np.isnan(actual[key]), key)
+            else:
+                self.assertEqual(value, actual[key], key)
+
+    def test_evaluators_match_reference(self):
+        references = {
+            AUCROCEvaluator: reference_aucroc,
+            HardNegativeEvaluator: reference_hard_negative,
+            LatentStatsEvaluator: reference_latent_stats,
+        }
+        for concept_id, current_df in self.data.groupby("concept_id"):
+            for model_name in self.model_names:
+                for evaluator_class, reference in references.items():
+                    with self.subTest(concept_id=concept_id, model=model_name, evaluator=evaluator_class):
+                        self.assertMetricsEqual(
+                            reference(current_df, model_name),
+                            evaluator_class(model_name).compute_metrics(current_df))
+
+    def test_grouped_matches_per_concept(self):
+        for model_name in self.model_names:
+            grouped = compute_latent_metrics(self.data, model_name)
+            self.assertEqual(sorted(grouped.keys()), list(range(12)))
+            for concept_id, current_df in self.data.groupby("concept_id"):
+                single = compute_latent_metrics(current_df, model_name, group_column=None)[None]
+                self.assertMetricsEqual(single, grouped[concept_id])
+
+    def test_roc_records_round_trip(self):
+        curves = [
+            (concept_id, "LsReFT", 0.5, np.linspace(0, 1, 7) ** 2, np.linspace(0, 1, 7) ** (1 / 3 + concept_id))
+            for concept_id in range(3)]
+        with tempfile.TemporaryDirectory() as dump_dir:
+            (Path(dump_dir) / "evaluate").mkdir()
+            append_roc_records(dump_dir, "latent", *build_roc_records(curves[:2]))
+            append_roc_records(dump_dir, "latent", *build_roc_records(curves[2:]))
+            records = load_roc_curves(dump_dir)
+            self.assertEqual(records["concept_id"].tolist(), [0, 1, 2])
+            self.assertEqual(records["tpr"].dtype, np.float64)
+            for i, curve in enumerate(curves):
+                np.testing.assert_array_equal(records["tpr"][i], interpolate_roc(curve[3], curve[4]))
+
+    def test_collect_roc_curves(self):
+        curves = [
+            (concept_id, "LsReFT", 0.5 + concept_id / 10, np.linspace(0, 1, 7) ** 2,
+             np.linspace(0, 1, 7) ** (1 / 3 + concept_id))
+            for concept_id in range(3)]
+        inline = lambda curve: {"roc_auc": curve[2], "roc_curve": {"fpr": curve[3].tolist(), "tpr": curve[4].tolist()}}
+        # concepts 0 and 1 were evaluated before the ROC records; concept 1 was re-evaluated since.
+        jsonl_data = [
+            {"concept_id": 0, "results": {"AUCROCEvaluator": {"LsReFT": inline(curves[0])}}},
+            {"concept_id": 1, "results": {"AUCROCEvaluator": {"LsReFT": inline(curves[0])}}},
+            {"concept_id": 2, "results": {"AUCROCEvaluator": {"LsReFT": {"roc_auc": curves[2][2]}}}},
+        ]
+        with tempfile.TemporaryDirectory() as dump_dir:
+            (Path(dump_dir) / "evaluate").mkdir()
+            append_roc_records(dump_dir, "latent", *build_roc_records(curves[1:]))
+            tprs, aucs = collect_roc_curves(jsonl_data, load_roc_curves(dump_dir))
+        self.assertEqual(sorted(aucs["LsReFT"]), [0.5, 0.6, 0.7])
+        np.testing.assert_allclose(
+            np.mean(tprs["LsReFT"], axis=0), np.mean([interpolate_roc(c[3], c[4]) for c in curves], axis=0))
+        tprs, aucs = collect_roc_curves(jsonl_data)
+        self.assertEqual(aucs["LsReFT"], [0.5, 0.5])
+
+
+if __name__ == "__main__":
+    unittest.main()
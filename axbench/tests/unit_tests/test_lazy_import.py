@@ -0,0 +1,39 @@
+import json
+import subprocess
+import sys
+import unittest
+from pathlib import Path
+
+import axbench
+from axbench.benchmarks.bench_import_time import HEAVY_MODULES
+
+
+def run_python(code):
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+        cwd=Path(axbench.__file__).resolve().parents[1])
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+class TestLazyImport(unittest.TestCase):
+    def test_import_loads_no_heavy_dependencies(self):
+        loaded = run_python(
+            "import sys, json\n"
+            "import axbench, axbench.evaluators\n"
+            "evaluator = axbench.WinRateEvaluator\n"
+            "from axbench.evaluators.winrate import WinRateEvaluator\n"
+            f"print(json.dumps([evaluator is WinRateEvaluator] + [m for m in {HEAVY_MODULES!r} if m in sys.modules]))")
+        self.assertEqual(loaded, [True])
+
+    def test_names_resolve_like_star_imports(self):
+        from axbench.utils.constants import EXAMPLE_TAG
+        from axbench.scripts.args.training_args import TrainingArgs
+        self.assertIs(axbench.EXAMPLE_TAG, EXAMPLE_TAG)
+        self.assertIs(getattr(axbench, "TrainingArgs"), TrainingArgs)
+        self.assertIn("LoRA", dir(axbench))
+        with self.assertRaises(AttributeError):
+            axbench.__missing__
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+import tempfile
+import multiprocessing
+from pathlib import Path
+
+import pandas as pd
+import torch
+
+from axbench.utils.ledger import ProgressLedger, content_checksum
+
+
+def record_units(path, worker_id, n):
+    ledger = ProgressLedger(path)
+    for concept_id in range(n):
+        ledger.record("train", concept_id, method=f"method_{worker_id}", rank=worker_id)
+
+
+class TestProgressLedger(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name) / "progress.jsonl"
+        self.ledger = ProgressLedger(self.path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_pending_skips_exactly_the_completed_units(self):
+        self.ledger.record("train", 0, method="LsReFT")
+        self.ledger.record("train", 1, method="LsReFT")
+        self.ledger.record("train", 1, method="SFT")
+        self.ledger.record("inference_latent", 2, method="LsReFT")
+        self.assertEqual(
+            self.ledger.pending("train", range(3), ["LsReFT", "SFT"]),
+            {0: ["SFT"], 2: ["LsReFT", "SFT"]})
+        # adding a method only adds its units.
+        self.assertEqual(
+            self.ledger.pending("train", range(2), ["LsReFT", "SFT", "LoReFT"]),
+            {0: ["SFT", "LoReFT"], 1: ["LoReFT"]})
+
+    def test_stages_without_methods(self):
+        self.assertFalse(self.ledger.has_stage("generate"))
+        self.ledger.record("generate", 0)
+        self.ledger.record("generate", 2)
+        self.assertTrue(self.ledger.has_stage("generate"))
+        self.assertEqual(list(self.ledger.pending("generate", range(4))), [1, 3])
+
+    def test_entries_keep_order_and_extra_fields(self):
+        self.ledger.record("train", 3, method="LsReFT", checksum="abc", rank=1)
+        self.ledger.record("train_merge", None, method="LsReFT")
+        entries = self.ledger.entries({"train", "train_merge"})
+        self.assertEqual([entry["stage"] for entry in entries], ["train", "train_merge"])
+        self.assertEqual((entries[0]["checksum"], entries[0]["rank"]), ("abc", 1))
+        self.assertEqual(self.ledger.entries("train_merge")[0]["concept_id"], None)
+
+    def test_invalidated_units_are_pending_again(self):
+        for concept_id in range(2):
+            self.ledger.record("train", concept_id, method="LsReFT", checksum="a")
+            self.ledger.record("train", concept_id, method="SFT")
+        self.ledger.invalidate("train", [(1, "SFT")])
+        self.assertEqual(self.ledger.pending("train", range(2), ["LsReFT", "SFT"]), {1: ["SFT"]})
+        self.ledger.record("train", 1, method="SFT")
+        self.assertEqual(self.ledger.pending("train", range(2), ["LsReFT", "SFT"]), {})
+        self.ledger.invalidate("train")
+        self.assertEqual(self.ledger.completed("train"), set())
+        # units recorded without a checksum are told apart by their time.
+        self.assertEqual(self.ledger.checksums("train"), {})
+        self.ledger.record("train", 0, method="SFT")
+        self.assertTrue(self.ledger.checksums("train")[("train", 0, "SFT")].startswith("time:"))
+
+    def test_torn_lines_are_skipped(self):
+        self.ledger.record("train", 0, method="LsReFT")
+        with open(self.path, "a") as f:
+            f.write('{"stage": "train", "concept_id": 1, "meth')
+        self.ledger.record("train", 2, method="LsReFT")
+        self.assertEqual(self.ledger.completed("train"), {(0, "LsReFT"), (2, "LsReFT")})
+
+    def test_concurrent_appends(self):
+        processes = [
+            multiprocessing.Process(target=record_units, args=(self.path, worker_id, 50))
+            for worker_id in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assertEqual(len(self.ledger.entries("train")), 200)
+        for worker_id in range(4):
+            self.assertEqual(
+                [entry["concept_id"] for entry in self.ledger.entries("train") if entry["rank"] == worker_id],
+                list(range(50)))
+
+    def test_content_checksum(self):
+        df = pd.DataFrame({"a": [1, 2], "b": ["x", "y"]})
+        self.assertEqual(content_checksum(df), content_checksum(df.copy()))
+        self.assertNotEqual(content_checksum(df), content_checksum(df.assign(b=["x", "z"])))
+        self.assertEqual(content_checksum(torch.ones(3)), content_checksum(torch.ones(3)))
+        self.assertNotEqual(content_checksum({"auc": 0.5}), content_checksum({"auc": 0.6}))
+        self.assertEqual(len(content_checksum([1, 2])), 16)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+import numpy as np
+import pandas as pd
+
+from axbench.evaluators.lm_judge import LMJudgeEvaluator
+from axbench.tests.unit_tests.fake_judge import FakeJudge, hashed_rating
+
+
+class TestLMJudgeCascade(unittest.TestCase):
+    def setUp(self):
+        self.data = pd.DataFrame({
+            "concept_id": 0, "input_id": range(8), "factor": [0.5] * 4 + [1.0] * 4,
+            "input_concept": "cats", "original_prompt": [f"prompt {i}" for i in range(8)],
+            "LsReFT_steered_generation": [
+                f"off-topic {i}" if i % 3 == 0 else f"generation {i}" for i in range(8)],
+        })
+        self.on_topic = [i % 3 != 0 for i in range(8)]
+        # off-topic answers rate 0 on the concept, but not on the other axes.
+        self.ratings = {
+            "concept": lambda prompt: 0.0 if "off-topic" in prompt else hashed_rating([1.0, 2.0])(prompt)}
+
+    def test_cascade_matches_full_ratings(self):
+        full_judge, cascade_judge = FakeJudge(self.ratings), FakeJudge(self.ratings)
+        full = LMJudgeEvaluator("LsReFT", lm_model=full_judge).compute_metrics(self.data)
+        cascade = LMJudgeEvaluator(
+            "LsReFT", lm_model=cascade_judge, lm_judge_cascade=True).compute_metrics(self.data)
+        # the two other axes of the 3 off-topic answers are skipped.
+        self.assertEqual(len(full_judge.prompts) - len(cascade_judge.prompts), 2 * 3)
+        self.assertEqual(np.isnan(cascade["raw_fluency_ratings"]).sum(), 3)
+        for key in ["factor", "lm_judge_rating", "relevance_concept_ratings", "raw_aggregated_ratings"]:
+            self.assertEqual(cascade[key], full[key], key)
+
+        # per-axis means of the cascade only cover the judged answers.
+        factors = self.data["factor"].tolist()
+        for key in ["relevance_instruction_ratings", "fluency_ratings"]:
+            full_ratings = np.array(full[f"raw_{key}"])
+            self.assertTrue((full_ratings[~np.array(self.on_topic)] > 0).any(), key)
+            expected = [
+                np.mean([r for r, f, judged in zip(full_ratings, factors, self.on_topic) if f == factor and judged])
+                for factor in full["factor"]]
+            np.testing.assert_allclose(cascade[key], expected, err_msg=key)
+            self.assertNotEqual(cascade[key], full[key], key)
+
+
+if __name__ == "__main__":
+    unittest.main()
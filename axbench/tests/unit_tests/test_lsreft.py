@@ -0,0 +1,74 @@
+import dataclasses
+import unittest
+
+import pandas as pd
+import torch
+from tokenizers import processors
+from transformers import Gemma2Config, Gemma2ForCausalLM
+
+from axbench.models.lsreft import LsReFT
+from axbench.scripts.args.training_args import ModelParams
+from axbench.tests.unit_tests.test_chat_template import create_tokenizer, GEMMA_CHAT_TEMPLATE, TEXTS
+
+
+def make_examples(seed, n=7):
+    generator = torch.Generator().manual_seed(seed)
+    choices = torch.randint(0, len(TEXTS) - 1, (n, 2), generator=generator).tolist()
+    return pd.DataFrame([(TEXTS[i] * 2, TEXTS[j]) for i, j in choices], columns=["input", "output"])
+
+
+class TestLsReFTJointTraining(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        torch.manual_seed(0)
+        cls.tokenizer = create_tokenizer(GEMMA_CHAT_TEMPLATE)
+        cls.tokenizer._tokenizer.post_processor = processors.TemplateProcessing(
+            single="<bos> $A", special_tokens=[("<bos>", cls.tokenizer.bos_token_id)])
+        cls.model = Gemma2ForCausalLM(Gemma2Config(
+            vocab_size=len(cls.tokenizer), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+            num_attention_heads=2, num_key_value_heads=1, head_dim=16, pad_token_id=cls.tokenizer.pad_token_id)).eval()
+        cls.training_args = ModelParams(
+            batch_size=3, n_epochs=2, topk=2, lr=0.01, coeff_latent_l1_loss=0.005, gradient_accumulation_steps=1)
+        cls.kwargs = {"prefix_length": 1, "positions": "all", "exclude_bos": True}
+
+    def make_lsreft(self, low_rank_dimension, training_args=None):
+        lsreft = LsReFT(
+            self.model, self.tokenizer, layer=1, training_args=training_args or self.training_args, device="cpu")
+        lsreft.make_model(mode="train", low_rank_dimension=low_rank_dimension)
+        return lsreft
+
+    def test_joint_training_matches_training_alone(self):
+        concept_examples = [make_examples(seed) for seed in range(3)]
+        weights = []
+        for examples in concept_examples:
+            lsreft = self.make_lsreft(1)
+            lsreft.train(examples, **self.kwargs)
+            weights.append(lsreft.ax.proj.weight.data)
+        joint = self.make_lsreft(len(concept_examples))
+        joint.train_concepts(concept_examples, **self.kwargs)
+        # every row is the subspace of its concept, as if trained alone.
+        self.assertTrue(torch.allclose(joint.ax.proj.weight.data, torch.cat(weights), atol=1e-6))
+        self.assertFalse(torch.allclose(weights[0], weights[1], atol=1e-3))
+
+    def test_unequal_concepts_match_training_alone(self):
+        # 3, 1 and 2 batches: every concept keeps its own schedule and stops when its data runs out.
+        concept_examples = [make_examples(seed, n) for seed, n in [(0, 7), (1, 3), (2, 5)]]
+        for gradient_accumulation_steps in [1, 2]:
+            with self.subTest(gradient_accumulation_steps=gradient_accumulation_steps):
+                training_args = dataclasses.replace(
+                    self.training_args, gradient_accumulation_steps=gradient_accumulation_steps)
+                alone = []
+                for examples in concept_examples:
+                    lsreft = self.make_lsreft(1, training_args)
+                    lsreft.train(examples, **self.kwargs)
+                    alone.append(lsreft.ax.proj)
+                joint = self.make_lsreft(len(concept_examples), training_args)
+                joint.train_concepts(concept_examples, **self.kwargs)
+                self.assertTrue(torch.allclose(
+                    joint.ax.proj.weight.data, torch.cat([proj.weight.data for proj in alone]), atol=1e-6))
+                self.assertTrue(torch.allclose(
+                    joint.ax.proj.bias.data, torch.cat([proj.bias.data for proj in alone]), atol=1e-6))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+import torch
+
+from axbench.utils.model_utils import get_model_continues, ADAPTIVE_BATCH_SIZE_GROWTH_INTERVAL
+from axbench.tests.unit_tests.test_chat_template import create_tokenizer, GEMMA_CHAT_TEMPLATE
+
+
+class FakeModel:
+    """Runs out of memory on batches of more than 2 rows with a long prompt; continues every prompt with <eos>."""
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.device = torch.device("cpu")
+        self.batch_sizes = []
+
+    def generate(self, input_ids, attention_mask, max_new_tokens, do_sample):
+        self.batch_sizes.append(len(input_ids))
+        if len(input_ids) > 2 and any("long" in text for text in self.tokenizer.batch_decode(input_ids)):
+            raise torch.cuda.OutOfMemoryError("out of memory")
+        eos = torch.full((len(input_ids), 1), self.tokenizer.eos_token_id)
+        return torch.cat([input_ids, eos], dim=1)
+
+
+class TestModelContinues(unittest.TestCase):
+    def test_adaptive_batch_size_grows_back(self):
+        tokenizer = create_tokenizer(GEMMA_CHAT_TEMPLATE)
+        model = FakeModel(tokenizer)
+        interval = ADAPTIVE_BATCH_SIZE_GROWTH_INTERVAL
+        n_short = 2 * (interval - 2) + 4 * interval + 8 * 2
+        prompts = ["long prompt"] * 4 + ["short"] * n_short
+        outputs = get_model_continues(
+            model, tokenizer, prompts, max_new_tokens=1, is_chat_model=False, batch_size=8, adaptive_batch_size=True)
+        self.assertEqual(outputs, [""] * len(prompts))
+        # halved twice for the long prompts, then doubled back after every `interval` batches.
+        self.assertEqual(model.batch_sizes, [8, 4] + [2] * interval + [4] * interval + [8] * 2)
+
+    def test_batch_size_is_fixed_by_default(self):
+        tokenizer = create_tokenizer(GEMMA_CHAT_TEMPLATE)
+        with self.assertRaises(torch.cuda.OutOfMemoryError):
+            get_model_continues(
+                FakeModel(tokenizer), tokenizer, ["long prompt"] * 4, max_new_tokens=1, is_chat_model=False)
+
+
+if __name__ == "__main__":
+    unittest.main()
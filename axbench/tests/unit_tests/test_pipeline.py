@@ -0,0 +1,115 @@
+import sys
+import copy
+import json
+import unittest
+import tempfile
+from pathlib import Path
+
+from axbench.utils.ledger import ProgressLedger, PROGRESS_LEDGER_FILE, content_checksum
+from axbench.utils.pipeline import Stage, StageRunner
+
+# a stand-in for the stage scripts: records its units, like a stage that redoes everything.
+RECORD_UNITS = (
+    "import sys, json, time\n"
+    "with open(sys.argv[1], 'a') as f:\n"
+    "    for stage, concept_id, method, checksum in json.loads(sys.argv[2]):\n"
+    "        f.write(json.dumps({'stage': stage, 'concept_id': concept_id, 'method': method, "
+    "'checksum': checksum, 'time': time.time()}) + '\\n')\n"
+)
+CONFIG = {
+    "generate": {"data": ["a", "b", "c"]},
+    "train": {"models": {"LsReFT": {"lr": 0.01}, "SFT": {"lr": 0.001}}},
+    "evaluate": {"models": ["LsReFT", "SFT"]},
+}
+
+
+def make_stages(config, dump_dir):
+    def record(units):
+        return [sys.executable, "-c", RECORD_UNITS, str(Path(dump_dir) / PROGRESS_LEDGER_FILE), json.dumps(units)]
+
+    data = config["generate"]["data"]
+    models = config["train"]["models"]
+    return [
+        Stage("generate", "generate", record([["generate", c, None, d] for c, d in enumerate(data)]),
+              method_field=None, output_dir="generate", shareable=True),
+        Stage("train", "train", record([
+            ["train", c, m, f"{d}-{content_checksum(params)}"] for c, d in enumerate(data) for m, params in models.items()]),
+            deps=["generate"]),
+        Stage("evaluate", "evaluate", record([
+            ["evaluate", c, m, "done"] for c in range(len(data)) for m in models]),
+            deps=["train"], resource="cpu"),
+    ]
+
+
+class TestStageRunner(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.dump_dir = Path(self.tmp_dir.name) / "run"
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def run_pipeline(self, config, dump_dir=None, **kwargs):
+        dump_dir = dump_dir or self.dump_dir
+        runner = StageRunner(make_stages(config, dump_dir), config, dump_dir, shared_dir=kwargs.pop("shared_dir", None))
+        return runner.run(**kwargs)
+
+    def invalidated(self, stage):
+        return [
+            entry["invalidate"] for entry in ProgressLedger(self.dump_dir / PROGRESS_LEDGER_FILE).entries(
+                stage, include_invalidations=True) if "invalidate" in entry]
+
+    def test_rerun_skips_up_to_date_stages(self):
+        self.assertEqual(self.run_pipeline(CONFIG), ["generate", "train", "evaluate"])
+        self.assertEqual(self.run_pipeline(CONFIG), [])
+        # speed-only fields are not part of the config.
+        config = copy.deepcopy(CONFIG)
+        config["train"]["num_of_workers"] = 8
+        self.assertEqual(self.run_pipeline(config), [])
+
+    def test_method_config_change_only_invalidates_its_units(self):
+        self.run_pipeline(CONFIG)
+        config = copy.deepcopy(CONFIG)
+        config["train"]["models"]["SFT"]["lr"] = 0.002
+        self.assertEqual(self.run_pipeline(config), ["train", "evaluate"])
+        self.assertEqual(self.invalidated("train"), [[[c, "SFT"] for c in range(3)]])
+        # only the evaluations of the retrained units are outdated.
+        self.assertEqual(self.invalidated("evaluate"), [[[c, "SFT"] for c in range(3)]])
+        self.assertEqual(self.run_pipeline(config), [])
+
+    def test_upstream_change_invalidates_the_units_built_from_it(self):
+        self.run_pipeline(CONFIG)
+        config = copy.deepcopy(CONFIG)
+        config["generate"]["data"][1] = "b2"
+        self.assertEqual(self.run_pipeline(config), ["generate", "train", "evaluate"])
+        self.assertEqual(self.invalidated("generate"), [None])
+        # regenerated concepts with unchanged data keep their trained units.
+        self.assertEqual(self.invalidated("train"), [[[1, "LsReFT"], [1, "SFT"]]])
+        self.assertEqual(self.invalidated("evaluate"), [[[1, "LsReFT"], [1, "SFT"]]])
+
+    def test_dry_run_changes_nothing(self):
+        self.run_pipeline(CONFIG)
+        config = copy.deepcopy(CONFIG)
+        config["generate"]["data"][1] = "b2"
+        files = {path: path.read_bytes() for path in self.dump_dir.iterdir() if path.is_file()}
+        self.assertEqual(self.run_pipeline(config, dry_run=True), ["generate", "train", "evaluate"])
+        self.assertEqual({path: path.read_bytes() for path in self.dump_dir.iterdir() if path.is_file()}, files)
+
+    def test_runs_share_generated_outputs(self):
+        shared_dir = Path(self.tmp_dir.name) / "shared"
+        other_dump_dir = Path(self.tmp_dir.name) / "other_run"
+        self.run_pipeline(CONFIG, shared_dir=shared_dir)
+        config = copy.deepcopy(CONFIG)
+        config["train"]["models"]["SFT"]["lr"] = 0.002
+        self.run_pipeline(config, dump_dir=other_dump_dir, shared_dir=shared_dir)
+        store = (self.dump_dir / "generate").resolve()
+        self.assertEqual(store.parent, (shared_dir / "generate").resolve())
+        self.assertEqual((other_dump_dir / "generate").resolve(), store)
+        # units generated by the first run are complete in the second one before it runs the stage.
+        other_entries = ProgressLedger(other_dump_dir / PROGRESS_LEDGER_FILE).entries("generate")
+        self.assertEqual([entry["concept_id"] for entry in other_entries[:3]], [0, 1, 2])
+        self.assertEqual(ProgressLedger(store / PROGRESS_LEDGER_FILE).completed("generate"), {(0, None), (1, None), (2, None)})
+
+
+if __name__ == "__main__":
+    unittest.main()
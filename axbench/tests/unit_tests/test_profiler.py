@@ -0,0 +1,69 @@
+import asyncio
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from axbench.utils import profiler
+from axbench.utils.profiler import span, profile_tags, profiled, start_profiling, stop_profiling
+
+
+@profiled("parse")
+def parse(text):
+    return int(text)
+
+
+@profiled("call")
+async def call(value):
+    await asyncio.sleep(0)
+    return value
+
+
+class TestStageProfiler(unittest.TestCase):
+    def tearDown(self):
+        stop_profiling()
+
+    def test_disabled_records_nothing(self):
+        with tempfile.TemporaryDirectory() as dump_dir:
+            self.assertIsNone(start_profiling(dump_dir, "train", enabled=False))
+            self.assertIs(span("train"), profiler._NULL_SPAN)
+            self.assertIs(profile_tags(concept_id=0), profiler._NULL_SPAN)
+            with profile_tags(concept_id=0), span("train"):
+                self.assertEqual(parse("1"), 1)
+            self.assertIsNone(stop_profiling())
+            self.assertFalse((Path(dump_dir) / profiler.PROFILE_DIR).exists())
+
+    def test_trace_and_totals(self):
+        with tempfile.TemporaryDirectory() as dump_dir:
+            start_profiling(dump_dir, "inference_latent", rank=1, enabled=True)
+            with profile_tags(concept_id=3, method="LsReFT"):
+                with span("predict_latent"):
+                    parse("1")
+                    parse("2")
+            self.assertEqual(asyncio.run(self._gather()), [0, 1])
+            summary = stop_profiling()
+
+            self.assertEqual({name: total["count"] for name, total in summary.items()},
+                             {"predict_latent": 1, "parse": 2, "call": 2})
+            self.assertGreaterEqual(summary["predict_latent"]["total_s"], summary["parse"]["total_s"])
+            profile_dir = Path(dump_dir) / profiler.PROFILE_DIR
+            with open(profile_dir / "inference_latent_rank_1_trace.json") as f:
+                events = [event for event in json.load(f) if event["ph"] == "X"]
+            with open(profile_dir / "inference_latent_rank_1_totals.json") as f:
+                self.assertEqual(json.load(f), summary)
+
+            parses = [event for event in events if event["name"] == "parse"]
+            self.assertEqual(parses[0]["args"], {"rank": 1, "concept_id": 3, "method": "LsReFT"})
+            self.assertTrue(all(event["pid"] == 1 for event in events))
+            # the tags do not leak out of their block.
+            calls = [event for event in events if event["name"] == "call"]
+            self.assertEqual([event["args"] for event in calls], [{"rank": 1}] * 2)
+            # every asyncio task gets its own track.
+            self.assertEqual(len({event["tid"] for event in calls}), 2)
+
+    async def _gather(self):
+        return await asyncio.gather(call(0), call(1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,16 @@
 import unittest
 from unittest.mock import MagicMock, patch
 import asyncio
-from axbench.utils.prompt_utils import get_concept_genres
+import numpy as np
+from datasets import Dataset
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+from transformers import PreTrainedTokenizerFast
+from axbench.utils.prompt_utils import (
+    get_concept_genres,
+    get_random_content,
+    truncate_to_tokens,
+    SeedContentSampler,
+)
 from axbench.utils.constants import EMPTY_CONCEPT
 
 class TestPromptUtils(unittest.TestCase):
@@ -86,6 +95,39 @@ class TestPromptUtils(unittest.TestCase):
         # Verify client wasn't called
         self.mock_client.chat_completions.assert_not_called()
 
+class TestSeedSampling(unittest.TestCase):
+    def setUp(self):
+        self.seed_sentences = {
+            f"{genre}_{split}": Dataset.from_dict({
+                "input": [f"{genre} {split} sentence number {i} ." for i in range(500)]})
+            for genre in ["text", "math", "code"] for split in ["train", "test"]
+        }
+        words = sorted({w for ds in self.seed_sentences.values() for text in ds["input"] for w in text.split()})
+        backend = Tokenizer(models.WordLevel({w: i for i, w in enumerate(words + ["[UNK]"])}, unk_token="[UNK]"))
+        backend.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+        backend.decoder = decoders.WordPiece()
+        self.tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, unk_token="[UNK]")
+
+    def test_seeded_sampling_is_reproducible(self):
+        sampler = SeedContentSampler(self.seed_sentences)
+        kwargs = dict(tokenizer=self.tokenizer, count=40, genres=["math"], concepts=["a", "b"], length=None, split="test")
+        first = get_random_content(sampler, rng=np.random.default_rng(7), **kwargs)
+        second = get_random_content(self.seed_sentences, rng=np.random.default_rng(7), **kwargs)
+        self.assertEqual(first, second)
+        self.assertEqual([len(first["a"]), len(first["b"])], [20, 20])
+        contents = first["a"] + first["b"]
+        self.assertEqual(len(set(contents)), 40)
+        self.assertTrue(all(content.startswith("math test") for content in contents))
+        self.assertNotEqual(first, get_random_content(sampler, rng=np.random.default_rng(8), **kwargs))
+
+    def test_batched_truncation_matches_tokenize(self):
+        texts = self.seed_sentences["text_train"]["input"][:20]
+        expected = [
+            self.tokenizer.convert_tokens_to_string(self.tokenizer.tokenize(text)[:3]) for text in texts]
+        self.assertEqual(expected, truncate_to_tokens(self.tokenizer, texts, 3))
+        self.assertEqual(truncate_to_tokens(self.tokenizer, [], 3), [])
+
+
 def run_async_test(coro):
     return asyncio.run(coro)
 
@@ -0,0 +1,59 @@
+import unittest
+import tempfile
+from pathlib import Path
+
+import torch
+from peft import PeftModel
+
+from axbench.models.stacked_lora import StackedLoRAModel
+from axbench.benchmarks.bench_multi_adapter import make_tiny_model, save_random_adapter
+
+
+class TestStackedLoRA(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        # adapters of different ranks and target modules.
+        cls.adapter_dirs = [Path(cls.tmp_dir.name) / str(concept_id) for concept_id in range(3)]
+        save_random_adapter(cls.adapter_dirs[0], 1, 2, ["q_proj"])
+        save_random_adapter(cls.adapter_dirs[1], 2, 4, ["q_proj", "v_proj"])
+        save_random_adapter(cls.adapter_dirs[2], 3, 1, ["down_proj"])
+        cls.input_ids = torch.randint(1, 64, (6, 7), generator=torch.Generator().manual_seed(0))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+
+    def adapter_outputs(self, adapter_dir, input_ids, generate=False):
+        peft_model = PeftModel.from_pretrained(make_tiny_model(), adapter_dir).eval()
+        with torch.no_grad():
+            if generate:
+                return peft_model.generate(input_ids=input_ids, max_new_tokens=5, do_sample=False)
+            return peft_model(input_ids=input_ids).logits
+
+    def test_rows_apply_their_own_adapter(self):
+        model = make_tiny_model()
+        base_logits = model(input_ids=self.input_ids).logits
+        stacked = StackedLoRAModel(model, self.adapter_dirs)
+        adapter_ids = torch.tensor([2, 0, 1, 1, 0, 2])
+        stacked.set_adapter_ids(adapter_ids)
+        with torch.no_grad():
+            logits = model(input_ids=self.input_ids).logits
+            generations = model.generate(input_ids=self.input_ids, max_new_tokens=5, do_sample=False)
+        for row, adapter_id in enumerate(adapter_ids.tolist()):
+            expected = self.adapter_outputs(self.adapter_dirs[adapter_id], self.input_ids[row:row + 1])
+            self.assertTrue(torch.allclose(logits[row], expected[0], atol=1e-5), row)
+            self.assertFalse(torch.allclose(logits[row], base_logits[row], atol=1e-3), row)
+            expected = self.adapter_outputs(self.adapter_dirs[adapter_id], self.input_ids[row:row + 1], generate=True)
+            self.assertTrue(torch.equal(generations[row], expected[0]), row)
+
+        # without adapter ids, or once unloaded, it is the base model.
+        stacked.set_adapter_ids(None)
+        self.assertTrue(torch.equal(model(input_ids=self.input_ids).logits, base_logits))
+        self.assertIs(stacked.unload(), model)
+        self.assertIsInstance(model.model.layers[1].self_attn.q_proj, torch.nn.Linear)
+        self.assertTrue(torch.equal(model(input_ids=self.input_ids).logits, base_logits))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import json
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import torch
+
+from axbench.utils.ledger import ProgressLedger
+
+# train.py is a script; its helpers are imported from the scripts directory.
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "scripts"))
+from train import (
+    merge_concept_blocks, concept_row_ranges, saved_rows, artifact_rows, load_merge_order, merge_method_files)
+
+
+def rows_of(values, width=2):
+    """One row per value, filled with that value."""
+    return torch.tensor(values, dtype=torch.float32).unsqueeze(1).repeat(1, width)
+
+
+class TestTrainMerge(unittest.TestCase):
+    def test_merge_concept_blocks(self):
+        shards = [rows_of([0, 1, 2]), rows_of([3, 4])]
+        # blocks are copied in the given order, also across shards; unlisted rows are dropped.
+        merged = merge_concept_blocks(shards, [(3, 5), (2, 3), (0, 1)])
+        self.assertEqual(merged[:, 0].tolist(), [3, 4, 2, 0])
+        merged = merge_concept_blocks([shard.T for shard in shards], [(1, 2), (4, 5)], dim=1)
+        self.assertEqual(merged[0].tolist(), [1, 4])
+        with self.assertRaises(ValueError):
+            merge_concept_blocks(shards, [(4, 6)])
+
+    def test_concept_row_ranges(self):
+        # rank 0 recorded concepts 2, 0, 1 and then saved row 9 without a record.
+        rank_blocks = {0: [(2, (0, 1)), (0, (1, 2)), (1, (2, 3))], 1: []}
+        self.assertEqual(concept_row_ranges([], rank_blocks, 0, [4, 0]), [(1, 2), (2, 3), (0, 1)])
+        # merged blocks come first; a retrained concept takes its latest rows.
+        rank_blocks = {0: [(5, (0, 2))], 1: [(1, (2, 4)), (3, (4, 6))]}
+        self.assertEqual(
+            concept_row_ranges([1, 4], rank_blocks, 4, [2, 6]), [(8, 10), (10, 12), (2, 4), (4, 6)])
+        # blocks recorded without rows are equal blocks, which orphan rows cannot be split into.
+        legacy_blocks = {0: [(2, None), (0, None), (1, None)]}
+        self.assertEqual(concept_row_ranges([], legacy_blocks, 0, [3]), [(1, 2), (2, 3), (0, 1)])
+        with self.assertRaises(ValueError):
+            concept_row_ranges([], legacy_blocks, 0, [4])
+        with self.assertRaises(ValueError):
+            concept_row_ranges([0, 1], {}, 3, [])
+        with self.assertRaises(ValueError):
+            concept_row_ranges([], {0: [(0, (0, 2))]}, 0, [1])
+
+    def test_saved_rows(self):
+        self.assertEqual(saved_rows(2, 6, 2), [[2, 4], [4, 6]])
+        self.assertEqual(saved_rows(3, 3, 2), [None, None])
+
+    def test_load_merge_order(self):
+        with tempfile.TemporaryDirectory() as dump_dir:
+            ledger = ProgressLedger(Path(dump_dir) / "progress.jsonl")
+            ledger.record("train", 7, method="LsReFT") # merged before the ledger existed.
+            ledger.record("train", 0, method="LsReFT", rank=0, rows=[0, 1])
+            ledger.record("train", 1, method="LsReFT", rank=1, rows=[0, 1])
+            ledger.record("train", 0, method="SAE", rank=0)
+            ledger.record("train_merge", None, method="LsReFT")
+            ledger.record("train", 3, method="LsReFT", rank=1, rows=[0, 1])
+            ledger.record("train", 0, method="LsReFT", rank=1, rows=[1, 2])
+            self.assertEqual(
+                load_merge_order(ledger, "LsReFT", 2), ([0, 1, 7], {0: [], 1: [(3, (0, 1)), (0, (1, 2))]}))
+            self.assertEqual(load_merge_order(ledger, "SAE", 2), ([], {0: [(0, None)], 1: []}))
+
+    def test_merge_method_files(self):
+        with tempfile.TemporaryDirectory() as dump_dir:
+            dump_dir = Path(dump_dir)
+            ledger = ProgressLedger(dump_dir / "progress.jsonl")
+            # concepts 0 and 2 were merged earlier, with 2 rows per concept.
+            torch.save(rows_of([0, 0, 2, 2]), dump_dir / "LsReFT_weight.pt")
+            torch.save(rows_of([0, 0, 2, 2])[:, 0], dump_dir / "LsReFT_bias.pt")
+            ledger.record("train", 0, method="LsReFT", rank=0, rows=[0, 2])
+            ledger.record("train", 2, method="LsReFT", rank=1, rows=[0, 2])
+            ledger.record("train_merge", None, method="LsReFT")
+
+            def save(rank, concept_id, value, record=True):
+                name = f"rank_{rank}_LsReFT"
+                rows_before = artifact_rows(dump_dir, name)
+                for suffix, new_rows in [("weight", rows_of([value] * 2)), ("bias", rows_of([value] * 2)[:, 0])]:
+                    path = dump_dir / f"{name}_{suffix}.pt"
+                    torch.save(torch.cat([torch.load(path), new_rows]) if path.exists() else new_rows, path)
+                if record:
+                    rows = saved_rows(rows_before, artifact_rows(dump_dir, name), 1)
+                    ledger.record("train", concept_id, method="LsReFT", rank=rank, rows=rows[0])
+
+            save(0, 3, 30)
+            save(0, 1, 10)
+            save(0, 4, 40, record=False) # stopped between its save and its record.
+            save(1, 2, 21) # retrained.
+            merged_concept_ids, rank_blocks = load_merge_order(ledger, "LsReFT", 2)
+            rank_files = merge_method_files(dump_dir, "LsReFT", merged_concept_ids, rank_blocks, 2)
+
+            weight = torch.load(dump_dir / "LsReFT_weight.pt")
+            self.assertEqual(weight[:, 0].tolist(), [0, 0, 10, 10, 21, 21, 30, 30])
+            self.assertEqual(torch.load(dump_dir / "LsReFT_bias.pt").tolist(), [0, 0, 10, 10, 21, 21, 30, 30])
+            self.assertEqual(sorted(f.name for f in rank_files), [
+                "rank_0_LsReFT_bias.pt", "rank_0_LsReFT_weight.pt", "rank_1_LsReFT_bias.pt", "rank_1_LsReFT_weight.pt"])
+
+    def test_merge_top_features(self):
+        with tempfile.TemporaryDirectory() as dump_dir:
+            dump_dir = Path(dump_dir)
+            ledger = ProgressLedger(dump_dir / "progress.jsonl")
+            with open(dump_dir / "rank_0_GemmaScopeSAE_top_features.json", "w") as f:
+                json.dump([12, 10, 99], f)
+            ledger.record("train", 2, method="GemmaScopeSAE", rank=0, rows=[0, 1])
+            ledger.record("train", 0, method="GemmaScopeSAE", rank=0, rows=[1, 2])
+            merge_method_files(dump_dir, "GemmaScopeSAE", *load_merge_order(ledger, "GemmaScopeSAE", 1), 1)
+            with open(dump_dir / "GemmaScopeSAE_top_features.json") as f:
+                self.assertEqual(json.load(f), [10, 12])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+
+import pandas as pd
+import torch
+from tokenizers import processors
+from transformers import Gemma2Config, Gemma2ForCausalLM
+
+from axbench.models.sft import SFT
+from axbench.models.lora import LoRA
+from axbench.models.probe import LinearProbe
+from axbench.scripts.args.training_args import ModelParams
+from axbench.utils.weight_snapshot import WeightSnapshot
+from axbench.tests.unit_tests.test_chat_template import create_tokenizer, GEMMA_CHAT_TEMPLATE, TEXTS
+
+
+class TestWeightSnapshot(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        torch.manual_seed(0)
+        cls.tokenizer = create_tokenizer(GEMMA_CHAT_TEMPLATE)
+        cls.tokenizer._tokenizer.post_processor = processors.TemplateProcessing(
+            single="<bos> $A", special_tokens=[("<bos>", cls.tokenizer.bos_token_id)])
+        cls.examples = pd.DataFrame({"input": TEXTS[:4], "output": TEXTS[1:5], "labels": [1, 0, 1, 0]})
+
+    def setUp(self):
+        self.model = Gemma2ForCausalLM(Gemma2Config(
+            vocab_size=len(self.tokenizer), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+            num_attention_heads=2, num_key_value_heads=1, head_dim=16, pad_token_id=self.tokenizer.pad_token_id)).eval()
+        self.original = {name: param.detach().clone() for name, param in self.model.named_parameters()}
+        self.snapshot = WeightSnapshot(self.model)
+
+    def make_method(self, method_class, **kwargs):
+        training_args = ModelParams(batch_size=2, n_epochs=2, lr=0.01, weight_decay=0.0, gradient_accumulation_steps=1, **kwargs)
+        method = method_class(self.model, self.tokenizer, layer=1, training_args=training_args, device="cpu", lm_model_name="tiny")
+        method.make_model(mode="train", low_rank_dimension=training_args.low_rank_dimension, concept_id=0)
+        return method
+
+    def assert_original_model(self):
+        for name, param in self.model.named_parameters():
+            self.assertTrue(torch.equal(param, self.original[name]), name)
+            self.assertTrue(param.requires_grad, name)
+        self.assertFalse(self.model.training)
+
+    def test_restores_fine_tuned_weights(self):
+        self.make_method(SFT).train(self.examples, prefix_length=1, positions="all", exclude_bos=True)
+        self.assertFalse(torch.equal(self.model.model.layers[0].mlp.up_proj.weight, self.original["model.layers.0.mlp.up_proj.weight"]))
+        self.assertEqual(self.snapshot.restore(), sorted(self.original))
+        self.assert_original_model()
+        # nothing changed since the restore.
+        self.assertEqual(self.snapshot.restore(), [])
+
+    def test_only_changed_parameters_are_restored(self):
+        with torch.no_grad():
+            self.model.model.norm.weight.add_(1.0)
+        self.model.lm_head.weight.requires_grad_(False)
+        self.assertEqual(self.snapshot.restore(), ["model.norm.weight"])
+        self.assert_original_model()
+
+    def test_restores_flags_of_frozen_base_models(self):
+        lora = self.make_method(LoRA, low_rank_dimension=2, lora_alpha=4, lora_components=["q_proj"], lora_layers=[1])
+        lora.train(self.examples, prefix_length=1, positions="all", exclude_bos=True)
+        self.assertIs(lora.ax_model.unload(), self.model)
+        self.make_method(LinearProbe)
+        self.assertEqual(self.snapshot.restore(), [])
+        self.assert_original_model()
+
+    def test_mismatched_names_raise(self):
+        # wrappers such as FSDP rename the parameters, so nothing could be copied back.
+        self.model.model.norm.register_parameter("extra", torch.nn.Parameter(torch.zeros(2)))
+        with self.assertRaises(ValueError):
+            self.snapshot.restore()
+
+    def test_tracks_reloaded_model(self):
+        reloaded = Gemma2ForCausalLM(self.model.config).eval()
+        reloaded.load_state_dict(self.model.state_dict())
+        self.make_method(SFT).train(self.examples, prefix_length=1, positions="all", exclude_bos=True)
+        self.snapshot.track(reloaded)
+        self.assertEqual(self.snapshot.restore(), [])
+        with torch.no_grad():
+            reloaded.model.norm.weight.add_(1.0)
+        self.model = reloaded
+        self.assertEqual(self.snapshot.restore(), ["model.norm.weight"])
+        self.assert_original_model()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+import numpy as np
+import pandas as pd
+
+from axbench.evaluators.winrate import (
+    WinRateEvaluator, compute_win_results, empty_ratings_table, pair_with_baseline, summarize_win_results)
+from axbench.tests.unit_tests.fake_judge import FakeJudge
+
+
+def reference_win_results(evaluator, data, model_name, baseline):
+    # per-row reference of the original WinRateEvaluator comparison.
+    def harmonic_mean(scores):
+        if 0 in scores:
+            return 0
+        return len(scores) / sum(1/s for s in scores)
+    baseline_ratings = evaluator._get_all_ratings_from_data(data, baseline)
+    model_ratings = evaluator._get_all_ratings_from_data(data, model_name)
+    results = []
+    for i in range(len(data)):
+        baseline_score = harmonic_mean([axis[i][-1] for axis in baseline_ratings])
+        model_score = harmonic_mean([axis[i][-1] for axis in model_ratings])
+        if abs(baseline_score - model_score) < 1e-6:
+            results.append("tie")
+        elif baseline_score > model_score:
+            results.append("baseline")
+        else:
+            results.append("model")
+    return results
+
+
+class TestWinRate(unittest.TestCase):
+    def setUp(self):
+        rows = []
+        for concept_id in range(3):
+            for input_id in range(20):
+                rows.append({
+                    "concept_id": concept_id, "input_id": input_id,
+                    "input_concept": f"concept {concept_id}", "original_prompt": f"prompt {input_id}",
+                    "PromptSteering_steered_generation": f"baseline {concept_id} {input_id}",
+                    "LsReFT_steered_generation": f"lsreft {concept_id} {input_id}",
+                    "SteeringVector_steered_generation": f"sv {concept_id} {input_id}",
+                })
+        self.data = pd.DataFrame(rows)
+
+    def test_matches_reference(self):
+        judge = FakeJudge()
+        ratings = empty_ratings_table()
+        for model_name in ["LsReFT", "SteeringVector"]:
+            evaluator = WinRateEvaluator(model_name, lm_model=judge, ratings=ratings)
+            data = self.data.copy()
+            evaluator.compute_metrics(data)
+            ratings = evaluator.ratings
+            expected = reference_win_results(evaluator, self.data, model_name, "PromptSteering")
+            self.assertEqual(expected, data[f"{model_name}_win_result"].tolist())
+
+    def test_methods_are_rated_once(self):
+        judge = FakeJudge()
+        ratings = empty_ratings_table()
+        for model_name in ["LsReFT", "SteeringVector"]:
+            evaluator = WinRateEvaluator(model_name, lm_model=judge, ratings=ratings)
+            evaluator.compute_metrics(self.data)
+            ratings = evaluator.ratings
+        # three methods, three axes, each generation judged once.
+        self.assertEqual(len(judge.prompts), 3 * 3 * len(self.data))
+        self.assertEqual(len(judge.prompts), len(ratings))
+
+        # a regenerated output is rated again instead of reusing a stale rating.
+        data = self.data.copy()
+        data.loc[0, "LsReFT_steered_generation"] = "a new generation"
+        evaluator = WinRateEvaluator("LsReFT", lm_model=judge, ratings=ratings)
+        self.assertEqual(len(evaluator.rate(data, "LsReFT")), 3)
+        self.assertEqual(len(evaluator.rate(data, "PromptSteering")), 0)
+
+    def test_pairs_searched_factors(self):
+        # LsReFT was searched to factor 1.0, PromptSteering only generates at the first factor
+        # and SteeringVector at every factor.
+        rows = []
+        for factor in [0.5, 1.0, 2.0]:
+            for input_id in range(10):
+                rows.append({
+                    "concept_id": 0, "input_id": input_id, "factor": factor,
+                    "input_concept": "concept 0", "original_prompt": f"prompt {input_id}",
+                    "PromptSteering_steered_generation": f"baseline {input_id}" if factor == 0.5 else None,
+                    "LsReFT_steered_generation": f"lsreft {input_id}" if factor == 1.0 else None,
+                    "SteeringVector_steered_generation": f"sv {factor} {input_id}",
+                })
+        data = pd.DataFrame(rows)
+        pairs = pair_with_baseline(data, "LsReFT", "PromptSteering")
+        self.assertEqual(pairs["input_id"].tolist(), list(range(10)))
+        self.assertEqual(pairs["PromptSteering_steered_generation"].tolist(), [f"baseline {i}" for i in range(10)])
+        # a baseline steered at the same factor is compared at that factor.
+        pairs = pair_with_baseline(data, "LsReFT", "SteeringVector")
+        self.assertEqual(pairs["SteeringVector_steered_generation"].tolist(), [f"sv 1.0 {i}" for i in range(10)])
+
+        judge = FakeJudge()
+        evaluator = WinRateEvaluator("LsReFT", lm_model=judge)
+        for model_name in ["LsReFT", "PromptSteering"]:
+            evaluator.rate(data[data[f"{model_name}_steered_generation"].notna()], model_name)
+        pairs = pair_with_baseline(data, "LsReFT", "PromptSteering")
+        aligned = data[data["factor"] == 1.0].reset_index(drop=True)
+        aligned["PromptSteering_steered_generation"] = pairs["PromptSteering_steered_generation"]
+        self.assertEqual(
+            compute_win_results(pairs, evaluator.ratings, "LsReFT", "PromptSteering"),
+            reference_win_results(evaluator, aligned, "LsReFT", "PromptSteering"))
+
+    def test_no_pairs(self):
+        data = self.data.assign(factor=1.0, PromptSteering_steered_generation=None)
+        self.assertEqual(len(pair_with_baseline(data, "LsReFT", "PromptSteering")), 0)
+        summary = summarize_win_results([], "PromptSteering")
+        self.assertTrue(np.isnan(summary["win_rate"]))
+        self.assertEqual(summary["baseline_model"], "PromptSteering")
+
+    def test_missing_ratings_raise(self):
+        with self.assertRaises(ValueError):
+            compute_win_results(self.data, empty_ratings_table(), "LsReFT", "PromptSteering")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+import tempfile
+import time
+import multiprocessing
+from pathlib import Path
+
+from axbench.utils.work_queue import ConceptWorkQueue
+
+
+def run_worker(path, concept_ids, worker_id, results, delay, crash_after=None):
+    queue = ConceptWorkQueue(path, concept_ids, worker_id, lease_timeout=1.0)
+    for n, concept_id in enumerate(queue):
+        if crash_after is not None and n == crash_after:
+            return # exits holding the claim, like a crashed rank.
+        time.sleep(delay)
+        results.append((worker_id, concept_id))
+        queue.complete(concept_id)
+    queue.close()
+
+
+class TestConceptWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name) / "queue.sqlite"
+        self.concept_ids = list(range(30))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def run_workers(self, workers):
+        with multiprocessing.Manager() as manager:
+            results = manager.list()
+            processes = [
+                multiprocessing.Process(target=run_worker, args=(self.path, self.concept_ids, *worker[:1], results, *worker[1:]))
+                for worker in workers]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+            return list(results)
+
+    def test_workers_share_the_queue(self):
+        # a slow and a fast worker: the fast one processes more concepts.
+        results = self.run_workers([("rank_0", 0.05), ("rank_1", 0.0)])
+        self.assertEqual(sorted(concept_id for _, concept_id in results), self.concept_ids)
+        counts = {worker: sum(w == worker for w, _ in results) for worker in ["rank_0", "rank_1"]}
+        self.assertGreater(counts["rank_1"], counts["rank_0"])
+        # a finished queue hands out nothing on rerun.
+        self.assertIsNone(ConceptWorkQueue(self.path, self.concept_ids, "rank_0").claim())
+
+    def test_crashed_claims_are_reclaimed(self):
+        results = self.run_workers([("rank_0", 0.0, 3)])
+        self.assertEqual([concept_id for _, concept_id in results], [0, 1, 2])
+        queue = ConceptWorkQueue(self.path, self.concept_ids, "rank_1", lease_timeout=1.0)
+        self.assertEqual(queue.status()["running"], 1)
+        # the abandoned claim is only reclaimed once its lease expired.
+        self.assertEqual(queue.claim(), 4)
+        time.sleep(1.1)
+        self.assertEqual(queue.claim(), 3)
+        queue.close()
+
+    def test_restarted_worker_reclaims_its_own_claims(self):
+        queue = ConceptWorkQueue(self.path, self.concept_ids, "rank_0")
+        self.assertEqual(queue.claim(), 0)
+        queue.close()
+        queue = ConceptWorkQueue(self.path, self.concept_ids, "rank_0")
+        self.assertEqual(queue.claim(), 0)
+        queue.close()
+
+    def test_heartbeat_keeps_claims(self):
+        queue = ConceptWorkQueue(self.path, self.concept_ids, "rank_0", lease_timeout=0.4)
+        self.assertEqual(queue.claim(), 0)
+        time.sleep(1.0)
+        other = ConceptWorkQueue(self.path, self.concept_ids, "rank_1", lease_timeout=0.4)
+        self.assertEqual(other.claim(), 1)
+        queue.close()
+        other.close()
+
+    def test_remove_if_done(self):
+        queue = ConceptWorkQueue(self.path, self.concept_ids[:2], "rank_0")
+        self.assertEqual(queue.claim(), 0)
+        queue.complete(0)
+        self.assertFalse(queue.remove_if_done())
+        self.assertTrue(self.path.exists())
+        self.assertEqual(queue.claim(), 1)
+        queue.complete(1)
+        self.assertTrue(queue.remove_if_done())
+        self.assertFalse(self.path.exists())
+        # the same concepts are queued again afterwards.
+        self.assertEqual(ConceptWorkQueue(self.path, self.concept_ids[:2], "rank_0").claim(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
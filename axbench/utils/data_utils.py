@@ -1,10 +1,21 @@
+from collections import OrderedDict
 from dataclasses import dataclass
 from tqdm.auto import tqdm
 from torch.utils.data import DataLoader
 from transformers import set_seed
 import transformers, datasets, torch
+import numpy as np
+import pyarrow as pa
 from typing import Dict, Optional, Sequence, Union, List, Any
 
+from .ledger import content_checksum
+from .profiler import profiled
+
+MAX_TOKENIZED_LENGTH = 1024
+# tokenized examples of the last few concepts, shared by the methods trained on them.
+TOKENIZED_CACHE_SIZE = 8
+_tokenized_cache = OrderedDict()
+
 
 def parse_positions(positions: str):
     # parse position
@@ -65,41 +76,178 @@ def get_intervention_locations(**kwargs):
     return intervention_locations
 
 
+def _offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def row_positions(lengths):
+    """Position of every token of the flattened rows within its row."""
+    offsets = _offsets(lengths)
+    return np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+
+
+def list_column(values, lengths, nested=False):
+    """Arrow list column of the flattened `values` split into rows of `lengths`; `nested` wraps every row once more."""
+    array = pa.ListArray.from_arrays(pa.array(_offsets(lengths)), pa.array(values, type=pa.int64()))
+    if nested:
+        array = pa.ListArray.from_arrays(pa.array(np.arange(len(lengths) + 1)), array)
+    return array
+
+
+def _prompt_lengths(tokenizer, prompts, encodings, max_length):
+    """
+    Number of prompt tokens at the start of every prompt + output encoding.
+
+    With a fast tokenizer, these are the tokens added before the text and
+    the tokens starting inside the prompt. Rows where a token straddles the
+    end of the prompt, or with tokens added after the text, are tokenized
+    again without the output, as are all rows of a slow tokenizer.
+    """
+    if "offset_mapping" not in encodings:
+        return np.array([len(ids) for ids in tokenizer(
+            prompts, max_length=max_length, truncation=True)["input_ids"]], dtype=np.int64)
+    lengths = np.array([len(ids) for ids in encodings["input_ids"]], dtype=np.int64)
+    row_ids = np.repeat(np.arange(len(prompts)), lengths)
+    offsets = np.array([o for row in encodings["offset_mapping"] for o in row], dtype=np.int64).reshape(-1, 2)
+    special = np.array([m for row in encodings["special_tokens_mask"] for m in row], dtype=bool)
+    prompt_ends = np.array([len(prompt) for prompt in prompts], dtype=np.int64)[row_ids]
+    content = np.cumsum(~special) - np.repeat(_offsets(np.bincount(row_ids[~special], minlength=len(prompts)))[:-1], lengths)
+    leading_special = special & (content == 0)
+    in_prompt = leading_special | (~special & (offsets[:, 0] < prompt_ends))
+    straddling = ~special & (offsets[:, 0] < prompt_ends) & (offsets[:, 1] > prompt_ends)
+    prompt_lengths = np.bincount(row_ids[in_prompt], minlength=len(prompts))
+    ambiguous = np.bincount(row_ids[straddling | (special & ~leading_special)], minlength=len(prompts)) > 0
+    if ambiguous.any():
+        rows = np.flatnonzero(ambiguous)
+        prompt_lengths[rows] = [len(ids) for ids in tokenizer(
+            [prompts[row] for row in rows], max_length=max_length, truncation=True)["input_ids"]]
+    return prompt_lengths.astype(np.int64)
+
+
+@profiled("tokenize")
+def tokenize_examples(tokenizer, df, with_output=True, max_length=MAX_TOKENIZED_LENGTH):
+    """
+    Tokenize the "input" (+ "output") of all rows of `df` in one batch.
+
+    Returns an Arrow table with the `input_ids` and the `prompt_lengths` (the
+    number of tokens of the input alone) of every row. Tables are cached by
+    tokenizer and content, so all methods training on the same examples
+    tokenize them once.
+    """
+    prompts = df["input"].tolist()
+    if with_output:
+        # a missing output is replaced by the eos token.
+        outputs = [tokenizer.eos_token if isinstance(output, float) else output for output in df["output"]]
+    key = (
+        tokenizer.name_or_path, type(tokenizer).__name__, len(tokenizer), with_output, max_length,
+        content_checksum([prompts, outputs] if with_output else prompts))
+    if key in _tokenized_cache:
+        _tokenized_cache.move_to_end(key)
+        return _tokenized_cache[key]
+
+    if with_output:
+        return_offsets = getattr(tokenizer, "is_fast", False)
+        encodings = tokenizer(
+            [prompt + output for prompt, output in zip(prompts, outputs)], max_length=max_length, truncation=True,
+            return_offsets_mapping=return_offsets, return_special_tokens_mask=return_offsets)
+    else:
+        encodings = tokenizer(prompts, max_length=max_length, truncation=True)
+    lengths = np.array([len(ids) for ids in encodings["input_ids"]], dtype=np.int64)
+    prompt_lengths = _prompt_lengths(tokenizer, prompts, encodings, max_length) if with_output else lengths
+    table = pa.table({
+        "input_ids": list_column(np.fromiter(
+            (i for ids in encodings["input_ids"] for i in ids), dtype=np.int64, count=lengths.sum()), lengths),
+        "prompt_lengths": pa.array(prompt_lengths),
+    })
+    _tokenized_cache[key] = table
+    if len(_tokenized_cache) > TOKENIZED_CACHE_SIZE:
+        _tokenized_cache.popitem(last=False)
+    return table
+
+
+def tokenized_arrays(table):
+    """The flattened input ids, the row lengths and the prompt lengths of a `tokenize_examples` table."""
+    input_ids = table["input_ids"].combine_chunks()
+    lengths = np.diff(input_ids.offsets.to_numpy()).astype(np.int64)
+    return input_ids.flatten().to_numpy(), lengths, table["prompt_lengths"].to_numpy()
+
+
+def prompt_masked_labels(input_ids, lengths, prompt_lengths):
+    """Flattened labels: the input ids with the prompt tokens of every row set to -100."""
+    labels = input_ids.copy()
+    labels[row_positions(lengths) < np.repeat(prompt_lengths, lengths)] = -100
+    return labels
+
+
+def intervention_positions(starts, ends):
+    """Flattened ranges [start, end) of every row and their lengths."""
+    lengths = np.maximum(ends - starts, 0)
+    return np.repeat(starts, lengths) + row_positions(lengths), lengths
+
+
+def fixed_intervention_positions(last_positions, first_n, last_n):
+    """
+    Vectorized `get_intervention_locations` with share_weights=True and
+    pad_mode="last": the first and last positions of every row, padded
+    with `last_position` to `first_n + last_n` positions.
+    """
+    last_positions = np.asarray(last_positions, dtype=np.int64)[:, None]
+    first = np.minimum(last_positions // 2, first_n)
+    last = np.minimum(last_positions // 2, last_n)
+    columns = np.arange(first_n + last_n)[None, :]
+    positions = np.where(
+        columns < first, columns,
+        np.where(columns - first < last, last_positions - last + columns - first, last_positions))
+    return positions.reshape(-1), np.full(len(last_positions), first_n + last_n, dtype=np.int64)
+
+
+def pad_tensors(tensors, padding_value, extra=0, left=False, dtype=torch.int):
+    """
+    Pad tensors along their last dimension into one pre-allocated batch
+    tensor of width max length + `extra`, on the right (or on the left).
+    Returns the batch and the unpadded length of every tensor.
+    """
+    lengths = torch.tensor([tensor.shape[-1] for tensor in tensors])
+    width = int(lengths.max()) + extra
+    batch = torch.full((len(tensors), *tensors[0].shape[:-1], width), padding_value, dtype=dtype)
+    for row, tensor in zip(batch, tensors):
+        if left:
+            row[..., width - tensor.shape[-1]:] = tensor
+        else:
+            row[..., :tensor.shape[-1]] = tensor
+    return batch, lengths
+
+
 @dataclass
 class InterventionDataCollator(object):
     """Collate examples for Intervention."""
     
     tokenizer: transformers.AutoTokenizer
-    data_collator: transformers.DataCollator
+    data_collator: Optional[transformers.DataCollator] = None # unused, kept for compatibility
 
     def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
-        max_intervention_len = max([len(inst["intervention_locations"][0]) for inst in instances])
-        max_seq_len = max([len(inst["input_ids"]) for inst in instances])
-        
-        for inst in instances:
-            non_pad_len = len(inst["input_ids"])
-
-            _intervention_mask = torch.ones_like(inst["intervention_locations"][0])
-            _intervention_location_paddings = torch.tensor(
-                [[len(inst["input_ids"]) for _ in range(max_intervention_len - len(inst["intervention_locations"][0]))]])
-            _intervention_mask_paddings = torch.tensor(
-                [0 for _ in range(max_intervention_len - len(inst["intervention_locations"][0]))])
-            inst["intervention_locations"] = torch.cat([inst["intervention_locations"], _intervention_location_paddings], dim=-1).int()
-            inst["intervention_masks"] = torch.cat([_intervention_mask, _intervention_mask_paddings], dim=-1).int()
-            inst["prompt_intervention_masks"] = inst["intervention_masks"].clone()
-            inst["prompt_intervention_masks"][inst["prompt_lengths"]:] = 0 # mask out the intervention locations after prompt length
-
-            _input_id_paddings = torch.tensor(
-                [self.tokenizer.pad_token_id for _ in range(max_seq_len - non_pad_len)])
-            inst["input_ids"] = torch.cat((inst["input_ids"], torch.tensor([self.tokenizer.pad_token_id]), _input_id_paddings)).int()
-
-            _label_paddings = torch.tensor([-100 for _ in range(max_seq_len - non_pad_len+1)])
-            inst["labels"] = torch.cat((inst["labels"], _label_paddings))
-            
-            inst["attention_mask"] = (inst["input_ids"] != self.tokenizer.pad_token_id).int()
-
-        batch_inputs = self.data_collator(instances)
-        return batch_inputs
+        pad_token_id = self.tokenizer.pad_token_id
+        # one pad token is always appended; padded intervention locations point to it.
+        input_ids, lengths = pad_tensors([inst["input_ids"] for inst in instances], pad_token_id, extra=1)
+        labels, _ = pad_tensors([inst["labels"] for inst in instances], -100, extra=1, dtype=torch.long)
+        intervention_locations, intervention_lengths = pad_tensors(
+            [inst["intervention_locations"] for inst in instances], 0)
+        positions = torch.arange(intervention_locations.shape[-1])
+        intervention_masks = positions[None, :] < intervention_lengths[:, None]
+        prompt_lengths = torch.stack([inst["prompt_lengths"] for inst in instances])
+        return {
+            "input_ids": input_ids,
+            "intervention_locations": torch.where(
+                intervention_masks[:, None, :], intervention_locations, lengths[:, None, None]).int(),
+            "labels": labels,
+            "prompt_lengths": prompt_lengths,
+            "intervention_masks": intervention_masks.int(),
+            # mask out the intervention locations after prompt length
+            "prompt_intervention_masks": (intervention_masks & (positions[None, :] < prompt_lengths[:, None])).int(),
+            "attention_mask": (input_ids != pad_token_id).int(),
+        }
 
 
 def make_data_module(
@@ -114,61 +262,32 @@ def make_data_module(
     if not exclude_bos:
         prefix_length = 0
     
-    all_base_input_ids, all_intervention_locations, all_output_ids,  = [], [], []
-    all_prompt_lengths = []
-    for _, row in df.iterrows():
-        _input, _output = row["input"], row["output"]
-        # prepare input ids
-        base_prompt = _input
-        if isinstance(_output, float):
-            _output = tokenizer.eos_token
-        base_input = base_prompt + _output
-        base_prompt_ids = tokenizer(
-            base_prompt, max_length=1024, truncation=True, return_tensors="pt")["input_ids"][0]
-        base_input_ids = tokenizer(
-            base_input, max_length=1024, truncation=True, return_tensors="pt")["input_ids"][0]
-        base_prompt_length = len(base_prompt_ids)
-        base_length = len(base_input_ids)
-
-        # output ids with prompt token mask
-        output_ids = base_input_ids.clone()
-        output_ids[:base_prompt_length] = -100
-
-        if positions is None or positions == "all_prompt":
-            intervention_locations = torch.tensor([[i for i in range(prefix_length, base_prompt_length)]])
-        elif positions == "all":
-            intervention_locations = torch.tensor([[i for i in range(prefix_length, base_length)]])
-        else:
-            first_n, last_n = parse_positions(positions)
-            intervention_locations = get_intervention_locations(
-                last_position=base_prompt_length - prefix_length, 
-                first_n=first_n, 
-                last_n=last_n,
-                pad_mode="last",
-                num_interventions=1,
-                share_weights=True,
-            )
-            # shift intervention locations by prefix length
-            shifted_intervention_locations = [[loc + prefix_length for loc in intervention_locations[0]]]
-            intervention_locations = shifted_intervention_locations
-        all_intervention_locations.append(intervention_locations)
-        all_base_input_ids.append(base_input_ids)
-        all_output_ids.append(output_ids)
-        all_prompt_lengths.append(torch.tensor(base_prompt_length - 1)) # exclude bos token
-        
-    train_dataset = datasets.Dataset.from_dict({
-        "input_ids": all_base_input_ids,
-        "intervention_locations": all_intervention_locations,
-        "labels": all_output_ids,
-        "prompt_lengths": all_prompt_lengths,
-    })
+    input_ids, lengths, prompt_lengths = tokenized_arrays(tokenize_examples(tokenizer, df))
+
+    # output ids with prompt token mask
+    output_ids = prompt_masked_labels(input_ids, lengths, prompt_lengths)
+
+    if positions is None or positions == "all_prompt":
+        locations, location_lengths = intervention_positions(
+            np.full(len(lengths), prefix_length), prompt_lengths)
+    elif positions == "all":
+        locations, location_lengths = intervention_positions(np.full(len(lengths), prefix_length), lengths)
+    else:
+        first_n, last_n = parse_positions(positions)
+        locations, location_lengths = fixed_intervention_positions(prompt_lengths - prefix_length, first_n, last_n)
+        # shift intervention locations by prefix length
+        locations = locations + prefix_length
+
+    train_dataset = datasets.Dataset(pa.table({
+        "input_ids": list_column(input_ids, lengths),
+        "intervention_locations": list_column(locations, location_lengths, nested=True),
+        "labels": list_column(output_ids, lengths),
+        "prompt_lengths": pa.array(prompt_lengths - 1), # exclude bos token
+    }))
     train_dataset.set_format(
         type='torch', columns=[
             'input_ids', 'intervention_locations', 'prompt_lengths', 'labels'])
 
-    data_collator_fn = transformers.DefaultDataCollator(
-        return_tensors="pt"
-    )
-    data_collator = InterventionDataCollator(tokenizer=tokenizer, data_collator=data_collator_fn)
+    data_collator = InterventionDataCollator(tokenizer=tokenizer)
     return dict(train_dataset=train_dataset, eval_dataset=None, data_collator=data_collator)
 
@@ -1,6 +1,7 @@
 import pandas as pd
 import asyncio
-import os, random, json, time, requests, copy, asyncio, csv, math
+import os, random, json, time, requests, copy, asyncio, csv, math, hashlib
+import numpy as np
 import torch, transformers, datasets
 from datasets import load_from_disk
 from dataclasses import dataclass, field
@@ -21,6 +22,7 @@ from ..utils.prompt_utils import (
     get_contrast_concepts,
     get_concept_genres,
     get_random_content,
+    SeedContentSampler,
     modify_content_with_concept,
     modify_content_with_polysemantic_concepts,
     sample_index_exclude,
@@ -34,7 +36,7 @@ from ..utils.prompt_utils import (
     response_with,
 )
 from ..utils.constants import EXAMPLE_TAG, EMPTY_CONCEPT
-from ..utils.model_utils import get_model_continues
+from ..utils.model_utils import get_model_continues, get_chat_template_formatter
 
 
 T_PROMPT_STEERING = """You must answer the question with content \
@@ -52,6 +54,11 @@ Optionally, provide in-context examples to reinforce this behavior.
 Return only the final prompt without any additional text."""
 
 
+# shared negative pools are cached under master_data_dir.
+NEGATIVE_POOL_DIR = "negative_pools"
+# initial batch size of negative pool generation; halved on out-of-memory.
+NEGATIVE_POOL_BATCH_SIZE = 64
+
 # special types for dataset
 Prompt = namedtuple("Prompt", ["concept", "tag", "content"])
 
@@ -76,14 +83,15 @@ class DatasetFactory(object):
         self.use_cache = use_cache
         self.lm_model = LanguageModel(
             lm_model, client, dump_dir, 
-            use_cache=use_cache, master_data_dir=master_data_dir
+            use_cache=use_cache, master_data_dir=master_data_dir,
+            batch_dir=kwargs.get("lm_batch_dir", None)
         )
         self.seed = kwargs.get("seed", 42)
         self.logger = kwargs.get("logger", logger)
 
         # load seed sentences
-        self.seed_sentences = load_from_disk(os.path.join(master_data_dir, "seed_sentences"))
-        self.seed_instructions = load_from_disk(os.path.join(master_data_dir, "seed_instructions"))
+        self.seed_sentences = SeedContentSampler(load_from_disk(os.path.join(master_data_dir, "seed_sentences")))
+        self.seed_instructions = SeedContentSampler(load_from_disk(os.path.join(master_data_dir, "seed_instructions")))
         self.dataset_category = dataset_category
         self.overwrite_inference_data_dir = kwargs.get("overwrite_inference_data_dir", None)
         if self.overwrite_inference_data_dir is not None and os.path.exists(self.overwrite_inference_data_dir):
@@ -93,29 +101,66 @@ class DatasetFactory(object):
 
         # create a shared genre-based negative pools all at once
         if start_concept_id == 0 and not kwargs.get("is_inference", False):
-            per_category_n = int(num_of_examples // 2)
-            start = time.time()
-            self.logger.warning("Creating genre-based and shared negative examples for all concepts.")
-            functor = continue_with if self.dataset_category == "continuation" else response_with
-            random_examples = []
-            for genre in ["text", "math", "code"]:
-                random_content = get_random_content(
-                    self.seed_sentences if self.dataset_category == "continuation" else self.seed_instructions, 
-                    tokenizer=tokenizer, count=per_category_n, 
-                    genres=[genre], concepts=["random"], length=None, split="train"
-                )
-                concept_outputs = get_model_continues(
-                    self.model, self.tokenizer, random_content["random"],
-                    max_new_tokens=int(output_length*1.5), is_chat_model=is_chat_model, include_system_prompt=include_system_prompt)
-                for i, (prompt, output) in enumerate(zip(random_content["random"], concept_outputs)):
-                    random_examples += [[
-                        prompt, output, EMPTY_CONCEPT, genre, "negative", self.dataset_category
-                    ]]
-            self.negative_df = pd.DataFrame(
-                random_examples, 
-                columns = ['input', 'output', 'output_concept', 'concept_genre', 'category', 'dataset_category'])
-            self.negative_df["concept_id"] = -1
-            self.logger.warning(f"Finished creating negative examples in {round(time.time() - start, 3)} sec.")
+            self.negative_df = self.load_or_create_negative_pool(
+                master_data_dir, num_of_examples, output_length, is_chat_model, include_system_prompt)
+
+    def get_negative_pool_path(self, master_data_dir, per_category_n, output_length, is_chat_model, include_system_prompt):
+        """Content address of the negative pool, keyed by everything that determines its examples."""
+        model_name = getattr(self.model, "name_or_path", None)
+        if not isinstance(model_name, str) or model_name == "" or master_data_dir is None:
+            return None # pools of unnamed models are not cached.
+        pool_key = {
+            "model": model_name,
+            "dataset_category": self.dataset_category,
+            "seed": self.seed,
+            "per_category_n": per_category_n,
+            "output_length": output_length,
+            "is_chat_model": is_chat_model,
+            "include_system_prompt": include_system_prompt,
+        }
+        digest = hashlib.sha256(json.dumps(pool_key, sort_keys=True).encode()).hexdigest()[:16]
+        return Path(master_data_dir) / NEGATIVE_POOL_DIR / f"{digest}.parquet"
+
+    def load_or_create_negative_pool(
+        self, master_data_dir, num_of_examples, output_length, is_chat_model, include_system_prompt):
+        per_category_n = int(num_of_examples // 2)
+        pool_path = self.get_negative_pool_path(
+            master_data_dir, per_category_n, output_length, is_chat_model, include_system_prompt)
+        if pool_path is not None and pool_path.exists():
+            self.logger.warning(f"Loading genre-based and shared negative examples from {pool_path}.")
+            return pd.read_parquet(pool_path)
+
+        start = time.time()
+        self.logger.warning("Creating genre-based and shared negative examples for all concepts.")
+        rng = np.random.default_rng(self.seed)
+        random_examples = []
+        for genre in ["text", "math", "code"]:
+            random_content = get_random_content(
+                self.seed_sentences if self.dataset_category == "continuation" else self.seed_instructions, 
+                tokenizer=self.tokenizer, count=per_category_n, 
+                genres=[genre], concepts=["random"], length=None, split="train", rng=rng
+            )
+            concept_outputs = get_model_continues(
+                self.model, self.tokenizer, random_content["random"],
+                max_new_tokens=int(output_length*1.5), is_chat_model=is_chat_model, include_system_prompt=include_system_prompt,
+                batch_size=NEGATIVE_POOL_BATCH_SIZE, sort_by_length=True, adaptive_batch_size=True)
+            for i, (prompt, output) in enumerate(zip(random_content["random"], concept_outputs)):
+                random_examples += [[
+                    prompt, output, EMPTY_CONCEPT, genre, "negative", self.dataset_category
+                ]]
+        negative_df = pd.DataFrame(
+            random_examples, 
+            columns = ['input', 'output', 'output_concept', 'concept_genre', 'category', 'dataset_category'])
+        negative_df["concept_id"] = -1
+        self.logger.warning(f"Finished creating negative examples in {round(time.time() - start, 3)} sec.")
+
+        # other runs with the same configuration reuse the pool.
+        if pool_path is not None:
+            pool_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = pool_path.with_suffix(f".{os.getpid()}.tmp")
+            negative_df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, pool_path)
+        return negative_df
 
     def save_cache(self):
         """Save the language model cache before exiting"""
@@ -129,6 +174,10 @@ class DatasetFactory(object):
         self.lm_model.stats.reset()
 
     def prepare_genre_concepts(self, concepts, **kwargs):
+        return asyncio.run(self.aprepare_genre_concepts(concepts, **kwargs))
+
+    async def aprepare_genre_concepts(self, concepts, **kwargs):
+        """Async version of prepare_genre_concepts, to share one event loop across concepts."""
         start = time.time()
         tasks = []
 
@@ -143,7 +192,7 @@ class DatasetFactory(object):
             tasks.append(genre_task)
         
         # run tasks
-        res = asyncio.run(run_tasks(tasks))
+        res = await run_tasks(tasks)
         concept_genres_map = res[0]
 
         # log
@@ -151,6 +200,10 @@ class DatasetFactory(object):
         return concept_genres_map
 
     def prepare_concepts(self, concepts, **kwargs):
+        return asyncio.run(self.aprepare_concepts(concepts, **kwargs))
+
+    async def aprepare_concepts(self, concepts, **kwargs):
+        """Async version of prepare_concepts, to share one event loop across concepts."""
         if self.overwrite_inference_data_dir is not None and os.path.exists(self.overwrite_inference_data_dir):
             self.logger.warning("Using pre-generated metadata.")
             return {}, {}
@@ -176,7 +229,7 @@ class DatasetFactory(object):
             tasks.append(genre_task)
         
         # run tasks
-        res = asyncio.run(run_tasks(tasks))
+        res = await run_tasks(tasks)
         contrast_concepts_map = res[0]
         if len(res) > 1:
             concept_genres_map = res[1]
@@ -207,6 +260,17 @@ class DatasetFactory(object):
         self, concepts, subset_n, concept_genres_map, 
         train_contrast_concepts_map, eval_contrast_concepts_map, mode="balance", **kwargs):
         """category: positive, negative, hard negative"""
+        return asyncio.run(self.acreate_eval_df(
+            concepts, subset_n, concept_genres_map, 
+            train_contrast_concepts_map, eval_contrast_concepts_map, mode=mode, **kwargs))
+
+    async def acreate_eval_df(
+        self, concepts, subset_n, concept_genres_map, 
+        train_contrast_concepts_map, eval_contrast_concepts_map, mode="balance", **kwargs):
+        """
+        Async version of create_eval_df, to share one event loop across concepts. The
+        positive, negative and hard negative examples of a concept are requested together.
+        """
         
         if self.overwrite_inference_data_dir is not None and os.path.exists(self.overwrite_inference_data_dir):
             if mode == "balance":
@@ -225,12 +289,14 @@ class DatasetFactory(object):
         # init vars
         lm_model, model, tokenizer = self.lm_model, self.model, self.tokenizer 
         output_length = kwargs.get("output_length", 32)
+        api_tag = kwargs.get("api_tag", "")
+        rng = kwargs.get("rng", None)
 
         all_examples = []
         concepts_random_content = get_random_content(
             self.seed_sentences if self.dataset_category == "continuation" else self.seed_instructions, 
             tokenizer=tokenizer, count=subset_n*2, 
-            genres=[concept_genres_map[concepts[0]][0]], concepts=concepts, length=None, split="test"
+            genres=[concept_genres_map[concepts[0]][0]], concepts=concepts, length=None, split="test", rng=rng
         )
 
         genre_balanced_random_content = {concept: [] for concept in concepts}
@@ -241,7 +307,7 @@ class DatasetFactory(object):
             genre_concepts_random_content = get_random_content(
                 self.seed_sentences if self.dataset_category == "continuation" else self.seed_instructions, 
                 tokenizer=tokenizer, count=genre_subset_n[genre], 
-                genres=[genre], concepts=concepts, length=None, split="test"
+                genres=[genre], concepts=concepts, length=None, split="test", rng=rng
             )
             for concept in concepts:
                 genre_concept_map[concept] += [genre] * genre_subset_n[genre]
@@ -256,27 +322,17 @@ class DatasetFactory(object):
 
         for idx, concept in enumerate(concepts):
             # positive continuation / instruction
-            continue_task = functors[0](
+            positive_task = functors[0](
                 self.lm_model, self.tokenizer, 
                 concepts=[concept]*len(concepts_random_content[concept][:subset_n]), 
-                content=concepts_random_content[concept][:subset_n], length=output_length)
-            concept_outputs = asyncio.run(run_tasks([continue_task]))[0]
-            for i, (prompt, output) in enumerate(zip(concepts_random_content[concept][:subset_n], concept_outputs)):
-                all_examples += [[
-                    prompt, output, concept, concept_genres_map[concepts[0]][0], "positive", self.dataset_category
-                ]]
+                content=concepts_random_content[concept][:subset_n], length=output_length, api_tag=api_tag)
 
             # negative continuation / instruction (genre balanced based on global genre distribution)
-            continue_task = functors[1](
+            negative_task = functors[1](
                 self.lm_model, self.tokenizer, 
                 content=genre_balanced_random_content[concept], 
                 concepts=[concept]*len(genre_balanced_random_content[concept]), 
-                length=output_length)
-            concept_outputs = asyncio.run(run_tasks([continue_task]))[0]
-            for i, (negative_genre, prompt, output) in enumerate(zip(genre_concept_map[concept], genre_balanced_random_content[concept], concept_outputs)):
-                all_examples += [[
-                    prompt, output, concept, negative_genre, "negative", self.dataset_category
-                ]]
+                length=output_length, api_tag=api_tag)
 
             # hard negative continuation / instruction
             splits = [
@@ -292,10 +348,21 @@ class DatasetFactory(object):
                         client=lm_model, tokenizer=tokenizer,
                         polysemantic_concepts=polysemantic_meanings,
                         concept=concept, content=polysemantic_random_content,
-                        length=output_length
+                        length=output_length, api_tag=api_tag
                     ))
                     tags.append((label, concept, idx))
-            hard_negative_eval_content = asyncio.run(run_tasks(eval_tasks))
+
+            # the three categories are requested together.
+            concept_outputs, negative_outputs, *hard_negative_eval_content = await run_tasks(
+                [positive_task, negative_task] + eval_tasks)
+            for i, (prompt, output) in enumerate(zip(concepts_random_content[concept][:subset_n], concept_outputs)):
+                all_examples += [[
+                    prompt, output, concept, concept_genres_map[concepts[0]][0], "positive", self.dataset_category
+                ]]
+            for i, (negative_genre, prompt, output) in enumerate(zip(genre_concept_map[concept], genre_balanced_random_content[concept], negative_outputs)):
+                all_examples += [[
+                    prompt, output, concept, negative_genre, "negative", self.dataset_category
+                ]]
             for (tag, concept, idx), eval_content in zip(tags, hard_negative_eval_content):
                 all_examples += [[content[0], content[2], "//".join(content[1]), concept_genres_map[concepts[0]][0], 
                                   tag, self.dataset_category] for content in eval_content[1]]
@@ -310,6 +377,10 @@ class DatasetFactory(object):
         return df
     
     def create_train_df(self, concept, n, concept_genres_map, **kwargs):
+        return asyncio.run(self.acreate_train_df(concept, n, concept_genres_map, **kwargs))
+
+    async def acreate_train_df(self, concept, n, concept_genres_map, **kwargs):
+        """Async version of create_train_df, to share one event loop across concepts."""
         lm_model, model, tokenizer = self.lm_model, self.model, self.tokenizer
         
         start = time.time()
@@ -329,7 +400,8 @@ class DatasetFactory(object):
         concepts_random_content = get_random_content(
             self.seed_sentences if self.dataset_category == "continuation" else self.seed_instructions, 
             tokenizer=tokenizer, count=n, 
-            genres=[genre], concepts=[concept], length=None, split="train"
+            genres=[genre], concepts=[concept], length=None, split="train",
+            rng=kwargs.get("rng", None)
         )
         per_category_n = int(n // 2)
 
@@ -337,8 +409,9 @@ class DatasetFactory(object):
         continue_task = functors[0](
             self.lm_model, self.tokenizer, 
             concepts=[concept]*len(concepts_random_content[concept][:per_category_n]), 
-            content=concepts_random_content[concept][:per_category_n], length=output_length)
-        concept_outputs = asyncio.run(run_tasks([continue_task]))[0]
+            content=concepts_random_content[concept][:per_category_n], length=output_length,
+            api_tag=kwargs.get("api_tag", ""))
+        concept_outputs = (await run_tasks([continue_task]))[0]
         for i, (prompt, output) in enumerate(zip(concepts_random_content[concept][:per_category_n], concept_outputs)):
             all_examples += [[
                 prompt, output, concept, genre, "positive", self.dataset_category
@@ -370,9 +443,30 @@ class SteeringDatasetFactory(object):
         if kwargs.get("lm_client", None):
             self.lm_model = LanguageModel(
                 kwargs.get("lm_model", "gpt-4o-mini"), kwargs["lm_client"], dump_dir, 
-                use_cache=True, master_data_dir=self.master_data_dir
+                use_cache=True, master_data_dir=self.master_data_dir,
+                batch_dir=kwargs.get("lm_batch_dir", None)
             )
         self.has_prompt_steering = has_prompt_steering
+        self.alpaca_eval_df = None
+        self.steering_prompts = {}
+
+    def load_alpaca_eval_df(self):
+        """Load the alpaca eval dataset once per factory."""
+        if self.alpaca_eval_df is None:
+            assert self.master_data_dir is not None, "Master data dir is required for AlpacaEval."
+            alpaca_eval_path = os.path.join(self.master_data_dir, "alpaca_eval.json")
+            self.alpaca_eval_df = pd.read_json(alpaca_eval_path)
+        return self.alpaca_eval_df
+
+    def prefetch_steering_prompts(self, concepts):
+        """Get the steering prompts of `concepts`, generating all missing ones in one bulk LM call."""
+        missing_concepts = list(dict.fromkeys(
+            concept for concept in concepts if concept not in self.steering_prompts))
+        if len(missing_concepts) > 0:
+            steering_prompts = asyncio.run(get_steering_prompts(self.lm_model, missing_concepts))
+            self.steering_prompts.update(zip(
+                missing_concepts, [prompt.strip() for prompt in steering_prompts]))
+        return [self.steering_prompts[concept] for concept in concepts]
 
     def create_eval_df(
             self, concepts, subset_n, steering_factors, steering_datasets, 
@@ -398,18 +492,15 @@ class SteeringDatasetFactory(object):
                 return df
             elif dataset_name == "AlpacaEval":
                 # load alpaca eval dataset.
-                assert self.master_data_dir is not None, "Master data dir is required for AlpacaEval."
-                alpaca_eval_path = os.path.join(self.master_data_dir, "alpaca_eval.json")
-                alpaca_eval_df = pd.read_json(alpaca_eval_path)
+                alpaca_eval_df = self.load_alpaca_eval_df()
 
                 # get gpt-4o boosted steering prompts.
                 if self.has_prompt_steering:
-                    steering_prompts = asyncio.run(get_steering_prompts(self.lm_model, concepts))
-                    steering_prompts = [prompt.strip() for prompt in steering_prompts]
+                    steering_prompts = self.prefetch_steering_prompts(concepts)
                 else:
                     # simply just a dummy one since no method is going to use it.
                     steering_prompts = [T_PROMPT_STEERING % (concept) for concept in concepts]
-                all_examples = []
+                examples = []
                 for idx, concept in enumerate(concepts):
                     # sample a random example from alpaca eval dataset.
                     sampled_prompts = alpaca_eval_df.sample(subset_n, random_state=int(concept_id))["instruction"].tolist()
@@ -419,34 +510,22 @@ class SteeringDatasetFactory(object):
                         steering_prompt = steering_prompts[idx] \
                             if steering_prompts[idx] != "" else T_PROMPT_STEERING % (concept)
                         steered_prompt = f" {steering_prompt}\n\nQuestion: {sampled_prompt}"
-                        if steering_model_name == "meta-llama/Llama-3.1-8B-Instruct":
-                            formatted_steered_prompt = self.tokenizer.apply_chat_template(
-                                [{"role": "system", "content": "You are a helpful assistant."}, 
-                                 {"role": "user", "content": steered_prompt}], 
-                                tokenize=True, add_generation_prompt=True)[1:] # get rid of bos token
-                            formatted_steered_prompt = self.tokenizer.decode(formatted_steered_prompt)
-                            # apply the tokenizer chat format to the prompt.
-                            formatted_prompt = self.tokenizer.apply_chat_template(
-                                [{"role": "system", "content": "You are a helpful assistant."}, 
-                                 {"role": "user", "content": sampled_prompt}], 
-                                tokenize=True, add_generation_prompt=True)[1:] # get rid of bos token
-                            formatted_prompt = self.tokenizer.decode(formatted_prompt)
-                        else:
-                            formatted_steered_prompt = self.tokenizer.apply_chat_template(
-                                [{"role": "user", "content": steered_prompt}], 
-                                tokenize=True, add_generation_prompt=True)[1:] # get rid of bos token
-                            formatted_steered_prompt = self.tokenizer.decode(formatted_steered_prompt)
-                            # apply the tokenizer chat format to the prompt.
-                            formatted_prompt = self.tokenizer.apply_chat_template(
-                                [{"role": "user", "content": sampled_prompt}], 
-                                tokenize=True, add_generation_prompt=True)[1:] # get rid of bos token
-                            formatted_prompt = self.tokenizer.decode(formatted_prompt)
-
-                        for factor in steering_factors:
-                            all_examples += [[
-                                dataset_name, idx, concept, i, factor, 
-                                sampled_prompt, formatted_steered_prompt, formatted_prompt
-                            ]]
+                        examples += [(idx, concept, i, sampled_prompt, steered_prompt)]
+
+                # apply the tokenizer chat format to the prompts (without the bos token).
+                formatter = get_chat_template_formatter(
+                    self.tokenizer, system_prompt="You are a helpful assistant." \
+                        if steering_model_name == "meta-llama/Llama-3.1-8B-Instruct" else None)
+                formatted_steered_prompts = formatter([example[4] for example in examples])
+                formatted_prompts = formatter([example[3] for example in examples])
+                all_examples = []
+                for (idx, concept, i, sampled_prompt, _), formatted_steered_prompt, formatted_prompt in zip(
+                    examples, formatted_steered_prompts, formatted_prompts):
+                    for factor in steering_factors:
+                        all_examples += [[
+                            dataset_name, idx, concept, i, factor, 
+                            sampled_prompt, formatted_steered_prompt, formatted_prompt
+                        ]]
                 df = pd.DataFrame(
                     all_examples, 
                     columns = [
@@ -455,15 +534,12 @@ class SteeringDatasetFactory(object):
                 return df
             elif dataset_name == "AlpacaEval_Suppress" or dataset_name == "AlpacaEval_Synergy":
                 # load alpaca eval dataset.
-                assert self.master_data_dir is not None, "Master data dir is required for AlpacaEval."
-                alpaca_eval_path = os.path.join(self.master_data_dir, "alpaca_eval.json")
-                alpaca_eval_df = pd.read_json(alpaca_eval_path)
+                alpaca_eval_df = self.load_alpaca_eval_df()
                 common_steering_factors = steering_factors
                 if dataset_name == "AlpacaEval_Suppress":
                     common_steering_factors = [f*-1.0 for f in common_steering_factors]
                 # get gpt-4o boosted steering prompts.
-                steering_prompts = asyncio.run(get_steering_prompts(self.lm_model, concepts))
-                steering_prompts = [prompt.strip() for prompt in steering_prompts]
+                steering_prompts = self.prefetch_steering_prompts(concepts)
                 all_examples = []
                 for idx, concept in enumerate(concepts):
                     for i in range(subset_n):
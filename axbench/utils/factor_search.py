@@ -0,0 +1,45 @@
+#################################
+#
+# Steering factor search utils.
+#
+#################################
+import math
+
+INVERSE_GOLDEN_RATIO = (math.sqrt(5) - 1) / 2
+
+
+def golden_section_factor_search(factors, evaluate):
+    """
+    Golden-section search for the steering factor with the highest score.
+
+    The search assumes the score is unimodal along the sorted factor grid, so
+    it only probes O(log n) factors instead of the whole grid. `evaluate` is
+    called at most once per factor.
+
+    Args:
+        factors: candidate steering factors.
+        evaluate: callable mapping a factor to a score to maximise.
+
+    Returns:
+        (best_factor, scores): the chosen factor and a {factor: score} dict of
+        every probed factor, in probing order.
+    """
+    factors = sorted(set(factors))
+    scores = {}
+
+    def score(idx):
+        if factors[idx] not in scores:
+            scores[factors[idx]] = evaluate(factors[idx])
+        return scores[factors[idx]]
+
+    lo, hi = 0, len(factors) - 1
+    while hi - lo > 2:
+        left = lo + round((hi - lo) * (1 - INVERSE_GOLDEN_RATIO))
+        right = max(lo + round((hi - lo) * INVERSE_GOLDEN_RATIO), left + 1)
+        # ties go to the smaller factor, like np.argmax over the full grid.
+        if score(left) >= score(right):
+            hi = right
+        else:
+            lo = left
+    best_idx = max(range(lo, hi + 1), key=lambda idx: (score(idx), -idx))
+    return factors[best_idx], scores
@@ -0,0 +1,128 @@
+#################################
+#
+# Progress ledger.
+#
+#################################
+import os, json, time, fcntl, hashlib
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import torch
+
+PROGRESS_LEDGER_FILE = "progress.jsonl"
+
+
+def content_checksum(value):
+    """Short sha256 digest of an artifact (DataFrame, tensor, array, dict or plain value)."""
+    digest = hashlib.sha256()
+    if isinstance(value, pd.DataFrame):
+        digest.update(",".join(map(str, value.columns)).encode())
+        digest.update(pd.util.hash_pandas_object(value.astype(str), index=False).values.tobytes())
+    elif isinstance(value, torch.Tensor):
+        digest.update(value.detach().float().cpu().numpy().tobytes())
+    elif isinstance(value, np.ndarray):
+        digest.update(value.tobytes())
+    elif isinstance(value, bytes):
+        digest.update(value)
+    else:
+        digest.update(json.dumps(value, sort_keys=True, default=str).encode())
+    return digest.hexdigest()[:16]
+
+
+class ProgressLedger(object):
+    """
+    Append-only JSONL ledger of completed work units.
+
+    A unit is a (stage, concept_id, method) triple, e.g. ("train", 3, "LsReFT");
+    stages without methods use method=None. Each entry also records a checksum
+    of the unit's artifact. Stages skip exactly the units in the ledger, so a
+    crash only redoes unfinished units and adding a method to a finished run
+    only computes that method. Appends are serialized with a file lock, so all
+    ranks of a job share one ledger. Units are invalidated by appending an
+    invalidation entry, which drops the matching units recorded before it.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def record(self, stage, concept_id, method=None, checksum=None, **extra):
+        """Record a completed unit; `extra` fields (e.g. rank) are stored with it."""
+        self.record_many([{
+            "stage": stage, "concept_id": None if concept_id is None else int(concept_id),
+            "method": method, "checksum": checksum, **extra}])
+
+    def record_many(self, entries):
+        lines = "".join(json.dumps({**entry, "time": time.time()}) + "\n" for entry in entries)
+        with open(self.path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                # never append to a line torn by an interrupted write.
+                if os.path.getsize(self.path) > 0:
+                    with open(self.path, "rb") as f_last:
+                        f_last.seek(-1, os.SEEK_END)
+                        if f_last.read(1) != b"\n":
+                            lines = "\n" + lines
+                f.write(lines)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def invalidate(self, stage, units=None):
+        """Invalidate the (concept_id, method) `units` of `stage`, or all of its units if None."""
+        self.record_many([{
+            "stage": stage, "invalidate": None if units is None else [
+                [None if concept_id is None else int(concept_id), method] for concept_id, method in units]}])
+
+    def entries(self, stages=None, include_invalidations=False):
+        """All entries of `stages` (a name or a collection of names), in the order they were recorded."""
+        if not self.path.exists():
+            return []
+        if isinstance(stages, str):
+            stages = {stages}
+        entries = []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # a torn line of an interrupted append.
+                if "invalidate" in entry and not include_invalidations:
+                    continue
+                if stages is None or entry["stage"] in stages:
+                    entries.append(entry)
+        return entries
+
+    def checksums(self, stages=None):
+        """
+        Map every completed (stage, concept_id, method) unit of `stages` to its
+        latest checksum; units recorded without one are identified by their time.
+        """
+        checksums = {}
+        for entry in self.entries(stages, include_invalidations=True):
+            if "invalidate" not in entry:
+                checksums[(entry["stage"], entry["concept_id"], entry["method"])] = \
+                    entry["checksum"] if entry["checksum"] is not None else f"time:{entry['time']}"
+            elif entry["invalidate"] is None:
+                checksums = {unit: checksum for unit, checksum in checksums.items() if unit[0] != entry["stage"]}
+            else:
+                for concept_id, method in entry["invalidate"]:
+                    checksums.pop((entry["stage"], concept_id, method), None)
+        return checksums
+
+    def completed(self, stage):
+        """Set of completed (concept_id, method) units of `stage`."""
+        return {(concept_id, method) for _, concept_id, method in self.checksums(stage)}
+
+    def pending(self, stage, concept_ids, methods=(None,)):
+        """Map every concept_id with unfinished units of `stage` to its unfinished methods, in order."""
+        completed = self.completed(stage)
+        pending = {}
+        for concept_id in concept_ids:
+            concept_methods = [
+                method for method in methods if (int(concept_id), method) not in completed]
+            if len(concept_methods) > 0:
+                pending[int(concept_id)] = concept_methods
+        return pending
+
+    def has_stage(self, stage):
+        return len(self.entries(stage)) > 0
@@ -3,9 +3,29 @@
 # Model utils.
 #
 #################################
-import torch, einops
+import torch, einops, logging
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
 from torch import nn
 
+from .data_utils import tokenize_examples, tokenized_arrays, pad_tensors
+from .ledger import content_checksum
+from .profiler import profiled
+
+logger = logging.getLogger(__name__)
+
+# placeholders used to locate the message contents in a rendered chat template.
+CHAT_TEMPLATE_PROMPT_SENTINEL = "<<axbench-prompt>>"
+CHAT_TEMPLATE_OUTPUT_SENTINEL = "<<axbench-output>>"
+# rows of every formatting call (the first one and a random sample) checked against the tokenizer's chat template.
+CHAT_TEMPLATE_NUM_OF_VALIDATION_EXAMPLES = 4
+# successful batches after which a batch size halved on running out of GPU memory is doubled again.
+ADAPTIVE_BATCH_SIZE_GROWTH_INTERVAL = 8
+# token activations of the last concepts, shared by the methods training on them.
+ACTIVATION_CACHE_SIZE = 2
+_activation_cache = OrderedDict()
+
 
 def get_lr(optimizer):
     for param_group in optimizer.param_groups:
@@ -13,43 +33,66 @@ def get_lr(optimizer):
 
 
 def get_model_continues(
-    model, tokenizer, prompts, max_new_tokens, is_chat_model=True, batch_size=8, include_system_prompt=False
+    model, tokenizer, prompts, max_new_tokens, is_chat_model=True, batch_size=8, include_system_prompt=False,
+    sort_by_length=False, adaptive_batch_size=False
 ):
-    """we ground examples with the model's original generation."""
+    """
+    we ground examples with the model's original generation.
+
+    With `sort_by_length`, prompts are generated in order of length so that
+    batches carry little padding; outputs are still returned in the input order.
+    With `adaptive_batch_size`, the batch size is halved whenever a batch runs
+    out of GPU memory, and doubled again (up to `batch_size`) after every
+    ADAPTIVE_BATCH_SIZE_GROWTH_INTERVAL successful batches, so a few long
+    prompts do not slow down the rest of the call.
+    """
     tokenizer.padding_side = "left"
     if is_chat_model:
-        if include_system_prompt:
-            def apply_chat_template(prompt):
-                messages = [{"role": "system", "content": "You are a helpful assistant."}, {"role": "user", "content": prompt}]
-                nobos = tokenizer.apply_chat_template(messages, tokenize=True, add_generation_prompt=True)[1:]
-                return tokenizer.decode(nobos)
-        else:
-            def apply_chat_template(prompt):
-                messages = [{"role": "user", "content": prompt}]
-                nobos = tokenizer.apply_chat_template(messages, tokenize=True, add_generation_prompt=True)[1:]
-                return tokenizer.decode(nobos)
-        prompts = [apply_chat_template(prompt) for prompt in prompts]
+        formatter = get_chat_template_formatter(
+            tokenizer, system_prompt="You are a helpful assistant." if include_system_prompt else None)
+        prompts = formatter(prompts)
+
+    order = list(range(len(prompts)))
+    if sort_by_length:
+        # character length is a cheap proxy of token length.
+        order.sort(key=lambda i: len(prompts[i]))
     
     # Process prompts in batches
-    all_generated_texts = []
-    for i in range(0, len(prompts), batch_size):
-        batch_prompts = prompts[i:i + batch_size]
+    all_generated_texts = [None] * len(prompts)
+    i, max_batch_size, n_successful_batches = 0, batch_size, 0
+    while i < len(order):
+        batch_indices = order[i:i + batch_size]
+        batch_prompts = [prompts[j] for j in batch_indices]
         encoding = tokenizer(batch_prompts, return_tensors='pt', padding=True).to(model.device)
-        with torch.no_grad():
-            generated_ids = model.generate(
-                **encoding, max_new_tokens=max_new_tokens, do_sample=False)
-            generated_ids = generated_ids[:, encoding.input_ids.shape[1]:]
+        try:
+            with torch.no_grad():
+                generated_ids = model.generate(
+                    **encoding, max_new_tokens=max_new_tokens, do_sample=False)
+        except torch.cuda.OutOfMemoryError:
+            if not adaptive_batch_size or batch_size == 1:
+                raise
+            del encoding
+            torch.cuda.empty_cache()
+            batch_size, n_successful_batches = batch_size // 2, 0
+            continue
+        generated_ids = generated_ids[:, encoding.input_ids.shape[1]:]
         batch_generated_texts = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
-        all_generated_texts.extend(batch_generated_texts)
+        for j, generated_text in zip(batch_indices, batch_generated_texts):
+            all_generated_texts[j] = generated_text
+        i += len(batch_indices)
+        n_successful_batches += 1
+        if batch_size < max_batch_size and n_successful_batches >= ADAPTIVE_BATCH_SIZE_GROWTH_INTERVAL:
+            batch_size, n_successful_batches = min(batch_size * 2, max_batch_size), 0
     
     return all_generated_texts
 
 
+@profiled("base_forward")
 def gather_residual_activations(model, target_layer, inputs):
   target_act = None
   def gather_target_act_hook(mod, inputs, outputs):
     nonlocal target_act # make sure we can modify the target_act from the outer scope
-    target_act = outputs[0]
+    target_act = outputs[0] if isinstance(outputs, tuple) else outputs
     return outputs
   handle = model.model.layers[target_layer].register_forward_hook(
       gather_target_act_hook, always_call=True)
@@ -58,6 +101,60 @@ def gather_residual_activations(model, target_layer, inputs):
   return target_act
 
 
+@torch.no_grad()
+def gather_token_activations(model, tokenizer, target_layer, examples, batch_size=32, prefix_length=1):
+    """
+    Residual activations of all non-BOS input tokens of `examples`, packed
+    into a token matrix.
+
+    Returns the [n_tokens, hidden] activations, ordered by example, and the
+    number of tokens of every example. The base model runs once per batch of
+    examples; results are cached by model, layer and inputs, so that all
+    epochs (and all methods) training on the same examples reuse them. The
+    cache assumes that the base model weights stay frozen.
+    """
+    key = (
+        id(model), target_layer, prefix_length, tokenizer.name_or_path, len(tokenizer),
+        content_checksum(examples["input"].tolist()))
+    if key in _activation_cache:
+        _activation_cache.move_to_end(key)
+        return _activation_cache[key]
+
+    input_ids, lengths, _ = tokenized_arrays(tokenize_examples(tokenizer, examples, with_output=False))
+    rows = torch.tensor(input_ids).split(lengths.tolist())
+    all_activations = []
+    for i in range(0, len(rows), batch_size):
+        batch_ids, batch_lengths = pad_tensors(rows[i:i + batch_size], tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.arange(batch_ids.shape[1])[None, :] < batch_lengths[:, None]
+        activations = gather_residual_activations(model, target_layer, {
+            "input_ids": batch_ids.to(model.device), "attention_mask": attention_mask.int().to(model.device)})
+        all_activations.append(activations[:, prefix_length:][attention_mask[:, prefix_length:].to(activations.device)])
+    result = (torch.cat(all_activations), torch.from_numpy(lengths - prefix_length).clamp(min=0))
+
+    if ACTIVATION_CACHE_SIZE > 0:
+        _activation_cache[key] = result
+        if len(_activation_cache) > ACTIVATION_CACHE_SIZE:
+            _activation_cache.popitem(last=False)
+    return result
+
+
+def reduce_token_activations(function, activations, lengths, reduce="mean", batch_size=32):
+    """
+    `function` of the packed token activations of every example, reduced
+    over the tokens of the example ("mean" or "amax"). The tokens of
+    `batch_size` consecutive examples are processed at a time.
+    """
+    ends = torch.cumsum(lengths, dim=0).tolist()
+    all_reduced = []
+    for i in range(0, len(lengths), batch_size):
+        batch_lengths = lengths[i:i + batch_size]
+        values = function(activations[ends[i] - int(lengths[i]):ends[i + len(batch_lengths) - 1]])
+        example_ids = torch.arange(len(batch_lengths)).repeat_interleave(batch_lengths).to(values.device)
+        reduced = torch.zeros(len(batch_lengths), values.shape[-1], dtype=values.dtype, device=values.device)
+        all_reduced.append(reduced.index_reduce_(0, example_ids, values, reduce, include_self=False))
+    return torch.cat(all_reduced)
+
+
 @torch.no_grad()
 def set_decoder_norm_to_unit_norm(model):
     assert model.proj.weight is not None, "Decoder weight was not initialized."
@@ -84,7 +181,7 @@ def remove_gradient_parallel_to_decoder_directions(model):
     )
 
 
-def calculate_l1_losses(latent, non_topk_latent, labels=None, mask=None):
+def calculate_l1_losses(latent, non_topk_latent, labels=None, mask=None, reduction="mean"):
     """
     Calculate L1 losses with masked mean.
     
@@ -93,6 +190,7 @@ def calculate_l1_losses(latent, non_topk_latent, labels=None, mask=None):
     - non_topk_latent: non-topk latent representation, shape [batch_size, seq_len]
     - labels: labels, shape [batch_size]
     - mask: long mask, shape [batch_size, seq_len]
+    - reduction: "mean" across the batch, or "none" for the loss of every example
     """
     if mask is None:
         mask = torch.ones_like(latent, dtype=torch.long)
@@ -103,21 +201,47 @@ def calculate_l1_losses(latent, non_topk_latent, labels=None, mask=None):
     eps = torch.finfo(latent.dtype).eps
     if non_topk_latent is not None:
         masked_non_topk_sum = (non_topk_latent * mask).sum(dim=-1)  # [batch_size]
-        mean_non_topk = masked_non_topk_sum / (valid_counts + eps)
-        l1_loss = mean_non_topk.mean() # mean across batch
+        l1_losses = masked_non_topk_sum / (valid_counts + eps)
     else:
         masked_sum = (latent * mask).sum(dim=-1)  # [batch_size]
-        mean_all = masked_sum / (valid_counts + eps)
-        l1_loss = mean_all.mean() # mean across batch
-    return l1_loss
+        l1_losses = masked_sum / (valid_counts + eps)
+    if reduction == "none":
+        return l1_losses
+    return l1_losses.mean() # mean across batch
+
+
+def causal_lm_losses(logits, labels):
+    """
+    Per-example next-token cross-entropy: the summed loss and the number of
+    labelled tokens of every example (the mean over all of them is the loss
+    of a causal LM forward with `labels`).
+    """
+    logits = logits[:, :-1].float()
+    labels = labels[:, 1:].to(logits.device)
+    token_losses = nn.functional.cross_entropy(
+        logits.reshape(-1, logits.shape[-1]), labels.reshape(-1), ignore_index=-100, reduction="none")
+    return token_losses.view(labels.shape).sum(dim=-1), (labels != -100).sum(dim=-1)
+
+
+@torch.no_grad()
+def clip_grad_norm_per_row(model, max_norm):
+    """`clip_grad_norm_` applied to every row of `model.proj` (a weight row and its bias) on its own."""
+    weight, bias = model.proj.weight, model.proj.bias
+    norms = weight.grad.float().pow(2).sum(dim=-1)
+    if bias is not None and bias.grad is not None:
+        norms += bias.grad.float().pow(2)
+    clip_coef = (max_norm / (norms.sqrt() + 1e-6)).clamp(max=1.0)
+    weight.grad.mul_(clip_coef[:, None].to(weight.grad.dtype))
+    if bias is not None and bias.grad is not None:
+        bias.grad.mul_(clip_coef.to(bias.grad.dtype))
 
 
 def get_prefix_length(tokenizer, common_prefix=None):
     if common_prefix is None:
         message_a = [{"role": "user", "content": "1"}]
         message_b = [{"role": "user", "content": "2"}]
-        tokens_a = tokenizer.apply_chat_template(message_a, tokenize=True)
-        tokens_b = tokenizer.apply_chat_template(message_b, tokenize=True)
+        tokens_a = tokenizer.apply_chat_template(message_a, tokenize=True, return_dict=False)
+        tokens_b = tokenizer.apply_chat_template(message_b, tokenize=True, return_dict=False)
         print("Detecting sequence a:", tokens_a)
         print("Detecting sequence b:", tokens_b)
         prefix_length = 0
@@ -128,7 +252,7 @@ def get_prefix_length(tokenizer, common_prefix=None):
     else:
         message = [{"role": "user", "content": common_prefix}]
         tokens = tokenizer.apply_chat_template(
-            message, tokenize=True, add_generation_prompt=True)
+            message, tokenize=True, add_generation_prompt=True, return_dict=False)
         prefix_length = len(tokens)
     return prefix_length
 
@@ -136,11 +260,122 @@ def get_prefix_length(tokenizer, common_prefix=None):
 def get_suffix_length(tokenizer):
     message_a = [{"role": "user", "content": "1"}]
     message_b = [{"role": "user", "content": "2"}]
-    tokens_a = tokenizer.apply_chat_template(message_a, tokenize=True)
-    tokens_b = tokenizer.apply_chat_template(message_b, tokenize=True)
+    tokens_a = tokenizer.apply_chat_template(message_a, tokenize=True, return_dict=False)
+    tokens_b = tokenizer.apply_chat_template(message_b, tokenize=True, return_dict=False)
     suffix_length = 0
     for i, (ta, tb) in enumerate(zip(reversed(tokens_a), reversed(tokens_b))):
         if ta != tb:
             suffix_length = i
             break
-    return suffix_length, tokenizer.decode(tokens_a[-suffix_length:])
\ No newline at end of file
+    return suffix_length, tokenizer.decode(tokens_a[-suffix_length:])
+
+class ChatTemplateFormatter(object):
+    """
+    Formats prompts with a tokenizer's chat template by string assembly.
+
+    The result equals decoding `tokenizer.apply_chat_template(messages, tokenize=True)`
+    without the bos token (and without the template suffix if `strip_suffix`),
+    which is how prompts are formatted across axbench. The literal prefix,
+    separator and suffix of the template are derived once, so formatting a
+    column does not tokenize and decode every row. The first row and a random
+    sample of the others are checked against the template in every call, and
+    any mismatch falls back to per-row formatting.
+    """
+    def __init__(
+        self, tokenizer, system_prompt=None, with_output=False, 
+        add_generation_prompt=True, strip_suffix=False):
+        self.tokenizer = tokenizer
+        self.system_prompt = system_prompt
+        self.with_output = with_output
+        self.add_generation_prompt = add_generation_prompt
+        self.suffix_length = get_suffix_length(tokenizer)[0] if strip_suffix else 0
+        self.pieces, self.trim_content = self._derive_pieces()
+        # a fixed seed keeps runs reproducible; successive calls still check different rows.
+        self.rng = np.random.default_rng(0)
+
+    def _get_messages(self, prompt, output=None):
+        messages = [] if self.system_prompt is None else [{"role": "system", "content": self.system_prompt}]
+        messages += [{"role": "user", "content": prompt}]
+        if self.with_output:
+            messages += [{"role": "assistant", "content": output}]
+        return messages
+
+    def format_one(self, prompt, output=None):
+        """Reference formatting of a single prompt through the tokenizer."""
+        tokens = self.tokenizer.apply_chat_template(
+            self._get_messages(prompt, output), tokenize=True, 
+            add_generation_prompt=self.add_generation_prompt, return_dict=False)
+        return self.tokenizer.decode(tokens[1:len(tokens)-self.suffix_length])
+
+    def _derive_pieces(self):
+        sentinels = [CHAT_TEMPLATE_PROMPT_SENTINEL]
+        if self.with_output:
+            sentinels += [CHAT_TEMPLATE_OUTPUT_SENTINEL]
+        text = self.format_one(*sentinels)
+        padded_text = self.format_one(*[f" {sentinel} " for sentinel in sentinels])
+        if not isinstance(text, str) or not isinstance(padded_text, str):
+            return None, False
+        # templates like gemma's and llama's trim the message contents.
+        if padded_text == text:
+            trim_content = True
+        elif padded_text == text.replace(sentinels[0], f" {sentinels[0]} ").replace(sentinels[-1], f" {sentinels[-1]} "):
+            trim_content = False
+        else:
+            return None, False
+        pieces, rest = [], text
+        for sentinel in sentinels:
+            if rest.count(sentinel) != 1:
+                return None, False
+            piece, rest = rest.split(sentinel)
+            pieces += [piece]
+        return pieces + [rest], trim_content
+
+    def __call__(self, prompts, outputs=None):
+        """Format `prompts` (and assistant `outputs`); returns a list of strings."""
+        prompts = pd.Series(prompts, dtype=object).reset_index(drop=True)
+        if self.with_output:
+            outputs = pd.Series(outputs, dtype=object).reset_index(drop=True)
+        if self.pieces is not None:
+            columns = [prompts, outputs] if self.with_output else [prompts]
+            formatted = self.pieces[0]
+            for column, piece in zip(columns, self.pieces[1:]):
+                formatted = formatted + (column.str.strip() if self.trim_content else column) + piece
+            formatted = formatted.tolist()
+            sample = [] if len(prompts) == 0 else [0] + sorted(self.rng.choice(
+                np.arange(1, len(prompts)), min(len(prompts) - 1, CHAT_TEMPLATE_NUM_OF_VALIDATION_EXAMPLES - 1),
+                replace=False).tolist())
+            for i in sample:
+                if formatted[i] != self.format_one(prompts[i], outputs[i] if self.with_output else None):
+                    logger.warning("Chat template formatting does not match the tokenizer; formatting per row.")
+                    self.pieces = None
+                    break
+            else:
+                return formatted
+        return [
+            self.format_one(prompt, outputs[i] if self.with_output else None) 
+            for i, prompt in enumerate(prompts)]
+
+
+# attribute of a tokenizer holding its formatters, so they are freed (and copied) along with it.
+CHAT_TEMPLATE_FORMATTERS_ATTR = "_axbench_chat_template_formatters"
+
+
+def get_chat_template_formatter(tokenizer, **kwargs):
+    """Return the ChatTemplateFormatter of `tokenizer` for `kwargs`, derived once per tokenizer."""
+    formatters = getattr(tokenizer, CHAT_TEMPLATE_FORMATTERS_ATTR, None)
+    if formatters is None:
+        formatters = {}
+        setattr(tokenizer, CHAT_TEMPLATE_FORMATTERS_ATTR, formatters)
+    key = tuple(sorted(kwargs.items()))
+    if key not in formatters:
+        formatters[key] = ChatTemplateFormatter(tokenizer, **kwargs)
+    return formatters[key]
+
+
+def prepare_df(current_df, tokenizer, is_chat_model, model_name):
+    if is_chat_model:
+        formatter = get_chat_template_formatter(
+            tokenizer, with_output=True, add_generation_prompt=False, strip_suffix=True,
+            system_prompt="You are a helpful assistant." if model_name == "meta-llama/Llama-3.1-8B-Instruct" else None)
+        current_df['input'] = formatter(current_df['input'], current_df['output'])
+    return current_df
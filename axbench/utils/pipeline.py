@@ -0,0 +1,343 @@
+#################################
+#
+# Stage DAG runner.
+#
+#################################
+import os, sys, json, time, fcntl, shutil, logging, threading, subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import yaml
+
+from axbench.utils.ledger import ProgressLedger, PROGRESS_LEDGER_FILE, content_checksum
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+# fields that only change how fast a stage runs, not what it outputs.
+NON_CONTENT_FIELDS = {
+    "num_of_workers", "report_to", "wandb_entity", "wandb_name", "run_name", "lm_batch_dir",
+    "latent_batch_size", "steering_batch_size", "concept_concurrency", "master_data_dir",
+    "data_dir", "train_dir", "dump_dir", "overwrite_data_dir",
+}
+# fields that select which concepts a stage covers; new concepts are simply pending units.
+SCOPE_FIELDS = {"max_concepts"}
+SCRIPTS_DIR = Path(__file__).resolve().parent.parent / "scripts"
+
+
+class Stage(object):
+    """
+    A node of the pipeline DAG.
+
+    `section` is the YAML section the stage's script reads. The stage's
+    effective config is that section without the fields in `ignore_fields`;
+    per-method configs are taken from `method_field` (a dict of method
+    params, or a list of method names), and the contents of the files named
+    by `input_fields` count as config. The stage's work units are those
+    recorded in the progress ledger under `ledger_stages(section_config)`.
+    Stages sharing a `resource` (e.g. the GPUs) never run concurrently.
+    The outputs of a `shareable` stage (in `output_dir` of the dump_dir)
+    only depend on its config, so runs with the same config can share them.
+    """
+    def __init__(
+        self, name, section, command, deps=(), ledger_stages=None, method_field="models",
+        ignore_fields=(), input_fields=(), resource="gpu", output_dir=None, shareable=False):
+        self.name = name
+        self.section = section
+        self.command = command
+        self.deps = list(deps)
+        self.ledger_stages = ledger_stages or (lambda section_config: [name])
+        self.method_field = method_field
+        self.ignore_fields = set(ignore_fields)
+        self.input_fields = list(input_fields)
+        self.resource = resource
+        self.output_dir = output_dir
+        self.shareable = shareable
+
+    def digests(self, config):
+        """Digests of the shared config, of every method's config and of the scope."""
+        section_config = config.get(self.section) or {}
+        shared_config = {
+            k: v for k, v in section_config.items()
+            if k not in NON_CONTENT_FIELDS | SCOPE_FIELDS | self.ignore_fields and k != self.method_field}
+        for field in self.input_fields:
+            if section_config.get(field) and os.path.isfile(section_config[field]):
+                with open(section_config[field], "rb") as f:
+                    shared_config[f"{field}_content"] = content_checksum(f.read())
+        methods = section_config.get(self.method_field) or {}
+        if not isinstance(methods, dict):
+            methods = {method: None for method in methods}
+        return {
+            "config": content_checksum(shared_config),
+            "methods": {method: content_checksum(params) for method, params in methods.items()},
+            "scope": content_checksum({k: section_config.get(k) for k in sorted(SCOPE_FIELDS)}),
+        }
+
+
+def default_stages(config_path, dump_dir, nproc_per_node=1):
+    """The generate -> train -> inference -> evaluate DAG of `demo/demo.sh`."""
+    def script(name, distributed=False):
+        launcher = [sys.executable]
+        if distributed:
+            launcher += ["-m", "torch.distributed.run", f"--nproc_per_node={nproc_per_node}"]
+        return launcher + [str(SCRIPTS_DIR / name), "--config", str(config_path), "--dump_dir", str(dump_dir)]
+
+    def evaluate_stages(mode, field):
+        return lambda section_config: [
+            f"evaluate_{mode}_{evaluator_name}" for evaluator_name in section_config.get(field) or []]
+
+    steering_fields = {"steering_evaluators", "winrate_split_ratio", "run_winrate", "winrate_baseline",
+                       "lm_judge_cascade", "prompt_steering_data_dir"}
+    return [
+        Stage("generate", "generate", script("generate.py"), method_field=None,
+              input_fields=["concept_path"], output_dir="generate", shareable=True),
+        Stage("train", "train", script("train.py", True), deps=["generate"]),
+        Stage("inference_latent", "inference", script("inference.py", True) + ["--mode", "latent"],
+              deps=["train"], ignore_fields={
+                  "steering_intervention_type", "steering_model_name", "steering_datasets",
+                  "steering_output_length", "steering_layers", "steering_num_of_examples", "steering_factors",
+                  "steering_factor_search", "steering_search_num_of_examples", "temperature"}),
+        Stage("inference_steering", "inference", script("inference.py", True) + ["--mode", "steering"],
+              deps=["train"], ignore_fields={"latent_num_of_examples", "imbalance_factor"}),
+        Stage("evaluate_latent", "evaluate", script("evaluate.py") + ["--mode", "latent"],
+              deps=["inference_latent"], ledger_stages=evaluate_stages("latent", "latent_evaluators"),
+              ignore_fields=steering_fields, resource="cpu"),
+        Stage("evaluate_steering", "evaluate", script("evaluate.py") + ["--mode", "steering"],
+              deps=["inference_steering"], ledger_stages=evaluate_stages("steering", "steering_evaluators"),
+              ignore_fields={"latent_evaluators", "save_raw_roc_curves"}, resource="cpu"),
+    ]
+
+
+class StageRunner(object):
+    """
+    Run a DAG of stages, re-running only what a config or input change invalidated.
+
+    Every completed stage is recorded in `manifest.json` with the digests of
+    its effective config, of every method's config and of the inputs of each
+    of its units. An input digest covers the ledger checksums of the same
+    concept (and method) in all upstream stages, so on a re-run:
+
+    - a changed shared config invalidates all units of the stage,
+    - a changed method config invalidates the units of that method,
+    - a changed upstream artifact invalidates the units built from it,
+
+    and a stage runs only if it has invalidated or new units. Invalidations
+    go to the progress ledger, so the stage scripts redo exactly those units.
+    Stages whose dependencies are met run concurrently unless they share a
+    resource.
+
+    With a `shared_dir`, the outputs of shareable stages are kept in
+    `shared_dir/<stage>/<config digest>` and linked into the dump_dir, so
+    sweeps with the same e.g. generate config generate their data once.
+    """
+    def __init__(self, stages, config, dump_dir, max_workers=2, shared_dir=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.config = config
+        self.dump_dir = Path(dump_dir)
+        self.dump_dir.mkdir(parents=True, exist_ok=True)
+        self.ledger = ProgressLedger(self.dump_dir / PROGRESS_LEDGER_FILE)
+        self.manifest_path = self.dump_dir / MANIFEST_FILE
+        self.max_workers = max_workers
+        self.shared_dir = None if shared_dir is None else Path(shared_dir)
+        self.lock = threading.Lock()
+        self.resource_locks = {stage.resource: threading.Lock() for stage in stages}
+
+    def load_manifest(self):
+        if self.manifest_path.exists():
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        return {"stages": {}}
+
+    def save_stage_manifest(self, name, stage_manifest):
+        with self.lock:
+            manifest = self.load_manifest()
+            manifest["stages"][name] = stage_manifest
+            tmp_path = self.manifest_path.with_suffix(".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(tmp_path, self.manifest_path)
+
+    def ancestors(self, name):
+        ancestors, to_visit = [], list(self.stages[name].deps)
+        while to_visit:
+            dep = to_visit.pop()
+            if dep in self.stages and dep not in ancestors:
+                ancestors.append(dep)
+                to_visit += self.stages[dep].deps
+        return ancestors
+
+    def ledger_stages(self, name):
+        stage = self.stages[name]
+        return stage.ledger_stages(self.config.get(stage.section) or {})
+
+    def input_digests(self, name):
+        """Input digest of every completed unit of stage `name`."""
+        upstream_stages = [
+            ledger_stage for ancestor in self.ancestors(name) for ledger_stage in self.ledger_stages(ancestor)]
+        upstream = {}
+        for (ledger_stage, concept_id, method), checksum in self.ledger.checksums(upstream_stages).items():
+            upstream.setdefault((concept_id, method), []).append((ledger_stage, checksum))
+        input_digests = {}
+        for ledger_stage, concept_id, method in self.ledger.checksums(self.ledger_stages(name)):
+            inputs = sorted(upstream.get((concept_id, None), []) + (
+                upstream.get((concept_id, method), []) if method is not None else []))
+            input_digests[json.dumps([ledger_stage, concept_id, method])] = content_checksum(inputs)
+        return input_digests
+
+    def output_digest(self, name):
+        return content_checksum(sorted(
+            self.ledger.checksums(self.ledger_stages(name)).items(), key=lambda unit: json.dumps(unit[0])))
+
+    def plan(self, name, upstream_ran, dry_run=False):
+        """Invalidate the outdated units of stage `name`; returns the reasons to run it (empty to skip)."""
+        stage = self.stages[name]
+        digests = stage.digests(self.config)
+        previous = self.load_manifest()["stages"].get(name)
+        if previous is None or "config" not in previous:
+            return ["never completed"]
+        reasons = []
+        ledger_stages = self.ledger_stages(name)
+        if previous["config"] != digests["config"]:
+            reasons.append("config changed")
+            if dry_run:
+                return reasons
+            for ledger_stage in ledger_stages:
+                self.ledger.invalidate(ledger_stage)
+            output_dir = self.dump_dir / stage.output_dir if stage.output_dir else None
+            if output_dir is not None and (output_dir.exists() or output_dir.is_symlink()):
+                # keep the outputs of the old config next to the new ones.
+                stale_dir = output_dir.with_name(f"{output_dir.name}.{previous['config'][:8]}")
+                if stale_dir.is_symlink():
+                    stale_dir.unlink()
+                shutil.rmtree(stale_dir, ignore_errors=True)
+                output_dir.rename(stale_dir)
+                logger.warning(f"Moved outputs of the previous {name} config to {stale_dir}")
+            return reasons
+
+        changed_methods = [
+            method for method, digest in digests["methods"].items()
+            if previous["methods"].get(method, digest) != digest]
+        new_methods = [method for method in digests["methods"] if method not in previous["methods"]]
+        changed_units = [
+            unit for unit, digest in self.input_digests(name).items()
+            if unit in previous["inputs"] and previous["inputs"][unit] != digest]
+        invalidated = {ledger_stage: [] for ledger_stage in ledger_stages}
+        for ledger_stage, concept_id, method in self.ledger.checksums(ledger_stages):
+            if method in changed_methods:
+                invalidated[ledger_stage].append((concept_id, method))
+        for unit in changed_units:
+            ledger_stage, concept_id, method = json.loads(unit)
+            if method not in changed_methods:
+                invalidated[ledger_stage].append((concept_id, method))
+        for ledger_stage, units in invalidated.items():
+            if len(units) > 0 and not dry_run:
+                self.ledger.invalidate(ledger_stage, units)
+
+        if len(changed_methods) > 0:
+            reasons.append(f"config of {', '.join(changed_methods)} changed")
+        if len(new_methods) > 0:
+            reasons.append(f"new methods {', '.join(new_methods)}")
+        if len(changed_units) > 0:
+            reasons.append(f"inputs of {len(changed_units)} units changed")
+        if previous["scope"] != digests["scope"]:
+            reasons.append("scope changed")
+        if len(upstream_ran) > 0:
+            reasons.append(f"upstream {', '.join(upstream_ran)} ran")
+        if previous.get("status") != "complete":
+            reasons.append("last run did not complete")
+        return reasons
+
+    def shared_store(self, name):
+        """The shared outputs of stage `name` for the current config, or None if it is not shared."""
+        stage = self.stages[name]
+        if self.shared_dir is None or not stage.shareable:
+            return None
+        store = self.shared_dir / name / stage.digests(self.config)["config"]
+        store.mkdir(parents=True, exist_ok=True)
+        output_dir = self.dump_dir / stage.output_dir
+        if not output_dir.exists() and not output_dir.is_symlink():
+            output_dir.symlink_to(store.resolve(), target_is_directory=True)
+        if output_dir.resolve() != store.resolve():
+            logger.warning(f"{output_dir} has outputs of its own; not sharing stage {name}.")
+            return None
+        return store
+
+    def sync_units(self, from_ledger, to_ledger, name):
+        """Copy the completed units of stage `name` missing from `to_ledger`."""
+        ledger_stages = self.ledger_stages(name)
+        completed = to_ledger.checksums(ledger_stages)
+        from_checksums = from_ledger.checksums(ledger_stages)
+        to_ledger.record_many([
+            {"stage": ledger_stage, "concept_id": concept_id, "method": method, "checksum": checksum}
+            for (ledger_stage, concept_id, method), checksum in from_checksums.items()
+            if completed.get((ledger_stage, concept_id, method)) != checksum])
+
+    def run_stage(self, name):
+        stage = self.stages[name]
+        with self.resource_locks[stage.resource]:
+            store = self.shared_store(name)
+            lock_file = open(store / ".lock", "w") if store is not None else None
+            try:
+                if lock_file is not None:
+                    # runs sharing the outputs take turns; units done by others are done here too.
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                    self.sync_units(ProgressLedger(store / PROGRESS_LEDGER_FILE), self.ledger, name)
+                logger.warning(f"Running stage {name}: {' '.join(map(str, stage.command))}")
+                start = time.time()
+                self.save_stage_manifest(name, {**self.load_manifest()["stages"].get(name, {}), "status": "running"})
+                subprocess.run([str(part) for part in stage.command], check=True)
+                if lock_file is not None:
+                    self.sync_units(self.ledger, ProgressLedger(store / PROGRESS_LEDGER_FILE), name)
+            finally:
+                if lock_file is not None:
+                    lock_file.close()
+            digests = stage.digests(self.config)
+            self.save_stage_manifest(name, {
+                **digests, "status": "complete", "inputs": self.input_digests(name),
+                "output": self.output_digest(name), "time": time.time(), "duration": time.time() - start})
+
+    def run(self, stage_names=None, dry_run=False):
+        """Run the selected stages (all by default) in dependency order; returns the stages that ran."""
+        selected = [name for name in self.stages if stage_names is None or name in stage_names]
+        done, ran, failed, running = set(), [], set(), {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while len(done) + len(failed) < len(selected):
+                for name in selected:
+                    if name in done or name in failed or name in running.values():
+                        continue
+                    deps = [dep for dep in self.stages[name].deps if dep in selected]
+                    if any(dep in failed for dep in deps):
+                        failed.add(name)
+                        logger.warning(f"Skipping stage {name}: an upstream stage failed.")
+                        continue
+                    if not all(dep in done for dep in deps):
+                        continue
+                    reasons = self.plan(name, [dep for dep in deps if dep in ran], dry_run=dry_run)
+                    if len(reasons) == 0 or dry_run:
+                        logger.warning(
+                            f"Stage {name}: {'would run (' + '; '.join(reasons) + ')' if reasons else 'up to date'}.")
+                        if len(reasons) > 0:
+                            ran.append(name)
+                        done.add(name)
+                        continue
+                    logger.warning(f"Stage {name} is outdated: {'; '.join(reasons)}.")
+                    running[executor.submit(self.run_stage, name)] = name
+                if len(running) == 0:
+                    continue
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(name)
+                        ran.append(name)
+                    except Exception as e:
+                        logger.warning(f"Stage {name} failed: {e}")
+                        failed.add(name)
+        if len(failed) > 0:
+            raise RuntimeError(f"Stages failed: {', '.join(sorted(failed))}")
+        return ran
+
+
+def load_pipeline_config(config_path):
+    with open(config_path) as f:
+        return yaml.safe_load(f)
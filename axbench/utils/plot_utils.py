@@ -7,6 +7,7 @@ from matplotlib.colors import hsv_to_rgb
 import seaborn as sns
 import pandas as pd
 from pathlib import Path
+from axbench.evaluators.latent_metrics import ROC_GRID, interpolate_roc
 from plotnine import (
     ggplot, aes, geom_line, geom_point, facet_wrap, geom_bar, geom_abline, xlim, scale_fill_manual,
     geom_text, position_dodge, ylim, labs, theme_bw, theme, element_text, scale_color_manual, coord_flip
@@ -30,29 +31,46 @@ COLORS = [
 MARKERS = ['o', 's', '^', 'D', 'v', '<', '>', 'p', '*', 'h']
 
 
-def plot_aggregated_roc(jsonl_data, write_to_path=None, report_to=[], wandb_name=None):
-    # Collect ROC data for each model
-    metrics_list = [aggregated_result["results"]["AUCROCEvaluator"] 
-                    for aggregated_result in jsonl_data]
-    
-    # Define common FPR thresholds for interpolation
-    common_fpr = np.linspace(0, 1, 100)
-    
+def collect_roc_curves(jsonl_data, roc_curves=None):
+    """
+    Gather the grid-interpolated TPRs and AUCs of every method, one per concept. ROC records
+    take precedence; concepts evaluated before the records existed carry their curves inline.
+    """
     tprs = {}
     aucs = {}
-    for metrics in metrics_list:
+    recorded = set()
+    if roc_curves is not None:
+        # ROC records are already interpolated on the common grid; keep the latest
+        # record of every (concept, method) and only touch those rows of the memmap.
+        latest = {}
+        for i, key in enumerate(zip(roc_curves["concept_id"].tolist(), roc_curves["method"].tolist())):
+            latest[key] = i
+        rows = {}
+        for (concept_id, method), i in sorted(latest.items(), key=lambda x: x[1]):
+            rows.setdefault(method.decode(), []).append(i)
+            recorded.add((concept_id, method.decode()))
+        for model_name, idx in rows.items():
+            tprs[model_name] = list(roc_curves["tpr"][idx].astype(np.float64))
+            aucs[model_name] = list(roc_curves["roc_auc"][idx])
+    # Collect ROC data for each model
+    for aggregated_result in jsonl_data:
+        metrics = aggregated_result["results"].get("AUCROCEvaluator", {})
         for model_name, value in metrics.items():
-            fpr = value["roc_curve"]["fpr"]
-            tpr = value["roc_curve"]["tpr"]
-            auc = value["roc_auc"]
-            
-            interp_tpr = np.interp(common_fpr, fpr, tpr)
-            interp_tpr[0] = 0.0  # Ensure TPR starts at 0
+            if "roc_curve" not in value or (aggregated_result.get("concept_id"), model_name) in recorded:
+                continue
+            interp_tpr = interpolate_roc(value["roc_curve"]["fpr"], value["roc_curve"]["tpr"])
             if model_name not in tprs:
                 tprs[model_name] = []
                 aucs[model_name] = []
             tprs[model_name].append(interp_tpr)
-            aucs[model_name].append(auc)
+            aucs[model_name].append(value["roc_auc"])
+    return tprs, aucs
+
+
+def plot_aggregated_roc(jsonl_data, write_to_path=None, report_to=[], wandb_name=None, roc_curves=None):
+    # Define common FPR thresholds for interpolation
+    common_fpr = ROC_GRID
+    tprs, aucs = collect_roc_curves(jsonl_data, roc_curves)
     
     # Prepare data for plotting
     plot_data = []
@@ -309,10 +327,10 @@ def plot_win_rates(jsonl_data, write_to_path=None, report_to=[], wandb_name=None
     loss_rates[baseline_model] = [50.0] * num_concepts
     tie_rates[baseline_model] = [0.0] * num_concepts
     
-    # Calculate mean percentages
-    win_means = {method: np.mean(vals) for method, vals in win_rates.items()}
-    loss_means = {method: np.mean(vals) for method, vals in loss_rates.items()}
-    tie_means = {method: np.mean(vals) for method, vals in tie_rates.items()}
+    # Calculate mean percentages; concepts without pairs to compare have NaN rates.
+    win_means = {method: np.nanmean(vals) for method, vals in win_rates.items()}
+    loss_means = {method: np.nanmean(vals) for method, vals in loss_rates.items()}
+    tie_means = {method: np.nanmean(vals) for method, vals in tie_rates.items()}
     
     # Sort methods: baseline at top, then methods by descending win rate
     non_baseline_methods = [m for m in methods if m != baseline_model]
@@ -0,0 +1,217 @@
+#################################
+#
+# Stage profiler.
+#
+#################################
+import os, json, time, atexit, asyncio, threading, functools, inspect, contextvars
+from pathlib import Path
+import logging
+
+logger = logging.getLogger(__name__)
+
+# set (to anything but "0") to profile the stages of a run.
+PROFILE_ENV = "AXBENCH_PROFILE"
+# traces and totals go to this subfolder of the dump dir.
+PROFILE_DIR = "profile"
+# events buffered in memory before they are appended to the trace file.
+TRACE_FLUSH_SIZE = 10000
+
+# the active profiler; None when profiling is disabled.
+_profiler = None
+# tags (concept_id, method, ...) of the enclosing `profile_tags` blocks.
+_tags = contextvars.ContextVar("profile_tags", default={})
+
+
+class StageProfiler(object):
+    """
+    Collects the spans of one process into a Chrome trace file (JSON array
+    format, viewable in chrome://tracing or Perfetto), one track per thread
+    or asyncio task, and keeps the per-stage totals.
+
+    Events are appended to the trace as they are flushed, so the trace of a
+    crashed run can still be opened; `close` ends the JSON array.
+    """
+    def __init__(self, trace_path, rank=0):
+        self.trace_path = Path(trace_path)
+        self.trace_path.parent.mkdir(parents=True, exist_ok=True)
+        self.rank = rank
+        self.events = []
+        self.totals = {}
+        self.lock = threading.Lock()
+        # trace timestamps are wall-clock microseconds, so traces of all ranks line up.
+        self.clock_offset_ns = time.time_ns() - time.perf_counter_ns()
+        with open(self.trace_path, "w") as f:
+            f.write("[\n")
+            f.write(json.dumps({
+                "name": "process_name", "ph": "M", "pid": rank, "tid": 0, "args": {"name": f"rank {rank}"}}))
+
+    def record(self, name, start_ns, end_ns, tags):
+        duration_s = (end_ns - start_ns) / 1e9
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        event = {
+            "name": name, "cat": "stage", "ph": "X", "pid": self.rank,
+            "tid": id(task) if task is not None else threading.get_ident(),
+            "ts": (start_ns + self.clock_offset_ns) / 1000, "dur": (end_ns - start_ns) / 1000,
+            "args": tags}
+        with self.lock:
+            self.events.append(event)
+            total = self.totals.setdefault(name, {"count": 0, "total_s": 0.0, "max_s": 0.0})
+            total["count"] += 1
+            total["total_s"] += duration_s
+            total["max_s"] = max(total["max_s"], duration_s)
+            if len(self.events) >= TRACE_FLUSH_SIZE:
+                self._flush()
+
+    def _flush(self):
+        if len(self.events) > 0:
+            with open(self.trace_path, "a") as f:
+                f.write("".join(",\n" + json.dumps(event, default=str) for event in self.events))
+            self.events = []
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def summary(self):
+        """Per-stage count, total, mean and max seconds, by decreasing total."""
+        with self.lock:
+            totals = sorted(self.totals.items(), key=lambda item: -item[1]["total_s"])
+        return {
+            name: {**total, "mean_s": total["total_s"] / total["count"]} for name, total in totals}
+
+    def close(self):
+        self.flush()
+        with open(self.trace_path, "a") as f:
+            f.write("\n]\n")
+        summary = self.summary()
+        with open(self.trace_path.with_name(self.trace_path.name.replace("_trace", "_totals")), "w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+
+class _Span(object):
+    __slots__ = ("name", "tags", "start_ns")
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        profiler = _profiler
+        if profiler is not None:
+            profiler.record(
+                self.name, self.start_ns, time.perf_counter_ns(),
+                {"rank": profiler.rank, **_tags.get(), **self.tags})
+        return False
+
+
+class _NullSpan(object):
+    """What `span` and `profile_tags` return when profiling is disabled."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Tags(object):
+    __slots__ = ("tags", "token")
+
+    def __init__(self, tags):
+        self.tags = tags
+
+    def __enter__(self):
+        self.token = _tags.set({**_tags.get(), **self.tags})
+        return self
+
+    def __exit__(self, *exc):
+        _tags.reset(self.token)
+        return False
+
+
+def span(name, **tags):
+    """Time the enclosed block as a `name` span with `tags` (plus the tags of enclosing `profile_tags`)."""
+    if _profiler is None:
+        return _NULL_SPAN
+    return _Span(name, tags)
+
+
+def profile_tags(**tags):
+    """Tag every span of the enclosed block, e.g. with its concept_id and method."""
+    if _profiler is None:
+        return _NULL_SPAN
+    return _Tags(tags)
+
+
+def profiled(name=None, **tags):
+    """Decorator timing every call of a function (or coroutine function) as a span."""
+    def decorator(function):
+        span_name = name or function.__qualname__
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                if _profiler is None:
+                    return await function(*args, **kwargs)
+                with _Span(span_name, tags):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return function(*args, **kwargs)
+            with _Span(span_name, tags):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profiling_enabled():
+    return _profiler is not None
+
+
+def start_profiling(dump_dir, stage, rank=0, enabled=None):
+    """
+    Start profiling `stage` (train, inference, ...) into
+    `dump_dir/profile/{stage}_rank_{rank}_trace.json` if `enabled` (by
+    default: if the AXBENCH_PROFILE env var is set). The profile is closed,
+    and its totals logged and saved next to the trace, by `stop_profiling`
+    or at exit.
+    """
+    global _profiler
+    if enabled is None:
+        enabled = os.environ.get(PROFILE_ENV, "0") not in {"", "0"}
+    if not enabled:
+        return None
+    if _profiler is not None:
+        stop_profiling()
+    _profiler = StageProfiler(Path(dump_dir) / PROFILE_DIR / f"{stage}_rank_{rank}_trace.json", rank=rank)
+    logger.warning(f"Profiling stages to {_profiler.trace_path}")
+    return _profiler
+
+
+def stop_profiling():
+    """Close the active profile and log its per-stage totals; returns them (None if disabled)."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return None
+    summary = profiler.close()
+    lines = [f"{'stage':<32} {'count':>8} {'total_s':>10} {'mean_s':>10} {'max_s':>10}"] + [
+        f"{name:<32} {total['count']:>8} {total['total_s']:>10.3f} {total['mean_s']:>10.4f} {total['max_s']:>10.3f}"
+        for name, total in summary.items()]
+    logger.warning(f"Stage totals of rank {profiler.rank} (trace: {profiler.trace_path}):\n" + "\n".join(lines))
+    return summary
+
+
+atexit.register(stop_profiling)
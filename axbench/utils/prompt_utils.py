@@ -5,6 +5,7 @@
 #################################
 
 import random, re
+import numpy as np
 
 from ..templates.prompt_templates import *
 from .constants import *
@@ -119,21 +120,67 @@ async def get_contrast_concepts(client, concepts, contrast_concepts=None, api_ta
     return polysemantics
 
 
-def get_random_content(seed_sentences, tokenizer, count, genres, concepts, length, split):
+class SeedContentSampler(object):
+    """
+    O(k) sampler over seed pools keyed by `{genre}_{split}`.
+
+    Each pool is wrapped once as an Arrow-formatted `input` column, so a draw
+    only samples k indices and gathers those rows in one columnar take,
+    instead of materialising an index list over the whole pool.
+    """
+    def __init__(self, seed_sentences):
+        self.seed_sentences = seed_sentences
+        self.pools = {}
+
+    def __getitem__(self, key):
+        return self.seed_sentences[key]
+
+    def __len__(self):
+        return len(self.seed_sentences)
+
+    def __iter__(self):
+        return iter(self.seed_sentences)
+
+    def sample(self, genre, split, count, rng):
+        key = f"{genre}_{split}"
+        if key not in self.pools:
+            self.pools[key] = self.seed_sentences[key].with_format("arrow", columns=["input"])
+        pool = self.pools[key]
+        indices = rng.choice(len(pool), size=count, replace=False)
+        return pool[indices.tolist()].column("input").to_pylist()
+
+
+def truncate_to_tokens(tokenizer, texts, length):
+    """Crop each text to its first `length` tokens; fast tokenizers tokenize the whole batch at once."""
+    if len(texts) == 0:
+        return []
+    if getattr(tokenizer, "is_fast", False):
+        all_tokens = [encoding.tokens for encoding in tokenizer(texts, add_special_tokens=False).encodings]
+    else:
+        all_tokens = [tokenizer.tokenize(text) for text in texts]
+    return [tokenizer.convert_tokens_to_string(tokens[:int(length)]) for tokens in all_tokens]
+
+
+def get_random_content(seed_sentences, tokenizer, count, genres, concepts, length, split, rng=None):
+    """
+    Sample `count` seed contents of the first genre and split them evenly over `concepts`.
+
+    `rng` is a NumPy Generator; an explicit one keeps sampling independent of the
+    order concepts are generated in. Without it, one is seeded from the `random`
+    module, so results stay reproducible under `set_seed`.
+    """
+    if not isinstance(seed_sentences, SeedContentSampler):
+        seed_sentences = SeedContentSampler(seed_sentences)
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
     random_content = {concept: [] for concept in concepts}
-    responses = []
     genre = genres[0] # if there are many, we pick the first one.
-    dataset = seed_sentences[f"{genre}_{split}"]
-    indices = random.sample(list(range(len(dataset))), count)
-    random_samples = dataset.select(indices)
-    responses += [sample["input"] for sample in random_samples]
-
+    responses = seed_sentences.sample(genre, split, count, rng)
+    responses = [response.strip(" .'").strip('"') for response in responses]
+    # during training, we don't crop otherwise it will cutoff prompts.
+    if length is not None:
+        responses = truncate_to_tokens(tokenizer, responses, length)
     for i, response in enumerate(responses):
-        response = response.strip(" .'").strip('"')
-        # during training, we don't crop otherwise it will cutoff prompts.
-        if length is not None:
-            response = tokenizer.convert_tokens_to_string(
-                tokenizer.tokenize(response)[:int(length)])
         random_content[concepts[i//(len(responses)//len(concepts))]] += [response]        
     return random_content
 
@@ -254,14 +301,8 @@ async def response_with(client, tokenizer, content, length, api_tag=""):
         content_token_lengths.append(len(content_tokens))
         prompts += [T_RESPONSE.format(INSTRUCTION=c)]
     responses = await client.chat_completions(f"{api_tag}.response_with", prompts)
-    response_content = []
-    for i, response in enumerate(responses):
-        full_tokens = tokenizer.tokenize(response.strip(" '").strip('"'))
-        # Skip the original content tokens and limit to requested length
-        response_tokens = full_tokens[:int(length)]
-        response_text = tokenizer.convert_tokens_to_string(response_tokens)
-        response_content.append(response_text)
-    return response_content
+    return truncate_to_tokens(
+        tokenizer, [response.strip(" '").strip('"') for response in responses], length)
 
 
 async def response_with_concept(client, tokenizer, concepts, content, length, api_tag=""):
@@ -273,14 +314,8 @@ async def response_with_concept(client, tokenizer, concepts, content, length, ap
         prompts += [T_RESPONSE_WITH_CONCEPT.format(
             INSTRUCTION=c, CONCEPT=concepts[i])]
     responses = await client.chat_completions(f"{api_tag}.response_with_concept", prompts)
-    response_content = []
-    for i, response in enumerate(responses):
-        full_tokens = tokenizer.tokenize(response.strip(" '").strip('"'))
-        # Skip the original content tokens and limit to requested length
-        response_tokens = full_tokens[:int(length)]
-        response_text = tokenizer.convert_tokens_to_string(response_tokens)
-        response_content.append(response_text)
-    return response_content
+    return truncate_to_tokens(
+        tokenizer, [response.strip(" '").strip('"') for response in responses], length)
 
 
 async def response_without_concept(client, tokenizer, concepts, content, length, api_tag=""):
@@ -292,14 +327,8 @@ async def response_without_concept(client, tokenizer, concepts, content, length,
         prompts += [T_RESPONSE_WITHOUT_CONCEPT.format(
             INSTRUCTION=c, CONCEPT=concepts[i])]
     responses = await client.chat_completions(f"{api_tag}.response_without_concept", prompts)
-    response_content = []
-    for i, response in enumerate(responses):
-        full_tokens = tokenizer.tokenize(response.strip(" '").strip('"'))
-        # Skip the original content tokens and limit to requested length
-        response_tokens = full_tokens[:int(length)]
-        response_text = tokenizer.convert_tokens_to_string(response_tokens)
-        response_content.append(response_text)
-    return response_content
+    return truncate_to_tokens(
+        tokenizer, [response.strip(" '").strip('"') for response in responses], length)
 
 
 async def response_with_polysemantic_concepts(
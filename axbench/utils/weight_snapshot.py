@@ -0,0 +1,85 @@
+#################################
+#
+# Base model weight snapshots.
+#
+#################################
+import logging
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class WeightSnapshot(object):
+    """
+    A CPU copy of the parameters of a model, to undo in place what training
+    did to them, instead of loading the checkpoint again.
+
+    Only parameters that require grads can be trained, and only the ones
+    that changed since the snapshot (or the last restore) are copied back,
+    so restoring after a method that trains a few parameters (or none)
+    copies just those. The `requires_grad` flags and the train/eval mode of
+    the model are restored as well, as methods freeze or unfreeze the base
+    model. The copy is pinned when the model is on a GPU, so restores are
+    plain host-to-device copies; in distributed training every rank holds
+    its own full pinned CPU copy of the model.
+
+    Parameters are matched by name. Wrappers that rename or flatten them,
+    like FSDP, make the snapshot unusable, and restore() raises instead of
+    silently copying nothing back.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.training = model.training
+        pin_memory = any(param.is_cuda for param in model.parameters())
+        self.params = {}
+        self.requires_grad = {}
+        for name, param in model.named_parameters():
+            copy = torch.empty(param.shape, dtype=param.dtype, pin_memory=pin_memory)
+            copy.copy_(param.detach())
+            self.params[name] = copy
+            self.requires_grad[name] = param.requires_grad
+        self._mark_clean()
+
+    def _check_names(self, model):
+        names = {name for name, _ in model.named_parameters()}
+        if names != set(self.params):
+            missing = sorted(set(self.params) - names)
+            unexpected = sorted(names - set(self.params))
+            raise ValueError(
+                f"Parameters of the model do not match the snapshot: missing {missing[:3]} "
+                f"({len(missing)} in total), unexpected {unexpected[:3]} ({len(unexpected)} in total)")
+
+    def _mark_clean(self):
+        # in-place updates (e.g. optimizer steps) bump the version of a parameter.
+        self.versions = {
+            name: (param._version, param.data_ptr()) for name, param in self.model.named_parameters()}
+
+    def changed(self):
+        """Names of the trainable parameters that changed since the snapshot or the last restore."""
+        return [
+            name for name, param in self.model.named_parameters()
+            if name in self.params and (param.requires_grad or param.grad is not None)
+            and (param._version, param.data_ptr()) != self.versions[name]]
+
+    @torch.no_grad()
+    def restore(self):
+        """Copy the changed parameters back in place; returns their names."""
+        self._check_names(self.model)
+        changed = set(self.changed())
+        for name, param in self.model.named_parameters():
+            if name in changed:
+                # the copy is ordered before any later use of the parameter on its stream.
+                param.copy_(self.params[name], non_blocking=True)
+            param.grad = None
+            param.requires_grad_(self.requires_grad.get(name, param.requires_grad))
+        self.model.train(self.training)
+        self._mark_clean()
+        if changed:
+            logger.warning(f"Restored {len(changed)} base model parameters from the snapshot")
+        return sorted(changed)
+
+    def track(self, model):
+        """Follow `model`, a fresh copy of the snapshotted model, e.g. after reloading its checkpoint."""
+        self._check_names(model)
+        self.model = model
+        self._mark_clean()
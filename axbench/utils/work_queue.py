@@ -0,0 +1,158 @@
+#################################
+#
+# Shared concept work queue.
+#
+#################################
+import time, socket, sqlite3, threading, logging
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# claims of a worker that stopped heartbeating for this long are reclaimed.
+CONCEPT_LEASE_TIMEOUT = 600 # in seconds
+SQLITE_TIMEOUT = 300 # in seconds
+
+PENDING, RUNNING, DONE = "pending", "running", "done"
+
+
+class ConceptWorkQueue(object):
+    """
+    A SQLite-backed queue of concept ids shared by all workers (ranks) of a job.
+
+    Instead of a static partition, workers claim concepts one at a time, in
+    order, until none are left, so faster workers simply process more concepts.
+    A claimed concept is marked done with `complete`. While a worker holds
+    claims, a background thread refreshes their heartbeat; claims whose
+    heartbeat is older than `lease_timeout` (e.g. of a crashed worker) are
+    reclaimed by the others. Done concepts are never handed out again, so
+    rerunning a job resumes it.
+
+    Every worker opens the queue with the same `path` and `concept_ids`. Only
+    the local filesystem (or a filesystem with working POSIX locks) is needed,
+    so the queue works with torchrun as well as plain multiprocessing.
+    """
+    def __init__(self, path, concept_ids, worker_id, lease_timeout=CONCEPT_LEASE_TIMEOUT):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.concept_ids = [int(concept_id) for concept_id in concept_ids]
+        self.worker_id = str(worker_id)
+        self.lease_timeout = lease_timeout
+        self.claimed = set()
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.heartbeat_thread = None
+
+        with self._transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS concepts ("
+                "concept_id INTEGER PRIMARY KEY, position INTEGER, status TEXT, "
+                "worker TEXT, host TEXT, heartbeat REAL, attempts INTEGER DEFAULT 0)")
+            conn.execute("CREATE INDEX IF NOT EXISTS concepts_status ON concepts (status, position)")
+            conn.executemany(
+                "INSERT OR IGNORE INTO concepts (concept_id, position, status) VALUES (?, ?, ?)",
+                [(concept_id, position, PENDING) for position, concept_id in enumerate(self.concept_ids)])
+            # claims left behind by a previous run of this worker are free again.
+            conn.execute(
+                "UPDATE concepts SET status = ?, worker = NULL WHERE status = ? AND worker = ?",
+                (PENDING, RUNNING, self.worker_id))
+
+    @contextmanager
+    def _transaction(self):
+        # a new connection per transaction, so any thread may use the queue.
+        conn = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def claim(self):
+        """Claim the next pending (or abandoned) concept; returns None once no concept is left."""
+        wanted = set(self.concept_ids)
+        now = time.time()
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT concept_id, status, worker FROM concepts "
+                "WHERE status = ? OR (status = ? AND heartbeat < ?) ORDER BY position",
+                (PENDING, RUNNING, now - self.lease_timeout))
+            for concept_id, status, worker in rows:
+                if concept_id in wanted:
+                    break
+            else:
+                return None
+            rows.close()
+            conn.execute(
+                "UPDATE concepts SET status = ?, worker = ?, host = ?, heartbeat = ?, "
+                "attempts = attempts + 1 WHERE concept_id = ?",
+                (RUNNING, self.worker_id, socket.gethostname(), now, concept_id))
+        if status == RUNNING:
+            logger.warning(f"Worker {self.worker_id} reclaimed concept {concept_id} abandoned by worker {worker}.")
+        with self.lock:
+            self.claimed.add(concept_id)
+        self._start_heartbeat()
+        return concept_id
+
+    def complete(self, concept_id):
+        """Mark a claimed concept as done."""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE concepts SET status = ?, heartbeat = ? WHERE concept_id = ?",
+                (DONE, time.time(), int(concept_id)))
+        with self.lock:
+            self.claimed.discard(int(concept_id))
+
+    def status(self):
+        """Number of concepts per status."""
+        with self._transaction() as conn:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM concepts GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in [PENDING, RUNNING, DONE]}
+
+    def __iter__(self):
+        while True:
+            concept_id = self.claim()
+            if concept_id is None:
+                return
+            yield concept_id
+
+    def _start_heartbeat(self):
+        if self.heartbeat_thread is not None and self.heartbeat_thread.is_alive():
+            return
+        self.stop.clear()
+        self.heartbeat_thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+
+    def _heartbeat(self):
+        while not self.stop.wait(self.lease_timeout / 4):
+            with self.lock:
+                claimed = list(self.claimed)
+            if len(claimed) == 0:
+                continue
+            with self._transaction() as conn:
+                conn.executemany(
+                    "UPDATE concepts SET heartbeat = ? WHERE concept_id = ? AND worker = ? AND status = ?",
+                    [(time.time(), concept_id, self.worker_id, RUNNING) for concept_id in claimed])
+
+    def close(self):
+        """Stop refreshing the heartbeat of outstanding claims."""
+        self.stop.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+
+    def remove_if_done(self):
+        """
+        Delete the queue once every concept is done, so a later run with the
+        same concepts gets a fresh queue; call it once no worker uses the
+        queue anymore. Returns whether the queue was deleted.
+        """
+        self.close()
+        status = self.status()
+        if status[PENDING] + status[RUNNING] > 0:
+            return False
+        self.path.unlink(missing_ok=True)
+        return True